@@ -0,0 +1,225 @@
+"""
+Load test of the JSON API: every classroom lends and returns books at the same time.
+
+A database is generated with generate_test_db.py (or --db points at an existing one), the API
+server is started as a separate process, and one client thread per classroom logs in as that
+classroom's leader and repeats a lending round: check a book's availability, lend it to a
+classmate, return the oldest loan of the classroom and look at the class leaderboard.
+Latency percentiles are reported per endpoint; 409 answers (no free copy, loan already
+returned) are counted as rejected, 5xx answers and connection failures as errors.
+
+Usage (from the repository root):
+    python benchmarks/api_load_test.py --classrooms 30 --rounds 50 --output benchmarks/results/api_load.json
+"""
+import argparse
+import contextlib
+import http.client
+import io
+import json
+import os
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from urllib.parse import quote
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from run_benchmarks import APP_DIR, LEADER_PASSWORD, SEED, SIZES, _percentile # noqa: E402
+
+import generate_test_db # noqa: E402
+
+SERVER_START_TIMEOUT = 30
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class Client:
+    """One keep-alive connection to the API, recording (endpoint, seconds, status) per call."""
+
+    def __init__(self, port, samples):
+        self.conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+        self.samples = samples
+        self.token = None
+
+    def call(self, endpoint, method, path, body=None):
+        headers = {"Content-Type": "application/json"}
+        if self.token:
+            headers["Authorization"] = f"Bearer {self.token}"
+        start = time.perf_counter()
+        try:
+            self.conn.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+            response = self.conn.getresponse()
+            status, payload = response.status, json.loads(response.read() or b"null")
+        except (OSError, http.client.HTTPException, ValueError):
+            self.conn.close() # reconnects on the next request
+            status, payload = 0, None
+        self.samples.append((endpoint, time.perf_counter() - start, status))
+        return status, payload
+
+
+def _classroom_fixture(db_path, classrooms):
+    """Per classroom: a leader name, its students' ids and the ids of the books shelved there."""
+    conn = sqlite3.connect(db_path)
+    fixtures = []
+    for classroom in classrooms:
+        leader = conn.execute("SELECT name FROM students WHERE role = 'leader' AND classroom_id = (SELECT id FROM classrooms WHERE name = ?) ORDER BY id LIMIT 1",
+                              (classroom,)).fetchone()
+        students = [row[0] for row in conn.execute(
+            "SELECT id FROM students WHERE role = 'student' AND classroom_id = (SELECT id FROM classrooms WHERE name = ?)", (classroom,))]
+        books = [row[0] for row in conn.execute("SELECT id FROM books WHERE location_id = (SELECT id FROM classrooms WHERE name = ?)", (classroom,))]
+        if leader and students and books:
+            fixtures.append({'classroom': classroom, 'leader': leader[0], 'students': students, 'books': books})
+    conn.close()
+    return fixtures
+
+
+def _classroom_worker(port, fixture, rounds, seed, samples, barrier):
+    rng = random.Random(seed)
+    client = Client(port, samples)
+    status, payload = client.call("login", "POST", "/api/login",
+                                  {"username": fixture['leader'], "password": LEADER_PASSWORD})
+    barrier.wait()
+    if status != 200:
+        return
+    client.token = payload['token']
+    classroom = quote(fixture['classroom'])
+    for _ in range(rounds):
+        book_id = rng.choice(fixture['books'])
+        status, book = client.call("book", "GET", f"/api/books/{book_id}")
+        if status == 200 and book['disponibles'] > 0:
+            status, _ = client.call("lend", "POST", "/api/loans",
+                                    {"book_id": book_id, "student_id": rng.choice(fixture['students'])})
+        status, loans = client.call("loans", "GET", f"/api/loans?ubicacion={classroom}")
+        if status == 200 and loans:
+            loan = loans[0] if rng.random() < 0.5 else rng.choice(loans)
+            client.call("return", "POST", f"/api/loans/{loan['loan_id']}/return",
+                        {"worksheet_submitted": rng.random() < 0.3})
+        client.call("leaderboard", "GET", f"/api/leaderboard?classroom={classroom}&limit=10")
+    client.conn.close()
+
+
+def _start_server(db_path, port, pool_size):
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(APP_DIR, "api_server.py"), "--db", db_path,
+         "--port", str(port), "--pool-size", str(pool_size)],
+        cwd=APP_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"API server exited: {server.stderr.read().decode(errors='replace')}")
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=2)
+            conn.request("GET", "/api/health")
+            if conn.getresponse().status == 200:
+                conn.close()
+                return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("API server did not start in time.")
+
+
+def _summarize(samples, seconds):
+    by_endpoint = {}
+    for endpoint, elapsed, status in samples:
+        by_endpoint.setdefault(endpoint, []).append((elapsed, status))
+    report = {}
+    for endpoint, items in sorted(by_endpoint.items()):
+        latencies = sorted(elapsed * 1000 for elapsed, _ in items)
+        statuses = [status for _, status in items]
+        report[endpoint] = {
+            'requests': len(items),
+            'ok': sum(1 for s in statuses if 200 <= s < 300),
+            'rejected': sum(1 for s in statuses if 400 <= s < 500),
+            'errors': sum(1 for s in statuses if s == 0 or s >= 500),
+            'p50_ms': round(_percentile(latencies, 0.50), 2),
+            'p95_ms': round(_percentile(latencies, 0.95), 2),
+            'max_ms': round(latencies[-1], 2),
+        }
+    total = len(samples)
+    return {'requests': total, 'seconds': round(seconds, 2),
+            'requests_per_sec': round(total / seconds, 1) if seconds else None,
+            'errors': sum(r['errors'] for r in report.values()), 'endpoints': report}
+
+
+def run(db_path, classrooms, rounds, pool_size):
+    conn = sqlite3.connect(db_path)
+    names = [row[0] for row in conn.execute(
+        "SELECT c.name FROM classrooms c WHERE EXISTS (SELECT 1 FROM students s WHERE s.classroom_id = c.id) ORDER BY c.name")]
+    conn.close()
+    fixtures = _classroom_fixture(db_path, names)[:classrooms]
+    port = _free_port()
+    server = _start_server(db_path, port, pool_size)
+    samples = []
+    barrier = threading.Barrier(len(fixtures) + 1)
+    threads = [threading.Thread(target=_classroom_worker, args=(port, fixture, rounds, SEED + i, samples, barrier))
+               for i, fixture in enumerate(fixtures)]
+    try:
+        for thread in threads:
+            thread.start()
+        barrier.wait() # everyone is logged in; start the clock
+        start = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        seconds = time.perf_counter() - start
+    finally:
+        server.terminate()
+        server.wait(10)
+    login_samples = [s for s in samples if s[0] == "login"]
+    report = _summarize([s for s in samples if s[0] != "login"], seconds)
+    report['classrooms'] = len(fixtures)
+    report['rounds_per_classroom'] = rounds
+    report['pool_size'] = pool_size
+    report['login'] = _summarize(login_samples, 1)['endpoints'].get('login')
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate every classroom lending through the API at once.")
+    parser.add_argument("--db", help="Existing database to load (a copy is used). Default: generate one of --size.")
+    parser.add_argument("--size", default="medium", choices=list(SIZES))
+    parser.add_argument("--classrooms", type=int, default=30, help="Concurrent classroom clients.")
+    parser.add_argument("--rounds", type=int, default=50, help="Lending rounds per classroom.")
+    parser.add_argument("--pool-size", type=int, default=16)
+    parser.add_argument("--output", default=os.path.join("benchmarks", "results",
+                                                         f"api_load_{datetime.now():%Y%m%d_%H%M%S}.json"))
+    args = parser.parse_args(argv)
+
+    tmp_dir = tempfile.mkdtemp(prefix="biblio_api_load_")
+    try:
+        db_path = os.path.join(tmp_dir, "api_load.db")
+        if args.db:
+            shutil.copyfile(args.db, db_path)
+        else:
+            sizes = dict(SIZES[args.size], classrooms=max(SIZES[args.size]['classrooms'], args.classrooms))
+            with contextlib.redirect_stdout(io.StringIO()):
+                generate_test_db.generate_database(db_path, seed=SEED, leader_password=LEADER_PASSWORD,
+                                                   overwrite=True, **sizes)
+        report = run(db_path, args.classrooms, args.rounds, args.pool_size)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    print(f"{report['classrooms']} classrooms x {report['rounds_per_classroom']} rounds: {report['requests']} requests "
+          f"in {report['seconds']} s ({report['requests_per_sec']} req/s), {report['errors']} errors")
+    for endpoint, stats in report['endpoints'].items():
+        print(f"  {endpoint:12s} {stats['requests']:6d} req  p50 {stats['p50_ms']:7.2f} ms  p95 {stats['p95_ms']:7.2f} ms  "
+              f"max {stats['max_ms']:8.2f} ms  rejected {stats['rejected']:4d}  errors {stats['errors']}")
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({'created': datetime.now().isoformat(timespec='seconds'), 'size': args.size, 'results': report}, f, indent=2)
+    print(f"\nResults written to {args.output}")
+    return 1 if report['errors'] else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
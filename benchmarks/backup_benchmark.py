@@ -0,0 +1,164 @@
+"""
+Full vs incremental backups: backup time, size on disk and restore time.
+
+A database is generated with generate_test_db.py, a full backup starts the chain, then each
+simulated school day (loans, returns and a few book edits through the managers) is followed
+by an incremental backup. At the end the full backup plus its chain is restored and compared
+with making and restoring a fresh full backup of the same data.
+
+Usage (from the repository root):
+    python benchmarks/backup_benchmark.py --size medium --days 5 --output benchmarks/results/backup.json
+"""
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from run_benchmarks import APP_DIR, LEADER_PASSWORD, SEED, SIZES, _point_managers_at # noqa: E402
+
+import backup_manager # noqa: E402
+import book_manager # noqa: E402
+import generate_test_db # noqa: E402
+from database.db_setup import CHANGE_TRACKED_TABLES # noqa: E402
+
+DEFAULT_LOANS_PER_DAY = 300
+DEFAULT_EDITS_PER_DAY = 20
+
+
+def _timed(call):
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = call()
+        return result, time.perf_counter() - start
+
+
+def _simulate_day(db_path, rng, loans_per_day, edits_per_day, due_date):
+    """Lends loans_per_day free books, returns as many earlier loans (deleting them) and edits a few books."""
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute("SELECT id FROM students WHERE role = 'leader' LIMIT 1")
+    leader_id = cursor.fetchone()[0]
+    cursor.execute("SELECT id FROM students WHERE role = 'student' ORDER BY RANDOM() LIMIT ?", (loans_per_day,))
+    borrower_ids = [row[0] for row in cursor.fetchall()]
+    cursor.execute("""
+        SELECT b.id FROM books b
+        WHERE b.cantidad_total > (SELECT COUNT(*) FROM loans l WHERE l.book_id = b.id)
+        ORDER BY RANDOM() LIMIT ?
+    """, (loans_per_day,))
+    book_ids = [row[0] for row in cursor.fetchall()]
+    cursor.execute("SELECT loan_id FROM loans ORDER BY RANDOM() LIMIT ?", (loans_per_day,))
+    returning_ids = [row[0] for row in cursor.fetchall()]
+    cursor.execute("SELECT id FROM books ORDER BY RANDOM() LIMIT ?", (edits_per_day,))
+    edited_ids = [row[0] for row in cursor.fetchall()]
+    conn.close()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        for book_id, student_id in zip(book_ids, borrower_ids):
+            book_manager.loan_book_db(book_id, student_id, due_date, leader_id)
+        for loan_id in returning_ids:
+            book_manager.return_book_db(loan_id, leader_id, worksheet_submitted=rng.random() < 0.3)
+    conn = sqlite3.connect(db_path)
+    moves = [(f"Estantería {rng.randint(1, 40)}", book_id) for book_id in edited_ids]
+    conn.executemany("INSERT OR IGNORE INTO classrooms (name) VALUES (?)", [(shelf,) for shelf, _ in moves])
+    conn.executemany("UPDATE books SET location_id = (SELECT id FROM classrooms WHERE name = ?) WHERE id = ?", moves)
+    conn.commit()
+    conn.close()
+
+
+def _content_digest(db_path):
+    """Hash of every row of the backed-up tables, to check a restore reproduced them exactly."""
+    digest = hashlib.sha256()
+    conn = sqlite3.connect(db_path)
+    try:
+        for table, key in CHANGE_TRACKED_TABLES.items():
+            for row in conn.execute(f"SELECT * FROM {table} ORDER BY {key}"):
+                digest.update(repr(row).encode())
+    finally:
+        conn.close()
+    return digest.hexdigest()
+
+
+def run(size_name, days, loans_per_day, edits_per_day, tmp_dir):
+    db_path = os.path.join(tmp_dir, f"backup_{size_name}.db")
+    with contextlib.redirect_stdout(io.StringIO()):
+        generate_test_db.generate_database(db_path, seed=SEED, leader_password=LEADER_PASSWORD,
+                                           overwrite=True, **SIZES[size_name])
+    _point_managers_at(db_path)
+    backup_manager.DB_PATH_FOR_CODE = db_path
+    backup_manager.BACKUP_DIR_FOR_CODE = os.path.join(tmp_dir, "backups")
+    rng = random.Random(SEED)
+    due_date = (datetime.now().date() + timedelta(days=14)).strftime('%Y-%m-%d')
+
+    base_path, full_seconds = _timed(lambda: backup_manager.create_backup())
+    report = {'database_bytes': os.path.getsize(db_path),
+              'full_backup': {'seconds': round(full_seconds, 3), 'bytes': os.path.getsize(base_path)},
+              'days': []}
+    for _ in range(days):
+        _simulate_day(db_path, rng, loans_per_day, edits_per_day, due_date)
+        result, seconds = _timed(backup_manager.create_incremental_backup)
+        report['days'].append({'seconds': round(seconds, 3), 'bytes': result['size'], 'changes': result['changes']})
+    expected_digest = _content_digest(db_path)
+
+    restored, chain_seconds = _timed(lambda: backup_manager.restore_incremental_backup(base_path))
+    chain_ok = restored and _content_digest(db_path) == expected_digest
+    latest_full, latest_full_seconds = _timed(lambda: backup_manager.create_backup())
+    restored, full_restore_seconds = _timed(lambda: backup_manager.restore_backup(latest_full))
+
+    chain_bytes = sum(day['bytes'] for day in report['days'])
+    report['incremental_total_bytes'] = chain_bytes
+    report['latest_full_backup'] = {'seconds': round(latest_full_seconds, 3), 'bytes': os.path.getsize(latest_full)}
+    report['restore'] = {'full_plus_chain_seconds': round(chain_seconds, 3), 'chain_matches_live': bool(chain_ok),
+                         'latest_full_seconds': round(full_restore_seconds, 3), 'latest_full_ok': bool(restored)}
+    return report
+
+
+def _print_report(size_name, report):
+    full = report['full_backup']
+    print(f"\n[{size_name}] database {report['database_bytes'] / 2**20:.1f} MB, "
+          f"full backup {full['bytes'] / 2**20:.2f} MB in {full['seconds']:.2f} s")
+    for number, day in enumerate(report['days'], start=1):
+        print(f"  day {number}: {day['changes']:6d} changes -> {day['bytes'] / 1024:8.1f} KB in {day['seconds']:.3f} s")
+    restore = report['restore']
+    print(f"  {len(report['days'])} increments: {report['incremental_total_bytes'] / 1024:.1f} KB in total "
+          f"(a new full backup: {report['latest_full_backup']['bytes'] / 1024:.1f} KB)")
+    print(f"  restore full + chain: {restore['full_plus_chain_seconds']:.2f} s "
+          f"({'matches' if restore['chain_matches_live'] else 'DOES NOT MATCH'} the live rows); "
+          f"restore of a new full backup: {restore['latest_full_seconds']:.2f} s")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare full and incremental backups of the library database.")
+    parser.add_argument("--size", default="medium", choices=list(SIZES))
+    parser.add_argument("--days", type=int, default=5)
+    parser.add_argument("--loans-per-day", type=int, default=DEFAULT_LOANS_PER_DAY)
+    parser.add_argument("--edits-per-day", type=int, default=DEFAULT_EDITS_PER_DAY)
+    parser.add_argument("--output", default=os.path.join("benchmarks", "results",
+                                                         f"backup_{datetime.now():%Y%m%d_%H%M%S}.json"))
+    args = parser.parse_args(argv)
+
+    tmp_dir = tempfile.mkdtemp(prefix="biblio_backup_bench_")
+    try:
+        report = run(args.size, args.days, args.loans_per_day, args.edits_per_day, tmp_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    _print_report(args.size, report)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({'created': datetime.now().isoformat(timespec='seconds'), 'size': args.size,
+                   'app_dir': APP_DIR, 'results': report}, f, indent=2)
+    print(f"\nResults written to {args.output}")
+    return 0 if report['restore']['chain_matches_live'] and report['restore']['latest_full_ok'] else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
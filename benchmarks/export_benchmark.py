@@ -0,0 +1,84 @@
+"""
+Time and peak memory of the CSV/XLSX exports on a large loan history.
+
+A database is generated with generate_test_db.py with --rows returned loans in loan_history
+(and their points in the ledger); each export is then timed with tracemalloc running, whose peak
+should stay flat however many rows are exported (tracemalloc also makes the exports slower
+than they are without it).
+
+Usage (from the repository root):
+    python benchmarks/export_benchmark.py --rows 1000000 --output benchmarks/results/export.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from run_benchmarks import LEADER_PASSWORD, SEED, SIZES, _point_managers_at # noqa: E402
+
+import export_manager # noqa: E402
+import generate_test_db # noqa: E402
+
+EXPORT_KINDS = ("loan_history", "books", "leaderboard")
+
+
+def run(size_name, rows, tmp_dir):
+    db_path = os.path.join(tmp_dir, f"export_{size_name}.db")
+    with contextlib.redirect_stdout(io.StringIO()):
+        summary = generate_test_db.generate_database(db_path, seed=SEED, leader_password=LEADER_PASSWORD,
+                                                     overwrite=True, history=rows, **SIZES[size_name])
+    _point_managers_at(db_path)
+    export_manager.DB_PATH_FOR_CODE = db_path
+
+    results = {'loan_history_rows': summary['loan_history']}
+    for kind in EXPORT_KINDS:
+        for fmt in export_manager.FORMATS:
+            path = os.path.join(tmp_dir, f"{kind}.{fmt}")
+            tracemalloc.start()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                written = export_manager.export_db(kind, path)
+            seconds = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results[f"{kind}.{fmt}"] = {'rows': written, 'seconds': round(seconds, 2),
+                                        'rows_per_sec': round(written / seconds) if written else None,
+                                        'peak_mib': round(peak / 2**20, 2), 'file_mib': round(os.path.getsize(path) / 2**20, 1)}
+            os.remove(path)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the streaming exports.")
+    parser.add_argument("--size", default="small", choices=list(SIZES))
+    parser.add_argument("--rows", type=int, default=1000000, help="Rows of loan history to export.")
+    parser.add_argument("--output", default=os.path.join("benchmarks", "results",
+                                                         f"export_{datetime.now():%Y%m%d_%H%M%S}.json"))
+    args = parser.parse_args(argv)
+
+    tmp_dir = tempfile.mkdtemp(prefix="biblio_export_bench_")
+    try:
+        results = run(args.size, args.rows, tmp_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    print(f"loan history: {results.pop('loan_history_rows')} rows")
+    for name, result in results.items():
+        print(f"  {name:18s} {result['rows']:>9} rows in {result['seconds']:6.2f} s "
+              f"({result['rows_per_sec']} rows/s), peak {result['peak_mib']:.2f} MiB, file {result['file_mib']} MiB")
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({'created': datetime.now().isoformat(timespec='seconds'), 'size': args.size, 'results': results}, f, indent=2)
+    print(f"\nResults written to {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,291 @@
+"""
+Benchmarks for the backend hot paths (login, book lists and search, loans, leaderboard, CSV imports).
+
+Each database size is generated with generate_test_db.py (fixed seed), every operation is run
+a number of times and p50/p95 latency plus throughput are written to a JSON file.
+Two result files can then be compared to spot regressions before a release.
+
+Usage (from the repository root):
+    python benchmarks/run_benchmarks.py run --sizes small,medium --output benchmarks/results/new.json
+    python benchmarks/run_benchmarks.py compare benchmarks/results/old.json benchmarks/results/new.json
+
+`compare` exits with status 1 when any operation got slower than --threshold percent.
+"""
+import argparse
+import contextlib
+import csv
+import io
+import json
+import math
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "classroom_library_app")
+sys.path.insert(0, APP_DIR)
+
+import auth_manager # noqa: E402
+import book_manager # noqa: E402
+import student_manager # noqa: E402
+import points_manager # noqa: E402
+import generate_test_db # noqa: E402
+
+SIZES = {
+    "small": dict(classrooms=10, students=500, books=5000, loans=1000),
+    "medium": dict(classrooms=30, students=3000, books=30000, loans=6000),
+    "large": dict(classrooms=300, students=30000, books=300000, loans=60000),
+}
+DEFAULT_SIZES = "small,medium"
+SEED = 42
+LEADER_PASSWORD = "lider123"
+CSV_ROWS = 200 # rows per CSV import
+
+
+def _percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list: the ceil(fraction * n)-th value."""
+    index = max(0, min(len(sorted_values) - 1, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def _summarize(latencies):
+    latencies = sorted(latencies)
+    total = sum(latencies)
+    return {
+        'iterations': len(latencies),
+        'p50_ms': round(_percentile(latencies, 0.50) * 1000, 4),
+        'p95_ms': round(_percentile(latencies, 0.95) * 1000, 4),
+        'mean_ms': round(statistics.fmean(latencies) * 1000, 4),
+        'ops_per_sec': round(len(latencies) / total, 2) if total else None,
+    }
+
+
+def _time_calls(calls):
+    """Runs each zero-argument callable once and returns the list of latencies in seconds.
+    Manager functions print progress/errors, which is not what we want to measure."""
+    latencies = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for call in calls:
+            start = time.perf_counter()
+            call()
+            latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def _point_managers_at(db_path):
+    # DB_PATH_FOR_CODE is joined onto the app directory; an absolute path replaces it.
+    for module in (student_manager, book_manager, book_manager.student_manager, auth_manager.student_manager,
+                   points_manager, book_manager.points_manager):
+        module.DB_PATH_FOR_CODE = db_path
+
+
+def _fixture(db_path, classroom, iterations):
+    """Ids the benchmarks need, read once from the generated database."""
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute("SELECT id, name FROM students WHERE role = 'leader' AND classroom_id = (SELECT id FROM classrooms WHERE name = ?) LIMIT 1", (classroom,))
+    leader_id, leader_name = cursor.fetchone()
+    cursor.execute("SELECT id FROM students WHERE role = 'student' AND classroom_id = (SELECT id FROM classrooms WHERE name = ?) LIMIT 1", (classroom,))
+    borrower_id = cursor.fetchone()[0]
+    # Books with a free copy, so every loan in the loan benchmark succeeds.
+    cursor.execute("""
+        SELECT b.id FROM books b
+        WHERE b.cantidad_total > (SELECT COUNT(*) FROM loans l WHERE l.book_id = b.id)
+        LIMIT ?
+    """, (iterations,))
+    available_book_ids = [row[0] for row in cursor.fetchall()]
+    cursor.execute("SELECT titulo FROM books LIMIT 1")
+    title_word = cursor.fetchone()[0].split()[-1]
+    conn.close()
+    return {
+        'leader_id': leader_id, 'leader_name': leader_name, 'borrower_id': borrower_id,
+        'available_book_ids': available_book_ids, 'title_word': title_word,
+    }
+
+
+def _write_csv_files(tmp_dir, classroom):
+    books_csv = os.path.join(tmp_dir, "books.csv")
+    with open(books_csv, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Título", "Autor", "Género", "Ubicación", "Cantidad_Total"])
+        for i in range(CSV_ROWS):
+            writer.writerow([f"Libro importado {i}", f"Autora {i % 20}", "Cuento", classroom, 1 + i % 2])
+    students_csv = os.path.join(tmp_dir, "students.csv")
+    with open(students_csv, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Apellido", "Nombre"])
+        for i in range(CSV_ROWS):
+            writer.writerow([f"Apellido{i}", f"Nombre{i}"])
+    return books_csv, students_csv
+
+
+def run_size(size_name, iterations, tmp_dir):
+    """Generates the database for one size and benchmarks every operation on it."""
+    db_path = os.path.join(tmp_dir, f"bench_{size_name}.db")
+    with contextlib.redirect_stdout(io.StringIO()):
+        summary = generate_test_db.generate_database(
+            db_path, seed=SEED, leader_password=LEADER_PASSWORD, overwrite=True, **SIZES[size_name])
+    _point_managers_at(db_path)
+    classroom = summary['classrooms'][0]
+    fx = _fixture(db_path, classroom, iterations)
+    books_csv, students_csv = _write_csv_files(tmp_dir, classroom)
+    due_date = (datetime.now().date() + timedelta(days=14)).strftime('%Y-%m-%d')
+    few = max(3, iterations // 10) # for the slow operations (PBKDF2 login, CSV imports)
+
+    results = {}
+    results['login'] = _time_calls(
+        [lambda: auth_manager.login(fx['leader_name'], LEADER_PASSWORD)] * few)
+    auth_manager.logout()
+    results['get_all_books_db'] = _time_calls(
+        [lambda: book_manager.get_all_books_db()] * few)
+    results['get_all_books_db(ubicacion)'] = _time_calls(
+        [lambda: book_manager.get_all_books_db(ubicacion_filter=classroom)] * iterations)
+    results['search_books_db'] = _time_calls(
+        [lambda: book_manager.search_books_db(fx['title_word'], "titulo")] * iterations)
+    results['get_available_book_count'] = _time_calls(
+        [lambda book_id=book_id: book_manager.get_available_book_count(book_id) for book_id in fx['available_book_ids']])
+
+    results['loan_book_db'] = _time_calls(
+        [lambda book_id=book_id: book_manager.loan_book_db(book_id, fx['borrower_id'], due_date, fx['leader_id'])
+         for book_id in fx['available_book_ids']])
+    new_loan_ids = [loan['loan_id'] for loan in book_manager.get_current_loans_db(student_id_filter=fx['borrower_id'])
+                    if loan['book_id'] in set(fx['available_book_ids'])]
+    results['return_book_db'] = _time_calls(
+        [lambda loan_id=loan_id: book_manager.return_book_db(loan_id, fx['leader_id']) for loan_id in new_loan_ids])
+
+    results['get_current_loans_db'] = _time_calls(
+        [lambda: book_manager.get_current_loans_db()] * few)
+    results['get_current_loans_db(ubicacion)'] = _time_calls(
+        [lambda: book_manager.get_current_loans_db(ubicacion_filter=classroom)] * iterations)
+    results['get_books_due_soon_db'] = _time_calls(
+        [lambda: book_manager.get_books_due_soon_db(7)] * iterations)
+    results['get_students_sorted_by_points(global)'] = _time_calls(
+        [lambda: student_manager.get_students_sorted_by_points()] * few)
+    results['get_students_sorted_by_points(classroom)'] = _time_calls(
+        [lambda: student_manager.get_students_sorted_by_points(classroom)] * iterations)
+    month_start, month_end = points_manager.period_bounds("month")
+    results['get_period_leaderboard_db(month)'] = _time_calls(
+        [lambda: points_manager.get_period_leaderboard_db(month_start, month_end, limit=51)] * iterations)
+    results['import_books_from_csv_db'] = _time_calls(
+        [lambda: book_manager.import_books_from_csv_db(books_csv)] * few)
+    results['import_students_from_csv'] = _time_calls(
+        [lambda: student_manager.import_students_from_csv(students_csv, classroom)] * few)
+
+    report = {}
+    for name, latencies in results.items():
+        report[name] = _summarize(latencies) if latencies else None
+    report['_database'] = {key: summary[key] for key in ("students", "books", "loans")}
+    return report
+
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=APP_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def cmd_run(args):
+    sizes = [s.strip() for s in args.sizes.split(",") if s.strip()]
+    unknown = [s for s in sizes if s not in SIZES]
+    if unknown:
+        print(f"Error: unknown size(s) {unknown}. Choose from {list(SIZES)}.")
+        return 2
+
+    output = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'git_revision': _git_revision(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'iterations': args.iterations,
+            'seed': SEED,
+        },
+        'results': {},
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size_name in sizes:
+            print(f"Running '{size_name}' ({SIZES[size_name]})...")
+            output['results'][size_name] = run_size(size_name, args.iterations, tmp_dir)
+            for name, stats in output['results'][size_name].items():
+                if name.startswith("_") or stats is None:
+                    continue
+                print(f"  {name:42s} p50 {stats['p50_ms']:9.3f} ms  p95 {stats['p95_ms']:9.3f} ms  "
+                      f"{stats['ops_per_sec']:10.1f} ops/s")
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(output, f, indent=2)
+    print(f"Results written to '{args.output}'.")
+    return 0
+
+
+def compare_results(old, new, threshold_pct, min_delta_ms):
+    """Returns (rows, regressions). A regression is a p50 or p95 that grew by more than
+    threshold_pct percent and by more than min_delta_ms (to ignore timer noise on fast calls)."""
+    rows = []
+    regressions = []
+    for size_name, new_ops in new['results'].items():
+        old_ops = old['results'].get(size_name, {})
+        for name, new_stats in new_ops.items():
+            old_stats = old_ops.get(name)
+            if name.startswith("_") or not new_stats or not old_stats:
+                continue
+            for metric in ("p50_ms", "p95_ms"):
+                before, after = old_stats[metric], new_stats[metric]
+                change_pct = (after - before) / before * 100 if before else 0.0
+                regressed = change_pct > threshold_pct and (after - before) > min_delta_ms
+                rows.append((size_name, name, metric, before, after, change_pct, regressed))
+                if regressed:
+                    regressions.append((size_name, name, metric))
+    return rows, regressions
+
+
+def cmd_compare(args):
+    with open(args.old, encoding="utf-8") as f:
+        old = json.load(f)
+    with open(args.new, encoding="utf-8") as f:
+        new = json.load(f)
+    rows, regressions = compare_results(old, new, args.threshold, args.min_delta_ms)
+    print(f"{'size':8s} {'operation':42s} {'metric':7s} {'old':>10s} {'new':>10s} {'change':>8s}")
+    for size_name, name, metric, before, after, change_pct, regressed in rows:
+        flag = "  REGRESSION" if regressed else ""
+        print(f"{size_name:8s} {name:42s} {metric:7s} {before:10.3f} {after:10.3f} {change_pct:+7.1f}%{flag}")
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) above {args.threshold}%.")
+        return 1
+    print("\nNo regressions.")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the library backend hot paths.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Run the benchmarks and write a JSON result file.")
+    run_parser.add_argument("--sizes", default=DEFAULT_SIZES, help=f"Comma separated, from {list(SIZES)}.")
+    run_parser.add_argument("--iterations", type=int, default=50)
+    run_parser.add_argument("--output", default=os.path.join("benchmarks", "results",
+                                                             f"bench_{datetime.now():%Y%m%d_%H%M%S}.json"))
+    run_parser.set_defaults(func=cmd_run)
+
+    compare_parser = subparsers.add_parser("compare", help="Compare two result files.")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=15.0, help="Allowed slowdown in percent.")
+    compare_parser.add_argument("--min-delta-ms", type=float, default=0.05)
+    compare_parser.set_defaults(func=cmd_compare)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,614 @@
+"""
+Headless JSON API over the manager modules, so one central database can serve every classroom.
+
+    python api_server.py --db /srv/biblio/library.db --port 8765
+
+Clients log in with POST /api/login {"username", "password"} and send the returned token as
+"Authorization: Bearer <token>" on every other request. Students can read the catalogue, the
+leaderboard and their own loans; leaders lend, return and extend loans; admins add books and
+students. Errors come back as {"error": "..."} with a 4xx status.
+
+GET answers carry an ETag (a hash of the body); a client that sends it back in If-None-Match
+gets 304 Not Modified instead of the same rows again. POST /api/batch {"requests": [{"method",
+"path", "body"}, ...]} runs up to MAX_BATCH_REQUESTS calls in one round trip and answers
+{"responses": [{"status", "body"}, ...]} in the same order (see data_backend.HttpBackend).
+Laptops working offline send their queued loans and returns to POST /api/sync/push and fetch
+the changed rows from GET /api/sync/pull (sync_manager.py); pulls include the password hashes
+so leaders can log in offline, which is why only leaders and admins may pull.
+
+The server is the stdlib ThreadingHTTPServer (one thread per request): the managers are
+blocking sqlite3 code, so asyncio would only move them to a thread pool anyway. Connections
+come from query_monitor's pool and the database is switched to WAL so readers don't block the
+writer.
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import auth_manager
+import book_manager
+import change_bus
+import points_manager
+import query_monitor
+import read_cache
+import student_manager
+import sync_manager
+from database import db_setup
+from utils import get_data_path
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_POOL_SIZE = 16
+DEFAULT_LOAN_DAYS = 14
+MAX_BODY_BYTES = 4 * 1024 * 1024
+MAX_BATCH_REQUESTS = 1000
+MAX_SYNC_OPS = 1000
+MAX_LEADERBOARD_ROWS = 500 # per request; the app pages through longer rankings
+MAX_RANK_NEIGHBORS = 25
+PRIVATE_STUDENT_FIELDS = ("hashed_password", "salt")
+
+_routes = [] # (method, compiled path regex, handler, roles or None for no login)
+
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def route(method, pattern, roles=("student", "leader", "admin")):
+    """Registers handler(request) for method + path regex; roles=None means no login needed."""
+    def decorator(handler):
+        _routes.append((method, re.compile(f"^{pattern}$"), handler, roles))
+        return handler
+    return decorator
+
+
+class Request:
+    def __init__(self, session, params, query, body):
+        self.session = session
+        self.params = params
+        self.query = query
+        self.body = body
+
+    def arg(self, name, default=None):
+        return self.query.get(name, default)
+
+    def int_arg(self, name, default=None):
+        value = self.query.get(name)
+        if value is None or value == "":
+            return default
+        try:
+            return int(value)
+        except ValueError:
+            raise ApiError(HTTPStatus.BAD_REQUEST, f"'{name}' debe ser un número entero.")
+
+    def field(self, name, required=True, default=None):
+        value = self.body.get(name, default)
+        if required and (value is None or value == ""):
+            raise ApiError(HTTPStatus.BAD_REQUEST, f"Falta el campo '{name}'.")
+        return value
+
+
+def _public_student(student):
+    public = {key: value for key, value in student.items() if key not in PRIVATE_STUDENT_FIELDS}
+    public['has_password'] = bool(student.get('hashed_password'))
+    return public
+
+
+def _lending_leader(request):
+    """The leader a loan or return is recorded for: the logged-in leader, or for an admin
+    (who picks a leader in the desktop app) the 'leader_id' of the request."""
+    if request.session['role'] == 'admin':
+        return request.field("leader_id")
+    return request.session['user_id']
+
+
+def _require_self_or_staff(request, student_id):
+    if request.session['role'] == 'student' and request.session['user_id'] != student_id:
+        raise ApiError(HTTPStatus.FORBIDDEN, "Solo puedes consultar tus propios datos.")
+
+
+# --- Session ---
+
+@route("GET", "/api/health", roles=None)
+def health(request):
+    return {'status': 'ok', 'pools': query_monitor.get_pool_stats(), 'caches': read_cache.get_cache_stats(),
+            'writes': query_monitor.get_write_stats()}
+
+
+@route("POST", "/api/login", roles=None)
+def login(request):
+    result = auth_manager.create_session(request.field("username"), request.body.get("password"))
+    if result is None:
+        raise ApiError(HTTPStatus.UNAUTHORIZED, "Usuario o contraseña incorrectos.")
+    token, session = result
+    return {'token': token, 'user': {'id': session['user_id'], 'name': session['name'],
+                                     'role': session['role'], 'classroom': session['classroom']}}
+
+
+@route("POST", "/api/logout")
+def logout(request):
+    auth_manager.end_session(request.session['token'])
+    return {'ok': True}
+
+
+@route("GET", "/api/me")
+def me(request):
+    student = student_manager.get_student_by_id_db(request.session['user_id'])
+    if student is None:
+        raise ApiError(HTTPStatus.NOT_FOUND, "Usuario no encontrado.")
+    return _public_student(student)
+
+
+# --- Books ---
+
+@route("GET", "/api/books")
+def list_books(request):
+    query = request.arg("q")
+    if query:
+        field = request.arg("field", "titulo")
+        if field not in ("titulo", "autor", "genero", "ubicacion"):
+            raise ApiError(HTTPStatus.BAD_REQUEST, f"Campo de búsqueda no válido: '{field}'.")
+        return book_manager.search_books_db(query, field)
+    return book_manager.get_all_books_db(request.arg("ubicacion"))
+
+
+@route("POST", "/api/books", roles=("admin",))
+def add_book(request):
+    try:
+        cantidad_total = int(request.field("cantidad_total", required=False, default=1))
+    except (TypeError, ValueError):
+        raise ApiError(HTTPStatus.BAD_REQUEST, "'cantidad_total' debe ser un número entero.")
+    book_id = book_manager.add_book_db(request.field("titulo"), request.field("autor"), request.field("ubicacion"),
+                                       request.field("genero", required=False), cantidad_total)
+    if not book_id:
+        raise ApiError(HTTPStatus.BAD_REQUEST, "No se pudo añadir el libro.")
+    return HTTPStatus.CREATED, book_manager.get_book_by_id_db(book_id)
+
+
+@route("GET", "/api/books/most-read")
+def most_read_books(request):
+    return book_manager.get_most_read_books_db(request.int_arg("limit", 10))
+
+
+@route("GET", "/api/books/new")
+def new_releases(request):
+    return book_manager.get_new_releases_db(request.int_arg("limit", 10))
+
+
+@route("GET", "/api/books/recommended")
+def recommended_books(request):
+    return book_manager.get_recommendations_db(request.int_arg("limit", 10))
+
+
+@route("GET", r"/api/books/(?P<book_id>[^/]+)/available")
+def book_available(request):
+    return {'available': book_manager.get_available_book_count(request.params['book_id'])}
+
+
+@route("GET", r"/api/books/(?P<book_id>[^/]+)")
+def get_book(request):
+    book = book_manager.get_book_by_id_db(request.params['book_id'])
+    if book is None:
+        raise ApiError(HTTPStatus.NOT_FOUND, "Libro no encontrado.")
+    book['disponibles'] = book_manager.get_available_book_count(book['id'])
+    return book
+
+
+# --- Loans ---
+
+@route("GET", "/api/loans")
+def list_loans(request):
+    student_id = request.arg("student_id")
+    if request.session['role'] == 'student':
+        student_id = request.session['user_id']
+    return book_manager.get_current_loans_db(student_id, request.arg("ubicacion"), request.arg("classroom"))
+
+
+@route("GET", "/api/loans/due-soon", roles=("leader", "admin"))
+def loans_due_soon(request):
+    return book_manager.get_books_due_soon_db(request.int_arg("days", 7), request.arg("ubicacion"), request.arg("classroom"))
+
+
+@route("GET", "/api/loans/reminders", roles=("leader", "admin"))
+def loan_reminders(request):
+    classroom = request.arg("classroom")
+    if not classroom:
+        raise ApiError(HTTPStatus.BAD_REQUEST, "Falta el parámetro 'classroom'.")
+    return book_manager.get_classroom_reminders_db(classroom)
+
+
+@route("POST", "/api/loans", roles=("leader", "admin"))
+def lend_book(request):
+    due_date = request.field("due_date", required=False) or \
+        (datetime.now().date() + timedelta(days=DEFAULT_LOAN_DAYS)).strftime('%Y-%m-%d')
+    if not book_manager.loan_book_db(request.field("book_id"), request.field("student_id"),
+                                     due_date, _lending_leader(request)):
+        raise ApiError(HTTPStatus.CONFLICT, "No se pudo registrar el préstamo (libro o alumno inexistente, o sin ejemplares libres).")
+    return HTTPStatus.CREATED, {'ok': True, 'due_date': due_date}
+
+
+def _bulk_items(request, name, required_keys):
+    items = request.field(name)
+    if not isinstance(items, list) or len(items) > MAX_BATCH_REQUESTS or \
+            not all(isinstance(item, dict) and all(item.get(key) for key in required_keys) for item in items):
+        raise ApiError(HTTPStatus.BAD_REQUEST,
+                       f"'{name}' debe ser una lista de como mucho {MAX_BATCH_REQUESTS} objetos con {', '.join(required_keys)}.")
+    return items
+
+
+@route("POST", "/api/loans/bulk", roles=("leader", "admin"))
+def lend_books_bulk(request):
+    default_due = (datetime.now().date() + timedelta(days=DEFAULT_LOAN_DAYS)).strftime('%Y-%m-%d')
+    loans = [{'book_id': item['book_id'], 'student_id': item['student_id'], 'due_date': item.get('due_date') or default_due}
+             for item in _bulk_items(request, "loans", ("book_id", "student_id"))]
+    loan_ids, errors = book_manager.loan_books_bulk_db(loans, _lending_leader(request))
+    return {'loan_ids': loan_ids, 'errors': errors}
+
+
+@route("POST", "/api/loans/bulk-return", roles=("leader", "admin"))
+def return_books_bulk(request):
+    returns = [{'loan_id': item['loan_id'], 'worksheet_submitted': bool(item.get('worksheet_submitted'))}
+               for item in _bulk_items(request, "returns", ("loan_id",))]
+    points, errors = book_manager.return_books_bulk_db(returns, _lending_leader(request))
+    return {'points': points, 'errors': errors}
+
+
+@route("POST", r"/api/loans/(?P<loan_id>[^/]+)/return", roles=("leader", "admin"))
+def return_book(request):
+    if not book_manager.return_book_db(request.params['loan_id'], _lending_leader(request),
+                                       worksheet_submitted=bool(request.body.get("worksheet_submitted"))):
+        raise ApiError(HTTPStatus.CONFLICT, "No se pudo registrar la devolución (¿préstamo inexistente?).")
+    return {'ok': True}
+
+
+@route("POST", r"/api/loans/(?P<loan_id>[^/]+)/extend", roles=("leader", "admin"))
+def extend_loan(request):
+    try:
+        days = int(request.field("days", required=False, default=DEFAULT_LOAN_DAYS))
+    except (TypeError, ValueError):
+        raise ApiError(HTTPStatus.BAD_REQUEST, "'days' debe ser un número entero.")
+    if not book_manager.extend_loan_db(request.params['loan_id'], days):
+        raise ApiError(HTTPStatus.CONFLICT, "No se pudo ampliar el préstamo.")
+    return {'ok': True}
+
+
+# --- Students and rankings ---
+
+@route("GET", "/api/students", roles=("leader", "admin"))
+def list_students(request):
+    return [_public_student(s) for s in student_manager.get_students_db(request.arg("classroom"), request.arg("role"))]
+
+
+@route("POST", "/api/students", roles=("admin",))
+def add_student(request):
+    role = request.field("role", required=False, default="student")
+    if role not in ("student", "leader", "admin"):
+        raise ApiError(HTTPStatus.BAD_REQUEST, f"Rol no válido: '{role}'.")
+    student_id = student_manager.add_student_db(request.field("name"), request.field("classroom"),
+                                                request.field("password", required=False), role)
+    if not student_id:
+        raise ApiError(HTTPStatus.BAD_REQUEST, "No se pudo añadir el alumno.")
+    return HTTPStatus.CREATED, _public_student(student_manager.get_student_by_id_db(student_id))
+
+
+@route("GET", r"/api/students/(?P<student_id>[^/]+)")
+def get_student(request):
+    _require_self_or_staff(request, request.params['student_id'])
+    student = student_manager.get_student_by_id_db(request.params['student_id'])
+    if student is None:
+        raise ApiError(HTTPStatus.NOT_FOUND, "Alumno no encontrado.")
+    return _public_student(student)
+
+
+@route("POST", r"/api/students/(?P<student_id>[^/]+)", roles=("admin",))
+def update_student(request):
+    if not student_manager.update_student_details_db(request.params['student_id'], request.field("name"),
+                                                     request.field("classroom"), request.field("role")):
+        raise ApiError(HTTPStatus.CONFLICT, "No se pudo actualizar el alumno.")
+    return {'ok': True}
+
+
+@route("DELETE", r"/api/students/(?P<student_id>[^/]+)", roles=("admin",))
+def delete_student(request):
+    if not student_manager.delete_student_db(request.params['student_id']):
+        raise ApiError(HTTPStatus.NOT_FOUND, "Alumno no encontrado.")
+    return {'ok': True}
+
+
+@route("POST", r"/api/students/(?P<student_id>[^/]+)/password")
+def change_password(request):
+    if request.session['role'] != 'admin' and request.session['user_id'] != request.params['student_id']:
+        raise ApiError(HTTPStatus.FORBIDDEN, "Solo puedes cambiar tu propia contraseña.")
+    if not student_manager.update_student_password_db(request.params['student_id'], request.field("password")):
+        raise ApiError(HTTPStatus.CONFLICT, "No se pudo cambiar la contraseña.")
+    return {'ok': True}
+
+
+@route("GET", r"/api/students/(?P<student_id>[^/]+)/points")
+def student_points(request):
+    _require_self_or_staff(request, request.params['student_id'])
+    start, end = request.arg("start"), request.arg("end")
+    if not start or not end:
+        raise ApiError(HTTPStatus.BAD_REQUEST, "Faltan 'start' y 'end'.")
+    return {'points': points_manager.get_student_points_in_period_db(request.params['student_id'], start, end)}
+
+
+@route("GET", r"/api/students/(?P<student_id>[^/]+)/rank")
+def student_rank(request):
+    scope = request.arg("scope", "global")
+    if scope not in ("global", "class"):
+        raise ApiError(HTTPStatus.BAD_REQUEST, "'scope' debe ser 'global' o 'class'.")
+    neighbors = min(max(request.int_arg("neighbors", 2), 0), MAX_RANK_NEIGHBORS)
+    rank = student_manager.get_student_rank_db(request.params['student_id'], neighbors, scope)
+    if rank is None:
+        raise ApiError(HTTPStatus.NOT_FOUND, "Alumno no encontrado.")
+    return rank
+
+
+@route("GET", "/api/leaderboard")
+def leaderboard(request):
+    classroom, limit, offset = request.arg("classroom"), request.int_arg("limit", 50), request.int_arg("offset", 0)
+    # -1 (limit=None in the managers) asks for the whole ranking: it gets the largest page instead.
+    limit = MAX_LEADERBOARD_ROWS if limit < 0 else min(limit, MAX_LEADERBOARD_ROWS)
+    offset = max(offset, 0)
+    start, end, period = request.arg("start"), request.arg("end"), request.arg("period")
+    if period:
+        try:
+            start, end = points_manager.period_bounds(period)
+        except ValueError as e:
+            raise ApiError(HTTPStatus.BAD_REQUEST, str(e))
+    if start and end:
+        return points_manager.get_period_leaderboard_db(start, end, classroom, limit, offset)
+    return student_manager.get_leaderboard_db(classroom, limit, offset)
+
+
+@route("GET", "/api/classrooms")
+def classrooms(request):
+    return student_manager.get_distinct_classrooms()
+
+
+@route("POST", "/api/classrooms/rename", roles=("admin",))
+def rename_classroom(request):
+    if not student_manager.rename_classroom(request.field("old_name"), request.field("new_name")):
+        raise ApiError(HTTPStatus.CONFLICT, "No se pudo renombrar la clase.")
+    return {'ok': True}
+
+
+# --- Change notifications (change_bus.py): clients poll this, mostly getting a 304 ---
+
+@route("GET", "/api/data-versions")
+def data_versions(request):
+    versions = change_bus.get_data_versions_db()
+    if versions is None:
+        raise ApiError(HTTPStatus.INTERNAL_SERVER_ERROR, "No se pudieron leer las versiones de los datos.")
+    return versions
+
+
+# --- Offline sync (sync_manager.py) ---
+
+@route("POST", "/api/sync/push", roles=("leader", "admin"))
+def sync_push(request):
+    ops = request.field("ops")
+    if not isinstance(ops, list) or len(ops) > MAX_SYNC_OPS or \
+            not all(isinstance(op, dict) and isinstance(op.get("payload"), dict) for op in ops):
+        raise ApiError(HTTPStatus.BAD_REQUEST, f"'ops' debe ser una lista de como mucho {MAX_SYNC_OPS} operaciones.")
+    # An operation without a leader_id is rejected on its own by SyncServer._apply (not_leader).
+    if request.session['role'] == 'leader' and any(
+            op['payload'].get("leader_id") not in (None, request.session['user_id']) for op in ops):
+        raise ApiError(HTTPStatus.FORBIDDEN, "Solo puedes sincronizar tus propios préstamos.")
+    result = sync_manager.SyncServer(book_manager._get_resolved_db_path()).push(str(request.field("node_id")), ops)
+    if result is None:
+        raise ApiError(HTTPStatus.BAD_REQUEST, "No se pudieron aplicar las operaciones.")
+    return result
+
+
+@route("GET", "/api/sync/pull", roles=("leader", "admin"))
+def sync_pull(request):
+    limit = min(max(request.int_arg("limit", sync_manager.PULL_BATCH), 1), sync_manager.PULL_BATCH)
+    result = sync_manager.SyncServer(book_manager._get_resolved_db_path()).pull(request.int_arg("cursor", 0), limit)
+    if result is None:
+        raise ApiError(HTTPStatus.INTERNAL_SERVER_ERROR, "No se pudieron leer los cambios.")
+    return result
+
+
+@route("POST", "/api/batch")
+def batch(request):
+    requests = request.field("requests")
+    if not isinstance(requests, list) or len(requests) > MAX_BATCH_REQUESTS:
+        raise ApiError(HTTPStatus.BAD_REQUEST, f"'requests' debe ser una lista de como mucho {MAX_BATCH_REQUESTS} peticiones.")
+    responses = []
+    for sub in requests:
+        if not isinstance(sub, dict) or urlsplit(str(sub.get("path", ""))).path.rstrip("/") == "/api/batch":
+            responses.append({'status': HTTPStatus.BAD_REQUEST, 'body': {'error': "Petición del lote no válida."}})
+            continue
+        status, payload = handle_request(str(sub.get("method", "GET")).upper(), str(sub.get("path", "")),
+                                         sub.get("body") or {}, request.session['token'])
+        responses.append({'status': int(status), 'body': payload})
+    return {'responses': responses}
+
+
+def _session_for(token):
+    """The caller's session, with the role, name and classroom of the student as they are now
+    (read through the versioned read cache), so a demotion or deletion applies to open tokens."""
+    session = auth_manager.get_session(token)
+    student = student_manager.get_student_by_id_db(session['user_id']) if session else None
+    if student is None:
+        auth_manager.end_session(token)
+        raise ApiError(HTTPStatus.UNAUTHORIZED, "Sesión no válida o caducada; inicia sesión de nuevo.")
+    session.update(role=student['role'], name=student['name'], classroom=student['classroom'], token=token)
+    return session
+
+
+def handle_request(method, raw_path, body, token):
+    """Routes one call and returns (status, payload); used for HTTP requests and batch entries."""
+    url = urlsplit(raw_path)
+    path = url.path.rstrip("/") or "/"
+    try:
+        if not isinstance(body, dict):
+            raise ApiError(HTTPStatus.BAD_REQUEST, "El cuerpo de la petición debe ser un objeto JSON.")
+        path_matched = False
+        for route_method, regex, handler, roles in _routes:
+            match = regex.match(path)
+            if not match:
+                continue
+            path_matched = True
+            if route_method != method:
+                continue
+            session = None
+            if roles is not None:
+                session = _session_for(token)
+                if session['role'] not in roles:
+                    raise ApiError(HTTPStatus.FORBIDDEN, "No tienes permiso para esta operación.")
+            query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            result = handler(Request(session, match.groupdict(), query, body))
+            return result if isinstance(result, tuple) else (HTTPStatus.OK, result)
+        if path_matched:
+            raise ApiError(HTTPStatus.METHOD_NOT_ALLOWED, "Método no permitido.")
+        raise ApiError(HTTPStatus.NOT_FOUND, "Ruta desconocida.")
+    except ApiError as e:
+        return e.status, {'error': e.message}
+    except Exception as e: # the managers print and return; anything else is a bug, not the client's fault
+        print(f"API error on {method} {url.path}: {e!r}")
+        return HTTPStatus.INTERNAL_SERVER_ERROR, {'error': "Error interno del servidor."}
+
+
+class ApiRequestHandler(BaseHTTPRequestHandler):
+    server_version = "BiblioAPI/1.0"
+    protocol_version = "HTTP/1.1" # keep-alive, so a classroom client reuses its connection
+    disable_nagle_algorithm = True # headers and body are separate writes; without this each answer waits ~40 ms for an ACK
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, status, payload, cacheable=False):
+        body = json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8")
+        etag = None
+        if cacheable and status == HTTPStatus.OK:
+            etag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+            if etag in (tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")):
+                status, body = HTTPStatus.NOT_MODIFIED, b""
+        self.send_response(status)
+        if etag:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache") # may be kept, but revalidated every time
+        if status != HTTPStatus.NOT_MODIFIED:
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_BODY_BYTES:
+            raise ApiError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "Petición demasiado grande.")
+        if not length:
+            return {}
+        try:
+            return json.loads(self.rfile.read(length).decode("utf-8"))
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            raise ApiError(HTTPStatus.BAD_REQUEST, "El cuerpo de la petición no es JSON válido.")
+
+    def _dispatch(self, method):
+        header = self.headers.get("Authorization", "")
+        token = header[7:].strip() if header.startswith("Bearer ") else None
+        try:
+            body = self._read_body() if method != "GET" else {}
+        except ApiError as e:
+            self.close_connection = True # the unread body would be taken for the next request
+            self._send_json(e.status, {'error': e.message})
+            return
+        status, payload = handle_request(method, self.path, body, token)
+        self._send_json(status, payload, cacheable=(method == "GET"))
+
+
+class ApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, verbose=False):
+        super().__init__(address, ApiRequestHandler)
+        self.verbose = verbose
+
+
+def configure_database(db_path):
+    """Points the managers at db_path (created if missing) and switches it to WAL.
+    Returns the resolved path."""
+    db_path = get_data_path(db_path)
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    db_setup.init_db(db_path)
+    for module in (student_manager, book_manager, points_manager, change_bus, auth_manager.student_manager,
+                   book_manager.student_manager, book_manager.points_manager):
+        module.DB_PATH_FOR_CODE = db_path
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute("PRAGMA journal_mode = WAL")
+    finally:
+        conn.close()
+    return db_path
+
+
+def create_server(db_path, host=DEFAULT_HOST, port=DEFAULT_PORT, pool_size=DEFAULT_POOL_SIZE, verbose=False):
+    """Configures the database and connection pool and returns a bound (not yet serving) ApiServer."""
+    configure_database(db_path)
+    query_monitor.enable_pooling(pool_size)
+    return ApiServer((host, port), verbose=verbose)
+
+
+def start_in_thread(server):
+    """Serves in a daemon thread (tests and the load test); stop with stop_server()."""
+    thread = threading.Thread(target=server.serve_forever, name="biblio-api", daemon=True)
+    thread.start()
+    return thread
+
+
+def stop_server(server):
+    server.shutdown()
+    server.server_close()
+    query_monitor.disable_pooling()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the library database as a JSON API.")
+    parser.add_argument("--db", default=book_manager.DB_PATH_FOR_CODE,
+                        help="Database file, relative to classroom_library_app/ unless absolute.")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="Use 0.0.0.0 to accept the classroom laptops.")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--pool-size", type=int, default=DEFAULT_POOL_SIZE, help="Pooled SQLite connections.")
+    parser.add_argument("--verbose", action="store_true", help="Log every request.")
+    args = parser.parse_args(argv)
+
+    server = create_server(args.db, args.host, args.port, args.pool_size, args.verbose)
+    print(f"API de la biblioteca en http://{args.host}:{server.server_address[1]}/api "
+          f"(base de datos: {get_data_path(args.db)}). Ctrl+C para parar.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        query_monitor.disable_pooling()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -1,26 +1,37 @@
 # auth_manager.py
 
+import secrets
+import threading
+import time
+
 import student_manager # Use . to indicate relative import within the package
+import query_monitor
 
 # Session Management Variables
 current_user_id = None
 current_user_role = None
 
-def login(username, password):
+# Token sessions for the API server (api_server.py), where many users are logged in at once.
+# The desktop app keeps using the single session above.
+SESSION_TTL_SECONDS = 8 * 3600 # a school day; each use extends it
+_sessions = {} # token -> {'user_id', 'role', 'name', 'classroom', 'expires'}
+_sessions_lock = threading.Lock()
+
+@query_monitor.timed
+def authenticate(username, password):
     """
-    Logs in a user (student) by their username (name) and password.
+    Checks a username (student name) and password without touching the session.
+    Returns the student's dict on success, None otherwise.
     Note: This function assumes 'name' from the students table is used as the username.
     If multiple students share the same name, the first one found will be used for login.
     For robust authentication, unique usernames are recommended.
     """
-    global current_user_id, current_user_role
-
-    # Fetch all students. In a larger system, fetching only the user by username would be more efficient.
-    all_students = student_manager.get_students_db()
-    if not all_students:
-        return False
+    # Fetch only the students with this name (indexed lookup) instead of every student.
+    matching_students = student_manager.get_students_by_name_db(username)
+    if not matching_students:
+        return None
 
-    for student in all_students:
+    for student in matching_students:
         # Assuming 'name' is used as the username field
         if student['name'] == username:
             # Check if user is 'student' and has no password set
@@ -30,12 +41,10 @@ def login(username, password):
 
                 # For students with no password, allow login if provided password is also empty or None
                 if password is None or password == '':
-                    current_user_id = student['id']
-                    current_user_role = student['role']
-                    return True
+                    return student
                 else:
                     # Student has no password set, but a password was provided by user
-                    return False # Password mismatch (no password vs some password)
+                    return None # Password mismatch (no password vs some password)
 
             # Existing logic for users with passwords (students, leaders, admins)
             stored_hashed_password = student.get('hashed_password')
@@ -47,18 +56,30 @@ def login(username, password):
                 print(f"Warning: User {username} (role: {student['role']}) is missing password/salt information needed for login.")
                 # If it's a student, this means they were expected to have a password but don't.
                 # If it's an admin/leader, they MUST have a password.
-                return False # Cannot log in without password info if it's expected.
+                return None # Cannot log in without password info if it's expected.
 
-            if student_manager.verify_password(stored_hashed_password, stored_salt, password):
-                current_user_id = student['id']
-                current_user_role = student['role']
-                return True
+            if student_manager.verify_password(stored_hashed_password, stored_salt, password or ''):
+                return student
             else:
                 # Password incorrect for this user
-                return False # Username found, but password mismatch
+                return None # Username found, but password mismatch
 
     # User not found
-    return False
+    return None
+
+@query_monitor.timed
+def login(username, password):
+    """
+    Logs in a user (student) by their username (name) and password.
+    Sets the session of this app instance; see authenticate() for the checks.
+    """
+    global current_user_id, current_user_role
+    student = authenticate(username, password)
+    if student is None:
+        return False
+    current_user_id = student['id']
+    current_user_role = student['role']
+    return True
 
 def logout():
     """Logs out the current user by resetting session variables."""
@@ -82,6 +103,48 @@ def is_admin():
     """Checks if the currently logged-in user has an 'admin' role."""
     return current_user_role == 'admin'
 
+def create_session(username, password):
+    """Logs a user in for the API. Returns (token, session dict) or None if the credentials are wrong."""
+    student = authenticate(username, password)
+    if student is None:
+        return None
+    purge_expired_sessions() # tokens nobody presents again would otherwise stay in _sessions
+    token = secrets.token_urlsafe(32)
+    session = {'user_id': student['id'], 'role': student['role'], 'name': student['name'],
+               'classroom': student['classroom'], 'expires': time.monotonic() + SESSION_TTL_SECONDS}
+    with _sessions_lock:
+        _sessions[token] = session
+    return token, dict(session)
+
+def get_session(token):
+    """The session for a token (and extends it), or None if it is unknown or expired."""
+    if not token:
+        return None
+    now = time.monotonic()
+    with _sessions_lock:
+        session = _sessions.get(token)
+        if session is None:
+            return None
+        if session['expires'] < now:
+            del _sessions[token]
+            return None
+        session['expires'] = now + SESSION_TTL_SECONDS
+        return dict(session)
+
+def end_session(token):
+    """Logs out an API token. Returns True if it was an active session."""
+    with _sessions_lock:
+        return _sessions.pop(token, None) is not None
+
+def purge_expired_sessions():
+    """Drops expired tokens; returns how many were removed."""
+    now = time.monotonic()
+    with _sessions_lock:
+        expired = [token for token, session in _sessions.items() if session['expires'] < now]
+        for token in expired:
+            del _sessions[token]
+    return len(expired)
+
 if __name__ == '__main__':
     # This section is for basic testing of auth_manager.
     # It requires student_manager and a database with students.
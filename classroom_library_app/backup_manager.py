@@ -0,0 +1,518 @@
+"""
+Online backup and restore of the library database.
+
+create_backup() copies the live database with the SQLite backup API a few pages at a time,
+sleeping between steps, so the app keeps reading and writing while the copy runs. The copy
+is checked with PRAGMA integrity_check before it is kept, optionally gzip-compressed, and
+only then renamed into database/backups/ (a half-written backup never has a backup name).
+
+restore_backup() verifies the chosen backup, saves a safety copy of the current database,
+then copies the backup over the live database in a single backup step: other connections
+see either the old database or the restored one, never a mix.
+
+Incremental backups: triggers (see db_setup.CHANGE_TRACKED_TABLES) note in change_log the
+key of every book, student, loan and ledger row written or deleted. create_incremental_backup()
+reads the current version of those rows and writes them, gzip-compressed as JSON lines, to a
+numbered segment in <full backup name>.increments/; every full backup starts a new chain.
+restore_incremental_backup() replays the segments onto a copy of their full backup and
+restores the result like restore_backup().
+
+BackupScheduler makes a backup in a background thread every BIBLIO_BACKUP_HOURS hours
+(default 24, 0 disables it) and keeps the newest BIBLIO_BACKUP_KEEP (default 10). With
+BIBLIO_BACKUP_INCREMENTAL=1 the scheduled backups are incremental, with a full backup every
+BIBLIO_BACKUP_FULL_DAYS days (default 7).
+"""
+import gzip
+import json
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import read_cache
+from utils import get_data_path
+from database.db_setup import CHANGE_TRACKED_TABLES, bump_data_versions, rebuild_points_rollups
+
+DB_PATH_FOR_CODE = os.path.join("database", "library.db")
+BACKUP_DIR_FOR_CODE = os.path.join("database", "backups")
+BACKUP_PREFIX = "library_"
+PAGES_PER_STEP = 128 # pages copied per backup step (4 KiB pages -> 512 KiB)
+STEP_SLEEP_SECONDS = 0.005 # pause between steps so writers are not starved
+DEFAULT_INTERVAL_HOURS = 24
+DEFAULT_KEEP = 10
+REQUIRED_TABLES = ("books", "students", "loans")
+DEFAULT_FULL_EVERY_DAYS = 7
+INCREMENTS_SUFFIX = ".increments"
+SEGMENT_FORMAT = 1
+KEYS_PER_QUERY = 500 # changed rows are read in chunks of this many keys
+
+_BACKUP_NAME_RE = re.compile(rf"^{BACKUP_PREFIX}\d{{8}}_\d{{6}}(_\w+)?\.db(\.gz)?$")
+_SEGMENT_NAME_RE = re.compile(r"^seg_(\d{5})\.jsonl\.gz$")
+# Held while a backup reads or resets the change log, so two backups never interleave
+# (a full backup from the scheduler and an incremental one from the admin tab, say).
+_chain_lock = threading.Lock()
+
+
+def _live_db_path():
+    return get_data_path(DB_PATH_FOR_CODE)
+
+
+def _backups_dir():
+    path = get_data_path(BACKUP_DIR_FOR_CODE)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _integrity_problems(conn):
+    """Returns a list of problems found in an open database (empty if it is sound)."""
+    problems = [row[0] for row in conn.execute("PRAGMA integrity_check") if row[0] != "ok"]
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    problems += [f"missing table '{table}'" for table in REQUIRED_TABLES if table not in tables]
+    return problems
+
+
+def _new_backup_path(label):
+    stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    suffix = f"_{label}" if label else ""
+    base = os.path.join(_backups_dir(), f"{BACKUP_PREFIX}{stamp}{suffix}")
+    path, n = base + ".db", 1
+    while os.path.exists(path) or os.path.exists(path + ".gz"): # two backups in the same second
+        n += 1
+        path = f"{base}_{n}.db"
+    return path
+
+
+def _last_change_id(conn):
+    """Newest change_log id in a database (0 if the log is empty or the table does not exist)."""
+    try:
+        return conn.execute("SELECT COALESCE(MAX(change_id), 0) FROM change_log").fetchone()[0]
+    except sqlite3.OperationalError:
+        return 0
+
+
+def _chain_state(conn):
+    return dict(conn.execute("SELECT key, value FROM backup_state").fetchall())
+
+
+def _start_chain(full_backup_path, last_change_id):
+    """Makes a new full backup the base of the incremental chain: changes up to last_change_id
+    (the newest one inside the copy) are dropped from the live change log."""
+    conn = None
+    try:
+        conn = sqlite3.connect(_live_db_path(), timeout=30)
+        conn.execute("DELETE FROM change_log WHERE change_id <= ?", (last_change_id,))
+        conn.execute("DELETE FROM backup_state")
+        conn.executemany("INSERT INTO backup_state (key, value) VALUES (?, ?)",
+                         [('base_backup', os.path.basename(full_backup_path)),
+                          ('base_created', datetime.now().isoformat(timespec='seconds')),
+                          ('segment_seq', '0')])
+        conn.commit()
+    except sqlite3.Error as e:
+        # The full backup itself is fine; the next incremental backup will start a new chain.
+        print(f"Backup Warning: could not start a new incremental chain: {e}")
+    finally:
+        if conn:
+            conn.close()
+
+
+def _reset_chain(conn):
+    """After a restore, the change log and chain state describe another database: forget them."""
+    conn.execute("DELETE FROM change_log")
+    conn.execute("DELETE FROM backup_state")
+
+
+def create_backup(compress=True, label=None, progress=None):
+    """Copies the live database into database/backups/ while the app keeps running.
+    label is appended to the file name (e.g. "antes_de_restaurar"). progress(copied, total)
+    is called after each step. The backup becomes the base of the next incremental backups.
+    Returns the backup path, or None if it failed."""
+    with _chain_lock:
+        return _create_full_backup(compress, label, progress)
+
+
+def _create_full_backup(compress, label, progress):
+    target = _new_backup_path(label)
+    partial = target + ".partial"
+    source = None
+    dest = None
+    try:
+        source = sqlite3.connect(_live_db_path())
+        dest = sqlite3.connect(partial)
+        source.backup(dest, pages=PAGES_PER_STEP, sleep=STEP_SLEEP_SECONDS,
+                      progress=(lambda status, remaining, total: progress(total - remaining, total)) if progress else None)
+        problems = _integrity_problems(dest)
+        last_change_id = _last_change_id(dest)
+        dest.close()
+        dest = None
+        if problems:
+            print(f"Backup Error: the copy failed its integrity check: {'; '.join(problems[:5])}")
+            os.remove(partial)
+            return None
+        if compress:
+            target += ".gz"
+            with open(partial, "rb") as raw, gzip.open(target + ".partial", "wb", compresslevel=6) as packed:
+                shutil.copyfileobj(raw, packed, 1024 * 1024)
+            os.remove(partial)
+            partial = target + ".partial"
+        os.replace(partial, target)
+        _start_chain(target, last_change_id)
+        print(f"Backup created: '{target}'.")
+        return target
+    except (sqlite3.Error, OSError) as e:
+        print(f"Backup Error: {e}")
+        if os.path.exists(partial):
+            try:
+                os.remove(partial)
+            except OSError:
+                pass
+        return None
+    finally:
+        if dest:
+            dest.close()
+        if source:
+            source.close()
+
+
+class _OpenedBackup:
+    """Context manager giving a plain .db path for a backup (decompressing .gz to a temp file).
+    With writable=True the path is always a temp copy, so the backup itself is never changed."""
+
+    def __init__(self, path, writable=False):
+        self.path = path
+        self.writable = writable
+        self._temp_path = None
+
+    def __enter__(self):
+        if not self.path.endswith(".gz") and not self.writable:
+            return self.path
+        fd, self._temp_path = tempfile.mkstemp(suffix=".db")
+        opener = gzip.open if self.path.endswith(".gz") else open
+        with os.fdopen(fd, "wb") as raw, opener(self.path, "rb") as packed:
+            shutil.copyfileobj(packed, raw, 1024 * 1024)
+        return self._temp_path
+
+    def __exit__(self, *exc_info):
+        if self._temp_path and os.path.exists(self._temp_path):
+            os.remove(self._temp_path)
+
+
+def verify_backup(path):
+    """Checks a backup file. Returns (True, "ok") or (False, description of the problem)."""
+    if not os.path.exists(path):
+        return False, f"'{path}' does not exist."
+    try:
+        with _OpenedBackup(path) as db_path:
+            conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+            try:
+                problems = _integrity_problems(conn)
+            finally:
+                conn.close()
+    except (sqlite3.Error, OSError, EOFError) as e: # EOFError: truncated .gz
+        return False, str(e)
+    if problems:
+        return False, "; ".join(problems[:5])
+    return True, "ok"
+
+
+def list_backups():
+    """Full backups in database/backups/, newest first. Each item is a dict with path, name,
+    size (bytes), created (datetime), compressed, increments (number of incremental segments
+    on top of it) and increments_size (bytes)."""
+    backups = []
+    for name in os.listdir(_backups_dir()):
+        if not _BACKUP_NAME_RE.match(name):
+            continue
+        path = os.path.join(_backups_dir(), name)
+        stat = os.stat(path)
+        segments = list_increments(path)
+        backups.append({'path': path, 'name': name, 'size': stat.st_size,
+                        'created': datetime.fromtimestamp(stat.st_mtime), 'compressed': name.endswith(".gz"),
+                        'increments': len(segments), 'increments_size': sum(os.path.getsize(seg) for seg in segments)})
+    backups.sort(key=lambda b: (b['created'], b['name']), reverse=True)
+    return backups
+
+
+def rotate_backups(keep=DEFAULT_KEEP):
+    """Deletes all but the newest `keep` full backups, with their incremental segments.
+    Returns the deleted paths."""
+    removed = []
+    for backup in list_backups()[keep:]:
+        try:
+            os.remove(backup['path'])
+            removed.append(backup['path'])
+            shutil.rmtree(_increments_dir(backup['path']), ignore_errors=True)
+        except OSError as e:
+            print(f"Backup rotation: could not delete '{backup['path']}': {e}")
+    return removed
+
+
+def restore_backup(path):
+    """Replaces the live database with a backup. The backup is verified first and the current
+    database is saved as a "antes_de_restaurar" backup. Returns True on success."""
+    ok, message = verify_backup(path)
+    if not ok:
+        print(f"Restore Error: '{path}' is not a valid backup: {message}")
+        return False
+    if create_backup(label="antes_de_restaurar") is None:
+        print("Restore Error: could not save the current database before restoring; nothing was changed.")
+        return False
+    try:
+        with _OpenedBackup(path, writable=True) as db_path:
+            _copy_into_live(db_path)
+        print(f"Database restored from '{path}'.")
+        return True
+    except (sqlite3.Error, OSError) as e:
+        print(f"Restore Error: {e}")
+        return False
+
+
+def _copy_into_live(db_path):
+    """Resets the chain state in db_path (a temp copy) and copies it over the live database.
+    The copy's data versions are moved past the live ones, so open views see the change
+    (change_bus) even where the backup's counters are lower."""
+    source = None
+    dest = None
+    try:
+        source = sqlite3.connect(db_path)
+        dest = sqlite3.connect(_live_db_path(), timeout=30)
+        _reset_chain(source)
+        bump_data_versions(source.cursor(), dict(dest.execute("SELECT name, version FROM data_versions").fetchall()))
+        source.commit()
+        source.backup(dest) # one step (pages=-1): a single write transaction on the live DB
+        read_cache.clear()
+    finally:
+        if dest:
+            dest.close()
+        if source:
+            source.close()
+
+
+def _increments_dir(full_backup_path):
+    name = os.path.basename(full_backup_path)
+    stem = name[:-len(".gz")] if name.endswith(".gz") else name
+    return os.path.join(os.path.dirname(full_backup_path), stem[:-len(".db")] + INCREMENTS_SUFFIX)
+
+
+def list_increments(full_backup_path):
+    """Paths of the incremental segments made on top of a full backup, oldest first."""
+    directory = _increments_dir(full_backup_path)
+    if not os.path.isdir(directory):
+        return []
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if _SEGMENT_NAME_RE.match(name)]
+
+
+def create_incremental_backup():
+    """Saves the rows changed since the previous (full or incremental) backup as a new segment.
+    Starts a new chain with a full backup if there is no usable one.
+    Returns a dict with kind ("incremental", "full" or "none" when nothing changed), path,
+    changes (rows saved or deleted) and size (bytes), or None if it failed."""
+    with _chain_lock:
+        conn = None
+        try:
+            conn = sqlite3.connect(_live_db_path(), timeout=30, isolation_level=None)
+            state = _chain_state(conn)
+            base_path = os.path.join(_backups_dir(), state.get('base_backup', ""))
+            if not state.get('base_backup') or not os.path.exists(base_path):
+                conn.close()
+                conn = None
+                path = _create_full_backup(True, None, None)
+                return {'kind': "full", 'path': path, 'changes': None,
+                        'size': os.path.getsize(path)} if path else None
+
+            # BEGIN IMMEDIATE keeps writers out until the segment is written and the log trimmed,
+            # so no change can slip in between reading a row and deleting its log entry.
+            conn.execute("BEGIN IMMEDIATE")
+            last_change_id = _last_change_id(conn)
+            latest = conn.execute("""
+                SELECT table_name, row_key, op FROM change_log
+                WHERE change_id IN (SELECT MAX(change_id) FROM change_log GROUP BY table_name, row_key)
+            """).fetchall()
+            if not latest:
+                conn.execute("COMMIT")
+                return {'kind': "none", 'path': None, 'changes': 0, 'size': 0}
+
+            seq = int(state.get('segment_seq', 0)) + 1
+            directory = _increments_dir(base_path)
+            os.makedirs(directory, exist_ok=True)
+            target = os.path.join(directory, f"seg_{seq:05d}.jsonl.gz")
+            partial = target + ".partial"
+            try:
+                with gzip.open(partial, "wt", encoding="utf-8", compresslevel=6) as segment:
+                    _write_segment(conn, segment, latest, seq, state['base_backup'], last_change_id)
+                os.replace(partial, target)
+            except (sqlite3.Error, OSError):
+                if os.path.exists(partial):
+                    os.remove(partial)
+                raise
+            conn.execute("DELETE FROM change_log WHERE change_id <= ?", (last_change_id,))
+            conn.execute("UPDATE backup_state SET value = ? WHERE key = 'segment_seq'", (str(seq),))
+            conn.execute("COMMIT")
+            print(f"Incremental backup created: '{target}' ({len(latest)} change(s)).")
+            return {'kind': "incremental", 'path': target, 'changes': len(latest), 'size': os.path.getsize(target)}
+        except (sqlite3.Error, OSError) as e:
+            print(f"Incremental Backup Error: {e}")
+            if conn and conn.in_transaction:
+                conn.execute("ROLLBACK")
+            return None
+        finally:
+            if conn:
+                conn.close()
+
+
+def _write_segment(conn, segment, latest, seq, base_name, last_change_id):
+    """Writes a header line, then one line per changed row: {"t", "op": "U", "row"} with the row's
+    current values, or {"t", "op": "D", "key"} for a deleted row."""
+    keys_by_table = {}
+    for table, key, op in latest:
+        keys_by_table.setdefault(table, {'U': [], 'D': []})[op].append(key)
+    columns = {table: [row[1] for row in conn.execute(f"PRAGMA table_info({table})")] for table in keys_by_table}
+    segment.write(json.dumps({'format': SEGMENT_FORMAT, 'base': base_name, 'seq': seq,
+                              'last_change_id': last_change_id, 'created': datetime.now().isoformat(timespec='seconds'),
+                              'columns': columns}) + "\n")
+    for table, ops in keys_by_table.items():
+        key_column = CHANGE_TRACKED_TABLES[table]
+        for key in ops['D']:
+            segment.write(json.dumps({'t': table, 'op': "D", 'key': key}) + "\n")
+        for start in range(0, len(ops['U']), KEYS_PER_QUERY):
+            chunk = ops['U'][start:start + KEYS_PER_QUERY]
+            placeholders = ", ".join("?" * len(chunk))
+            rows = conn.execute(f"SELECT {', '.join(columns[table])} FROM {table} "
+                                f"WHERE {key_column} IN ({placeholders})", chunk)
+            for row in rows:
+                segment.write(json.dumps({'t': table, 'op': "U", 'row': list(row)}) + "\n")
+
+
+def _replay_segment(conn, segment_path, base_name, expected_seq):
+    with gzip.open(segment_path, "rt", encoding="utf-8") as segment:
+        header = json.loads(segment.readline())
+        if header.get('format') != SEGMENT_FORMAT or header.get('base') != base_name or header.get('seq') != expected_seq:
+            raise ValueError(f"'{segment_path}' does not follow segment {expected_seq - 1} of '{base_name}'.")
+        columns = header['columns']
+        for line in segment:
+            change = json.loads(line)
+            table = change['t']
+            if table not in CHANGE_TRACKED_TABLES:
+                raise ValueError(f"'{segment_path}' contains rows of an unknown table '{table}'.")
+            key_column = CHANGE_TRACKED_TABLES[table]
+            if change['op'] == "D":
+                conn.execute(f"DELETE FROM {table} WHERE {key_column} = ?", (change['key'],))
+            else:
+                # OR REPLACE removes the old version without firing delete triggers
+                # (recursive_triggers is off), so the append-only ledger guard does not object.
+                names = columns[table]
+                conn.execute(f"INSERT OR REPLACE INTO {table} ({', '.join(names)}) VALUES ({', '.join('?' * len(names))})",
+                             change['row'])
+
+
+def restore_incremental_backup(full_backup_path, upto=None):
+    """Restores a full backup plus its incremental segments (the first `upto` of them, or all).
+    The segments are replayed onto a temp copy of the full backup, the points rollups are rebuilt
+    and the result is checked before it replaces the live database, as in restore_backup().
+    Returns True on success."""
+    ok, message = verify_backup(full_backup_path)
+    if not ok:
+        print(f"Restore Error: '{full_backup_path}' is not a valid backup: {message}")
+        return False
+    segments = list_increments(full_backup_path)[:upto]
+    base_name = os.path.basename(full_backup_path)
+    try:
+        with _OpenedBackup(full_backup_path, writable=True) as db_path:
+            conn = sqlite3.connect(db_path)
+            try:
+                for seq, segment_path in enumerate(segments, start=1):
+                    _replay_segment(conn, segment_path, base_name, seq)
+                rebuild_points_rollups(conn.cursor())
+                conn.commit()
+                problems = _integrity_problems(conn)
+            finally:
+                conn.close()
+            if problems:
+                print(f"Restore Error: the replayed database failed its integrity check: {'; '.join(problems[:5])}")
+                return False
+            if create_backup(label="antes_de_restaurar") is None:
+                print("Restore Error: could not save the current database before restoring; nothing was changed.")
+                return False
+            _copy_into_live(db_path)
+        print(f"Database restored from '{full_backup_path}' and {len(segments)} incremental segment(s).")
+        return True
+    except (sqlite3.Error, OSError, EOFError, ValueError, KeyError) as e: # EOFError: truncated .gz
+        print(f"Restore Error: {e}")
+        return False
+
+
+class BackupScheduler:
+    """Creates a backup every interval_hours (and rotates old ones) in a daemon thread.
+    The first backup is due interval_hours after the newest existing one. With incremental=True
+    the backups are incremental, and a full one is made when the chain's full backup is
+    full_every_days old."""
+
+    def __init__(self, interval_hours=DEFAULT_INTERVAL_HOURS, keep=DEFAULT_KEEP, compress=True,
+                 incremental=False, full_every_days=DEFAULT_FULL_EVERY_DAYS):
+        self.interval_seconds = interval_hours * 3600
+        self.keep = keep
+        self.compress = compress
+        self.incremental = incremental
+        self.full_every_seconds = full_every_days * 86400
+        self.last_backup_path = None
+        self._last_run = 0.0 # an incremental run with nothing to save writes no file
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def seconds_until_due(self):
+        backups = list_backups()
+        if not backups:
+            return 0
+        newest = backups[0]['created'].timestamp()
+        segments = list_increments(backups[0]['path'])
+        if segments:
+            newest = max(newest, os.path.getmtime(segments[-1]))
+        age = time.time() - max(newest, self._last_run)
+        return max(0.0, self.interval_seconds - age)
+
+    def _full_backup_due(self):
+        backups = list_backups()
+        return not backups or time.time() - backups[0]['created'].timestamp() >= self.full_every_seconds
+
+    def _run(self):
+        while not self._stop_event.wait(self.seconds_until_due()):
+            if self.incremental and not self._full_backup_due():
+                result = create_incremental_backup()
+                ok, path = result is not None, result and result['path']
+            else:
+                path = create_backup(compress=self.compress)
+                ok = path is not None
+            if ok:
+                self._last_run = time.time()
+                self.last_backup_path = path or self.last_backup_path
+                rotate_backups(self.keep)
+            else:
+                self._stop_event.wait(600) # retry failed backups after 10 minutes, not in a loop
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="backup-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+
+def start_scheduler_from_env():
+    """Starts the scheduled backups unless BIBLIO_BACKUP_HOURS=0; returns the scheduler or None."""
+    try:
+        interval_hours = float(os.environ.get("BIBLIO_BACKUP_HOURS", DEFAULT_INTERVAL_HOURS))
+        keep = int(os.environ.get("BIBLIO_BACKUP_KEEP", DEFAULT_KEEP))
+        full_every_days = float(os.environ.get("BIBLIO_BACKUP_FULL_DAYS", DEFAULT_FULL_EVERY_DAYS))
+    except ValueError:
+        print("Backups: invalid BIBLIO_BACKUP_HOURS/BIBLIO_BACKUP_KEEP/BIBLIO_BACKUP_FULL_DAYS, using the defaults.")
+        interval_hours, keep, full_every_days = DEFAULT_INTERVAL_HOURS, DEFAULT_KEEP, DEFAULT_FULL_EVERY_DAYS
+    if interval_hours <= 0:
+        return None
+    incremental = os.environ.get("BIBLIO_BACKUP_INCREMENTAL", "0").lower() in ("1", "true", "yes")
+    scheduler = BackupScheduler(interval_hours=interval_hours, keep=max(1, keep),
+                                incremental=incremental, full_every_days=full_every_days)
+    scheduler.start()
+    return scheduler
@@ -3,9 +3,12 @@ import uuid
 import csv # Re-added for CSV import functionality
 from datetime import datetime, timedelta
 import student_manager
+import points_manager
+import query_monitor
 import os
 # Assuming utils.py is in the same directory level (classroom_library_app/)
 from utils import get_data_path
+from database.db_setup import CLASSROOM_ID_BY_NAME, get_classroom_id, rebuild_loan_reminders
 
 # DB_PATH_FOR_CODE is the relative path string that get_data_path will use.
 # It should point to where the database is expected to be within the application's
@@ -20,41 +23,43 @@ def _get_resolved_db_path():
     os.makedirs(os.path.dirname(path), exist_ok=True)
     return path
 
+# Book rows with their location's name as 'ubicacion' (books.location_id points at classrooms).
+_BOOK_COLUMNS = "b.id, b.titulo, b.autor, b.genero, loc.name AS ubicacion, b.cantidad_total"
+_JOIN_LOCATION = "LEFT JOIN classrooms loc ON loc.id = b.location_id"
+
 def generate_id():
     """Generates a unique ID for a book."""
     return str(uuid.uuid4())
 
+@query_monitor.timed
 def add_book_db(titulo, autor, ubicacion, genero=None, cantidad_total=1): # Added genero, cantidad_total, changed others
     """Adds a new book to the database.
     Returns the new book's ID or None on failure."""
     book_id = generate_id()
-    try:
-        conn = sqlite3.connect(_get_resolved_db_path())
-        cursor = conn.cursor()
+    def insert(cursor):
         cursor.execute("""
-            INSERT INTO books (id, titulo, autor, genero, ubicacion, cantidad_total)
+            INSERT INTO books (id, titulo, autor, genero, location_id, cantidad_total)
             VALUES (?, ?, ?, ?, ?, ?)
-        """, (book_id, titulo, autor, genero, ubicacion, cantidad_total))
-        conn.commit()
+        """, (book_id, titulo, autor, genero, get_classroom_id(cursor, ubicacion), cantidad_total))
         return book_id
+    try:
+        return query_monitor.write_transaction(_get_resolved_db_path(), insert)
     except sqlite3.Error as e:
         print(f"Database error in add_book_db: {e}")
         return None
-    finally:
-        if conn:
-            conn.close()
 
+@query_monitor.timed
 def get_all_books_db(ubicacion_filter=None): # Changed classroom_filter to ubicacion_filter, removed status_filter
     """Queries the books table, applying optional filters for ubicacion.
     Returns a list of dictionaries (each dict representing a book)."""
     try:
-        conn = sqlite3.connect(_get_resolved_db_path())
+        conn = query_monitor.connect(_get_resolved_db_path())
         conn.row_factory = sqlite3.Row # Access columns by name
         cursor = conn.cursor()
-        query = "SELECT id, titulo, autor, genero, ubicacion, cantidad_total FROM books" # Updated columns
+        query = f"SELECT {_BOOK_COLUMNS} FROM books b {_JOIN_LOCATION}"
         params = []
         if ubicacion_filter and ubicacion_filter != "All": # Assuming "All" means no filter
-            query += " WHERE ubicacion = ?"
+            query += f" WHERE b.location_id = {CLASSROOM_ID_BY_NAME}"
             params.append(ubicacion_filter)
         cursor.execute(query, params)
         books = [dict(row) for row in cursor.fetchall()]
@@ -66,18 +71,19 @@ def get_all_books_db(ubicacion_filter=None): # Changed classroom_filter to ubica
         if conn:
             conn.close()
 
+@query_monitor.timed
 def get_book_by_id_db(book_id):
     """Fetches a specific book by its ID from the database.
     Returns a dictionary representing the book if found, else None."""
     conn = None
     try:
-        conn = sqlite3.connect(_get_resolved_db_path())
+        conn = query_monitor.connect(_get_resolved_db_path())
         conn.row_factory = sqlite3.Row  # Access columns by name
         cursor = conn.cursor()
-        cursor.execute("""
-            SELECT id, titulo, autor, genero, ubicacion, cantidad_total
-            FROM books
-            WHERE id = ?
+        cursor.execute(f"""
+            SELECT {_BOOK_COLUMNS}
+            FROM books b {_JOIN_LOCATION}
+            WHERE b.id = ?
         """, (book_id,))
         book_row = cursor.fetchone()
         if book_row:
@@ -91,6 +97,7 @@ def get_book_by_id_db(book_id):
         if conn:
             conn.close()
 
+@query_monitor.timed
 def import_books_from_csv_db(file_path):
     """Reads a CSV file and adds books to the database using batch processing.
     Expected headers: Título, Autor, Género, Ubicación, Cantidad_Total.
@@ -101,18 +108,21 @@ def import_books_from_csv_db(file_path):
     conn = None
 
     try:
-        # Fetch valid locations first (outside transaction, as it reads DB)
+        # Locations are checked against the classrooms table as they appear (outside the
+        # write transaction), each distinct name once.
         try:
-            distinct_classrooms = student_manager.get_distinct_classrooms()
-        except Exception as e_sm:
-            error_messages.append(f"Error crítico al obtener clases existentes: {e_sm}. No se puede continuar con la importación.")
+            conn = query_monitor.connect(_get_resolved_db_path())
+        except sqlite3.Error as e_db:
+            error_messages.append(f"Error crítico al obtener clases existentes: {e_db}. No se puede continuar con la importación.")
             return 0, error_messages
-
         fixed_locations = ["Biblioteca"]
-        valid_locations = set(distinct_classrooms + fixed_locations)
-        if not valid_locations and "Biblioteca" not in fixed_locations : # Corrected logic
-             error_messages.append("No se pudieron determinar ubicaciones válidas (clases o Biblioteca). La importación no puede continuar sin ubicaciones válidas.")
-             return 0, error_messages
+        valid_locations = {} # location -> bool
+
+        def is_valid_location(location):
+            if location not in valid_locations:
+                valid_locations[location] = (location in fixed_locations or
+                                             student_manager.classroom_has_students(conn.cursor(), location))
+            return valid_locations[location]
 
         with open(file_path, mode='r', encoding='utf-8-sig') as file:
             reader = csv.DictReader(file)
@@ -160,7 +170,7 @@ def import_books_from_csv_db(file_path):
                     continue
 
                 ubicacion = ubicacion_raw.strip()
-                if ubicacion not in valid_locations:
+                if not is_valid_location(ubicacion):
                     error_messages.append(f"Fila {row_num}: La ubicación '{ubicacion}' no es válida. Debe ser una clase existente o 'Biblioteca'. Saltando fila.")
                     continue
 
@@ -176,24 +186,26 @@ def import_books_from_csv_db(file_path):
                 book_id = generate_id() # Generate ID here
                 books_to_insert.append((book_id, titulo, autor, genero, ubicacion, cantidad_total_int))
 
+        conn.close()
+        conn = None
         if not books_to_insert:
             if not error_messages: # No books to insert and no errors means empty valid CSV or all rows skipped
                  error_messages.append("No se encontraron libros válidos para importar en el archivo CSV.")
             return 0, error_messages # Return early if no books were prepared
 
-        conn = sqlite3.connect(_get_resolved_db_path())
-        cursor = conn.cursor()
-        conn.execute("BEGIN TRANSACTION;")
-
         try:
-            cursor.executemany("""
-                INSERT INTO books (id, titulo, autor, genero, ubicacion, cantidad_total)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, books_to_insert)
-            conn.commit()
+            def insert_all(cursor):
+                location_ids = {} # ubicacion -> id, each looked up once
+                for book in books_to_insert:
+                    if book[4] not in location_ids:
+                        location_ids[book[4]] = get_classroom_id(cursor, book[4])
+                cursor.executemany("""
+                    INSERT INTO books (id, titulo, autor, genero, location_id, cantidad_total)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, [book[:4] + (location_ids[book[4]],) + book[5:] for book in books_to_insert])
+            query_monitor.write_transaction(_get_resolved_db_path(), insert_all)
             successful_imports = len(books_to_insert)
         except sqlite3.Error as e:
-            conn.rollback()
             error_messages.append(f"Error de base de datos durante la inserción en lote: {e}. No se importaron libros en este lote.")
             return 0, error_messages # Return 0 successful imports for this batch on DB error
 
@@ -201,29 +213,28 @@ def import_books_from_csv_db(file_path):
         error_messages.append(f"Error: No se encontró el archivo '{file_path}'.")
     except Exception as e:
         error_messages.append(f"Ocurrió un error inesperado durante la importación del CSV: {e}")
-        if conn: # If connection was established before this generic error
-            conn.rollback() # Rollback any potential transaction
     finally:
         if conn:
             conn.close()
 
     return successful_imports, error_messages
 
+@query_monitor.timed
 def search_books_db(query, search_field="titulo"): # default to 'titulo'
     """Searches books where search_field CONTAINS query (case-insensitive).
     Returns a list of book dictionaries."""
     if not query:
         return []
     try:
-        conn = sqlite3.connect(_get_resolved_db_path())
+        conn = query_monitor.connect(_get_resolved_db_path())
         conn.row_factory = sqlite3.Row # Access columns by name
         cursor = conn.cursor()
-        allowed_search_fields = ["titulo", "autor", "genero", "ubicacion"] # Updated fields
+        allowed_search_fields = {"titulo": "b.titulo", "autor": "b.autor", "genero": "b.genero", "ubicacion": "loc.name"}
         if search_field not in allowed_search_fields:
             print(f"Invalid search field: {search_field}. Defaulting to titulo.")
             search_field = "titulo"
         # Using LIKE for case-insensitive partial matching
-        sql_query = f"SELECT id, titulo, autor, genero, ubicacion, cantidad_total FROM books WHERE {search_field} LIKE ?" # Updated columns
+        sql_query = f"SELECT {_BOOK_COLUMNS} FROM books b {_JOIN_LOCATION} WHERE {allowed_search_fields[search_field]} LIKE ?"
         cursor.execute(sql_query, (f"%{query}%",))
         books = [dict(row) for row in cursor.fetchall()]
         return books
@@ -235,20 +246,20 @@ def search_books_db(query, search_field="titulo"): # default to 'titulo'
             conn.close()
 
 # --- Loan Management Functions ---
+@query_monitor.timed
 def get_available_book_count(book_id):
     """Calculates the number of available copies for a given book_id using a single optimized query."""
     conn = None
     try:
-        conn = sqlite3.connect(_get_resolved_db_path())
+        conn = query_monitor.connect(_get_resolved_db_path())
         cursor = conn.cursor()
+        # Correlated count so only this book's loans are read (via idx_loans_book_due_covering),
+        # instead of grouping the whole loans table.
         query = """
-            SELECT b.cantidad_total - COALESCE(l.active_loans, 0) AS available_count
+            SELECT b.cantidad_total - (
+                SELECT COUNT(*) FROM loans l WHERE l.book_id = b.id
+            ) AS available_count
             FROM books b
-            LEFT JOIN (
-                SELECT book_id, COUNT(*) AS active_loans
-                FROM loans
-                GROUP BY book_id
-            ) l ON b.id = l.book_id
             WHERE b.id = ?;
         """
         cursor.execute(query, (book_id,))
@@ -268,140 +279,239 @@ def get_available_book_count(book_id):
         if conn:
             conn.close()
 
-def loan_book_db(book_id, student_id, due_date_str, lending_student_leader_id):
-    """Records a book loan in the 'loans' table."""
-    if not student_manager.is_student_leader(lending_student_leader_id):
-        print(f"Loan Error: Lending student {lending_student_leader_id} is not a leader or does not exist.")
-        return False
-    borrower = student_manager.get_student_by_id_db(student_id)
-    if not borrower:
-        print(f"Loan Error: Borrower student {student_id} does not exist.")
-        return False
-    conn = None # Ensure conn is defined for the finally block
-    try:
-        conn = sqlite3.connect(_get_resolved_db_path())
-        cursor = conn.cursor()
-        # Check if book exists (though get_available_book_count also implicitly checks)
-        cursor.execute("SELECT id FROM books WHERE id = ?", (book_id,))
+POINTS_FOR_BORROWING = 10
+POINTS_FOR_RETURNING = 5
+POINTS_FOR_WORKSHEET = 15
+POINTS_FOR_EARLY_RETURN = 5
+
+def insert_loan(cursor, loan_id, book_id, student_id, loan_date_str, due_date_str):
+    """Inserts a loan and awards the borrowing points, in the caller's transaction.
+    Shared by loan_book_db and the sync of loans made offline (sync_manager)."""
+    cursor.execute("""
+        INSERT INTO loans (loan_id, book_id, student_id, loan_date, due_date)
+        VALUES (?, ?, ?, ?, ?)
+    """, (loan_id, book_id, student_id, loan_date_str, due_date_str))
+    points_manager.record_points(cursor, student_id, POINTS_FOR_BORROWING, points_manager.REASON_LOAN, loan_id)
+
+def close_loan(cursor, loan_id, worksheet_submitted=False, return_date=None):
+    """Awards the return points, archives the loan into loan_history and deletes it, in the
+    caller's transaction. return_date (a date, default today) decides the early-return bonus.
+    Returns the points awarded, or None if there is no such loan."""
+    return_date = return_date or datetime.now().date()
+    # --- Gamification Logic: Step 1 - Fetch loan details BEFORE deleting ---
+    cursor.execute("SELECT student_id, due_date, early_return_bonus_applied FROM loans WHERE loan_id = ?", (loan_id,))
+    loan_details = cursor.fetchone()
+    if not loan_details:
+        return None
+    student_id, due_date_str, early_bonus_applied_val = loan_details
+    early_bonus_already_applied = bool(early_bonus_applied_val)
+    awards = [] # (points, ledger reason), one ledger entry each
+    # 1. Base points for returning
+    awards.append((POINTS_FOR_RETURNING, points_manager.REASON_RETURN))
+    # 2. Worksheet bonus
+    if worksheet_submitted:
+        awards.append((POINTS_FOR_WORKSHEET, points_manager.REASON_WORKSHEET))
+        # Mark worksheet as submitted for this loan
+        cursor.execute("UPDATE loans SET worksheet_submitted = 1 WHERE loan_id = ?", (loan_id,))
+    # 3. Early return bonus
+    if due_date_str and not early_bonus_already_applied: # Check if bonus not already applied
+        try:
+            due_date_dt = datetime.strptime(due_date_str, '%Y-%m-%d').date()
+            if return_date < due_date_dt:
+                awards.append((POINTS_FOR_EARLY_RETURN, points_manager.REASON_EARLY_RETURN))
+                # Mark bonus as applied for this loan
+                cursor.execute("UPDATE loans SET early_return_bonus_applied = 1 WHERE loan_id = ?", (loan_id,))
+        except ValueError as ve:
+            print(f"Warning: Could not parse due_date '{due_date_str}' for loan {loan_id} during gamification: {ve}")
+    # Record the points in the ledger (also updates the student's cached total)
+    for points, reason in awards:
+        points_manager.record_points(cursor, student_id, points, reason, loan_id)
+    # --- Main Return Logic: Step 2 - Archive and delete the loan record ---
+    cursor.execute("""
+        INSERT INTO loan_history (loan_id, book_id, student_id, loan_date, due_date, return_date)
+        SELECT loan_id, book_id, student_id, loan_date, due_date, ? FROM loans WHERE loan_id = ?
+    """, (return_date.strftime('%Y-%m-%d'), loan_id))
+    cursor.execute("DELETE FROM loans WHERE loan_id = ?", (loan_id,))
+    return sum(points for points, _ in awards)
+
+@query_monitor.timed
+def loan_book_db(book_id, student_id, due_date_str, lending_student_leader_id, loan_id=None):
+    """Records a book loan in the 'loans' table.
+    loan_id can be given by the caller (loans recorded offline keep their id when synced).
+    The checks and the insert are one BEGIN IMMEDIATE transaction, so two leaders lending the
+    last copy at the same time (from any process) can't both get it."""
+    loan_id = loan_id or str(uuid.uuid4())
+    loan_date_str = datetime.now().strftime('%Y-%m-%d')
+    def lend(cursor):
+        cursor.execute("SELECT role FROM students WHERE id = ?", (lending_student_leader_id,))
+        leader = cursor.fetchone()
+        if not leader or leader[0] != 'leader':
+            print(f"Loan Error: Lending student {lending_student_leader_id} is not a leader or does not exist.")
+            return False
+        cursor.execute("SELECT 1 FROM students WHERE id = ?", (student_id,))
         if not cursor.fetchone():
+            print(f"Loan Error: Borrower student {student_id} does not exist.")
+            return False
+        # Same count as get_available_book_count, but inside the write lock.
+        cursor.execute("""
+            SELECT b.cantidad_total - (SELECT COUNT(*) FROM loans l WHERE l.book_id = b.id)
+            FROM books b WHERE b.id = ?
+        """, (book_id,))
+        available = cursor.fetchone()
+        if available is None:
             print(f"Loan Error: Book with ID {book_id} not found.")
             return False
-        available_count = get_available_book_count(book_id)
-        if available_count <= 0:
+        if available[0] <= 0:
             print(f"Loan Error: No available copies of book ID {book_id} to loan.")
             return False
-        loan_id = str(uuid.uuid4())
-        loan_date_str = datetime.now().strftime('%Y-%m-%d')
-        cursor.execute("""
-            INSERT INTO loans (loan_id, book_id, student_id, loan_date, due_date)
-            VALUES (?, ?, ?, ?, ?)
-        """, (loan_id, book_id, student_id, loan_date_str, due_date_str))
-        # --- Add points for borrowing ---
-        try:
-            points_for_borrowing = 10 # Example: 10 points for borrowing a book
-            cursor.execute("UPDATE students SET points = points + ? WHERE id = ?", (points_for_borrowing, student_id))
-            print(f"Awarded {points_for_borrowing} points to student {student_id} for borrowing book {book_id}.") # Optional logging
-        except sqlite3.Error as e:
-            print(f"Error awarding points during loan: {e}")
-            # This error should cause the transaction to be rolled back by the outer catch block if commit is not reached.
-            raise # Re-raise the exception to ensure transaction rollback
-        # --- End points for borrowing ---
-        conn.commit()
-        print(f"Book '{book_id}' loaned to student '{student_id}' successfully. Loan ID: {loan_id}")
+        # The loan and its points are one transaction: a ledger error rolls the loan back.
+        insert_loan(cursor, loan_id, book_id, student_id, loan_date_str, due_date_str)
         return True
+    try:
+        if not query_monitor.write_transaction(_get_resolved_db_path(), lend):
+            return False
     except sqlite3.Error as e:
         print(f"Database error in loan_book_db: {e}")
-        if conn:
-            conn.rollback() # Ensure rollback on SQLite error
         return False
-    finally:
-        if conn:
-            conn.close()
+    print(f"Awarded {POINTS_FOR_BORROWING} points to student {student_id} for borrowing book {book_id}.") # Optional logging
+    print(f"Book '{book_id}' loaned to student '{student_id}' successfully. Loan ID: {loan_id}")
+    return True
 
+@query_monitor.timed
 def return_book_db(loan_id, student_leader_id, worksheet_submitted=False):
-    """Removes a loan record from the 'loans' table upon book return and applies gamification points."""
-    if not student_manager.is_student_leader(student_leader_id):
-        print(f"Return Error: Returning student {student_leader_id} is not a leader or does not exist.")
-        return False
+    """Removes a loan record from the 'loans' table upon book return and applies gamification points.
+    The leader check is read in the same BEGIN IMMEDIATE transaction as the return, like loan_book_db."""
     if not loan_id:
         print("Return Error: Loan ID cannot be empty.")
         return False
-    conn = None
-    try:
-        conn = sqlite3.connect(_get_resolved_db_path())
-        cursor = conn.cursor()
-        conn.execute("BEGIN TRANSACTION;") # Start transaction
-        # --- Gamification Logic: Step 1 - Fetch loan details BEFORE deleting ---
-        cursor.execute("SELECT student_id, due_date, early_return_bonus_applied FROM loans WHERE loan_id = ?", (loan_id,))
-        loan_details = cursor.fetchone()
-        if not loan_details:
+    def give_back(cursor):
+        cursor.execute("SELECT role FROM students WHERE id = ?", (student_leader_id,))
+        leader = cursor.fetchone()
+        if not leader or leader[0] != 'leader':
+            print(f"Return Error: Returning student {student_leader_id} is not a leader or does not exist.")
+            return None
+        points = close_loan(cursor, loan_id, worksheet_submitted)
+        if points is None:
             print(f"Error: Loan ID {loan_id} not found for gamification or return.")
-            conn.rollback() # Rollback if loan not found
-            return False
-        student_id, due_date_str, early_bonus_applied_val = loan_details
-        early_bonus_already_applied = bool(early_bonus_applied_val)
-        points_to_award = 0
-        # 1. Base points for returning
-        points_to_award += 5
-        # 2. Worksheet bonus
-        if worksheet_submitted:
-            points_to_award += 15
-            # Mark worksheet as submitted for this loan
-            cursor.execute("UPDATE loans SET worksheet_submitted = 1 WHERE loan_id = ?", (loan_id,))
-        # 3. Early return bonus
-        if due_date_str and not early_bonus_already_applied: # Check if bonus not already applied
-            try:
-                due_date_dt = datetime.strptime(due_date_str, '%Y-%m-%d').date()
-                if datetime.now().date() < due_date_dt:
-                    points_to_award += 5
-                    # Mark bonus as applied for this loan
-                    cursor.execute("UPDATE loans SET early_return_bonus_applied = 1 WHERE loan_id = ?", (loan_id,))
-            except ValueError as ve:
-                print(f"Warning: Could not parse due_date '{due_date_str}' for loan {loan_id} during gamification: {ve}")
-        # Update student's total points
-        if points_to_award > 0:
-            cursor.execute("UPDATE students SET points = points + ? WHERE id = ?", (points_to_award, student_id))
-        # --- Main Return Logic: Step 2 - Delete the loan record ---
-        cursor.execute("DELETE FROM loans WHERE loan_id = ?", (loan_id,))
-        if cursor.rowcount == 0:
-            # This means the loan was not found by the DELETE, which is unexpected if SELECT found it.
-            # This could indicate a concurrent deletion or an issue with loan_id.
-            print(f"Error: Failed to delete loan ID '{loan_id}'. Loan might have been deleted concurrently.")
-            conn.rollback()
-            return False
-        conn.commit() # Commit all changes (gamification and deletion)
-        print(f"Loan ID '{loan_id}' returned successfully. Points awarded: {points_to_award}")
-        return True
+        return points
+    try:
+        points_to_award = query_monitor.write_transaction(_get_resolved_db_path(), give_back)
     except sqlite3.Error as e:
         print(f"Database error in return_book_db for loan_id {loan_id}: {e}")
-        if conn:
-            conn.rollback()
         return False
-    except ValueError as ve:
-        print(f"Date format error for loan ID {loan_id} in return_book_db: {ve}")
-        if conn:
-            conn.rollback()
+    if points_to_award is None:
         return False
-    finally:
-        if conn:
-            conn.close()
+    print(f"Loan ID '{loan_id}' returned successfully. Points awarded: {points_to_award}")
+    return True
+
+def _existing_ids(cursor, table, ids):
+    """The subset of ids present in table.id (in chunks, under SQLite's parameter limit)."""
+    ids, found = list(set(ids)), set()
+    for first in range(0, len(ids), 500):
+        chunk = ids[first:first + 500]
+        cursor.execute(f"SELECT id FROM {table} WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+        found.update(row[0] for row in cursor.fetchall())
+    return found
+
+@query_monitor.timed
+def loan_books_bulk_db(loans, lending_student_leader_id):
+    """Lends several books in one transaction (a whole class at library hour).
+    loans: list of dicts {'book_id', 'student_id', 'due_date'} plus an optional 'loan_id'.
+    Each loan is checked like loan_book_db does (the free copies count the earlier loans of the
+    batch too); the valid ones are committed together, the others are skipped.
+    Returns (loan_ids, errors): loan_ids in the order of loans, None where the loan was refused,
+    and a message per refused loan."""
+    loan_date_str = datetime.now().strftime('%Y-%m-%d')
+    def lend_all(cursor):
+        loan_ids, errors = [], []
+        cursor.execute("SELECT role FROM students WHERE id = ?", (lending_student_leader_id,))
+        leader = cursor.fetchone()
+        if not leader or leader[0] != 'leader':
+            return [None] * len(loans), [f"El alumno {lending_student_leader_id} no es un líder o no existe."]
+        students = _existing_ids(cursor, "students", [loan['student_id'] for loan in loans])
+        free = {}
+        book_ids = list({loan['book_id'] for loan in loans})
+        for first in range(0, len(book_ids), 500):
+            chunk = book_ids[first:first + 500]
+            cursor.execute(f"""
+                SELECT b.id, b.cantidad_total - (SELECT COUNT(*) FROM loans l WHERE l.book_id = b.id)
+                FROM books b WHERE b.id IN ({','.join('?' * len(chunk))})
+            """, chunk)
+            free.update(cursor.fetchall())
+        for number, loan in enumerate(loans, start=1):
+            book_id, student_id = loan['book_id'], loan['student_id']
+            if student_id not in students:
+                errors.append(f"Préstamo {number}: el alumno {student_id} no existe.")
+            elif book_id not in free:
+                errors.append(f"Préstamo {number}: el libro {book_id} no existe.")
+            elif free[book_id] <= 0:
+                errors.append(f"Préstamo {number}: no quedan ejemplares libres del libro {book_id}.")
+            else:
+                loan_id = loan.get('loan_id') or str(uuid.uuid4())
+                insert_loan(cursor, loan_id, book_id, student_id, loan_date_str, loan['due_date'])
+                free[book_id] -= 1
+                loan_ids.append(loan_id)
+                continue
+            loan_ids.append(None)
+        return loan_ids, errors
+    if not loans:
+        return [], []
+    try:
+        loan_ids, errors = query_monitor.write_transaction(_get_resolved_db_path(), lend_all)
+    except sqlite3.Error as e:
+        print(f"Database error in loan_books_bulk_db: {e}")
+        return [None] * len(loans), [f"Error de base de datos: {e}. No se registró ningún préstamo."]
+    print(f"Bulk loan: {sum(1 for loan_id in loan_ids if loan_id)} of {len(loans)} books loaned.")
+    return loan_ids, errors
+
+@query_monitor.timed
+def return_books_bulk_db(returns, student_leader_id):
+    """Returns several loans in one transaction.
+    returns: list of dicts {'loan_id', 'worksheet_submitted'}.
+    Returns (points, errors): the points awarded per return in the order of returns (None where
+    the loan was not found) and a message per failed return."""
+    def return_all(cursor):
+        cursor.execute("SELECT role FROM students WHERE id = ?", (student_leader_id,))
+        leader = cursor.fetchone()
+        if not leader or leader[0] != 'leader':
+            return [None] * len(returns), [f"El alumno {student_leader_id} no es un líder o no existe."]
+        points, errors = [], []
+        for number, item in enumerate(returns, start=1):
+            awarded = close_loan(cursor, item['loan_id'], bool(item.get('worksheet_submitted')))
+            if awarded is None:
+                errors.append(f"Devolución {number}: el préstamo {item['loan_id']} no existe (¿ya devuelto?).")
+            points.append(awarded)
+        return points, errors
+    if not returns:
+        return [], []
+    try:
+        points, errors = query_monitor.write_transaction(_get_resolved_db_path(), return_all)
+    except sqlite3.Error as e:
+        print(f"Database error in return_books_bulk_db: {e}")
+        return [None] * len(returns), [f"Error de base de datos: {e}. No se registró ninguna devolución."]
+    print(f"Bulk return: {sum(1 for p in points if p is not None)} of {len(returns)} loans returned.")
+    return points, errors
 
-def get_current_loans_db(student_id_filter=None, ubicacion_filter=None):
+@query_monitor.timed
+def get_current_loans_db(student_id_filter=None, ubicacion_filter=None, classroom_filter=None):
     """Fetches current loans, joining with books and students tables.
-    Filters by student_id (exact match) and/or books.ubicacion (exact match).
+    Filters by student_id (exact match), the book's location (exact match) and/or the borrower's
+    classroom (students.classroom_id: the students of the class, then their loans, through
+    idx_students_classroom_points and idx_loans_student_due).
     Returns list of dicts (loan info + book info + borrower_name)."""
     conn = None
     try:
-        conn = sqlite3.connect(_get_resolved_db_path())
+        conn = query_monitor.connect(_get_resolved_db_path())
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
         query = """
             SELECT l.loan_id, l.loan_date, l.due_date,
-                   b.id as book_id, b.titulo, b.autor, b.genero, b.ubicacion,
+                   b.id as book_id, b.titulo, b.autor, b.genero, loc.name as ubicacion,
                    s.id as student_id, s.name as borrower_name
             FROM loans l
             JOIN books b ON l.book_id = b.id
             JOIN students s ON l.student_id = s.id
+            LEFT JOIN classrooms loc ON loc.id = b.location_id
         """
         params = []
         conditions = []
@@ -409,8 +519,11 @@ def get_current_loans_db(student_id_filter=None, ubicacion_filter=None):
             conditions.append("l.student_id = ?")
             params.append(student_id_filter)
         if ubicacion_filter and ubicacion_filter != "All": # "All" means no filter for ubicacion
-            conditions.append("b.ubicacion = ?")
+            conditions.append(f"b.location_id = {CLASSROOM_ID_BY_NAME}")
             params.append(ubicacion_filter)
+        if classroom_filter:
+            conditions.append(f"s.classroom_id = {CLASSROOM_ID_BY_NAME}")
+            params.append(classroom_filter)
         if conditions:
             query += " WHERE " + " AND ".join(conditions)
         query += " ORDER BY l.due_date ASC"
@@ -424,29 +537,34 @@ def get_current_loans_db(student_id_filter=None, ubicacion_filter=None):
         if conn:
             conn.close()
 
-def get_books_due_soon_db(days_threshold=7, ubicacion_filter=None):
+@query_monitor.timed
+def get_books_due_soon_db(days_threshold=7, ubicacion_filter=None, classroom_filter=None):
     """Fetches loans due within days_threshold or already overdue.
-    Joins with books and students. Filters by books.ubicacion.
+    Joins with books and students. Filters by the book's location and/or the borrower's classroom.
     Returns list of dicts."""
     conn = None
     try:
-        conn = sqlite3.connect(_get_resolved_db_path())
+        conn = query_monitor.connect(_get_resolved_db_path())
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
         threshold_date_str = (datetime.now().date() + timedelta(days=days_threshold)).strftime('%Y-%m-%d')
         query = """
             SELECT l.loan_id, l.loan_date, l.due_date,
-                   b.id as book_id, b.titulo, b.autor, b.genero, b.ubicacion,
+                   b.id as book_id, b.titulo, b.autor, b.genero, loc.name as ubicacion,
                    s.id as student_id, s.name as borrower_name
             FROM loans l
             JOIN books b ON l.book_id = b.id
             JOIN students s ON l.student_id = s.id
+            LEFT JOIN classrooms loc ON loc.id = b.location_id
             WHERE l.due_date <= ?
         """
         params = [threshold_date_str]
         if ubicacion_filter and ubicacion_filter != "All":
-            query += " AND b.ubicacion = ?"
+            query += f" AND b.location_id = {CLASSROOM_ID_BY_NAME}"
             params.append(ubicacion_filter)
+        if classroom_filter:
+            query += f" AND s.classroom_id = {CLASSROOM_ID_BY_NAME}"
+            params.append(classroom_filter)
         query += " ORDER BY l.due_date ASC"
         cursor.execute(query, params)
         due_books = [dict(row) for row in cursor.fetchall()]
@@ -458,11 +576,57 @@ def get_books_due_soon_db(days_threshold=7, ubicacion_filter=None):
         if conn:
             conn.close()
 
-def extend_loan_db(loan_id, days_to_extend=14):
-    conn = None  # Initialize conn to None for the finally block
+REMINDER_DAYS = 7 # the leaders' reminder panels list the loans due within this many days
+
+def _refresh_reminder_snapshot(conn, today):
+    """Rebuilds the loan_reminders snapshot if it was computed for another day (or another
+    REMINDER_DAYS): once a day, on the first read. The state is checked again inside the write
+    transaction, so two processes starting the day together rebuild it once."""
+    snapshot = (today.strftime('%Y-%m-%d'), (today + timedelta(days=REMINDER_DAYS)).strftime('%Y-%m-%d'))
+    def is_current(cursor):
+        cursor.execute("SELECT key, value FROM reminder_state WHERE key IN ('snapshot_date', 'due_until')")
+        state = dict(cursor.fetchall())
+        return (state.get('snapshot_date'), state.get('due_until')) == snapshot
+    def rebuild(cursor):
+        if not is_current(cursor):
+            rebuild_loan_reminders(cursor, *snapshot)
+    if not is_current(conn.cursor()):
+        query_monitor.write_transaction(_get_resolved_db_path(), rebuild)
+
+@query_monitor.timed
+def get_classroom_reminders_db(classroom):
+    """Loans of the students of a classroom that are overdue or due within REMINDER_DAYS, overdue
+    first, then by due date. Reads the loan_reminders snapshot: one range of its classroom index.
+    Returns list of dicts with the fields of get_books_due_soon_db plus 'overdue' (0/1)."""
+    conn = None
     try:
-        conn = sqlite3.connect(_get_resolved_db_path())
+        conn = query_monitor.connect(_get_resolved_db_path())
+        conn.row_factory = sqlite3.Row
+        _refresh_reminder_snapshot(conn, datetime.now().date())
         cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT r.loan_id, l.loan_date, r.due_date, r.urgency = 0 AS overdue,
+                   b.id as book_id, b.titulo, b.autor, b.genero, loc.name as ubicacion,
+                   s.id as student_id, s.name as borrower_name
+            FROM loan_reminders r
+            JOIN loans l ON l.loan_id = r.loan_id
+            JOIN books b ON b.id = l.book_id
+            JOIN students s ON s.id = l.student_id
+            LEFT JOIN classrooms loc ON loc.id = b.location_id
+            WHERE r.classroom_id = {CLASSROOM_ID_BY_NAME}
+            ORDER BY r.urgency, r.due_date
+        """, (classroom,))
+        return [dict(row) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        print(f"Database error in get_classroom_reminders_db: {e}")
+        return []
+    finally:
+        if conn:
+            conn.close()
+
+@query_monitor.timed
+def extend_loan_db(loan_id, days_to_extend=14):
+    def extend(cursor):
         # Fetch the current due_date
         cursor.execute("SELECT due_date FROM loans WHERE loan_id = ?", (loan_id,))
         result = cursor.fetchone()
@@ -475,40 +639,32 @@ def extend_loan_db(loan_id, days_to_extend=14):
             print(f"Error: Due date is missing for loan ID {loan_id}.")
             return False
         current_due_date_dt = datetime.strptime(current_due_date_str, '%Y-%m-%d').date()
-        new_due_date_dt = current_due_date_dt + timedelta(days=days_to_extend)
-        new_due_date_str = new_due_date_dt.strftime('%Y-%m-%d')
-        # Update the due_date
+        new_due_date_str = (current_due_date_dt + timedelta(days=days_to_extend)).strftime('%Y-%m-%d')
         cursor.execute("UPDATE loans SET due_date = ? WHERE loan_id = ?", (new_due_date_str, loan_id))
-        conn.commit()
-        if cursor.rowcount == 0:
-            # This case should ideally not be hit if the SELECT found the loan,
-            # but as a safeguard for the UPDATE not affecting rows.
-            print(f"Error: Failed to update loan ID {loan_id}. Loan might have been deleted concurrently.")
-            return False
-        return True
+        return cursor.rowcount > 0
+    try:
+        return query_monitor.write_transaction(_get_resolved_db_path(), extend)
     except sqlite3.Error as e:
         print(f"Database error in extend_loan_db: {e}")
-        # Consider specific error handling or logging here
         return False
     except ValueError as ve: # Handles potential strptime errors if date format is unexpected
         print(f"Date format error for loan ID {loan_id}: {ve}")
         return False
-    finally:
-        if conn:
-            conn.close()
 
+@query_monitor.timed
 def get_most_read_books_db(limit=10):
     """Fetches the most loaned books from the database.
     Returns a list of book dictionaries, ordered by loan count."""
     conn = None
     try:
-        conn = sqlite3.connect(_get_resolved_db_path())
+        conn = query_monitor.connect(_get_resolved_db_path())
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
-        query = """
-            SELECT b.id, b.titulo, b.autor, b.genero, b.ubicacion, b.cantidad_total, COUNT(l.book_id) as loan_count
+        query = f"""
+            SELECT {_BOOK_COLUMNS}, COUNT(l.book_id) as loan_count
             FROM books b
             JOIN loans l ON b.id = l.book_id
+            {_JOIN_LOCATION}
             GROUP BY l.book_id
             ORDER BY loan_count DESC
             LIMIT ?;
@@ -523,18 +679,19 @@ def get_most_read_books_db(limit=10):
         if conn:
             conn.close()
 
+@query_monitor.timed
 def get_new_releases_db(limit=10):
     """Fetches a list of new releases (currently random books) from the database.
     Returns a list of book dictionaries."""
     conn = None
     try:
-        conn = sqlite3.connect(_get_resolved_db_path())
+        conn = query_monitor.connect(_get_resolved_db_path())
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
-        query = """
-            SELECT id, titulo, autor, genero, ubicacion, cantidad_total, date_added
-            FROM books
-            ORDER BY date_added DESC
+        query = f"""
+            SELECT {_BOOK_COLUMNS}, b.date_added
+            FROM books b {_JOIN_LOCATION}
+            ORDER BY b.date_added DESC
             LIMIT ?;
         """
         cursor.execute(query, (limit,))
@@ -547,17 +704,18 @@ def get_new_releases_db(limit=10):
         if conn:
             conn.close()
 
+@query_monitor.timed
 def get_recommendations_db(limit=10):
     """Fetches a list of recommended books (currently random books) from the database.
     Returns a list of book dictionaries."""
     conn = None
     try:
-        conn = sqlite3.connect(_get_resolved_db_path())
+        conn = query_monitor.connect(_get_resolved_db_path())
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
-        query = """
-            SELECT id, titulo, autor, genero, ubicacion, cantidad_total
-            FROM books
+        query = f"""
+            SELECT {_BOOK_COLUMNS}
+            FROM books b {_JOIN_LOCATION}
             ORDER BY RANDOM()
             LIMIT ?;
         """
@@ -0,0 +1,121 @@
+"""
+Change notifications, so the desktop app only reloads the views whose data changed.
+
+Every write bumps a counter in the data_versions table, in the same transaction, through the
+triggers db_setup creates (see db_setup.DATA_VERSIONS: books, loans, loan_history, students and
+"roster", which ignores points changes). That covers the app's own writes, the API server, sync
+pulls and any other process writing the same file.
+
+- `get_data_versions_db()` returns the counters. It keeps a connection per thread and asks it for
+  PRAGMA data_version, which only moves when another connection commits, so polling an idle
+  database never reads the table. `read_data_versions(db_path)` does the same for any file
+  (read_cache stamps its entries with them).
+- `ChangeBus(versions_func)` remembers the counters of the previous `poll()` and calls the
+  subscribers of the ones that moved, each once per poll. `apply_versions(versions)` does the same
+  with counters read on another thread (the desktop app reads a server's off the Tk thread). Subscribers reading through read_cache
+  get the new data: its entries are stamped with the same counters, read on the same
+  per-thread connection.
+"""
+import os
+import sqlite3
+import threading
+from utils import get_data_path
+
+DB_PATH_FOR_CODE = os.path.join("database", "library.db")
+
+_local = threading.local() # the thread's _VersionWatchers, by database path
+
+
+def _get_resolved_db_path():
+    path = get_data_path(DB_PATH_FOR_CODE)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+class _VersionWatcher:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.conn = None
+        self.data_version = None
+        self.versions = None
+
+    def read(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.db_path)
+        data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        if self.versions is None or data_version != self.data_version:
+            self.versions = dict(self.conn.execute("SELECT name, version FROM data_versions").fetchall())
+            self.data_version = data_version
+        return dict(self.versions)
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+        self.conn = None
+        self.versions = None
+
+
+def read_data_versions(db_path):
+    """{name: version} for the data_versions counters of db_path, or None on a database error."""
+    watchers = getattr(_local, 'watchers', None)
+    if watchers is None:
+        watchers = _local.watchers = {}
+    watcher = watchers.get(db_path)
+    if watcher is None:
+        watcher = watchers[db_path] = _VersionWatcher(db_path)
+    try:
+        return watcher.read()
+    except sqlite3.Error as e:
+        print(f"Database error reading the data versions of {db_path}: {e}")
+        watcher.close() # reconnect next time (e.g. the file was replaced)
+        del watchers[db_path]
+        return None
+
+
+def close_watchers():
+    """Closes this thread's connections (e.g. before deleting a temp database)."""
+    for watcher in getattr(_local, 'watchers', {}).values():
+        watcher.close()
+    _local.watchers = {}
+
+
+def get_data_versions_db():
+    """{name: version} for the data_versions counters, or None on a database error."""
+    return read_data_versions(_get_resolved_db_path())
+
+
+class ChangeBus:
+    """Calls subscribers when the data they show changed. poll() runs on the caller's thread
+    (the Tk main loop in the desktop app), so subscribers can update widgets directly."""
+
+    def __init__(self, versions_func):
+        self.versions_func = versions_func
+        self._versions = None # counters at the previous poll
+        self._subscribers = [] # (names, callback), called in subscription order
+
+    def subscribe(self, names, callback):
+        self._subscribers.append((frozenset(names), callback))
+
+    def poll(self):
+        """Calls the subscribers of the counters that moved since the previous poll and returns
+        their names. The first poll only records the counters."""
+        return self.apply_versions(self.versions_func())
+
+    def apply_versions(self, versions):
+        """poll() with counters read elsewhere, e.g. on a worker thread when reading them means a
+        network round trip; call it on the subscribers' thread."""
+        if versions is None: # could not read them; try again next poll
+            return set()
+        if self._versions is None:
+            self._versions = versions
+            return set()
+        changed = {name for name in versions.keys() | self._versions.keys()
+                   if versions.get(name) != self._versions.get(name)}
+        self._versions = versions
+        for names, callback in list(self._subscribers):
+            if names & changed:
+                try:
+                    callback()
+                except Exception as e: # one failing view must not keep the others stale
+                    print(f"Error refreshing {getattr(callback, '__name__', callback)} after a data change: {e}")
+        return changed
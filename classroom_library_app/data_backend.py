@@ -0,0 +1,452 @@
+"""
+Where the desktop app reads and writes its data: the local SQLite file or a central server.
+
+main.py calls `backend.<operation>(...)` instead of book_manager/student_manager directly.
+Operations keep the manager names, arguments and return values (lists of dicts, ids, True/False,
+[] or None on failure), so the UI code is the same in both modes.
+
+- LocalBackend delegates to the manager modules (the default).
+- HttpBackend talks to api_server.py. GET answers are kept with their ETag and revalidated with
+  If-None-Match, so an unchanged catalogue or student list costs a 304 instead of the rows.
+  batch() sends many small calls in one POST /api/batch, and fetch_all() runs the independent
+  reads of a tab refresh concurrently over several keep-alive connections.
+
+Set BIBLIO_SERVER_URL (e.g. http://biblioteca.local:8765) to start the app against a server.
+"""
+import http.client
+import json
+import os
+import re
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urlencode, urlsplit
+
+import auth_manager
+import book_manager
+import change_bus
+import points_manager
+import student_manager
+
+SERVER_URL_ENV = "BIBLIO_SERVER_URL"
+HTTP_TIMEOUT_SECONDS = 30
+FETCH_WORKERS = 4
+BATCH_CHUNK = 500 # calls per POST /api/batch (the server accepts up to api_server.MAX_BATCH_REQUESTS)
+ETAG_CACHE_ENTRIES = 64
+REMOTE_ONLY_ERROR = "No disponible con la base de datos en el servidor."
+
+# Operation name -> module that implements it locally.
+OPERATIONS = {
+    'add_book_db': book_manager, 'get_all_books_db': book_manager, 'get_book_by_id_db': book_manager,
+    'search_books_db': book_manager, 'get_available_book_count': book_manager, 'loan_book_db': book_manager,
+    'return_book_db': book_manager, 'loan_books_bulk_db': book_manager, 'return_books_bulk_db': book_manager,
+    'get_current_loans_db': book_manager, 'get_books_due_soon_db': book_manager, 'get_classroom_reminders_db': book_manager,
+    'extend_loan_db': book_manager, 'get_most_read_books_db': book_manager, 'get_new_releases_db': book_manager,
+    'get_recommendations_db': book_manager, 'import_books_from_csv_db': book_manager,
+    'add_student_db': student_manager, 'get_student_by_id_db': student_manager, 'get_students_db': student_manager,
+    'get_students_by_classroom_db': student_manager, 'delete_student_db': student_manager,
+    'update_student_password_db': student_manager, 'update_student_details_db': student_manager,
+    'get_leaderboard_db': student_manager, 'get_student_rank_db': student_manager,
+    'get_distinct_classrooms': student_manager, 'rename_classroom': student_manager,
+    'import_students_from_csv': student_manager,
+    'get_student_points_in_period_db': points_manager, 'get_period_leaderboard_db': points_manager,
+    'get_data_versions_db': change_bus,
+}
+
+
+def student_has_password(student):
+    """Whether a student record (local or from the API, which leaves the hash out) has a password."""
+    if 'has_password' in student:
+        return bool(student['has_password'])
+    return bool(student.get('hashed_password'))
+
+
+# Bulk loan/return errors about a single item start "Préstamo <n>:" / "Devolución <n>:"
+# (book_manager.loan_books_bulk_db and return_books_bulk_db, 1-based positions).
+_BULK_ITEM_ERROR_RE = re.compile(r"^(?:Préstamo|Devolución) (\d+):")
+
+
+def bulk_items_not_attempted(items, results, errors):
+    """The items of a loan_books_bulk_db / return_books_bulk_db call that are neither registered
+    nor refused one by one: what a call that failed as a whole (database error, write lock still
+    busy after the retries, server unreachable, not a leader) left to try again."""
+    refused = {int(match.group(1)) - 1 for match in map(_BULK_ITEM_ERROR_RE.match, errors) if match}
+    return [item for position, (item, result) in enumerate(zip(items, results))
+            if result is None and position not in refused]
+
+
+class LibraryBackend:
+    """Common part of the backends: the session calls and the multi-call helpers.
+    calls are (operation name, args tuple, kwargs dict)."""
+
+    def login(self, username, password):
+        return auth_manager.login(username, password)
+
+    def logout(self):
+        auth_manager.logout()
+
+    def get_current_user_id(self):
+        return auth_manager.get_current_user_id()
+
+    def is_admin(self):
+        return auth_manager.is_admin()
+
+    def batch(self, calls):
+        """Runs the calls and returns their results in order."""
+        return [getattr(self, name)(*args, **kwargs) for name, args, kwargs in calls]
+
+    def fetch_all(self, calls):
+        """{key: call} -> {key: result}, for the independent reads of one refresh."""
+        return {key: getattr(self, name)(*args, **kwargs) for key, (name, args, kwargs) in calls.items()}
+
+
+def _local_operation(module, name):
+    def operation(self, *args, **kwargs):
+        return getattr(module, name)(*args, **kwargs)
+    operation.__name__ = name
+    operation.__doc__ = f"{module.__name__}.{name}"
+    return operation
+
+
+class LocalBackend(LibraryBackend):
+    """Reads and writes the local database through the manager modules."""
+    is_remote = False
+
+
+for _name, _module in OPERATIONS.items():
+    setattr(LocalBackend, _name, _local_operation(_module, _name))
+
+
+# One HTTP call: the request plus how to turn its JSON answer into the manager-style result,
+# and the result to return when it fails (what the manager returns on a database error).
+_Call = namedtuple("_Call", "method path body convert default")
+
+
+def _remote(func):
+    """Marks an HttpBackend method whose body builds a _Call; calling it sends the call."""
+    def method(self, *args, **kwargs):
+        return self._execute(func(self, *args, **kwargs))
+    method.__name__ = func.__name__
+    method.build = func
+    return method
+
+
+def _path(path, **params):
+    query = urlencode({key: value for key, value in params.items() if value is not None})
+    return f"{path}?{query}" if query else path
+
+
+def _ok(payload):
+    return bool(payload and payload.get('ok'))
+
+
+def _identity(payload):
+    return payload
+
+
+class HttpBackend(LibraryBackend):
+    """Reads and writes through the JSON API of a central server (api_server.py)."""
+    is_remote = True
+
+    def __init__(self, base_url, timeout=HTTP_TIMEOUT_SECONDS, workers=FETCH_WORKERS):
+        url = urlsplit(base_url)
+        self.host, self.port = url.hostname, url.port or (443 if url.scheme == "https" else 80)
+        self.https = url.scheme == "https"
+        self.timeout = timeout
+        self.token = None
+        self.user = None
+        self._local = threading.local() # one keep-alive connection per thread
+        self._etags = OrderedDict() # GET path -> (etag, body bytes), least recently used first
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="biblio-fetch")
+        self.stats = {'requests': 0, 'not_modified': 0, 'batched_calls': 0, 'errors': 0}
+
+    # --- Transport ---
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            factory = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            conn = self._local.conn = factory(self.host, self.port, timeout=self.timeout)
+        return conn
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self.stats[key] += n
+
+    def _request(self, method, path, body=None, cache=True):
+        """Sends one request; returns (status, payload), or (0, None) if the server can't be reached.
+        cache=False keeps a GET answer out of the ETag cache (answers that are never asked for twice)."""
+        headers = {"Accept": "application/json"}
+        if self.token:
+            headers["Authorization"] = f"Bearer {self.token}"
+        cached = None
+        if method == "GET" and cache:
+            with self._lock:
+                cached = self._etags.get(path)
+            if cached:
+                headers["If-None-Match"] = cached[0]
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        self._count('requests')
+        attempts = 2 if method == "GET" else 1 # a kept-alive connection the server closed fails once; only reads are resent
+        for attempt in range(attempts):
+            conn = self._connection()
+            try:
+                conn.request(method, path, body=data, headers=headers)
+                response = conn.getresponse()
+                raw = response.read()
+                break
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                self._local.conn = None
+                if attempt == attempts - 1:
+                    print(f"Error de conexión con el servidor ({method} {path}): {e}")
+                    self._count('errors')
+                    return 0, None
+        if response.status == 304 and cached:
+            self._count('not_modified')
+            with self._lock:
+                self._etags.move_to_end(path)
+            raw = cached[1]
+            status = 200
+        else:
+            status = response.status
+            etag = response.getheader("ETag")
+            if method == "GET" and cache and status == 200 and etag:
+                with self._lock:
+                    self._etags[path] = (etag, raw)
+                    self._etags.move_to_end(path)
+                    while len(self._etags) > ETAG_CACHE_ENTRIES:
+                        self._etags.popitem(last=False)
+        try:
+            return status, json.loads(raw) if raw else None
+        except ValueError:
+            print(f"Respuesta no válida del servidor ({method} {path}).")
+            return 0, None
+
+    def _result(self, call, status, payload):
+        if 200 <= status < 300:
+            return call.convert(payload)
+        if status:
+            error = payload.get('error') if isinstance(payload, dict) else payload
+            print(f"Server error {status} on {call.method} {call.path}: {error}")
+            self._count('errors')
+        return call.default
+
+    def _execute(self, call):
+        status, payload = self._request(call.method, call.path, call.body)
+        return self._result(call, status, payload)
+
+    def _build(self, name, args, kwargs):
+        return getattr(type(self), name).build(self, *args, **kwargs)
+
+    def batch(self, calls):
+        """Sends the calls in POST /api/batch requests of up to BATCH_CHUNK calls each."""
+        built = [self._build(name, args, kwargs) for name, args, kwargs in calls]
+        results = []
+        for first in range(0, len(built), BATCH_CHUNK):
+            chunk = built[first:first + BATCH_CHUNK]
+            status, payload = self._request("POST", "/api/batch", {'requests': [
+                {'method': call.method, 'path': call.path, 'body': call.body} for call in chunk]})
+            self._count('batched_calls', len(chunk))
+            if status != 200:
+                self._result(_Call("POST", "/api/batch", None, _identity, None), status, payload)
+                results.extend(call.default for call in chunk)
+                continue
+            for call, response in zip(chunk, payload['responses']):
+                results.append(self._result(call, response['status'], response['body']))
+        return results
+
+    def fetch_all(self, calls):
+        """Runs the calls concurrently (one keep-alive connection per worker thread)."""
+        futures = {key: self._executor.submit(getattr(self, name), *args, **kwargs)
+                   for key, (name, args, kwargs) in calls.items()}
+        return {key: future.result() for key, future in futures.items()}
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    # --- Session ---
+
+    def login(self, username, password):
+        status, payload = self._request("POST", "/api/login", {'username': username, 'password': password})
+        if status != 200:
+            return False
+        self.token, self.user = payload['token'], payload['user']
+        return True
+
+    def logout(self):
+        if self.token:
+            self._request("POST", "/api/logout", {})
+        self.token = self.user = None
+        with self._lock:
+            self._etags.clear()
+
+    def get_current_user_id(self):
+        return self.user['id'] if self.user else None
+
+    def is_admin(self):
+        return bool(self.user) and self.user['role'] == 'admin'
+
+    # --- Books and loans ---
+
+    @_remote
+    def add_book_db(self, titulo, autor, ubicacion, genero=None, cantidad_total=1):
+        return _Call("POST", "/api/books", {'titulo': titulo, 'autor': autor, 'ubicacion': ubicacion,
+                                            'genero': genero, 'cantidad_total': cantidad_total},
+                     lambda book: book['id'], None)
+
+    @_remote
+    def get_all_books_db(self, ubicacion_filter=None):
+        return _Call("GET", _path("/api/books", ubicacion=ubicacion_filter), None, _identity, [])
+
+    @_remote
+    def get_book_by_id_db(self, book_id):
+        return _Call("GET", f"/api/books/{quote(book_id, safe='')}", None, _identity, None)
+
+    @_remote
+    def search_books_db(self, query, search_field="titulo"):
+        return _Call("GET", _path("/api/books", q=query, field=search_field), None, _identity, [])
+
+    @_remote
+    def get_available_book_count(self, book_id):
+        return _Call("GET", f"/api/books/{quote(book_id, safe='')}/available", None,
+                     lambda payload: payload['available'], 0)
+
+    @_remote
+    def loan_book_db(self, book_id, student_id, due_date_str, lending_student_leader_id):
+        return _Call("POST", "/api/loans", {'book_id': book_id, 'student_id': student_id, 'due_date': due_date_str,
+                                            'leader_id': lending_student_leader_id}, _ok, False)
+
+    @_remote
+    def return_book_db(self, loan_id, student_leader_id, worksheet_submitted=False):
+        return _Call("POST", f"/api/loans/{quote(loan_id, safe='')}/return",
+                     {'leader_id': student_leader_id, 'worksheet_submitted': worksheet_submitted}, _ok, False)
+
+    @_remote
+    def loan_books_bulk_db(self, loans, lending_student_leader_id):
+        return _Call("POST", "/api/loans/bulk", {'loans': loans, 'leader_id': lending_student_leader_id},
+                     lambda payload: (payload['loan_ids'], payload['errors']),
+                     ([None] * len(loans), ["No se pudo contactar con el servidor."]))
+
+    @_remote
+    def return_books_bulk_db(self, returns, student_leader_id):
+        return _Call("POST", "/api/loans/bulk-return", {'returns': returns, 'leader_id': student_leader_id},
+                     lambda payload: (payload['points'], payload['errors']),
+                     ([None] * len(returns), ["No se pudo contactar con el servidor."]))
+
+    @_remote
+    def get_current_loans_db(self, student_id_filter=None, ubicacion_filter=None, classroom_filter=None):
+        return _Call("GET", _path("/api/loans", student_id=student_id_filter, ubicacion=ubicacion_filter,
+                                  classroom=classroom_filter), None, _identity, [])
+
+    @_remote
+    def get_books_due_soon_db(self, days_threshold=7, ubicacion_filter=None, classroom_filter=None):
+        return _Call("GET", _path("/api/loans/due-soon", days=days_threshold, ubicacion=ubicacion_filter,
+                                  classroom=classroom_filter), None, _identity, [])
+
+    @_remote
+    def get_classroom_reminders_db(self, classroom):
+        return _Call("GET", _path("/api/loans/reminders", classroom=classroom), None, _identity, [])
+
+    @_remote
+    def extend_loan_db(self, loan_id, days_to_extend=14):
+        return _Call("POST", f"/api/loans/{quote(loan_id, safe='')}/extend", {'days': days_to_extend}, _ok, False)
+
+    @_remote
+    def get_most_read_books_db(self, limit=10):
+        return _Call("GET", _path("/api/books/most-read", limit=limit), None, _identity, [])
+
+    @_remote
+    def get_new_releases_db(self, limit=10):
+        return _Call("GET", _path("/api/books/new", limit=limit), None, _identity, [])
+
+    @_remote
+    def get_recommendations_db(self, limit=10):
+        return _Call("GET", _path("/api/books/recommended", limit=limit), None, _identity, [])
+
+    def import_books_from_csv_db(self, file_path):
+        return 0, [REMOTE_ONLY_ERROR]
+
+    # --- Students and rankings ---
+
+    @_remote
+    def add_student_db(self, name, classroom, password, role='student'):
+        return _Call("POST", "/api/students", {'name': name, 'classroom': classroom, 'password': password, 'role': role},
+                     lambda student: student['id'], None)
+
+    @_remote
+    def get_student_by_id_db(self, student_id):
+        return _Call("GET", f"/api/students/{quote(student_id, safe='')}", None, _identity, None)
+
+    @_remote
+    def get_students_db(self, classroom_filter=None, role_filter=None):
+        return _Call("GET", _path("/api/students", classroom=classroom_filter, role=role_filter), None, _identity, [])
+
+    @_remote
+    def get_students_by_classroom_db(self, classroom):
+        return HttpBackend.get_students_db.build(self, classroom)
+
+    @_remote
+    def delete_student_db(self, student_id):
+        return _Call("DELETE", f"/api/students/{quote(student_id, safe='')}", None, _ok, False)
+
+    @_remote
+    def update_student_password_db(self, student_id, new_password):
+        return _Call("POST", f"/api/students/{quote(student_id, safe='')}/password", {'password': new_password},
+                     _ok, False)
+
+    @_remote
+    def update_student_details_db(self, student_id, name, classroom, role):
+        return _Call("POST", f"/api/students/{quote(student_id, safe='')}",
+                     {'name': name, 'classroom': classroom, 'role': role}, _ok, False)
+
+    @_remote
+    def get_leaderboard_db(self, classroom_filter=None, limit=None, offset=0):
+        return _Call("GET", _path("/api/leaderboard", classroom=classroom_filter,
+                                  limit=-1 if limit is None else limit, offset=offset), None, _identity, [])
+
+    @_remote
+    def get_student_rank_db(self, student_id, neighbors=2, scope="global"):
+        return _Call("GET", _path(f"/api/students/{quote(student_id, safe='')}/rank", neighbors=neighbors, scope=scope),
+                     None, _identity, None)
+
+    @_remote
+    def get_distinct_classrooms(self):
+        return _Call("GET", "/api/classrooms", None, _identity, [])
+
+    @_remote
+    def rename_classroom(self, old_classroom_name, new_classroom_name):
+        return _Call("POST", "/api/classrooms/rename", {'old_name': old_classroom_name, 'new_name': new_classroom_name},
+                     _ok, False)
+
+    def import_students_from_csv(self, file_path, classroom_name):
+        return 0, [REMOTE_ONLY_ERROR]
+
+    @_remote
+    def get_student_points_in_period_db(self, student_id, start, end):
+        return _Call("GET", _path(f"/api/students/{quote(student_id, safe='')}/points", start=start, end=end),
+                     None, lambda payload: payload['points'], 0)
+
+    @_remote
+    def get_period_leaderboard_db(self, start, end, classroom_filter=None, limit=None, offset=0):
+        return _Call("GET", _path("/api/leaderboard", start=start, end=end, classroom=classroom_filter,
+                                  limit=-1 if limit is None else limit, offset=offset), None, _identity, [])
+
+    @_remote
+    def get_data_versions_db(self):
+        return _Call("GET", "/api/data-versions", None, _identity, None)
+
+
+def create_from_env():
+    """HttpBackend for BIBLIO_SERVER_URL if it is set; else the offline replica syncing with
+    BIBLIO_SYNC_URL if that is set (sync_manager.OfflineBackend); else LocalBackend."""
+    url = os.environ.get(SERVER_URL_ENV, "").strip()
+    if url:
+        print(f"Usando el servidor de la biblioteca en {url}")
+        return HttpBackend(url)
+    import sync_manager # imports this module
+    return sync_manager.create_offline_backend_from_env() or LocalBackend()
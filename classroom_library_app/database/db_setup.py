@@ -24,15 +24,162 @@ def _local_hash_password(password_str):
     )
     return salt_bytes.hex(), hashed_password_bytes.hex()
 
-def init_db():
-    """Initializes the database and creates the books table if it doesn't exist."""
+# Tables whose row changes are recorded in change_log for incremental backups, with their key column.
+# The points rollups are not tracked: they are rebuilt from points_ledger after a replay.
+CHANGE_TRACKED_TABLES = {"classrooms": "id", "books": "id", "students": "id", "loans": "loan_id",
+                         "points_ledger": "entry_id", "loan_history": "history_id"}
+
+# Tables replicated to the classroom laptops by sync_manager, with their key column, in the
+# order their rows are applied (classrooms before the books and students that reference them,
+# and those before their loans).
+SYNC_TABLES = {"classrooms": "id", "books": "id", "students": "id", "loans": "loan_id"}
+
+# Change counters the desktop app refreshes its views from (change_bus), bumped by triggers in
+# the writing transaction. "roster" moves only when students are added or removed or change
+# name, classroom, role or password; "students" moves on every write (points included).
+# Renaming a classroom moves the counters of everything that shows its name.
+# Each entry lists (table, columns whose updates count, or None for any column).
+DATA_VERSIONS = {
+    "books": [("books", None), ("classrooms", None)],
+    "loans": [("loans", None)],
+    "loan_history": [("loan_history", None)],
+    "students": [("students", None), ("classrooms", None)],
+    "roster": [("students", "name, classroom_id, role, hashed_password"), ("classrooms", None)],
+}
+
+# Classrooms and book locations are rows of the classrooms table: students.classroom_id and
+# books.location_id point at it, and reads join it for the names (as "classroom" and
+# "ubicacion"), so renaming a classroom only updates its classrooms row.
+LIBRARY_LOCATION = "Biblioteca" # always a valid book location, never pruned
+# Filter on a classroom or location given by name: one lookup in the classrooms name index.
+CLASSROOM_ID_BY_NAME = "(SELECT id FROM classrooms WHERE name = ?)"
+# Classroom filter values the UI and the API use for "every classroom" (compared in lower case).
+GLOBAL_FILTER_VALUES = ("global", "🏆 global", "all", "todas")
+
+def is_global_filter(classroom_filter):
+    """True if classroom_filter selects no classroom in particular (empty, or one of GLOBAL_FILTER_VALUES)."""
+    return not classroom_filter or classroom_filter.lower() in GLOBAL_FILTER_VALUES
+
+def get_classroom_id(cursor, name):
+    """The id of the classroom (or book location) called name, added if it is new.
+    None for an empty name."""
+    if not name:
+        return None
+    cursor.execute("INSERT OR IGNORE INTO classrooms (name) VALUES (?)", (name,))
+    cursor.execute("SELECT id FROM classrooms WHERE name = ?", (name,))
+    return cursor.fetchone()[0]
+
+def prune_classroom(cursor, classroom_id):
+    """Drops the classroom if no student or book uses it any more."""
+    cursor.execute("""
+        DELETE FROM classrooms
+        WHERE id = ? AND name != ?
+          AND NOT EXISTS (SELECT 1 FROM students WHERE classroom_id = classrooms.id)
+          AND NOT EXISTS (SELECT 1 FROM books WHERE location_id = classrooms.id)
+    """, (classroom_id, LIBRARY_LOCATION))
+
+def _migrate_classroom_names(cursor):
+    """Databases from before the classrooms table kept the names in students.classroom and
+    books.ubicacion: moves them to classrooms and drops the two columns. The triggers, indexes
+    and reminder snapshot that read them are dropped first; init_db creates the current ones
+    afterwards. Returns True if the database needed it."""
+    cursor.execute("PRAGMA table_info(students)")
+    if not any(column[1] == 'classroom' for column in cursor.fetchall()):
+        return False
+    for table, name_column, id_column in (("students", "classroom", "classroom_id"),
+                                          ("books", "ubicacion", "location_id")):
+        cursor.execute(f"PRAGMA table_info({table})")
+        if not any(column[1] == id_column for column in cursor.fetchall()):
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {id_column} INTEGER REFERENCES classrooms(id)")
+        cursor.execute(f"""
+            INSERT OR IGNORE INTO classrooms (name)
+            SELECT DISTINCT {name_column} FROM {table} WHERE {name_column} != ''
+        """)
+        # Through the sync_log triggers, this also sends every row again to the laptops.
+        cursor.execute(f"UPDATE {table} SET {id_column} = (SELECT id FROM classrooms WHERE name = {table}.{name_column})")
+    cursor.execute("""
+        SELECT type, name FROM sqlite_master
+        WHERE (type = 'trigger' AND (name GLOB 'data_version_*' OR name GLOB 'loan_reminders_*' OR name GLOB 'classrooms_*'))
+           OR (type = 'index' AND name IN ('idx_books_ubicacion', 'idx_students_classroom', 'idx_students_classroom_id',
+                                           'idx_students_classroom_points', 'idx_students_points'))
+    """)
+    for object_type, name in cursor.fetchall():
+        cursor.execute(f"DROP {object_type.upper()} {name}")
+    cursor.execute("DROP TABLE IF EXISTS loan_reminders")
+    cursor.execute("DROP TABLE IF EXISTS reminder_state")
+    cursor.execute("ALTER TABLE students DROP COLUMN classroom")
+    cursor.execute("ALTER TABLE books DROP COLUMN ubicacion")
+    # Segments with the new columns cannot be replayed onto an older full backup: start a new chain.
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name IN ('change_log', 'backup_state')")
+    for (table,) in cursor.fetchall():
+        cursor.execute(f"DELETE FROM {table}")
+    print("Classroom names moved to the 'classrooms' table.")
+    return True
+
+def seed_sync_log(cursor):
+    """Adds a sync_log entry for every replicated row that has none yet (rows written
+    before the sync triggers existed, or bulk-loaded with the triggers dropped)."""
+    for table, key in SYNC_TABLES.items():
+        # idx_sync_log_row makes rows that already have an entry no-ops
+        cursor.execute(f"INSERT OR IGNORE INTO sync_log (table_name, row_key) SELECT '{table}', {key} FROM {table}")
+
+def bump_data_versions(cursor, floors=None):
+    """Moves every data version forward, past floors[name] if given, for writes the triggers
+    did not see: a bulk load with the triggers dropped, or a restored copy of the database."""
+    floors = floors or {}
+    for name in DATA_VERSIONS:
+        cursor.execute("UPDATE data_versions SET version = MAX(version, ?) + 1 WHERE name = ?",
+                       (floors.get(name, 0), name))
+
+# The loan_reminders row of a loan, for the day and window in reminder_state: urgency 0 is
+# overdue, 1 due within the window. Loans due later (or of unknown students) have no row.
+LOAN_REMINDER_SELECT = """
+    SELECT l.loan_id, s.classroom_id, CASE WHEN l.due_date < day.value THEN 0 ELSE 1 END, l.due_date
+    FROM loans l
+    JOIN students s ON s.id = l.student_id
+    JOIN reminder_state day ON day.key = 'snapshot_date'
+    JOIN reminder_state until ON until.key = 'due_until'
+    WHERE l.due_date <= until.value
+"""
+
+def rebuild_loan_reminders(cursor, snapshot_date, due_until):
+    """Recomputes the reminder snapshot for snapshot_date: loans overdue on that day or due
+    on or before due_until (both 'YYYY-MM-DD'). The triggers keep it current until the next day."""
+    cursor.execute("DELETE FROM reminder_state")
+    cursor.executemany("INSERT INTO reminder_state (key, value) VALUES (?, ?)",
+                       [('snapshot_date', snapshot_date), ('due_until', due_until)])
+    cursor.execute("DELETE FROM loan_reminders")
+    cursor.execute(f"INSERT INTO loan_reminders (loan_id, classroom_id, urgency, due_date) {LOAN_REMINDER_SELECT}")
+
+def rebuild_points_rollups(cursor):
+    """Recomputes the per-day and per-week points rollups from points_ledger.
+    Opening balances are left out: they were not earned in any period."""
+    cursor.execute("DELETE FROM points_daily")
+    cursor.execute("DELETE FROM points_weekly")
+    cursor.execute("""
+        INSERT INTO points_daily (day, student_id, points)
+        SELECT substr(created_at, 1, 10), student_id, SUM(delta) FROM points_ledger
+        WHERE reason != 'opening_balance'
+        GROUP BY substr(created_at, 1, 10), student_id
+    """)
+    # date(day, 'weekday 0', '-6 days') is the Monday of the day's week
+    cursor.execute("""
+        INSERT INTO points_weekly (week_start, student_id, points)
+        SELECT date(day, 'weekday 0', '-6 days'), student_id, SUM(points) FROM points_daily
+        GROUP BY date(day, 'weekday 0', '-6 days'), student_id
+    """)
+
+def init_db(db_path=None):
+    """Initializes the database and creates the books table if it doesn't exist.
+    db_path overrides the app database location (e.g. for generated test databases)."""
+    conn = None
     try:
         # get_data_path will handle making this correct for dev vs bundle
         # DB_PATH_FOR_CODE is "database/library.db"
         # get_data_path("database/library.db") will give:
         # DEV: classroom_library_app/database/library.db
         # BUNDLE: MEIPASS/database/library.db
-        actual_db_path = get_data_path(DB_PATH_FOR_CODE)
+        actual_db_path = db_path or get_data_path(DB_PATH_FOR_CODE)
 
         print("\n--- IMPORTANT ---")
         print("If you've run this application before with an older database structure,")
@@ -47,13 +194,22 @@ def init_db():
         conn = sqlite3.connect(actual_db_path)
         cursor = conn.cursor()
 
+        # Classrooms and book locations (see get_classroom_id).
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS classrooms (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL UNIQUE
+            )
+        """)
+        cursor.execute("INSERT OR IGNORE INTO classrooms (name) VALUES (?)", (LIBRARY_LOCATION,))
+
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS books (
                 id TEXT PRIMARY KEY,
                 titulo TEXT NOT NULL,
                 autor TEXT NOT NULL,
                 genero TEXT,
-                ubicacion TEXT NOT NULL,
+                location_id INTEGER REFERENCES classrooms(id),
                 cantidad_total INTEGER NOT NULL DEFAULT 1
             )
         """)
@@ -76,7 +232,7 @@ def init_db():
             CREATE TABLE IF NOT EXISTS students (
                 id TEXT PRIMARY KEY,
                 name TEXT NOT NULL,
-                classroom TEXT NOT NULL,
+                classroom_id INTEGER REFERENCES classrooms(id),
                 role TEXT NOT NULL DEFAULT 'student' CHECK(role IN ('student', 'leader', 'admin')),
                 hashed_password TEXT,
                 salt TEXT
@@ -130,6 +286,277 @@ def init_db():
             else:
                 raise
 
+        classrooms_migrated = _migrate_classroom_names(cursor)
+        conn.commit()
+
+        # Points ledger: one row per points change; students.points caches the running total.
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS points_ledger (
+                entry_id INTEGER PRIMARY KEY,
+                student_id TEXT NOT NULL,
+                delta INTEGER NOT NULL,
+                reason TEXT NOT NULL,
+                loan_id TEXT,
+                created_at TEXT NOT NULL,
+                FOREIGN KEY (student_id) REFERENCES students(id)
+            )
+        """)
+        # Append-only: corrections are new 'adjustment' entries, never edits.
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS points_ledger_no_update BEFORE UPDATE ON points_ledger
+            BEGIN SELECT RAISE(ABORT, 'points_ledger is append-only'); END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS points_ledger_no_delete BEFORE DELETE ON points_ledger
+            BEGIN SELECT RAISE(ABORT, 'points_ledger is append-only'); END
+        """)
+        # Totals earned before the ledger existed become one opening-balance entry per student,
+        # so the ledger always sums to students.points.
+        cursor.execute("""
+            INSERT INTO points_ledger (student_id, delta, reason, created_at)
+            SELECT id, points, 'opening_balance', strftime('%Y-%m-%d %H:%M:%S', 'now', 'localtime')
+            FROM students
+            WHERE points != 0 AND NOT EXISTS (SELECT 1 FROM points_ledger pl WHERE pl.student_id = students.id)
+        """)
+        if cursor.rowcount > 0:
+            print(f"Opening balances recorded in 'points_ledger' for {cursor.rowcount} students.")
+        conn.commit()
+
+        # Points rollups for the week/month/term leaderboards, kept up to date by
+        # points_manager.record_points. The primary key doubles as the range index.
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS points_daily (
+                day TEXT NOT NULL,
+                student_id TEXT NOT NULL,
+                points INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, student_id)
+            ) WITHOUT ROWID
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS points_weekly (
+                week_start TEXT NOT NULL,
+                student_id TEXT NOT NULL,
+                points INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (week_start, student_id)
+            ) WITHOUT ROWID
+        """)
+        # Ledgers that predate the rollups get them filled in once.
+        cursor.execute("""
+            SELECT EXISTS (SELECT 1 FROM points_ledger WHERE reason != 'opening_balance')
+               AND NOT EXISTS (SELECT 1 FROM points_daily)
+        """)
+        if cursor.fetchone()[0]:
+            rebuild_points_rollups(cursor)
+            print("Points rollups ('points_daily', 'points_weekly') built from 'points_ledger'.")
+        conn.commit()
+
+        # Returned loans (loans only holds the open ones), including loan history migrated
+        # from the legacy HTML app, whose records do not always have a return date.
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS loan_history (
+                history_id INTEGER PRIMARY KEY,
+                loan_id TEXT,
+                book_id TEXT NOT NULL,
+                student_id TEXT NOT NULL,
+                loan_date TEXT NOT NULL,
+                due_date TEXT NOT NULL,
+                return_date TEXT,
+                FOREIGN KEY (book_id) REFERENCES books(id),
+                FOREIGN KEY (student_id) REFERENCES students(id)
+            )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_loan_history_book ON loan_history (book_id, student_id, loan_date)")
+        # Legacy history rows (no loan_id) are unique on their content: legacy_import inserts them
+        # with INSERT OR IGNORE, so a repeated migration skips them without reading the table first.
+        cursor.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_loan_history_legacy
+            ON loan_history (book_id, student_id, loan_date, IFNULL(return_date, '')) WHERE loan_id IS NULL
+        """)
+        # Legacy ids (e.g. Bibliov0.4.html book ids) and the rows they were imported as,
+        # so repeated or split migrations resolve references and skip what is already in.
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS legacy_id_map (
+                kind TEXT NOT NULL,
+                legacy_id TEXT NOT NULL,
+                new_id TEXT NOT NULL,
+                PRIMARY KEY (kind, legacy_id)
+            ) WITHOUT ROWID
+        """)
+        conn.commit()
+
+        # Change capture for incremental backups (backup_manager): triggers note which rows were
+        # written ('U') or deleted ('D') since the last backup; the rows themselves are read when
+        # the incremental backup is made, so repeated edits of a row are stored once.
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS change_log (
+                change_id INTEGER PRIMARY KEY AUTOINCREMENT, -- never reused, even after the log is emptied
+                table_name TEXT NOT NULL,
+                row_key NOT NULL, -- no declared type: keeps the key's own type (TEXT ids, INTEGER loan ids)
+                op TEXT NOT NULL CHECK(op IN ('U', 'D'))
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS backup_state (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        """)
+        for table, key in CHANGE_TRACKED_TABLES.items():
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS change_log_{table}_insert AFTER INSERT ON {table}
+                BEGIN INSERT INTO change_log (table_name, row_key, op) VALUES ('{table}', NEW.{key}, 'U'); END
+            """)
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS change_log_{table}_update AFTER UPDATE ON {table}
+                BEGIN
+                    INSERT INTO change_log (table_name, row_key, op) SELECT '{table}', OLD.{key}, 'D' WHERE OLD.{key} IS NOT NEW.{key};
+                    INSERT INTO change_log (table_name, row_key, op) VALUES ('{table}', NEW.{key}, 'U');
+                END
+            """)
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS change_log_{table}_delete AFTER DELETE ON {table}
+                BEGIN INSERT INTO change_log (table_name, row_key, op) VALUES ('{table}', OLD.{key}, 'D'); END
+            """)
+        conn.commit()
+
+        # Replication to classroom laptops (sync_manager). sync_log holds one entry per row of the
+        # SYNC_TABLES, moved to a new seq on every write: a laptop pulls the rows whose seq is
+        # above its cursor, reading their current values (a missing row means it was deleted).
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sync_log'")
+        sync_log_is_new = cursor.fetchone() is None
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS sync_log (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                table_name TEXT NOT NULL,
+                row_key NOT NULL
+            )
+        """)
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_sync_log_row ON sync_log (table_name, row_key)")
+        for table, key in SYNC_TABLES.items():
+            for event, row in (("insert", "NEW"), ("update", "NEW"), ("delete", "OLD")):
+                # DELETE + INSERT rather than INSERT OR REPLACE: inside a trigger the conflict
+                # policy of the outer statement (an upsert, INSERT OR IGNORE) would override REPLACE.
+                keys = [f"{row}.{key}"]
+                if event == "update": # a changed key also moves the old key (to "deleted")
+                    keys.insert(0, f"OLD.{key}")
+                body = "".join(
+                    f"DELETE FROM sync_log WHERE table_name = '{table}' AND row_key = {k};"
+                    f"INSERT INTO sync_log (table_name, row_key) VALUES ('{table}', {k});" for k in keys)
+                cursor.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS sync_log_{table}_{event} AFTER {event.upper()} ON {table}
+                    BEGIN
+                        {body}
+                    END
+                """)
+        if sync_log_is_new or classrooms_migrated: # the classrooms rows were written without the triggers
+            seed_sync_log(cursor)
+        # Client side: operations made on this laptop and not yet sent, and the ones the server refused.
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS sync_outbox (
+                op_id TEXT PRIMARY KEY,
+                hlc TEXT NOT NULL, -- hybrid logical clock stamp, sortable as text
+                op TEXT NOT NULL CHECK(op IN ('loan', 'return', 'extend')),
+                payload TEXT NOT NULL -- JSON
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS sync_conflicts (
+                op_id TEXT PRIMARY KEY,
+                op TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                reason TEXT NOT NULL,
+                detected_at TEXT NOT NULL
+            )
+        """)
+        # Server side: every operation received, so a resent one gets the same answer.
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS sync_applied_ops (
+                op_id TEXT PRIMARY KEY,
+                node_id TEXT NOT NULL,
+                hlc TEXT NOT NULL,
+                status TEXT NOT NULL CHECK(status IN ('applied', 'rejected', 'duplicate')),
+                reason TEXT,
+                applied_at TEXT NOT NULL
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS sync_state (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        """)
+        conn.commit()
+
+        # Change counters for the views of the desktop app (see DATA_VERSIONS and change_bus).
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS data_versions (
+                name TEXT PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 0
+            ) WITHOUT ROWID
+        """)
+        cursor.executemany("INSERT OR IGNORE INTO data_versions (name) VALUES (?)",
+                           [(name,) for name in DATA_VERSIONS])
+        for name, sources in DATA_VERSIONS.items():
+            for table, columns in sources:
+                for event in ("insert", "update", "delete"):
+                    when = f"UPDATE OF {columns}" if event == "update" and columns else event.upper()
+                    cursor.execute(f"""
+                        CREATE TRIGGER IF NOT EXISTS data_version_{name}_{table}_{event} AFTER {when} ON {table}
+                        BEGIN UPDATE data_versions SET version = version + 1 WHERE name = '{name}'; END
+                    """)
+        conn.commit()
+
+        # Reminders for the leaders' panels: the loans overdue or due soon, per borrower classroom,
+        # so a panel is one index range. Rebuilt for each new day by book_manager; in between,
+        # the triggers add, move and drop the rows of loans as they are lent, extended and returned.
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS loan_reminders (
+                loan_id TEXT PRIMARY KEY,
+                classroom_id INTEGER, -- the borrower's
+                urgency INTEGER NOT NULL, -- 0 overdue, 1 due soon
+                due_date TEXT NOT NULL
+            ) WITHOUT ROWID
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_loan_reminders_classroom
+            ON loan_reminders (classroom_id, urgency, due_date)
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS reminder_state (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        """)
+        # DELETE + INSERT, as for sync_log: an outer upsert's conflict policy would override REPLACE.
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS loan_reminders_insert AFTER INSERT ON loans
+            BEGIN
+                DELETE FROM loan_reminders WHERE loan_id = NEW.loan_id;
+                INSERT INTO loan_reminders (loan_id, classroom_id, urgency, due_date)
+                {LOAN_REMINDER_SELECT} AND l.loan_id = NEW.loan_id;
+            END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS loan_reminders_update AFTER UPDATE OF loan_id, student_id, due_date ON loans
+            BEGIN
+                DELETE FROM loan_reminders WHERE loan_id IN (OLD.loan_id, NEW.loan_id);
+                INSERT INTO loan_reminders (loan_id, classroom_id, urgency, due_date)
+                {LOAN_REMINDER_SELECT} AND l.loan_id = NEW.loan_id;
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS loan_reminders_delete AFTER DELETE ON loans
+            BEGIN DELETE FROM loan_reminders WHERE loan_id = OLD.loan_id; END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS loan_reminders_student_classroom AFTER UPDATE OF classroom_id ON students
+            BEGIN
+                UPDATE loan_reminders SET classroom_id = NEW.classroom_id
+                WHERE loan_id IN (SELECT loan_id FROM loans WHERE student_id = NEW.id);
+            END
+        """)
+        conn.commit()
+
         # Check for and create the specific default admin user if it doesn't exist
         cursor.execute("SELECT id FROM students WHERE name = ? AND role = ?", ("admin", "admin"))
         existing_default_admin = cursor.fetchone()
@@ -145,9 +572,9 @@ def init_db():
 
             try:
                 cursor.execute("""
-                    INSERT INTO students (id, name, classroom, role, hashed_password, salt)
+                    INSERT INTO students (id, name, classroom_id, role, hashed_password, salt)
                     VALUES (?, ?, ?, 'admin', ?, ?)
-                """, (admin_id, admin_name, admin_classroom, hashed_password_hex, salt_hex))
+                """, (admin_id, admin_name, get_classroom_id(cursor, admin_classroom), hashed_password_hex, salt_hex))
                 conn.commit()
                 print(f"\nDefault admin user '{admin_name}' created.") # Added admin_name for clarity
                 print(f"  Username: {admin_name}")
@@ -160,14 +587,65 @@ def init_db():
 
         # Add Indexes
         print("Creating database indexes...")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_loans_book_id ON loans (book_id)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_loans_student_id ON loans (student_id)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_loans_due_date ON loans (due_date)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_books_ubicacion ON books (ubicacion)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_students_classroom ON students (classroom)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_books_location_id ON books (location_id)") # books of a location, renames
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_books_titulo ON books (titulo)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_books_autor ON books (autor)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_students_name ON students (name)") # login
+        # Case-insensitive title and name lookups (legacy_import matches what is already in the database).
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_books_titulo_nocase ON books (titulo COLLATE NOCASE)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_students_name_nocase ON students (name COLLATE NOCASE)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_students_role ON students (role)") # leader lists
+
+        # Composite/covering indexes matching the real query workload.
+        # Loans in due-date order (get_current_loans_db, get_books_due_soon_db) are read
+        # straight from the index, without touching the loans table or sorting.
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_loans_due_date_covering
+            ON loans (due_date, book_id, student_id, loan_date, loan_id)
+        """)
+        # Loans of a given book, already in due-date order (also used for availability counts).
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_loans_book_due_covering
+            ON loans (book_id, due_date, student_id, loan_date, loan_id)
+        """)
+        # A student's loans in due-date order (loans tab filtered by student, return checks).
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_loans_student_due
+            ON loans (student_id, due_date)
+        """)
+        # Leaderboards: per-classroom and global, both already ordered by points. The classroom
+        # one also serves the students of a classroom (lists, filters, get_distinct_classrooms).
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_students_classroom_points
+            ON students (classroom_id, points DESC, name, id)
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_students_points
+            ON students (points DESC, name, classroom_id, id)
+        """)
+        # Points ledger: a student's history (newest first, entry_id breaks ties) and period
+        # totals use (student_id, created_at, entry_id). Period leaderboards read the rollups.
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_points_ledger_student
+            ON points_ledger (student_id, created_at, entry_id, delta)
+        """)
+        # New releases (get_new_releases_db). The column may be missing on very old databases.
+        cursor.execute("PRAGMA table_info(books)")
+        if any(column[1] == 'date_added' for column in cursor.fetchall()):
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_books_date_added ON books (date_added DESC)")
+
+        # These single-column indexes are strict prefixes of the composite ones above.
+        cursor.execute("DROP INDEX IF EXISTS idx_loans_student_id")
+        cursor.execute("DROP INDEX IF EXISTS idx_loans_book_id")
+        cursor.execute("DROP INDEX IF EXISTS idx_loans_due_date")
+        cursor.execute("DROP INDEX IF EXISTS idx_students_classroom")
+        cursor.execute("DROP INDEX IF EXISTS idx_students_classroom_id")
+        # No query ranges over created_at alone since the leaderboards moved to the rollups.
+        cursor.execute("DROP INDEX IF EXISTS idx_points_ledger_created")
         conn.commit()
+
+        # Let SQLite refresh planner statistics where they are missing or stale.
+        cursor.execute("PRAGMA optimize")
         print("Database indexes created successfully.")
 
     except sqlite3.Error as e:
@@ -0,0 +1,307 @@
+"""
+CSV and XLSX exports of the catalog, loans, students and leaderboards.
+
+Rows are read from the cursor in chunks of FETCH_SIZE and written to the file straight away,
+so an export never holds more than one chunk in memory, whatever the table size. XLSX files
+are written with zipfile as a stream of worksheet XML (inline strings, no shared-strings
+table to build up), starting a new sheet every XLSX_MAX_ROWS rows as Excel requires.
+The file is written under a .partial name and renamed when complete.
+"""
+import csv
+import os
+import re
+import sqlite3
+import zipfile
+from datetime import datetime
+from xml.sax.saxutils import escape
+
+from utils import get_data_path
+from database.db_setup import CLASSROOM_ID_BY_NAME, is_global_filter
+import points_manager
+import query_monitor
+
+DB_PATH_FOR_CODE = os.path.join("database", "library.db")
+FETCH_SIZE = 2000 # rows per fetchmany()
+XLSX_MAX_ROWS = 1048576 # Excel's rows per sheet, header included
+FORMATS = ("csv", "xlsx")
+
+# Characters XML 1.0 does not allow (Excel refuses the file if they appear in a cell).
+_XML_ILLEGAL_RE = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+
+def _get_resolved_db_path():
+    return get_data_path(DB_PATH_FOR_CODE)
+
+
+def _books_query(classroom_filter, period):
+    query = """
+        SELECT b.id, b.titulo, b.autor, b.genero, loc.name, b.cantidad_total,
+               COALESCE(l.lent, 0), b.cantidad_total - COALESCE(l.lent, 0)
+        FROM books b
+        LEFT JOIN classrooms loc ON loc.id = b.location_id
+        LEFT JOIN (SELECT book_id, COUNT(*) AS lent FROM loans GROUP BY book_id) l ON l.book_id = b.id
+    """
+    params = []
+    if not is_global_filter(classroom_filter):
+        query += f" WHERE b.location_id = {CLASSROOM_ID_BY_NAME}"
+        params.append(classroom_filter)
+    return query + " ORDER BY b.titulo", params
+
+
+def _active_loans_query(classroom_filter, period):
+    query = """
+        SELECT l.loan_id, b.titulo, b.autor, loc.name, s.name, c.name, l.loan_date, l.due_date,
+               CASE WHEN l.due_date < date('now', 'localtime') THEN 'Sí' ELSE 'No' END
+        FROM loans l
+        JOIN books b ON l.book_id = b.id
+        JOIN students s ON l.student_id = s.id
+        LEFT JOIN classrooms loc ON loc.id = b.location_id
+        LEFT JOIN classrooms c ON c.id = s.classroom_id
+    """
+    params = []
+    if not is_global_filter(classroom_filter):
+        query += f" WHERE b.location_id = {CLASSROOM_ID_BY_NAME}"
+        params.append(classroom_filter)
+    return query + " ORDER BY l.due_date", params
+
+
+def _loan_history_query(classroom_filter, period):
+    # In history_id order (the rowid): no sort, so even millions of rows stream at once.
+    query = """
+        SELECT h.loan_id, b.titulo, b.autor, s.name, c.name, h.loan_date, h.due_date, h.return_date
+        FROM loan_history h
+        LEFT JOIN books b ON h.book_id = b.id
+        LEFT JOIN students s ON h.student_id = s.id
+        LEFT JOIN classrooms c ON c.id = s.classroom_id
+    """
+    params = []
+    if not is_global_filter(classroom_filter):
+        query += f" WHERE s.classroom_id = {CLASSROOM_ID_BY_NAME}"
+        params.append(classroom_filter)
+    return query + " ORDER BY h.history_id", params
+
+
+def _students_query(classroom_filter, period):
+    query = "SELECT s.id, s.name, c.name, s.role, s.points FROM students s LEFT JOIN classrooms c ON c.id = s.classroom_id"
+    params = []
+    if not is_global_filter(classroom_filter):
+        query += f" WHERE s.classroom_id = {CLASSROOM_ID_BY_NAME}"
+        params.append(classroom_filter)
+    return query + " ORDER BY c.name, s.name", params
+
+
+def _leaderboard_query(classroom_filter, period):
+    if period and period != "all":
+        start, end = points_manager.period_bounds(period)
+        query, params = points_manager.period_leaderboard_query(start, end, classroom_filter)
+        # rank is school-wide; the window is computed before the classroom condition applies
+        return (f"SELECT rank, name, classroom, points FROM ({query}) "
+                f"ORDER BY points DESC, name, classroom, id", params)
+    # Unlike get_leaderboard_db (one page at a time), the whole table is read, so the ranks
+    # come from window functions over all students.
+    query = """
+        SELECT global_rank, class_rank, name, classroom, points FROM (
+            SELECT RANK() OVER (ORDER BY s.points DESC) AS global_rank,
+                   RANK() OVER (PARTITION BY s.classroom_id ORDER BY s.points DESC) AS class_rank,
+                   s.name, c.name AS classroom, s.points, s.id
+            FROM students s LEFT JOIN classrooms c ON c.id = s.classroom_id
+        )
+    """
+    params = []
+    if not is_global_filter(classroom_filter):
+        query += " WHERE classroom = ?"
+        params.append(classroom_filter)
+    return query + " ORDER BY points DESC, name, classroom, id", params
+
+
+# kind -> (sheet title, column headers, query builder(classroom_filter, period) -> (query, params))
+EXPORTS = {
+    "books": ("Libros", ["ID", "Título", "Autor", "Género", "Ubicación", "Cantidad Total", "Prestados", "Disponibles"],
+              _books_query),
+    "active_loans": ("Préstamos Activos", ["ID Préstamo", "Título", "Autor", "Ubicación", "Alumno", "Clase",
+                                           "Fecha de Préstamo", "Fecha de Vencimiento", "Vencido"], _active_loans_query),
+    "loan_history": ("Historial de Préstamos", ["ID Préstamo", "Título", "Autor", "Alumno", "Clase", "Fecha de Préstamo",
+                                                "Fecha de Vencimiento", "Fecha de Devolución"], _loan_history_query),
+    "students": ("Alumnos", ["ID", "Nombre", "Clase", "Rol", "Puntos"], _students_query),
+    "leaderboard": ("Clasificación", ["Puesto", "Puesto en Clase", "Nombre", "Clase", "Puntos"], _leaderboard_query),
+}
+# The period leaderboards have one rank column and no id.
+_PERIOD_LEADERBOARD_HEADERS = ["Puesto", "Nombre", "Clase", "Puntos"]
+
+
+def _headers(kind, period):
+    if kind == "leaderboard" and period and period != "all":
+        return _PERIOD_LEADERBOARD_HEADERS
+    return EXPORTS[kind][1]
+
+
+def _chunks(cursor):
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            return
+        yield rows
+
+
+def _write_csv(path, headers, chunks, progress):
+    written = 0
+    # utf-8-sig: Excel opens the accents correctly, as with the legacy app's downloads.
+    with open(path, "w", newline="", encoding="utf-8-sig") as file:
+        writer = csv.writer(file)
+        writer.writerow(headers)
+        for rows in chunks:
+            writer.writerows(rows)
+            written += len(rows)
+            if progress:
+                progress(written)
+    return written
+
+
+def _xlsx_cell(letter, row_number, value):
+    ref = f"{letter}{row_number}"
+    if value is None:
+        return ""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return f'<c r="{ref}"><v>{value}</v></c>'
+    text = escape(_XML_ILLEGAL_RE.sub("", str(value)))
+    return f'<c r="{ref}" t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+def _column_letter(index):
+    letters = ""
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+_SHEET_HEADER = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                 '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+_SHEET_FOOTER = '</sheetData></worksheet>'
+
+
+def _write_xlsx(path, title, headers, chunks, progress):
+    written = 0
+    sheet_count = 0
+    letters = [_column_letter(column) for column in range(len(headers))]
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as workbook:
+        sheet = None
+        row_number = XLSX_MAX_ROWS # forces the first sheet to be opened
+        try:
+            for rows in chunks:
+                xml = []
+                for row in rows:
+                    if row_number >= XLSX_MAX_ROWS:
+                        if sheet:
+                            sheet.write("".join(xml).encode() + _SHEET_FOOTER.encode())
+                            sheet.close()
+                            xml = []
+                        sheet_count += 1
+                        sheet = workbook.open(f"xl/worksheets/sheet{sheet_count}.xml", "w", force_zip64=True)
+                        sheet.write(_SHEET_HEADER.encode())
+                        xml.append(_xlsx_row(1, headers, letters))
+                        row_number = 1
+                    row_number += 1
+                    xml.append(_xlsx_row(row_number, row, letters))
+                sheet.write("".join(xml).encode()) # one write per chunk
+                written += len(rows)
+                if progress:
+                    progress(written)
+            if sheet is None: # no rows: a sheet with only the headers
+                sheet_count = 1
+                sheet = workbook.open("xl/worksheets/sheet1.xml", "w")
+                sheet.write(_SHEET_HEADER.encode())
+                sheet.write(_xlsx_row(1, headers, letters).encode())
+            sheet.write(_SHEET_FOOTER.encode())
+        finally:
+            if sheet:
+                sheet.close()
+        _write_xlsx_package(workbook, title, sheet_count)
+    return written
+
+
+def _xlsx_row(row_number, values, letters):
+    cells = "".join(_xlsx_cell(letter, row_number, value) for letter, value in zip(letters, values))
+    return f'<row r="{row_number}">{cells}</row>'
+
+
+def _write_xlsx_package(workbook, title, sheet_count):
+    """The parts around the worksheets; written last, once the number of sheets is known."""
+    # Sheet names: at most 31 characters, some punctuation not allowed.
+    base_name = re.sub(r"[\[\]:*?/\\]", "", title)[:25]
+    names = [base_name if n == 1 else f"{base_name} ({n})" for n in range(1, sheet_count + 1)]
+    workbook.writestr("[Content_Types].xml",
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        + "".join(f'<Override PartName="/xl/worksheets/sheet{n}.xml" '
+                  f'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+                  for n in range(1, sheet_count + 1))
+        + '</Types>')
+    workbook.writestr("_rels/.rels",
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>')
+    workbook.writestr("xl/workbook.xml",
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"><sheets>'
+        + "".join(f'<sheet name="{escape(name)}" sheetId="{n}" r:id="rId{n}"/>' for n, name in enumerate(names, start=1))
+        + '</sheets></workbook>')
+    workbook.writestr("xl/_rels/workbook.xml.rels",
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        + "".join(f'<Relationship Id="rId{n}" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+                  f'Target="worksheets/sheet{n}.xml"/>' for n in range(1, sheet_count + 1))
+        + '</Relationships>')
+
+
+def default_file_name(kind, fmt="csv", period=None):
+    suffix = f"_{period}" if kind == "leaderboard" and period and period != "all" else ""
+    return f"{kind}{suffix}_{datetime.now():%Y%m%d_%H%M}.{fmt}"
+
+
+@query_monitor.timed
+def export_db(kind, path, classroom_filter=None, period=None, progress=None):
+    """Exports one of EXPORTS to path (.csv or .xlsx, chosen by the extension).
+    classroom_filter limits books and active loans to a ubicacion, and students, loan history
+    and leaderboards to a classroom. For the leaderboard, period is "week", "month" or "term"
+    (see points_manager.period_bounds) or None for all-time points.
+    progress(rows_written) is called after every chunk. Returns the number of rows, or None on error."""
+    if kind not in EXPORTS:
+        print(f"Export Error: unknown export '{kind}' (expected one of {list(EXPORTS)}).")
+        return None
+    fmt = os.path.splitext(path)[1].lower().lstrip(".")
+    if fmt not in FORMATS:
+        print(f"Export Error: unsupported file type '.{fmt}' (expected .csv or .xlsx).")
+        return None
+    title, _, build_query = EXPORTS[kind]
+    partial = path + ".partial"
+    conn = None
+    try:
+        query, params = build_query(classroom_filter, period)
+        conn = query_monitor.connect(_get_resolved_db_path())
+        cursor = conn.cursor()
+        cursor.execute(query, tuple(params))
+        if fmt == "csv":
+            written = _write_csv(partial, _headers(kind, period), _chunks(cursor), progress)
+        else:
+            written = _write_xlsx(partial, title, _headers(kind, period), _chunks(cursor), progress)
+        os.replace(partial, path)
+        print(f"Exported {written} rows of '{kind}' to '{path}'.")
+        return written
+    except (sqlite3.Error, OSError, ValueError) as e:
+        print(f"Export Error ({kind}): {e}")
+        if os.path.exists(partial):
+            try:
+                os.remove(partial)
+            except OSError:
+                pass
+        return None
+    finally:
+        if conn:
+            conn.close()
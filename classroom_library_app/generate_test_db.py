@@ -0,0 +1,339 @@
+"""
+Builds a synthetic, district-sized library database for performance testing.
+
+The schema comes from the real init_db(), so generated databases always match the app.
+Generation is deterministic for a given --seed. Rows are bulk-inserted in a single
+transaction with the secondary indexes rebuilt at the end, so a ~1M row database
+takes seconds instead of minutes.
+
+Returned loans (--history, three per student by default) go to loan_history, and the points
+ledger is built from them and the active loans the way the app awards points, with the same
+loan ids; each student's points are the sum of their ledger entries.
+
+Usage (from classroom_library_app/):
+    python generate_test_db.py --output database/district.db --classrooms 300 \\
+        --students 30000 --books 600000 --loans 60000 --history 1000000 --seed 42
+
+Leaders can log in with the shared --leader-password (default "lider123").
+"""
+import argparse
+import os
+import random
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+from utils import get_data_path
+from database.db_setup import LIBRARY_LOCATION, bump_data_versions, init_db, rebuild_points_rollups, seed_sync_log
+import book_manager
+import points_manager
+import read_cache
+import student_manager
+
+DEFAULT_OUTPUT = os.path.join("database", "district_test.db")
+
+FIRST_NAMES = [
+    "Lucía", "Hugo", "Martina", "Mateo", "Sofía", "Leo", "María", "Daniel", "Julia", "Pablo",
+    "Paula", "Álvaro", "Valeria", "Manuel", "Emma", "Alejandro", "Daniela", "Adrián", "Carla", "Enzo",
+    "Alba", "Mario", "Noa", "Diego", "Sara", "Marcos", "Carmen", "Javier", "Vega", "Izan",
+    "Lola", "Bruno", "Claudia", "Marco", "Valentina", "Thiago", "Jimena", "Gonzalo", "Aitana", "Nicolás",
+]
+SURNAMES = [
+    "García", "Rodríguez", "González", "Fernández", "López", "Martínez", "Sánchez", "Pérez", "Gómez", "Martín",
+    "Jiménez", "Ruiz", "Hernández", "Díaz", "Moreno", "Muñoz", "Álvarez", "Romero", "Alonso", "Gutiérrez",
+    "Navarro", "Torres", "Domínguez", "Vázquez", "Ramos", "Gil", "Ramírez", "Serrano", "Blanco", "Molina",
+    "Morales", "Suárez", "Ortega", "Delgado", "Castro", "Ortiz", "Rubio", "Marín", "Sanz", "Iglesias",
+]
+GENRES = [
+    "Aventura", "Fantasía", "Misterio", "Ciencia Ficción", "Cuento", "Poesía", "Cómic", "Historia",
+    "Ciencias", "Biografía", "Humor", "Teatro", "Mitología", "Naturaleza", "Deportes",
+]
+TITLE_NOUNS = [
+    "dragón", "castillo", "bosque", "tesoro", "pirata", "estrella", "río", "secreto", "lobo", "faro",
+    "mapa", "volcán", "reino", "sombrero", "jardín", "cometa", "isla", "biblioteca", "robot", "búho",
+    "princesa", "caballero", "barco", "desierto", "laberinto", "espejo", "gigante", "duende", "tren", "planeta",
+]
+TITLE_ADJECTIVES = [
+    "perdido", "mágico", "dormido", "invisible", "valiente", "olvidado", "encantado", "misterioso", "último", "pequeño",
+    "gigante", "secreto", "plateado", "salvaje", "antiguo", "curioso", "silencioso", "dorado", "escondido", "travieso",
+]
+TITLE_PATTERNS = [
+    "El {noun} {adj}",
+    "La leyenda del {noun}",
+    "Aventuras en el {noun} {adj}",
+    "El misterio del {noun}",
+    "Diario de un {noun} {adj}",
+    "Viaje al {noun}",
+    "Cuentos del {noun} {adj}",
+    "El {noun} y el {noun2}",
+]
+# Copies per title: most titles have a single copy, class sets have several.
+COPIES_WEIGHTS = [(1, 70), (2, 18), (3, 6), (4, 3), (5, 3)]
+HISTORY_DAYS = 180 # returned loans are spread over about two terms
+WORKSHEET_SHARE = 0.25 # returns that came with a worksheet
+
+
+def _seeded_ids(rng, count):
+    """UUID4-formatted ids drawn from the seeded generator, so ids are reproducible.
+    Returned in sorted order: inserting rows in primary-key order keeps the key b-tree
+    append-only instead of splitting pages all over the file."""
+    ids = []
+    for _ in range(count):
+        h = f"{rng.getrandbits(128):032x}"
+        ids.append(f"{h[:8]}-{h[8:12]}-4{h[13:16]}-{h[16:20]}-{h[20:]}")
+    ids.sort()
+    return ids
+
+
+def classroom_names(count):
+    """Returns `count` classroom names like "1ºA", prefixed by school once a single school is full."""
+    names = []
+    for i in range(count):
+        school, rest = divmod(i, 24) # 6 grades x 4 groups per school
+        grade, group = divmod(rest, 4)
+        name = f"{grade + 1}º{'ABCD'[group]}"
+        names.append(f"C{school + 1:02d} {name}" if count > 24 else name)
+    return names
+
+
+def _title_pool():
+    titles = set()
+    for pattern in TITLE_PATTERNS:
+        for noun in TITLE_NOUNS:
+            for adj in TITLE_ADJECTIVES:
+                for noun2 in TITLE_NOUNS:
+                    titles.add(pattern.format(noun=noun, noun2=noun2, adj=adj))
+    return sorted(titles)
+
+
+def _date_pool(today, days_back, fmt):
+    return [(today - timedelta(days=d)).strftime(fmt) for d in range(days_back + 1)]
+
+
+# Rows are built column by column with rng.choices(..., k=n) over precomputed value pools;
+# per-row random.choice()/strftime() calls dominated generation time at district scale.
+
+def _student_rows(rng, classrooms, n_students, leaders_per_classroom, leader_salt, leader_hash):
+    """(id, name, classroom, role, hashed_password, salt) rows; their points come from the ledger."""
+    full_names = [f"{first} {s1} {s2}" for first in FIRST_NAMES for s1 in SURNAMES for s2 in SURNAMES]
+    ids = _seeded_ids(rng, n_students)
+    names = rng.choices(full_names, k=n_students)
+    rows = []
+    for i in range(n_students):
+        if i // len(classrooms) < leaders_per_classroom:
+            role, hashed, salt = "leader", leader_hash, leader_salt
+        else:
+            role, hashed, salt = "student", None, None
+        rows.append((ids[i], names[i], classrooms[i % len(classrooms)], role, hashed, salt))
+    return rows
+
+
+def _book_rows(rng, classrooms, n_books, today):
+    authors = [f"{first} {surname}" for first in FIRST_NAMES for surname in SURNAMES]
+    locations = classrooms + [LIBRARY_LOCATION] * max(1, len(classrooms) // 4) # ~20% in the central library
+    added_days = _date_pool(today, 3 * 365, '%Y-%m-%d')
+    added_times = [f"{h:02d}:{m:02d}:00" for h in range(8, 18) for m in range(60)] # school hours
+    return list(zip(
+        _seeded_ids(rng, n_books),
+        rng.choices(_title_pool(), k=n_books),
+        rng.choices(authors, k=n_books),
+        rng.choices(GENRES, k=n_books),
+        rng.choices(locations, k=n_books),
+        rng.choices([c for c, _ in COPIES_WEIGHTS], [w for _, w in COPIES_WEIGHTS], k=n_books),
+        [f"{day} {time_of_day}" for day, time_of_day in zip(rng.choices(added_days, k=n_books), rng.choices(added_times, k=n_books))],
+    ))
+
+
+def _loan_rows(rng, book_rows, student_ids, n_loans, today):
+    """Active loans only (the app deletes a loan on return). Most loans are recent,
+    some were extended and a tail is overdue. Never lends more copies than a book has."""
+    dates = _date_pool(today + timedelta(days=28), 90 + 28, '%Y-%m-%d')[::-1] # dates[k] = today - 90 + k
+    on_loan = {}
+    rows = []
+    attempts = 0
+    while len(rows) < n_loans and attempts < n_loans * 5:
+        attempts += 1
+        book = book_rows[int(rng.random() * len(book_rows))]
+        book_id, copies = book[0], book[5]
+        if on_loan.get(book_id, 0) >= copies:
+            continue
+        on_loan[book_id] = on_loan.get(book_id, 0) + 1
+        age_days = min(int(rng.expovariate(1 / 9)), 90)
+        loan_days = 28 if rng.random() < 0.15 else 14 # extended once
+        rows.append((book_id, student_ids[int(rng.random() * len(student_ids))],
+                     dates[90 - age_days], dates[90 - age_days + loan_days]))
+    return [(loan_id,) + row for loan_id, row in zip(_seeded_ids(rng, len(rows)), rows)]
+
+
+def _history_rows(rng, book_rows, student_ids, n_history, today):
+    """Returned loans over the last HISTORY_DAYS, as (loan_id, book_id, student_id, loan_date,
+    due_date, return_date, worksheet_submitted). A few readers borrow most of the books; loans
+    come back one to three weeks later (by yesterday), so some are early and some late."""
+    days = _date_pool(today, HISTORY_DAYS, '%Y-%m-%d')[::-1] # days[k] = today - HISTORY_DAYS + k
+    habits = [rng.expovariate(1) for _ in student_ids] # how much each student reads
+    lent = rng.choices(range(HISTORY_DAYS - 21), k=n_history)
+    return [(loan_id, book_id, student_id, days[k], days[k + 14], days[k + back_after], worksheet)
+            for loan_id, book_id, student_id, k, back_after, worksheet in zip(
+                _seeded_ids(rng, n_history),
+                rng.choices([row[0] for row in book_rows], k=n_history),
+                rng.choices(student_ids, habits, k=n_history),
+                lent,
+                rng.choices(range(1, 22), k=n_history),
+                [rng.random() < WORKSHEET_SHARE for _ in range(n_history)])]
+
+
+def _ledger_rows(rng, loan_rows, history_rows):
+    """The points ledger of the loans, as the app records it (book_manager.loan_book_db and
+    close_loan): borrowing points on the loan date, then the return points, worksheet bonus and
+    early-return bonus on the return date, all with the loan's id."""
+    times = [f"{h:02d}:{m:02d}:00" for h in range(8, 18) for m in range(60)] # school hours
+    rows = []
+    for loan_id, _, student_id, loan_date, *_ in loan_rows:
+        rows.append((student_id, book_manager.POINTS_FOR_BORROWING, points_manager.REASON_LOAN, loan_id, loan_date))
+    for loan_id, _, student_id, loan_date, due_date, return_date, worksheet in history_rows:
+        rows.append((student_id, book_manager.POINTS_FOR_BORROWING, points_manager.REASON_LOAN, loan_id, loan_date))
+        rows.append((student_id, book_manager.POINTS_FOR_RETURNING, points_manager.REASON_RETURN, loan_id, return_date))
+        if worksheet:
+            rows.append((student_id, book_manager.POINTS_FOR_WORKSHEET, points_manager.REASON_WORKSHEET, loan_id, return_date))
+        if return_date < due_date:
+            rows.append((student_id, book_manager.POINTS_FOR_EARLY_RETURN, points_manager.REASON_EARLY_RETURN, loan_id, return_date))
+    return [row[:4] + (f"{row[4]} {time_of_day}",) for row, time_of_day in zip(rows, rng.choices(times, k=len(rows)))]
+
+
+def generate_database(output_path, classrooms=30, students=3000, books=30000, loans=6000, history=None,
+                      leaders_per_classroom=2, leader_password="lider123", seed=42, overwrite=False):
+    """Creates a new database at output_path filled with synthetic data. history is the number
+    of returned loans (default: three per student).
+    Returns a summary dictionary, or None if the file exists and overwrite is False."""
+    if os.path.exists(output_path):
+        if not overwrite:
+            print(f"Error: '{output_path}' already exists. Use --force to overwrite it.")
+            return None
+        os.remove(output_path)
+
+    start = time.perf_counter()
+    rng = random.Random(seed)
+    today = datetime.now().date()
+    init_db(output_path)
+
+    names = classroom_names(classrooms)
+    # Hashing is deliberately slow (PBKDF2), so all leaders share one salt/hash pair.
+    leader_salt, leader_hash = student_manager.hash_password(leader_password, salt=rng.randbytes(16))
+
+    conn = sqlite3.connect(output_path)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("PRAGMA journal_mode = OFF")
+        cursor.execute("PRAGMA synchronous = OFF")
+        cursor.execute("PRAGMA cache_size = -262144") # 256 MB, for the index builds
+        # Loading into unindexed tables and building each index once is much faster
+        # than maintaining every index row by row. Triggers (change capture for incremental
+        # backups, ledger guards) are also dropped for the load: a fresh database has no backups.
+        cursor.execute("SELECT type, name, sql FROM sqlite_master WHERE type IN ('index', 'trigger') AND sql IS NOT NULL")
+        schema_objects = cursor.fetchall()
+
+        cursor.execute("BEGIN")
+        for object_type, object_name, _ in schema_objects:
+            cursor.execute(f"DROP {object_type.upper()} {object_name}")
+
+        # Rows carry classroom names; the inserts look their ids up (the name index is a
+        # UNIQUE constraint's, so it is not among the dropped indexes).
+        cursor.executemany("INSERT OR IGNORE INTO classrooms (name) VALUES (?)", [(name,) for name in names])
+        student_rows = _student_rows(rng, names, students, leaders_per_classroom, leader_salt, leader_hash)
+        book_rows = _book_rows(rng, names, books, today)
+        loan_rows, history_rows = [], []
+        if student_rows and book_rows:
+            student_ids = [row[0] for row in student_rows]
+            loan_rows = _loan_rows(rng, book_rows, student_ids, loans, today)
+            history_rows = _history_rows(rng, book_rows, student_ids, 3 * students if history is None else history, today)
+        ledger_rows = _ledger_rows(rng, loan_rows, history_rows)
+        points = dict.fromkeys((row[0] for row in student_rows), 0)
+        for student_id, delta, *_ in ledger_rows:
+            points[student_id] += delta
+
+        cursor.executemany("""
+            INSERT INTO students (id, name, classroom_id, role, hashed_password, salt, points)
+            VALUES (?, ?, (SELECT id FROM classrooms WHERE name = ?), ?, ?, ?, ?)
+        """, [row + (points[row[0]],) for row in student_rows])
+        cursor.executemany("""
+            INSERT INTO books (id, titulo, autor, genero, location_id, cantidad_total, date_added)
+            VALUES (?, ?, ?, ?, (SELECT id FROM classrooms WHERE name = ?), ?, ?)
+        """, book_rows)
+        cursor.executemany("""
+            INSERT INTO loans (loan_id, book_id, student_id, loan_date, due_date)
+            VALUES (?, ?, ?, ?, ?)
+        """, loan_rows)
+        cursor.executemany("""
+            INSERT INTO loan_history (loan_id, book_id, student_id, loan_date, due_date, return_date)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, [row[:6] for row in history_rows])
+        cursor.executemany("""
+            INSERT INTO points_ledger (student_id, delta, reason, loan_id, created_at) VALUES (?, ?, ?, ?, ?)
+        """, ledger_rows)
+        rebuild_points_rollups(cursor)
+
+        for _, _, object_sql in schema_objects:
+            cursor.execute(object_sql)
+        seed_sync_log(cursor) # the sync triggers were dropped for the load
+        bump_data_versions(cursor) # and so were the data version ones
+        conn.commit()
+        read_cache.clear() # the file may have been open in this process before (overwrite=True)
+        cursor.execute("PRAGMA analysis_limit = 1000") # sampled statistics are enough for the planner
+        cursor.execute("ANALYZE")
+
+        cursor.execute("""
+            SELECT (SELECT COUNT(*) FROM students), (SELECT COUNT(*) FROM books), (SELECT COUNT(*) FROM loans),
+                   (SELECT COUNT(*) FROM loan_history), (SELECT COUNT(*) FROM points_ledger)
+        """)
+        student_count, book_count, loan_count, history_count, ledger_count = cursor.fetchone()
+    except sqlite3.Error as e:
+        conn.rollback()
+        print(f"Database error while generating '{output_path}': {e}")
+        return None
+    finally:
+        conn.close()
+
+    return {
+        'path': output_path,
+        'classrooms': names,
+        'students': student_count,
+        'books': book_count,
+        'loans': loan_count,
+        'loan_history': history_count,
+        'ledger_entries': ledger_count,
+        'leader_password': leader_password,
+        'seconds': time.perf_counter() - start,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic district-scale library database.")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT,
+                        help="Database file to create, relative to classroom_library_app/ unless absolute.")
+    parser.add_argument("--classrooms", type=int, default=30)
+    parser.add_argument("--students", type=int, default=3000)
+    parser.add_argument("--books", type=int, default=30000)
+    parser.add_argument("--loans", type=int, default=6000)
+    parser.add_argument("--history", type=int, default=None, help="Returned loans (default: three per student).")
+    parser.add_argument("--leaders-per-classroom", type=int, default=2)
+    parser.add_argument("--leader-password", default="lider123")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--force", action="store_true", help="Overwrite the output file if it exists.")
+    args = parser.parse_args(argv)
+
+    summary = generate_database(
+        get_data_path(args.output), classrooms=args.classrooms, students=args.students,
+        books=args.books, loans=args.loans, history=args.history, leaders_per_classroom=args.leaders_per_classroom,
+        leader_password=args.leader_password, seed=args.seed, overwrite=args.force)
+    if summary is None:
+        return 1
+    print(f"\nGenerated '{summary['path']}' in {summary['seconds']:.1f}s: "
+          f"{len(summary['classrooms'])} classrooms, {summary['students']} students, "
+          f"{summary['books']} books, {summary['loans']} active loans, {summary['loan_history']} returned loans, "
+          f"{summary['ledger_entries']} points ledger entries.")
+    print(f"Leaders log in with password '{summary['leader_password']}'.")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
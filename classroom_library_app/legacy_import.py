@@ -0,0 +1,469 @@
+"""
+Migrates the data of the legacy single-file app (Bibliov0.4.html) into the SQLite database.
+
+Accepted inputs, in any combination:
+  * the CSV files of its "Exportar Backup" section: backup_books.csv, backup_users.csv,
+    backup_active_loans.csv and backup_history_loans.csv;
+  * a JSON dump of its localStorage ({"books": ..., "users": ..., "loans": ...}, each value
+    either an array or the JSON text localStorage keeps). Only this dump has the book ids
+    the loans refer to, so loans exported as CSV can be linked to books imported from a
+    dump, now or in an earlier run.
+
+CSV files are read line by line and every row goes to the database in executemany batches,
+all inside one query_monitor.write_transaction (BEGIN IMMEDIATE): a failed migration leaves the
+database as it was. Legacy book ids and user names are recorded in legacy_id_map, and books,
+students and loans already in the database are matched on their content, so running the
+migration again (or importing the files one at a time) adds nothing twice. Legacy loans do not
+award points.
+
+Usage:
+    python legacy_import.py localStorage.json backup_history_loans.csv --classroom "Biblioteca antigua"
+"""
+import argparse
+import functools
+import json
+import os
+import re
+import sqlite3
+import uuid
+from datetime import datetime, timedelta
+
+from utils import get_data_path
+import query_monitor
+import read_cache
+import student_manager
+from database.db_setup import get_classroom_id
+
+DB_PATH_FOR_CODE = os.path.join("database", "library.db")
+DEFAULT_CLASSROOM = "Importados" # classroom of the accounts and borrowers that are created
+DEFAULT_LOCATION = "Biblioteca"
+BATCH_SIZE = 1000
+LEGACY_LOAN_DAYS = 14 # the legacy app lent books for two weeks
+
+# The legacy exports wrap every field in quotes without escaping the quotes inside it; its own
+# importer splits on commas outside quotes and strips the outer quotes, and so does this one.
+_LEGACY_FIELD_SPLIT_RE = re.compile(r',(?=(?:(?:[^"]*"){2})*[^"]*$)')
+_LEGACY_DATE_FORMATS = ('%d/%m/%Y', '%Y-%m-%d', '%d-%m-%Y', '%d/%m/%y', '%Y/%m/%d')
+# Sections are imported in this order, so loans find the books and users they refer to.
+SECTIONS = ("books", "users", "active_loans", "history_loans")
+
+
+def _get_resolved_db_path():
+    return get_data_path(DB_PATH_FOR_CODE)
+
+
+def _clean(value):
+    """Legacy fields as text: JavaScript wrote missing values as "undefined" or "null"."""
+    text = "" if value is None else str(value).strip()
+    return "" if text in ("undefined", "null", "NaN") else text
+
+
+def _norm(value):
+    return " ".join(_clean(value).split()).casefold()
+
+
+def _legacy_date(text, timestamp_ms=None):
+    """A legacy date as 'YYYY-MM-DD'. The JSON dump has millisecond timestamps; the CSV files only
+    have toLocaleDateString() text, which is day first in Spanish browsers."""
+    if isinstance(timestamp_ms, (int, float)) and timestamp_ms > 0:
+        return datetime.fromtimestamp(timestamp_ms / 1000).strftime('%Y-%m-%d')
+    return _parse_date_text(_clean(text).split(",")[0].strip()) # "19/10/2025, 10:30:00" from toLocaleString()
+
+
+@functools.lru_cache(maxsize=None) # years of history repeat a few thousand dates; strptime is slow
+def _parse_date_text(text):
+    for fmt in _LEGACY_DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).strftime('%Y-%m-%d')
+        except ValueError:
+            continue
+    return None
+
+
+def _legacy_csv_rows(path):
+    """Yields (line number, fields) for each data line of a legacy CSV export."""
+    with open(path, mode='r', encoding='utf-8-sig') as file:
+        for line_num, line in enumerate(file, start=1):
+            if line.strip():
+                yield line_num, [field.strip().strip('"').strip() for field in _LEGACY_FIELD_SPLIT_RE.split(line.rstrip("\r\n"))]
+
+
+def _csv_section(header):
+    header = [_norm(field) for field in header]
+    if header[:2] in (["título", "autor"], ["titulo", "autor"]):
+        return "books"
+    if header[:2] in (["usuario", "contraseña"], ["usuario", "contrasena"]):
+        return "users"
+    if header and header[0] == "libroid":
+        return "history_loans" if len(header) >= 5 else "active_loans"
+    return None
+
+
+def _read_csv_export(path):
+    """(section, iterator of records) for a CSV export; records look like the localStorage objects."""
+    rows = _legacy_csv_rows(path)
+    first = next(rows, None)
+    section = _csv_section(first[1]) if first else None
+    if section is None:
+        raise ValueError(f"'{os.path.basename(path)}' no es una exportación reconocida de Bibliov0.4 (encabezado desconocido).")
+
+    def records():
+        for line_num, fields in rows:
+            where = f"{os.path.basename(path)}, fila {line_num}"
+            if section == "books" and len(fields) >= 4:
+                yield where, {'titulo': fields[0], 'autor': fields[1], 'genero': fields[2], 'ubicacion': fields[3],
+                              'cantidad': fields[4] if len(fields) >= 5 else 1}
+            elif section == "users" and len(fields) >= 3:
+                yield where, {'username': fields[0], 'password': fields[1], 'role': fields[2]}
+            elif section in ("active_loans", "history_loans") and len(fields) >= 4:
+                yield where, {'bookIndex': fields[0], 'usuario': fields[1], 'fechaPrestamo': fields[2],
+                              'fechaVencimiento': fields[3], 'devuelto': section == "history_loans",
+                              'fechaDevolucion': fields[4] if len(fields) >= 5 else ""}
+            else:
+                yield where, None
+    return section, records()
+
+
+def _read_local_storage_dump(path):
+    """[(section, iterator of records)] from a JSON dump of the legacy localStorage."""
+    with open(path, mode='r', encoding='utf-8-sig') as file:
+        # localStorage is capped at a few MB per site, so the whole dump fits in memory.
+        dump = json.load(file)
+    if not isinstance(dump, dict):
+        raise ValueError(f"'{os.path.basename(path)}' no contiene un volcado de localStorage (se esperaba un objeto JSON).")
+
+    def value(key):
+        data = dump.get(key) or []
+        return json.loads(data) if isinstance(data, str) else data
+
+    name = os.path.basename(path)
+    books, users, loans = value("books"), value("users"), value("loans")
+    return [
+        ("books", ((f"{name}, libro {i + 1}", book) for i, book in enumerate(books))),
+        ("users", ((f"{name}, usuario {i + 1}", user) for i, user in enumerate(users))),
+        ("active_loans", ((f"{name}, préstamo {i + 1}", loan) for i, loan in enumerate(loans) if not loan.get('devuelto'))),
+        ("history_loans", ((f"{name}, préstamo {i + 1}", loan) for i, loan in enumerate(loans) if loan.get('devuelto'))),
+    ]
+
+
+class _Migration:
+    """State of one import run: what it added or already looked up, and the pending batches.
+    Rows already in the database are found through its indexes, one record at a time."""
+
+    def __init__(self, cursor, classroom, batch_size):
+        self.cursor = cursor
+        self.classroom = classroom
+        self.batch_size = batch_size
+        self.errors = []
+        self.summary = {section: {'created': 0, 'duplicates': 0, 'skipped': 0} for section in SECTIONS}
+        self.summary['borrowers_created'] = 0
+        self.pending = {"books": [], "students": [], "loans": [], "loan_history": [], "legacy_id_map": []}
+
+        # Rows queued here may not be in the database yet, so what this run maps, creates or
+        # finds is remembered. Legacy history rows are not: the database skips repeated ones.
+        self.id_map = {} # (kind, legacy id) -> new id
+        self.books_by_key = {} # (titulo, autor, ubicacion) normalized -> book id
+        self.students_by_name = {} # normalized name -> [(student id, classroom)]
+        self.loan_keys = set() # (book_id, student_id, loan_date) of the active loans queued
+        self.classroom_ids = {} # classroom or location name -> classrooms id
+        self.created_book_ids = set()
+        self.pending_book_rows = {} # book id -> pending row of a book created in this run (copies are merged into it)
+
+    # --- batching ---
+    _INSERTS = {
+        "books": "INSERT INTO books (id, titulo, autor, genero, location_id, cantidad_total) VALUES (?, ?, ?, ?, ?, ?)",
+        "students": "INSERT INTO students (id, name, classroom_id, role, hashed_password, salt) VALUES (?, ?, ?, ?, ?, ?)",
+        "loans": "INSERT INTO loans (loan_id, book_id, student_id, loan_date, due_date) VALUES (?, ?, ?, ?, ?)",
+        # idx_loan_history_legacy makes a repeated legacy row a no-op; flush() counts them.
+        "loan_history": "INSERT OR IGNORE INTO loan_history (book_id, student_id, loan_date, due_date, return_date) VALUES (?, ?, ?, ?, ?)",
+        "legacy_id_map": "INSERT OR IGNORE INTO legacy_id_map (kind, legacy_id, new_id) VALUES (?, ?, ?)",
+    }
+
+    # Queued book and student rows hold the location / classroom name at this index.
+    _CLASSROOM_NAME_COLUMN = {"books": 4, "students": 2}
+
+    def _classroom_id(self, name):
+        if name not in self.classroom_ids:
+            self.classroom_ids[name] = get_classroom_id(self.cursor, name)
+        return self.classroom_ids[name]
+
+    def _queue(self, table, row):
+        self.pending[table].append(row)
+        if len(self.pending[table]) >= self.batch_size:
+            self.flush(table)
+
+    def flush(self, table=None):
+        for name in ([table] if table else self.pending):
+            rows = self.pending[name]
+            if rows:
+                rows = [tuple(row) for row in rows]
+                if name in self._CLASSROOM_NAME_COLUMN:
+                    column = self._CLASSROOM_NAME_COLUMN[name]
+                    rows = [row[:column] + (self._classroom_id(row[column]),) + row[column + 1:] for row in rows]
+                self.cursor.executemany(self._INSERTS[name], rows)
+                if name == "loan_history":
+                    self.summary['history_loans']['created'] += self.cursor.rowcount
+                    self.summary['history_loans']['duplicates'] += len(rows) - self.cursor.rowcount
+                if name == "books":
+                    self.pending_book_rows.clear() # flushed books get their extra copies with an UPDATE
+                self.pending[name] = []
+
+    def _map(self, kind, legacy_id, new_id):
+        self.id_map[(kind, legacy_id)] = new_id
+        self._queue("legacy_id_map", (kind, legacy_id, new_id))
+
+    # --- lookups ---
+    def _mapped(self, kind, legacy_id):
+        """The id a legacy book or user was imported as, in this run or an earlier one, or None."""
+        key = (kind, legacy_id)
+        if key not in self.id_map:
+            self.cursor.execute("SELECT new_id FROM legacy_id_map WHERE kind = ? AND legacy_id = ?", key)
+            row = self.cursor.fetchone()
+            if row is None:
+                return None
+            self.id_map[key] = row[0]
+        return self.id_map[key]
+
+    @staticmethod
+    def _spellings(text):
+        # NOCASE only folds ASCII letters and compares spaces as they are: the candidates are
+        # the text as typed and with its spaces collapsed, then checked with _norm.
+        text = _clean(text)
+        return text, " ".join(text.split())
+
+    def _find_book(self, titulo, autor, ubicacion):
+        key = (_norm(titulo), _norm(autor), _norm(ubicacion))
+        if key not in self.books_by_key:
+            self.cursor.execute("""
+                SELECT b.id, b.titulo, b.autor, loc.name FROM books b LEFT JOIN classrooms loc ON loc.id = b.location_id
+                WHERE b.titulo COLLATE NOCASE IN (?, ?)
+            """, self._spellings(titulo)) # idx_books_titulo_nocase
+            matches = [book_id for book_id, *fields in self.cursor.fetchall() if tuple(map(_norm, fields)) == key]
+            if not matches:
+                return key, None
+            self.books_by_key[key] = matches[0]
+        return key, self.books_by_key[key]
+
+    def _students_named(self, name):
+        """[(student id, classroom name)] of the students whose name matches name."""
+        key = _norm(name)
+        if key not in self.students_by_name:
+            self.cursor.execute("""
+                SELECT s.id, s.name, c.name FROM students s LEFT JOIN classrooms c ON c.id = s.classroom_id
+                WHERE s.name COLLATE NOCASE IN (?, ?)
+            """, self._spellings(name)) # idx_students_name_nocase
+            self.students_by_name[key] = [(student_id, classroom) for student_id, found, classroom
+                                          in self.cursor.fetchall() if _norm(found) == key]
+        return self.students_by_name[key]
+
+    def _loan_exists(self, key):
+        if key in self.loan_keys:
+            return True
+        self.cursor.execute("SELECT 1 FROM loans WHERE book_id = ? AND student_id = ? AND loan_date = ? LIMIT 1", key)
+        return self.cursor.fetchone() is not None
+
+    # --- sections ---
+    def add_book(self, where, book, active_copies):
+        legacy_id = _clean(book.get('id'))
+        if legacy_id and self._mapped("book", legacy_id) is not None:
+            self.summary['books']['duplicates'] += 1
+            return
+        titulo, autor = _clean(book.get('titulo')), _clean(book.get('autor')) or "Desconocido"
+        if not titulo:
+            self.errors.append(f"{where}: libro sin título. Saltando.")
+            self.summary['books']['skipped'] += 1
+            return
+        ubicacion = _clean(book.get('ubicacion')) or DEFAULT_LOCATION
+        try:
+            available = max(0, int(_clean(book.get('cantidad')) or 1))
+        except ValueError:
+            available = 1
+        # The legacy 'cantidad' counts the copies on the shelf; lent copies are added back.
+        copies = max(1, available + active_copies.get(legacy_id, 0))
+        key, book_id = self._find_book(titulo, autor, ubicacion)
+        if book_id is None:
+            book_id = str(uuid.uuid4())
+            self.books_by_key[key] = book_id
+            row = [book_id, titulo, autor, _clean(book.get('genero')) or None, ubicacion, copies]
+            self.created_book_ids.add(book_id)
+            self.pending_book_rows[book_id] = row
+            self._queue("books", row)
+            self.summary['books']['created'] += 1
+        else:
+            self.summary['books']['duplicates'] += 1
+            if book_id in self.pending_book_rows: # same book twice in the legacy data: one record, all copies
+                self.pending_book_rows[book_id][5] += copies
+            elif book_id in self.created_book_ids:
+                self.cursor.execute("UPDATE books SET cantidad_total = cantidad_total + ? WHERE id = ?", (copies, book_id))
+        if legacy_id:
+            self._map("book", legacy_id, book_id)
+
+    def add_user(self, where, user):
+        name = " ".join(_clean(user.get('username')).split())
+        if not name:
+            self.errors.append(f"{where}: usuario sin nombre. Saltando.")
+            self.summary['users']['skipped'] += 1
+            return
+        if self._mapped("user", _norm(name)) is not None or self._students_named(name):
+            self.summary['users']['duplicates'] += 1
+            return
+        role = "admin" if _norm(user.get('role')) == "admin" else "leader" # legacy 'usuario' accounts lent books
+        password = _clean(user.get('password'))
+        salt_hex, hashed_hex = student_manager.hash_password(password) if password else (None, None)
+        student_id = str(uuid.uuid4())
+        self._queue("students", (student_id, name, self.classroom, role, hashed_hex, salt_hex))
+        self.students_by_name[_norm(name)] = [(student_id, self.classroom)]
+        self._map("user", _norm(name), student_id)
+        self.summary['users']['created'] += 1
+
+    def _borrower_id(self, name):
+        """Student id for a borrower typed by hand in the legacy app, created if unknown."""
+        key = _norm(name)
+        mapped = self._mapped("user", key)
+        if mapped is not None:
+            return mapped
+        matches = self._students_named(name)
+        if matches:
+            in_classroom = [student_id for student_id, classroom in matches if classroom == self.classroom]
+            return in_classroom[0] if in_classroom else matches[0][0]
+        student_id = str(uuid.uuid4())
+        self._queue("students", (student_id, " ".join(_clean(name).split()), self.classroom, "student", None, None))
+        self.students_by_name[key] = [(student_id, self.classroom)]
+        self._map("user", key, student_id)
+        self.summary['borrowers_created'] += 1
+        return student_id
+
+    def add_loan(self, where, loan, section):
+        legacy_book_id = _clean(loan.get('bookIndex'))
+        book_id = self._mapped("book", legacy_book_id)
+        borrower = _clean(loan.get('usuario'))
+        loan_date = _legacy_date(loan.get('fechaPrestamo'), loan.get('fechaPrestamoTS'))
+        if book_id is None or not borrower or loan_date is None:
+            problem = (f"el libro legado '{legacy_book_id}' no se ha importado" if book_id is None
+                       else "falta el usuario" if not borrower else "fecha de préstamo no válida")
+            self.errors.append(f"{where}: {problem}. Saltando préstamo.")
+            self.summary[section]['skipped'] += 1
+            return
+        due_date = (_legacy_date(loan.get('fechaVencimiento'), loan.get('fechaVencimientoTS'))
+                    or (datetime.fromisoformat(loan_date) + timedelta(days=LEGACY_LOAN_DAYS)).strftime('%Y-%m-%d'))
+        student_id = self._borrower_id(borrower)
+        if section == "active_loans":
+            key = (book_id, student_id, loan_date)
+            if self._loan_exists(key):
+                self.summary[section]['duplicates'] += 1
+                return
+            self.loan_keys.add(key)
+            self._queue("loans", (str(uuid.uuid4()), book_id, student_id, loan_date, due_date))
+            self.summary[section]['created'] += 1
+        else: # created or duplicate: counted when the batch is inserted
+            return_date = _legacy_date(loan.get('fechaDevolucion'))
+            self._queue("loan_history", (book_id, student_id, loan_date, due_date, return_date))
+
+
+def _read_sections(paths):
+    """{section: [iterators of (where, record)]} for the files, in the order they were given."""
+    sections = {section: [] for section in SECTIONS}
+    for path in paths:
+        if path.lower().endswith(".json"):
+            for section, records in _read_local_storage_dump(path):
+                sections[section].append(records)
+        else:
+            section, records = _read_csv_export(path)
+            sections[section].append(records)
+    return sections
+
+
+def _migrate(cursor, paths, classroom, batch_size):
+    sections = _read_sections(paths) # read again if write_transaction runs this again: the CSV records stream
+    migration = _Migration(cursor, classroom, batch_size)
+
+    # The lent copies of each book, to turn the legacy shelf count into a total.
+    # Only the JSON dump links loans to books by id, and it is small.
+    active_copies = {}
+    active_loans = []
+    for records in sections["active_loans"]:
+        for where, loan in records:
+            active_loans.append((where, loan))
+            if loan:
+                legacy_book_id = _clean(loan.get('bookIndex'))
+                active_copies[legacy_book_id] = active_copies.get(legacy_book_id, 0) + 1
+
+    for records in sections["books"]:
+        for where, book in records:
+            if book is None:
+                migration.errors.append(f"{where}: faltan columnas. Saltando.")
+                migration.summary['books']['skipped'] += 1
+                continue
+            migration.add_book(where, book, active_copies)
+    for records in sections["users"]:
+        for where, user in records:
+            if user is None:
+                migration.errors.append(f"{where}: faltan columnas. Saltando.")
+                migration.summary['users']['skipped'] += 1
+                continue
+            migration.add_user(where, user)
+    for section, loans in (("active_loans", [active_loans]), ("history_loans", sections["history_loans"])):
+        for records in loans:
+            for where, loan in records:
+                if loan is None:
+                    migration.errors.append(f"{where}: faltan columnas. Saltando.")
+                    migration.summary[section]['skipped'] += 1
+                    continue
+                migration.add_loan(where, loan, section)
+    migration.flush()
+    query_monitor.on_commit(read_cache.clear)
+    return migration.summary, migration.errors
+
+
+def import_legacy_data(paths, classroom=DEFAULT_CLASSROOM, batch_size=BATCH_SIZE):
+    """Imports Bibliov0.4.html exports (CSV files and/or localStorage JSON dumps) in one transaction.
+    Returns a tuple: (summary dictionary, error_messages_list). The summary has 'created',
+    'duplicates' and 'skipped' counts for each of SECTIONS, plus 'borrowers_created'; it is
+    None if nothing was imported because of an error."""
+    try:
+        _read_sections(paths) # unreadable or unrecognised files are reported before taking the write lock
+    except FileNotFoundError as e:
+        return None, [f"Error: No se encontró el archivo '{e.filename}'."]
+    except (ValueError, UnicodeDecodeError) as e: # json.JSONDecodeError is a ValueError
+        return None, [f"Error al leer los datos legados: {e}"]
+
+    # The lookups and the inserts run in one BEGIN IMMEDIATE transaction: a deferred one that
+    # read first could not take the write lock later if another connection wrote in between.
+    try:
+        return query_monitor.write_transaction(
+            _get_resolved_db_path(), lambda cursor: _migrate(cursor, paths, classroom, batch_size))
+    except sqlite3.Error as e:
+        print(f"Database error in import_legacy_data: {e}")
+        return None, [f"Error de base de datos durante la migración: {e}. No se ha importado nada."]
+    except FileNotFoundError as e: # removed since the first read
+        return None, [f"Error: No se encontró el archivo '{e.filename}'."]
+    except (ValueError, UnicodeDecodeError) as e:
+        return None, [f"Error al leer los datos legados: {e}. No se ha importado nada."]
+
+
+def main(argv=None):
+    global DB_PATH_FOR_CODE
+    parser = argparse.ArgumentParser(description="Migrate Bibliov0.4.html exports into the library database.")
+    parser.add_argument("paths", nargs="+", help="CSV exports and/or localStorage JSON dumps.")
+    parser.add_argument("--classroom", default=DEFAULT_CLASSROOM,
+                        help="Classroom of the accounts and borrowers that have to be created.")
+    parser.add_argument("--db", default=None, help="Database file (default: the application database).")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args(argv)
+    if args.db:
+        DB_PATH_FOR_CODE = os.path.abspath(args.db)
+
+    summary, errors = import_legacy_data(args.paths, classroom=args.classroom, batch_size=args.batch_size)
+    for message in errors:
+        print(message)
+    if summary is None:
+        return 1
+    for section in SECTIONS:
+        counts = summary[section]
+        print(f"{section}: {counts['created']} imported, {counts['duplicates']} already present, {counts['skipped']} skipped")
+    print(f"borrowers created: {summary['borrowers_created']}")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
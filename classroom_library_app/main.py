@@ -2,9 +2,17 @@ import customtkinter as ctk
 from tkinter import filedialog, messagebox
 from PIL import Image
 from database.db_setup import init_db
-import book_manager
-import student_manager
-import auth_manager # Added for user management context
+import data_backend # book/student/auth operations, on the local database or the central server
+import points_manager
+import query_monitor
+import read_cache
+import ui_monitor
+import profiler_hook
+import backup_manager
+import change_bus
+import export_manager
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from tkinter import simpledialog # Added for password dialogs
 from datetime import datetime, timedelta
 import os # <--- ADD THIS LINE
@@ -23,6 +31,15 @@ SUBHEADING_FONT = (APP_FONT_FAMILY, 18, "bold")
 BODY_FONT = (APP_FONT_FAMILY, 14)
 BUTTON_FONT = (APP_FONT_FAMILY, 15, "bold")
 
+backend = data_backend.create_from_env() # LocalBackend, or HttpBackend when BIBLIO_SERVER_URL is set
+
+LEADERBOARD_PAGE_SIZE = 50 # Rows shown per "Cargar más" step in the leaderboard
+CHANGE_POLL_MS = 3000 # how often to look for changes made by other processes (see change_bus)
+REMOTE_VERSIONS_CHECK_MS = 200 # how often to look whether the server's counters arrived (see _poll_data_changes)
+EXPORT_KINDS = {"Catálogo de libros": "books", "Préstamos activos": "active_loans", "Historial de préstamos": "loan_history",
+                "Alumnos": "students", "Clasificación": "leaderboard"} # label -> export_manager kind
+LEADERBOARD_PERIODS = {"Total": None, "Este trimestre": "term", "Este mes": "month", "Esta semana": "week"} # label -> points_manager period
+
 # Define a simple color palette (using CTk's theme system primarily, but can define for specific widgets if needed)
 # COLOR_PRIMARY = "#007ACC" # Blue
 # COLOR_SECONDARY = "#F0F0F0" # Light Gray
@@ -35,6 +52,10 @@ class App(ctk.CTk):
         self.title("📚 Leerflix 🧸") # Changed title
         self.geometry("950x750")
 
+        # Opt-in event-loop stall monitor (BIBLIO_UI_MONITOR=1). Wraps the handlers before any widget
+        # is created, so the command= callbacks below are the timed versions.
+        self.ui_monitor = ui_monitor.create_from_env(self)
+
         # Set window icon
         try:
             # Ensure get_data_path and os are available in this scope
@@ -55,6 +76,10 @@ class App(ctk.CTk):
 
         # Initialize database
         init_db() # Ensure DB is set up early
+        self.backup_scheduler = backup_manager.start_scheduler_from_env() # periodic online backups
+        self.backup_busy = False
+        self.versions_reader = None # worker reading a server's data versions (initialize_main_app_ui)
+        self.pending_versions = None # the read in progress on versions_reader
 
         self.current_leader_id = None
         self.current_leader_classroom = None
@@ -80,6 +105,13 @@ class App(ctk.CTk):
         self.reminder_item_frames = {}
         self.no_reminders_label = None
 
+        # For refresh_leaderboard_display (top-N window, rows keyed by student id)
+        self.leaderboard_item_frames = {}
+        self.leaderboard_order = []
+        self.leaderboard_visible_count = LEADERBOARD_PAGE_SIZE
+        self.no_leaderboard_label = None
+        self.leaderboard_load_more_button = None
+
         self.withdraw() # Hide main window initially
         self.show_login_screen() # Show login screen first
 
@@ -145,7 +177,7 @@ class App(ctk.CTk):
         def login_action():
             username = username_entry.get()
             password = password_entry.get()
-            if auth_manager.login(username, password):
+            if backend.login(username, password):
                 self.login_window.destroy()
                 self.login_window = None
                 self.initialize_main_app_ui()
@@ -277,7 +309,7 @@ class App(ctk.CTk):
         if hasattr(self, 'setup_manage_loans_tab'): self.setup_manage_loans_tab()
 
         # Pestañas condicionales de administrador
-        if auth_manager.is_admin():
+        if backend.is_admin():
             self.manage_users_tab = self.tab_view.add("👤 Gestionar Usuarios") # Translated
             if hasattr(self, 'setup_manage_users_tab'):
                  self.setup_manage_users_tab()
@@ -289,6 +321,15 @@ class App(ctk.CTk):
                 self.setup_manage_classrooms_tab()
             else:
                 print("Error: El método setup_manage_classrooms_tab no se encontró pero se esperaba para el admin.")
+
+            self.diagnostics_tab = self.tab_view.add("🩺 Diagnóstico")
+            self.setup_diagnostics_tab()
+
+            self.backups_tab = self.tab_view.add("💾 Copias de Seguridad")
+            self.setup_backups_tab()
+
+            self.export_tab = self.tab_view.add("📤 Exportar")
+            self.setup_export_tab()
         else:
             self.manage_users_tab = None
             # self.manage_classrooms_tab = None # Ensure it's None if user is not admin
@@ -296,6 +337,21 @@ class App(ctk.CTk):
         # Asegurar que la pestaña de Clasificación esté activa
         self.tab_view.set("🏠 Inicio")
 
+        # Views reload when the data they show changes, here or in another process (change_bus)
+        self.change_bus = change_bus.ChangeBus(backend.get_data_versions_db)
+        self.change_bus.subscribe(("books", "loans"), self.search_books_ui) # keeps the current search
+        self.change_bus.subscribe(("roster",), self.refresh_all_classroom_displays)
+        self.change_bus.subscribe(("books", "loans", "roster"), self.refresh_loan_related_combos_and_lists)
+        self.change_bus.subscribe(("students",), self.refresh_student_list_ui)
+        self.change_bus.subscribe(("students",), self.refresh_user_list_ui)
+        self.change_bus.subscribe(("students",), self.refresh_leaderboard_display)
+        self.change_bus.poll() # the views were just loaded: only records the current versions
+        # A server's counters are a GET that can wait for the whole timeout when the network is
+        # lost: the periodic poll reads them on this worker (one keep-alive connection) instead.
+        if backend.is_remote:
+            self.versions_reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="biblio-versions")
+        self.after(CHANGE_POLL_MS, self._poll_data_changes)
+
         # Deiconify (show) the main window now that UI is initialized
         self.deiconify()
 
@@ -326,7 +382,7 @@ class App(ctk.CTk):
 
         for widget in most_read_content_frame.winfo_children():
             widget.destroy()
-        most_read_books = book_manager.get_most_read_books_db(limit=10)
+        most_read_books = backend.get_most_read_books_db(limit=10)
         if most_read_books:
             h_scroll_frame_most_read = ctk.CTkScrollableFrame(most_read_content_frame, orientation="horizontal", height=140, fg_color="transparent")
             h_scroll_frame_most_read.pack(expand=True, fill="x", pady=5)
@@ -344,7 +400,7 @@ class App(ctk.CTk):
 
         for widget in new_releases_content_frame.winfo_children():
             widget.destroy()
-        new_release_books = book_manager.get_new_releases_db(limit=10)
+        new_release_books = backend.get_new_releases_db(limit=10)
         if new_release_books:
             h_scroll_frame_new_releases = ctk.CTkScrollableFrame(new_releases_content_frame, orientation="horizontal", height=140, fg_color="transparent")
             h_scroll_frame_new_releases.pack(expand=True, fill="x", pady=5)
@@ -362,7 +418,7 @@ class App(ctk.CTk):
 
         for widget in recommendations_content_frame.winfo_children():
             widget.destroy()
-        recommended_books = book_manager.get_recommendations_db(limit=10)
+        recommended_books = backend.get_recommendations_db(limit=10)
         if recommended_books:
             h_scroll_frame_recommendations = ctk.CTkScrollableFrame(recommendations_content_frame, orientation="horizontal", height=140, fg_color="transparent")
             h_scroll_frame_recommendations.pack(expand=True, fill="x", pady=5)
@@ -371,6 +427,32 @@ class App(ctk.CTk):
         else:
             ctk.CTkLabel(recommendations_content_frame, text="No tenemos recomendaciones para ti en este momento.", font=BODY_FONT).pack(pady=10)
 
+    def refresh_changed_views(self):
+        """Reloads the views whose data changed; called after each write made from the UI."""
+        self.change_bus.poll()
+
+    def _poll_data_changes(self):
+        # Skipped while an action is profiled: its dialogs run the event loop, and the refreshes
+        # would end up in the profile. The next poll still sees the changes.
+        if profiler_hook.is_profiling():
+            pass
+        elif self.versions_reader is None:
+            self.change_bus.poll()
+        elif self.pending_versions is None: # else the server has not answered the previous read yet
+            self.pending_versions = self.versions_reader.submit(backend.get_data_versions_db)
+            self.after(REMOTE_VERSIONS_CHECK_MS, self._apply_remote_versions)
+        self.after(CHANGE_POLL_MS, self._poll_data_changes)
+
+    def _apply_remote_versions(self):
+        # The subscribers update widgets, so they run here on the Tk thread once the counters arrive.
+        if not self.pending_versions.done():
+            self.after(REMOTE_VERSIONS_CHECK_MS, self._apply_remote_versions)
+            return
+        versions = self.pending_versions.result()
+        self.pending_versions = None
+        if not profiler_hook.is_profiling():
+            self.change_bus.apply_versions(versions)
+
     def quit_application(self):
         # Perform any cleanup if necessary
         if self.login_window is not None and self.login_window.winfo_exists():
@@ -438,7 +520,7 @@ class App(ctk.CTk):
 
         ctk.CTkLabel(add_book_frame, text="Ubicación:", font=BODY_FONT).grid(row=4, column=0, padx=10, pady=10, sticky="w") # Increased pady
 
-        dynamic_classrooms = student_manager.get_distinct_classrooms()
+        dynamic_classrooms = backend.get_distinct_classrooms()
         fixed_locations = ["Biblioteca"]
         all_ubicaciones = sorted(list(set(dynamic_classrooms + fixed_locations)))
         display_values_setup = all_ubicaciones if all_ubicaciones else ["N/A"]
@@ -493,7 +575,7 @@ class App(ctk.CTk):
             return
 
         # Assuming book_manager.add_book_db signature is (titulo, autor, ubicacion, genero=None, cantidad_total=1)
-        book_id = book_manager.add_book_db(titulo, autor, ubicacion, genero if genero else None, cantidad_total)
+        book_id = backend.add_book_db(titulo, autor, ubicacion, genero if genero else None, cantidad_total)
 
         if book_id:
             messagebox.showinfo("¡Éxito! 🎉", f"¡Excelente! El libro '{titulo}' ha sido añadido correctamente.") # Translated
@@ -502,11 +584,11 @@ class App(ctk.CTk):
             self.genero_entry.delete(0, "end")
             # self.ubicacion_combobox.set("Salón A") # Reset to default or clear
             self.cantidad_total_entry.delete(0, "end")
-            if hasattr(self, 'refresh_book_list_ui'): self.refresh_book_list_ui()
-            if hasattr(self, 'refresh_loan_related_combos_and_lists'): self.refresh_loan_related_combos_and_lists()
+            self.refresh_changed_views()
         else:
             messagebox.showerror("¡Oh no! 😟", "Algo salió mal al añadir el libro.") # Translated
 
+    @profiler_hook.profile_next_action
     def import_csv_ui(self): # Re-implemented
         file_path = filedialog.askopenfilename(
             title="Seleccionar archivo CSV para importar", # Translated
@@ -518,7 +600,7 @@ class App(ctk.CTk):
         # The os.makedirs("assets") line was likely for a sample CSV, not needed for general import.
         # If a specific assets folder for user-provided CSVs was intended, that's a different feature.
 
-        success_count, errors = book_manager.import_books_from_csv_db(file_path)
+        success_count, errors = backend.import_books_from_csv_db(file_path)
 
         summary_message = f"Resumen de Importación CSV:\n\nLibros importados con éxito: {success_count}." # Translated
         if errors:
@@ -527,8 +609,7 @@ class App(ctk.CTk):
         else:
             messagebox.showinfo("Importación Exitosa", summary_message) # Translated
 
-        if hasattr(self, 'refresh_book_list_ui'): self.refresh_book_list_ui()
-        if hasattr(self, 'refresh_loan_related_combos_and_lists'): self.refresh_loan_related_combos_and_lists()
+        self.refresh_changed_views()
 
 
     def setup_view_books_tab(self):
@@ -539,7 +620,7 @@ class App(ctk.CTk):
         controls_frame.pack(pady=15, padx=15, fill="x")
 
         ctk.CTkLabel(controls_frame, text="Filtrar por Ubicación:", font=BODY_FONT).grid(row=0, column=0, padx=(10,5), pady=10, sticky="w")
-        self.view_ubicacion_filter = ctk.CTkComboBox(controls_frame, values=["Todos", "Biblioteca"] + student_manager.get_distinct_classrooms() , command=lambda x: self.refresh_book_list_ui(), font=BODY_FONT, dropdown_font=BODY_FONT, width=150) # Dynamic classrooms
+        self.view_ubicacion_filter = ctk.CTkComboBox(controls_frame, values=["Todos", "Biblioteca"] + backend.get_distinct_classrooms() , command=lambda x: self.refresh_book_list_ui(), font=BODY_FONT, dropdown_font=BODY_FONT, width=150) # Dynamic classrooms
         self.view_ubicacion_filter.grid(row=0, column=1, padx=5, pady=10)
         self.view_ubicacion_filter.set("Todos")
 
@@ -572,12 +653,13 @@ class App(ctk.CTk):
 
         self.refresh_book_list_ui()
 
-    def _create_book_item_frame(self, book_data):
+    def _create_book_item_frame(self, book_data, available_count=None):
         book_item_frame = ctk.CTkFrame(self.book_list_frame, corner_radius=6, border_width=1, border_color=("gray75", "gray30"))
         book_item_frame.book_id = book_data['id'] # Store book_id here
         book_item_frame.columnconfigure(1, weight=1)
 
-        available_count = book_manager.get_available_book_count(book_data['id'])
+        if available_count is None:
+            available_count = backend.get_available_book_count(book_data['id'])
         total_count = book_data.get('cantidad_total', 0)
         availability_text = f"Disponible: {available_count} / {total_count}"
         availability_color = (("green", "lightgreen") if available_count > 0 else ("#D12D2D", "#FF6B6B"))
@@ -613,10 +695,11 @@ class App(ctk.CTk):
 
         return book_item_frame
 
-    def _update_book_item_frame_content(self, frame, book_data):
+    def _update_book_item_frame_content(self, frame, book_data, available_count=None):
         frame.book_id = book_data['id'] # Ensure book_id is up-to-date
 
-        available_count = book_manager.get_available_book_count(book_data['id'])
+        if available_count is None:
+            available_count = backend.get_available_book_count(book_data['id'])
         total_count = book_data.get('cantidad_total', 0)
         availability_text = f"Disponible: {available_count} / {total_count}"
         availability_color = (("green", "lightgreen") if available_count > 0 else ("#D12D2D", "#FF6B6B"))
@@ -634,6 +717,7 @@ class App(ctk.CTk):
         frame.widgets['lend_button'].configure(state=lend_button_state, command=lambda b_id=book_data['id']: self.prompt_lend_book_from_view_tab(b_id))
 
 
+    @profiler_hook.profile_next_action
     def refresh_book_list_ui(self, books_to_display=None):
         # For initial setup of no_books_label if it's None
         if self.no_books_label is None and hasattr(self, 'book_list_frame'):
@@ -644,7 +728,7 @@ class App(ctk.CTk):
         ubicacion_val = self.view_ubicacion_filter.get() if hasattr(self, 'view_ubicacion_filter') else "Todos"
 
         if books_to_display is None:
-            books_data_list = book_manager.get_all_books_db(
+            books_data_list = backend.get_all_books_db(
                 ubicacion_filter=ubicacion_val if ubicacion_val != "Todos" else None
             )
         else:
@@ -661,14 +745,16 @@ class App(ctk.CTk):
         # Update existing and add new book frames
         # We need to keep track of the order for packing
         ordered_frames = []
-        for book_data in books_data_list:
+        # One batch for every card's availability (a single request in server mode)
+        available_counts = backend.batch([("get_available_book_count", (book['id'],), {}) for book in books_data_list])
+        for book_data, available_count in zip(books_data_list, available_counts):
             book_id = book_data['id']
             if book_id in self.book_item_frames:
                 frame = self.book_item_frames[book_id]
-                self._update_book_item_frame_content(frame, book_data)
+                self._update_book_item_frame_content(frame, book_data, available_count)
                 ordered_frames.append(frame)
             else:
-                new_frame = self._create_book_item_frame(book_data)
+                new_frame = self._create_book_item_frame(book_data, available_count)
                 self.book_item_frames[book_id] = new_frame
                 ordered_frames.append(new_frame)
 
@@ -691,6 +777,7 @@ class App(ctk.CTk):
                 self.no_books_label.pack_forget()
 
 
+    @profiler_hook.profile_next_action
     def search_books_ui(self):
         query = self.search_entry.get()
         if not query:
@@ -699,8 +786,8 @@ class App(ctk.CTk):
 
         # Search by title and author, then combine results
         # book_manager.search_books_db now defaults to "titulo" if field not specified
-        results_titulo = book_manager.search_books_db(query, search_field="titulo")
-        results_autor = book_manager.search_books_db(query, search_field="autor")
+        results_titulo = backend.search_books_db(query, search_field="titulo")
+        results_autor = backend.search_books_db(query, search_field="autor")
         # Potentially search by genero and ubicacion as well if desired by product
         # results_genero = book_manager.search_books_db(query, search_field="genero")
         # results_ubicacion = book_manager.search_books_db(query, search_field="ubicacion")
@@ -735,7 +822,7 @@ class App(ctk.CTk):
 
         ctk.CTkLabel(add_student_frame, text="Clase:", font=BODY_FONT).grid(row=2, column=0, padx=10, pady=10, sticky="w") # BODY_FONT, Increased pady
 
-        current_classrooms_stud = student_manager.get_distinct_classrooms()
+        current_classrooms_stud = backend.get_distinct_classrooms()
         stud_combo_values = current_classrooms_stud if current_classrooms_stud else ["N/A"]
         self.student_classroom_combo = ctk.CTkComboBox(add_student_frame, values=stud_combo_values, width=300, font=BODY_FONT, dropdown_font=BODY_FONT) # Ensured BODY_FONT
         self.student_classroom_combo.grid(row=2, column=1, padx=10, pady=10, sticky="ew") # Increased pady
@@ -798,14 +885,11 @@ class App(ctk.CTk):
         role_english = role_map_simple.get(role_spanish, "student") # Default to student
 
         # For this simplified tab, password is not set directly, so it will be None
-        student_id = student_manager.add_student_db(name, classroom_stripped, None, role_english)
+        student_id = backend.add_student_db(name, classroom_stripped, None, role_english)
         if student_id:
             messagebox.showinfo("¡Fantástico! ✨", f"¡El alumno '{name}' se ha unido al listado!") # Translated
             self.student_name_entry.delete(0, "end")
-            # self.refresh_student_list_ui() # This will be covered by refresh_all_classroom_displays
-            # if hasattr(self, 'refresh_leader_selector_combo'):
-            #      self.refresh_leader_selector_combo() # Also covered by refresh_all_classroom_displays
-            self.refresh_all_classroom_displays() # Ensure all classroom lists are updated
+            self.refresh_changed_views() # student lists, classroom lists and leader selector
         else:
             messagebox.showerror("¡Oh No! 💔", "Algo salió mal al añadir el alumno. Revisa la consola.") # Translated
 
@@ -832,6 +916,7 @@ class App(ctk.CTk):
         frame.configure(fg_color=fg_color)
 
 
+    @profiler_hook.profile_next_action
     def refresh_student_list_ui(self):
         if not hasattr(self, 'students_list_frame'):
             return
@@ -841,7 +926,7 @@ class App(ctk.CTk):
             self.no_students_label_manage_tab = ctk.CTkLabel(self.students_list_frame, text="No se encontraron alumnos.", font=BODY_FONT)
             # Don't pack it yet
 
-        students_data_list = student_manager.get_students_db() # Fetches all students
+        students_data_list = backend.get_students_db() # Fetches all students
 
         current_student_ids_to_display = {student['id'] for student in students_data_list}
         existing_student_ids = set(self.student_item_frames.keys())
@@ -951,6 +1036,22 @@ class App(ctk.CTk):
         self.extend_loan_button = ctk.CTkButton(return_frame, text="Extender Préstamo", image=extend_loan_icon, font=BUTTON_FONT, state="disabled", corner_radius=8, command=self.extend_loan_ui) # Ensured BUTTON_FONT and corner_radius
         self.extend_loan_button.grid(row=4, column=0, columnspan=2, pady=(5,15), sticky="ew")
 
+        # --- Library-hour session: loans and returns are queued and registered together ---
+        self.session_loans = [] # dicts for backend.loan_books_bulk_db
+        self.session_returns = [] # dicts for backend.return_books_bulk_db
+        self.session_leader_id = None
+        session_frame = ctk.CTkFrame(left_frame, corner_radius=8)
+        session_frame.pack(pady=10, padx=10, fill="x")
+        self.session_mode_switch = ctk.CTkSwitch(session_frame, text="Modo sesión (hora de biblioteca)", font=BODY_FONT, command=self.on_session_mode_toggle)
+        self.session_mode_switch.grid(row=0, column=0, columnspan=2, padx=5, pady=(10,5), sticky="w")
+        self.session_status_label = ctk.CTkLabel(session_frame, text="Préstamos y devoluciones se registran al momento.", font=BODY_FONT, wraplength=320, justify="left")
+        self.session_status_label.grid(row=1, column=0, columnspan=2, padx=5, pady=5, sticky="w")
+        self.finish_session_button = ctk.CTkButton(session_frame, text="Registrar sesión", font=BUTTON_FONT, state="disabled", corner_radius=8, command=self.finish_session_ui)
+        self.finish_session_button.grid(row=2, column=0, padx=5, pady=(5,10), sticky="ew")
+        self.discard_session_button = ctk.CTkButton(session_frame, text="Descartar cola", font=BUTTON_FONT, state="disabled", corner_radius=8, fg_color="gray", command=self.discard_session_ui)
+        self.discard_session_button.grid(row=2, column=1, padx=5, pady=(5,10), sticky="ew")
+        session_frame.columnconfigure((0, 1), weight=1)
+
         right_frame = ctk.CTkFrame(main_loan_content_frame, fg_color="transparent")
         right_frame.pack(side="left", expand=True, fill="both", padx=(10,0), pady=0)
 
@@ -976,7 +1077,7 @@ class App(ctk.CTk):
         self.refresh_leader_selector_combo() # Populate initially, which then calls on_leader_selected
 
     def refresh_leader_selector_combo(self):
-        leaders = student_manager.get_students_db(role_filter='leader')
+        leaders = backend.get_students_db(role_filter='leader')
         self.leader_student_map = {f"{s['name']} ({s['classroom']})": s['id'] for s in leaders} # classroom here refers to student's classroom
         leader_names = list(self.leader_student_map.keys())
 
@@ -987,6 +1088,8 @@ class App(ctk.CTk):
         if leader_names:
             if current_value in leader_names:
                 self.leader_selector_combo.set(current_value)
+                if self.leader_student_map[current_value] == self.current_leader_id:
+                    return # same leader and classroom: keep the loan lists (and any queued session)
             else:
                 self.leader_selector_combo.set(leader_names[0])
             self.on_leader_selected(self.leader_selector_combo.get())
@@ -995,9 +1098,11 @@ class App(ctk.CTk):
             self.on_leader_selected(None)
 
     def on_leader_selected(self, selected_leader_display_name):
+        if self.session_loans or self.session_returns:
+            self.finish_session_ui() # the queue belongs to the previous leader
         if selected_leader_display_name and selected_leader_display_name != "No hay líderes": # Translated
             self.current_leader_id = self.leader_student_map.get(selected_leader_display_name)
-            leader_details = student_manager.get_student_by_id_db(self.current_leader_id)
+            leader_details = backend.get_student_by_id_db(self.current_leader_id)
             if leader_details:
                 self.current_leader_classroom = leader_details['classroom'] # This is the leader's classroom, used as ubicacion for books
                 self.current_loans_label.configure(text=f"Préstamos Actuales en {self.current_leader_classroom}") # Translated
@@ -1038,6 +1143,7 @@ class App(ctk.CTk):
         for widget in self.reminders_frame.winfo_children(): widget.destroy()
         ctk.CTkLabel(self.reminders_frame, text="Por favor, seleccione un líder estudiantil para ver recordatorios.", font=BODY_FONT).pack(pady=20, padx=10) # Translated
 
+    @profiler_hook.profile_next_action
     def refresh_loan_related_combos_and_lists(self):
         if not self.current_leader_id or not self.current_leader_classroom: # current_leader_classroom is the ubicacion
             self.update_loan_section_for_no_leader()
@@ -1045,13 +1151,27 @@ class App(ctk.CTk):
 
         can_lend = True # Flag to manage lend button state
 
+        # The independent reads of this refresh, fetched concurrently in server mode
+        data = backend.fetch_all({
+            'books': ("get_all_books_db", (), {'ubicacion_filter': None}), # Filter by leader's classroom later if needed
+            'students': ("get_students_by_classroom_db", (self.current_leader_classroom,), {}),
+            # Only the loans of the leader's class: students by classroom, then their loans, in SQL
+            'loans': ("get_current_loans_db", (), {'classroom_filter': self.current_leader_classroom}),
+        })
+
         # Populate Lend Book ComboBox
-        all_books_in_ubicacion = book_manager.get_all_books_db(ubicacion_filter=None) # Filter by leader's classroom later if needed
+        all_books_in_ubicacion = data['books']
+        # Refreshes also come from changes made elsewhere: keep what the leader had picked
+        previous_book_id = self.lend_book_map.get(self.lend_book_combo.get())
+        previous_borrower = self.borrower_combo.get()
+        previous_return = self.return_book_combo.get()
+        available_counts = backend.batch([("get_available_book_count", (book['id'],), {}) for book in all_books_in_ubicacion])
         lend_book_display_names = []
         self.lend_book_map = {}
-        for book in all_books_in_ubicacion:
-            available_count = book_manager.get_available_book_count(book['id'])
+        self.lend_book_available = {}
+        for book, available_count in zip(all_books_in_ubicacion, available_counts):
             if available_count > 0:
+                self.lend_book_available[book['id']] = available_count
                 display_text = f"{book.get('titulo', 'N/A')} (por {book.get('autor', 'N/A')}) - Disp: {available_count}" # Spanish 'by'
                 self.lend_book_map[display_text] = book['id']
                 lend_book_display_names.append(display_text)
@@ -1062,11 +1182,12 @@ class App(ctk.CTk):
             can_lend = False
         else:
             self.lend_book_combo.configure(values=lend_book_display_names, state="normal")
-            self.lend_book_combo.set(lend_book_display_names[0])
+            self.lend_book_combo.set(next((name for name, book_id in self.lend_book_map.items() if book_id == previous_book_id),
+                                          lend_book_display_names[0]))
 
         # Populate Borrower ComboBox
         # Students from the selected leader's classroom
-        students_in_classroom = student_manager.get_students_by_classroom_db(self.current_leader_classroom)
+        students_in_classroom = data['students']
         self.borrower_student_map = {s['name']: s['id'] for s in students_in_classroom if s['id'] != self.current_leader_id} # Leader cannot borrow from themselves
         borrower_names = list(self.borrower_student_map.keys())
 
@@ -1076,7 +1197,7 @@ class App(ctk.CTk):
             can_lend = False
         else:
             self.borrower_combo.configure(values=borrower_names, state="normal")
-            self.borrower_combo.set(borrower_names[0])
+            self.borrower_combo.set(previous_borrower if previous_borrower in borrower_names else borrower_names[0])
 
         # Manage Lend Book Button state
         if hasattr(self, 'lend_book_button'): # Ensure button exists
@@ -1085,20 +1206,15 @@ class App(ctk.CTk):
             else:
                 self.lend_book_button.configure(state="disabled")
 
-        # Populate Return Book ComboBox
-        # New Logic: Fetch all loans, then filter by students in the leader's class
-        students_in_leader_class = student_manager.get_students_by_classroom_db(self.current_leader_classroom)
-        student_ids_in_leader_class = [s['id'] for s in students_in_leader_class]
-
-        all_active_loans = book_manager.get_current_loans_db(ubicacion_filter=None, student_id_filter=None) # Ensure fetching all
-
-        relevant_loans_for_return = []
-        if all_active_loans: # Ensure all_active_loans is not None
-            relevant_loans_for_return = [loan for loan in all_active_loans if loan.get('student_id') in student_ids_in_leader_class]
+        # Populate Return Book ComboBox with the loans of the leader's class
+        relevant_loans_for_return = data['loans']
 
         self.return_book_map = {}
         return_book_display_names = []
+        queued_returns = {item['loan_id'] for item in self.session_returns}
         for loan in relevant_loans_for_return:
+            if loan['loan_id'] in queued_returns: # already queued in this session
+                continue
             due_date_str = loan.get('due_date', 'N/A')
             due_date_display = 'N/A'
             if due_date_str != 'N/A':
@@ -1117,13 +1233,14 @@ class App(ctk.CTk):
             self.return_book_combo.set("No hay libros prestados por alumnos de esta clase") # Updated placeholder
         else:
             self.return_book_combo.configure(values=return_book_display_names, state="normal")
-            self.return_book_combo.set(return_book_display_names[0])
+            self.return_book_combo.set(previous_return if previous_return in return_book_display_names else return_book_display_names[0])
 
         self.on_return_book_selection_change(self.return_book_combo.get())
 
-        self.refresh_current_loans_list()
+        self.refresh_current_loans_list(data['loans'])
         self.refresh_reminders_list()
 
+    @profiler_hook.profile_next_action
     def lend_book_ui(self):
         if not self.current_leader_id:
             messagebox.showerror("Líder No Seleccionado", "Por favor, seleccione primero un líder estudiantil.") # Translated
@@ -1146,17 +1263,21 @@ class App(ctk.CTk):
         due_date_calculated = datetime.now() + timedelta(days=14)
         due_date_str_for_db = due_date_calculated.strftime('%Y-%m-%d')
 
-        success = book_manager.loan_book_db(book_id, borrower_id, due_date_str_for_db, self.current_leader_id)
+        if self.session_mode_switch.get():
+            self.queue_session_loan(book_id, borrower_id, due_date_str_for_db, book_display_name.split(' (por ')[0], borrower_display_name)
+            return
+
+        success = backend.loan_book_db(book_id, borrower_id, due_date_str_for_db, self.current_leader_id)
 
         if success:
             # Assuming display_text format: "Book Title (por Author) - Disp: Count"
             actual_book_title = book_display_name.split(' (por ')[0]
             messagebox.showinfo("Éxito", f"Libro '{actual_book_title}' prestado a {borrower_display_name}.") # Translated
-            self.refresh_loan_related_combos_and_lists()
-            if hasattr(self, 'refresh_book_list_ui'): self.refresh_book_list_ui()
+            self.refresh_changed_views()
         else:
             messagebox.showerror("Préstamo Fallido", "Error al prestar el libro. Revise la consola (el libro podría no estar disponible o ocurrió otro error de BD).") # Translated
 
+    @profiler_hook.profile_next_action
     def return_book_ui(self):
         if not self.current_leader_id:
             messagebox.showerror("Líder No Seleccionado", "Por favor, seleccione primero un líder estudiantil.") # Translated
@@ -1174,19 +1295,104 @@ class App(ctk.CTk):
 
         is_worksheet_submitted = bool(self.worksheet_submitted_checkbox.get())
 
+        if self.session_mode_switch.get():
+            self.queue_session_return(loan_id, is_worksheet_submitted, return_loan_display_name)
+            return
+
         # Call the updated book_manager.return_book_db with loan_id
-        success = book_manager.return_book_db(loan_id, self.current_leader_id, worksheet_submitted=is_worksheet_submitted)
+        success = backend.return_book_db(loan_id, self.current_leader_id, worksheet_submitted=is_worksheet_submitted)
 
         if success:
             messagebox.showinfo("Success", f"Loan returned successfully.")
-            self.refresh_loan_related_combos_and_lists()
-            if hasattr(self, 'refresh_book_list_ui'): self.refresh_book_list_ui()
+            self.refresh_changed_views()
             self.worksheet_submitted_checkbox.deselect()
             # Ensure the checkbox state is updated based on new combo selection
             self.on_return_book_selection_change(self.return_book_combo.get())
         else:
             messagebox.showerror("Return Failed", "Failed to return book. Check console (loan ID might be invalid or other DB error).")
 
+    # --- Library-hour session ---
+
+    def on_session_mode_toggle(self):
+        if not self.session_mode_switch.get() and (self.session_loans or self.session_returns):
+            self.finish_session_ui() # switching off registers what was queued
+        self._update_session_status()
+
+    def _start_session_item(self):
+        if self.session_leader_id is None:
+            self.session_leader_id = self.current_leader_id
+
+    def queue_session_loan(self, book_id, borrower_id, due_date_str, book_title, borrower_name):
+        queued_copies = sum(1 for loan in self.session_loans if loan['book_id'] == book_id)
+        if queued_copies >= self.lend_book_available.get(book_id, 0):
+            messagebox.showerror("Sin ejemplares", f"Ya están en cola todos los ejemplares libres de '{book_title}'.")
+            return
+        self._start_session_item()
+        self.session_loans.append({'book_id': book_id, 'student_id': borrower_id, 'due_date': due_date_str})
+        self._update_session_status(f"En cola: '{book_title}' para {borrower_name}.")
+
+    def queue_session_return(self, loan_id, worksheet_submitted, display_name):
+        self._start_session_item()
+        self.session_returns.append({'loan_id': loan_id, 'worksheet_submitted': worksheet_submitted})
+        # Take the loan out of the combo so it can't be queued twice.
+        self.return_book_map.pop(display_name, None)
+        remaining = list(self.return_book_map.keys())
+        if remaining:
+            self.return_book_combo.configure(values=remaining)
+            self.return_book_combo.set(remaining[0])
+        else:
+            self.return_book_combo.configure(values=["No quedan préstamos por devolver"])
+            self.return_book_combo.set("No quedan préstamos por devolver")
+        self.worksheet_submitted_checkbox.deselect()
+        self.on_return_book_selection_change(self.return_book_combo.get())
+        self._update_session_status(f"En cola: devolución de {display_name.split(' (Prestatario')[0]}.")
+
+    def _update_session_status(self, last_action=None):
+        queued = len(self.session_loans) + len(self.session_returns)
+        if not self.session_mode_switch.get() and not queued:
+            text = "Préstamos y devoluciones se registran al momento."
+        else:
+            text = f"Cola de la sesión: {len(self.session_loans)} préstamo(s), {len(self.session_returns)} devolución(es)."
+            if last_action:
+                text += f"\n{last_action}"
+        self.session_status_label.configure(text=text)
+        state = "normal" if queued else "disabled"
+        self.finish_session_button.configure(state=state)
+        self.discard_session_button.configure(state=state)
+
+    @profiler_hook.profile_next_action
+    def finish_session_ui(self):
+        """Registers the queued returns and then the queued loans (each in one transaction) and refreshes once.
+        Items refused one by one leave the queue; if a call fails as a whole, its items stay queued."""
+        leader_id = self.session_leader_id or self.current_leader_id
+        returns, loans = self.session_returns, self.session_loans
+        points, return_errors = backend.return_books_bulk_db(returns, leader_id) if returns else ([], [])
+        loan_ids, loan_errors = backend.loan_books_bulk_db(loans, leader_id) if loans else ([], [])
+        self.session_returns = data_backend.bulk_items_not_attempted(returns, points, return_errors)
+        self.session_loans = data_backend.bulk_items_not_attempted(loans, loan_ids, loan_errors)
+        if not self.session_returns and not self.session_loans:
+            self.session_leader_id = None
+        returned = sum(1 for p in points if p is not None)
+        lent = sum(1 for loan_id in loan_ids if loan_id)
+        summary = f"Sesión registrada: {lent} de {len(loans)} préstamo(s) y {returned} de {len(returns)} devolución(es)."
+        if self.session_returns or self.session_loans:
+            summary += (f"\nSiguen en cola {len(self.session_loans)} préstamo(s) y {len(self.session_returns)} "
+                        "devolución(es) que no se pudieron registrar; pulse de nuevo «Registrar sesión» para reintentarlo.")
+        errors = return_errors + loan_errors
+        if errors:
+            messagebox.showwarning("Sesión registrada con incidencias", summary + "\n\n" + "\n".join(errors[:15]))
+        else:
+            messagebox.showinfo("Sesión registrada", summary)
+        self._update_session_status()
+        self.refresh_changed_views()
+
+    def discard_session_ui(self):
+        if not messagebox.askyesno("Descartar cola", "¿Descartar los préstamos y devoluciones en cola sin registrarlos?"):
+            return
+        self.session_returns, self.session_loans, self.session_leader_id = [], [], None
+        self._update_session_status()
+        self.refresh_loan_related_combos_and_lists() # puts the queued returns back in the combo
+
     def on_return_book_selection_change(self, selection=None): # 'selection' arg is passed by CTkComboBox command
         # selection is the display text from the combobox
         loan_id = self.return_book_map.get(selection)
@@ -1198,6 +1404,7 @@ class App(ctk.CTk):
             self.worksheet_submitted_checkbox.configure(state="disabled")
             self.worksheet_submitted_checkbox.deselect()
 
+    @profiler_hook.profile_next_action
     def extend_loan_ui(self):
         selected_loan_display_text = self.return_book_combo.get()
         loan_id = self.return_book_map.get(selected_loan_display_text)
@@ -1208,12 +1415,11 @@ class App(ctk.CTk):
 
         # Assuming book_manager.extend_loan_db(loan_id) will be created and will return True on success, False on failure.
         # We'll default days_to_extend to 14 in the db function.
-        success = book_manager.extend_loan_db(loan_id)
+        success = backend.extend_loan_db(loan_id)
 
         if success:
             messagebox.showinfo("Éxito", "Préstamo extendido con éxito por 14 días.")
-            self.refresh_loan_related_combos_and_lists()
-            # Consider if self.refresh_book_list_ui() is needed if due dates are shown there or affect availability. For now, focus on loan list.
+            self.refresh_changed_views()
         else:
             messagebox.showerror("Error", "No se pudo extender el préstamo. Verifique la consola para más detalles.")
 
@@ -1280,7 +1486,9 @@ class App(ctk.CTk):
         frame.widgets['details_label'].configure(text=details)
 
 
-    def refresh_current_loans_list(self):
+    @profiler_hook.profile_next_action
+    def refresh_current_loans_list(self, loans_data_list=None):
+        # loans_data_list: the class's loans when the caller already has them
         if not hasattr(self, 'current_loans_frame'): return
 
         if self.no_current_loans_label is None:
@@ -1302,11 +1510,8 @@ class App(ctk.CTk):
             self.no_current_loans_label.pack_forget()
 
 
-        loans_data_list = book_manager.get_current_loans_db(ubicacion_filter=None) # Filter by leader's class if necessary, or all for admin view
-        # Assuming loans for the current leader's classroom are desired here,
-        # The original code fetched all loans (ubicacion_filter=None) then displayed a label like "in {self.current_leader_classroom}"
-        # This might need adjustment if loans should be filtered by self.current_leader_classroom at DB level.
-        # For now, replicating existing logic of fetching all.
+        if loans_data_list is None:
+            loans_data_list = backend.get_current_loans_db(classroom_filter=self.current_leader_classroom)
 
         current_loan_ids_to_display = {loan['loan_id'] for loan in loans_data_list}
         existing_loan_ids = set(self.loan_item_frames.keys())
@@ -1407,6 +1612,7 @@ class App(ctk.CTk):
                                                  text_color=text_color_for_label,
                                                  font=ctk.CTkFont(family=APP_FONT_FAMILY, size=BODY_FONT[1], weight=font_weight))
 
+    @profiler_hook.profile_next_action
     def refresh_reminders_list(self):
         if not hasattr(self, 'reminders_frame'): return
 
@@ -1426,7 +1632,8 @@ class App(ctk.CTk):
         if self.no_reminders_label.winfo_ismapped() and self.no_reminders_label.cget("text") == "Seleccione un líder para ver los recordatorios.":
             self.no_reminders_label.pack_forget()
 
-        reminders_data_list = book_manager.get_books_due_soon_db(days_threshold=7, ubicacion_filter=None) # Similar to loans, fetched all.
+        # Loans of the leader's classroom overdue or due within a week, from the daily snapshot
+        reminders_data_list = backend.get_classroom_reminders_db(self.current_leader_classroom)
 
         current_reminder_loan_ids = {reminder['loan_id'] for reminder in reminders_data_list} # Keyed by loan_id
         existing_reminder_loan_ids = set(self.reminder_item_frames.keys())
@@ -1496,7 +1703,7 @@ class App(ctk.CTk):
 
         ctk.CTkLabel(add_user_outer_frame, text="Clase/Oficina:", font=BODY_FONT).grid(row=4, column=0, padx=(10,5), pady=10, sticky="w") # BODY_FONT, pady adjusted
 
-        current_classrooms_um = student_manager.get_distinct_classrooms()
+        current_classrooms_um = backend.get_distinct_classrooms()
         # Ensure "OficinaAdmin" is always an option, and handle if no other classrooms exist
         um_initial_values = sorted(list(set(current_classrooms_um + ["OficinaAdmin"])))
         if not um_initial_values:
@@ -1536,7 +1743,7 @@ class App(ctk.CTk):
 
         # Populate classroom combo for CSV import
         # Note: get_distinct_classrooms() is already defined in student_manager
-        available_classrooms_for_csv = student_manager.get_distinct_classrooms()
+        available_classrooms_for_csv = backend.get_distinct_classrooms()
         if not available_classrooms_for_csv: # If no classrooms exist yet, provide a default or guidance
             available_classrooms_for_csv = ["Primero cree una clase"]
 
@@ -1687,13 +1894,14 @@ class App(ctk.CTk):
         frame.bind("<Button-1>", lambda event, uid=user_id, udata=user_data: self.select_user_for_management(uid, udata))
         frame.widgets['details_label'].bind("<Button-1>", lambda event, uid=user_id, udata=user_data: self.select_user_for_management(uid, udata))
 
+    @profiler_hook.profile_next_action
     def refresh_user_list_ui(self):
         if not hasattr(self, 'user_list_scroll_frame'): return
 
         if self.no_users_label_admin_tab is None:
             self.no_users_label_admin_tab = ctk.CTkLabel(self.user_list_scroll_frame, text="No hay usuarios en el sistema.", font=BODY_FONT)
 
-        users_data_list = student_manager.get_students_db()
+        users_data_list = backend.get_students_db()
 
         current_user_ids_to_display = {user['id'] for user in users_data_list}
         existing_user_ids = set(self.user_item_frames_admin_tab.keys())
@@ -1781,11 +1989,11 @@ class App(ctk.CTk):
                 messagebox.showerror("Error de Entrada", "Por favor, seleccione o introduzca un nombre de clase/oficina válido.")
             return
 
-        student_id = student_manager.add_student_db(name, classroom_stripped, password, role_english)
+        student_id = backend.add_student_db(name, classroom_stripped, password, role_english)
         if student_id:
             messagebox.showinfo("Éxito", f"Usuario '{name}' ({role_english}) añadido con éxito. ID: {student_id}") # Translated
             self.clear_user_form_ui(clear_selection=False)
-            self.refresh_all_classroom_displays()
+            self.refresh_changed_views()
         else:
             messagebox.showerror("Error de Base de Datos", f"Error al añadir usuario '{name}'. Revisa la consola para más detalles.") # Translated
 
@@ -1816,15 +2024,15 @@ class App(ctk.CTk):
         }
         new_role_english = role_map.get(new_role_spanish.lower(), "student") # Default to student if mapping fails
 
-        success = student_manager.update_student_details_db(user_id, new_name, new_classroom_stripped, new_role_english)
+        success = backend.update_student_details_db(user_id, new_name, new_classroom_stripped, new_role_english)
 
         if success:
             messagebox.showinfo("Actualización Exitosa", f"Los detalles del usuario '{new_name}' (Rol: {new_role_spanish}) han sido actualizados.") # Translated, show Spanish role
 
             # Check if the user was made a leader and has no password
             if new_role_english == 'leader':
-                updated_student_details = student_manager.get_student_by_id_db(user_id)
-                if updated_student_details and (updated_student_details.get('hashed_password') is None or updated_student_details.get('hashed_password') == ''):
+                updated_student_details = backend.get_student_by_id_db(user_id)
+                if updated_student_details and not data_backend.student_has_password(updated_student_details):
                     # Prompt to set password for the new leader
                     new_leader_password = simpledialog.askstring("Establecer Contraseña para Líder", # Translated
                                                                  f"El usuario {new_name} ha sido asignado como líder. Por favor, establece una contraseña para este líder:", # Translated
@@ -1833,7 +2041,7 @@ class App(ctk.CTk):
                         confirm_leader_password = simpledialog.askstring("Confirmar Nueva Contraseña", # Translated
                                                                          "Confirma la nueva contraseña:", show='*') # Translated
                         if new_leader_password == confirm_leader_password:
-                            if student_manager.update_student_password_db(user_id, new_leader_password):
+                            if backend.update_student_password_db(user_id, new_leader_password):
                                 messagebox.showinfo("Contraseña Establecida", f"Contraseña para el líder {new_name} establecida con éxito.") # Translated
                             else:
                                 messagebox.showerror("Error de Contraseña", f"No se pudo establecer la contraseña para {new_name}.") # Translated
@@ -1844,10 +2052,7 @@ class App(ctk.CTk):
 
 
             self.clear_user_form_ui(clear_selection=True)
-            # self.refresh_user_list_ui() # Covered
-            # if hasattr(self, 'refresh_student_list_ui'): self.refresh_student_list_ui() # Covered
-            # if hasattr(self, 'refresh_leader_selector_combo'): self.refresh_leader_selector_combo() # Covered
-            self.refresh_all_classroom_displays()
+            self.refresh_changed_views()
         else:
             messagebox.showerror("Actualización Fallida", f"No se pudieron actualizar los detalles para el usuario '{new_name}'. Por favor, revisa la consola.") # Translated
 
@@ -1857,19 +2062,17 @@ class App(ctk.CTk):
             return
 
         user_id = self.selected_user_id_manage_tab
-        user_details = student_manager.get_student_by_id_db(user_id)
+        user_details = backend.get_student_by_id_db(user_id)
         user_name = user_details['name'] if user_details else "el usuario seleccionado" # Translated
 
         if not messagebox.askyesno("Confirmar Eliminación", f"¿Estás seguro de que quieres eliminar permanentemente al usuario '{user_name}' (ID: {user_id[:8]})?\nEsta acción no se puede deshacer."): # Translated
             return
 
-        success = student_manager.delete_student_db(user_id)
+        success = backend.delete_student_db(user_id)
         if success:
             messagebox.showinfo("Eliminación Exitosa", f"El usuario '{user_name}' ha sido eliminado.") # Translated
             self.clear_user_form_ui(clear_selection=True)
-            self.refresh_user_list_ui()
-            if hasattr(self, 'refresh_student_list_ui'): self.refresh_student_list_ui()
-            if hasattr(self, 'refresh_leader_selector_combo'): self.refresh_leader_selector_combo()
+            self.refresh_changed_views()
         else:
             messagebox.showerror("Eliminación Fallida", f"Error al eliminar el usuario '{user_name}'. Podría estar involucrado en préstamos activos o ocurrió un error.") # Translated
 
@@ -1879,7 +2082,7 @@ class App(ctk.CTk):
             return
 
         user_id = self.selected_user_id_manage_tab
-        user_details = student_manager.get_student_by_id_db(user_id)
+        user_details = backend.get_student_by_id_db(user_id)
         user_name = user_details['name'] if user_details else "usuario seleccionado" # Translated
 
         new_password = simpledialog.askstring("Nueva Contraseña", f"Introduce la nueva contraseña para {user_name}:", show='*') # Translated
@@ -1892,12 +2095,13 @@ class App(ctk.CTk):
             messagebox.showerror("Contraseñas no Coinciden", "Las nuevas contraseñas no coinciden. La contraseña no ha sido restablecida.") # Translated
             return
 
-        success = student_manager.update_student_password_db(user_id, new_password)
+        success = backend.update_student_password_db(user_id, new_password)
         if success:
             messagebox.showinfo("Contraseña Restablecida", f"La contraseña para el usuario '{user_name}' ha sido restablecida con éxito.") # Translated
         else:
             messagebox.showerror("Error al Restablecer Contraseña", f"Error al restablecer la contraseña para '{user_name}'.") # Translated
 
+    @profiler_hook.profile_next_action
     def import_students_csv_ui(self):
         selected_classroom = self.import_csv_classroom_combo.get().strip() # Added .strip() here
         if not selected_classroom or selected_classroom == "Primero cree una clase": # Check after stripping
@@ -1911,7 +2115,7 @@ class App(ctk.CTk):
         if not file_path:
             return # User cancelled
 
-        success_count, errors = student_manager.import_students_from_csv(file_path, selected_classroom)
+        success_count, errors = backend.import_students_from_csv(file_path, selected_classroom)
 
         summary_message = f"Resumen de Importación de Alumnos CSV:\n\nAlumnos importados con éxito: {success_count} a la clase '{selected_classroom}'." # Translated
         if errors:
@@ -1923,7 +2127,7 @@ class App(ctk.CTk):
         else:
             messagebox.showinfo("Importación Exitosa", summary_message) # Translated
 
-        self.refresh_all_classroom_displays() # Use the new central refresh method
+        self.refresh_changed_views()
 
 
     def setup_manage_classrooms_tab(self):
@@ -1971,7 +2175,7 @@ class App(ctk.CTk):
         for widget in self.classrooms_list_frame.winfo_children():
             widget.destroy()
 
-        classrooms = student_manager.get_distinct_classrooms()
+        classrooms = backend.get_distinct_classrooms()
         if not classrooms:
             ctk.CTkLabel(self.classrooms_list_frame, text="No hay clases definidas actualmente.", font=BODY_FONT).pack(pady=10) # Translated
             # Disable rename functionality if no classes
@@ -2019,11 +2223,11 @@ class App(ctk.CTk):
         #                                f"La clase '{new_name}' ya existe. Si continúas, los alumnos de '{old_name}' se moverán a '{new_name}'.\n¿Estás seguro?"):
         #         return
 
-        success = student_manager.rename_classroom(old_name, new_name)
+        success = backend.rename_classroom(old_name, new_name)
 
         if success:
             messagebox.showinfo("Éxito", f"La clase '{old_name}' ha sido renombrada a '{new_name}'.") # Translated
-            self.refresh_all_classroom_displays()
+            self.refresh_changed_views()
             # Reset selection and UI state
             self.selected_classroom_for_rename = None
             self.rename_classroom_entry.delete(0, "end")
@@ -2032,13 +2236,14 @@ class App(ctk.CTk):
         else:
             messagebox.showerror("Error al Renombrar", f"No se pudo renombrar la clase '{old_name}'. Verifica si la clase tenía alumnos o revisa la consola.") # Translated
 
+    @profiler_hook.profile_next_action
     def refresh_all_classroom_displays(self):
         # 1. Refresh the list in the current "Gestionar Clases" tab
         if hasattr(self, 'refresh_classroom_management_list'):
             self.refresh_classroom_management_list()
 
         # 2. Get updated list of distinct classrooms
-        updated_classrooms = student_manager.get_distinct_classrooms()
+        updated_classrooms = backend.get_distinct_classrooms()
         # Ensure "OficinaAdmin" is available if it's special, or handle classroom lists consistently
         # For now, let's assume "OficinaAdmin" might not be in distinct_classrooms if no student is there.
         # It's better if UI elements requiring "OficinaAdmin" explicitly add it if not present.
@@ -2131,9 +2336,331 @@ class App(ctk.CTk):
         if hasattr(self, 'refresh_leader_selector_combo'):
             self.refresh_leader_selector_combo()
 
+        # 10. Refresh classroom filter in "Exportar"
+        if hasattr(self, 'export_classroom_menu'):
+            self.refresh_export_classrooms()
+
         print("All relevant classroom displays and lists have been refreshed.")
 
 
+    def setup_diagnostics_tab(self):
+        """Admin-only view of query_monitor stats: slowest manager functions and SQL statements."""
+        tab = self.diagnostics_tab
+
+        controls_frame = ctk.CTkFrame(tab, fg_color="transparent")
+        controls_frame.pack(fill="x", padx=15, pady=(15, 5))
+
+        ctk.CTkLabel(controls_frame, text="Umbral de consulta lenta (ms):", font=BODY_FONT).pack(side="left", padx=(0, 5))
+        self.slow_threshold_entry = ctk.CTkEntry(controls_frame, font=BODY_FONT, width=80)
+        self.slow_threshold_entry.insert(0, f"{query_monitor.SLOW_QUERY_THRESHOLD_MS:g}")
+        self.slow_threshold_entry.pack(side="left", padx=(0, 5))
+        ctk.CTkButton(controls_frame, text="Aplicar", font=BUTTON_FONT, width=90, corner_radius=8,
+                      command=self.apply_slow_threshold_ui).pack(side="left", padx=(0, 20))
+
+        ctk.CTkButton(controls_frame, text="Actualizar", font=BUTTON_FONT, width=110, corner_radius=8,
+                      command=self.refresh_diagnostics_display).pack(side="left", padx=5)
+        ctk.CTkButton(controls_frame, text="Reiniciar Estadísticas", font=BUTTON_FONT, corner_radius=8,
+                      command=self.reset_diagnostics_ui).pack(side="left", padx=5)
+
+        self.slow_log_path_label = ctk.CTkLabel(tab, text="", font=BODY_FONT, anchor="w")
+        self.slow_log_path_label.pack(fill="x", padx=15, pady=(0, 5))
+        self.read_cache_label = ctk.CTkLabel(tab, text="", font=BODY_FONT, anchor="w", justify="left")
+        self.read_cache_label.pack(fill="x", padx=15, pady=(0, 5))
+
+        profile_frame = ctk.CTkFrame(tab, fg_color="transparent")
+        profile_frame.pack(fill="x", padx=15, pady=(0, 5))
+        self.profile_next_action_switch = ctk.CTkSwitch(profile_frame, text="Perfilar la próxima acción (cProfile)", font=BODY_FONT,
+                                                        command=self.toggle_profile_next_action_ui)
+        self.profile_next_action_switch.pack(side="left")
+        self.profile_status_label = ctk.CTkLabel(profile_frame, text="", font=BODY_FONT, anchor="w")
+        self.profile_status_label.pack(side="left", padx=15, fill="x", expand=True)
+
+        ctk.CTkLabel(tab, text="Funciones más lentas (tiempo total)", font=SUBHEADING_FONT).pack(anchor="w", padx=15, pady=(5, 0))
+        self.diagnostics_functions_frame = ctk.CTkScrollableFrame(tab, corner_radius=6, height=200)
+        self.diagnostics_functions_frame.pack(fill="both", expand=True, padx=15, pady=(5, 10))
+
+        ctk.CTkLabel(tab, text="Consultas SQL más lentas (tiempo total)", font=SUBHEADING_FONT).pack(anchor="w", padx=15, pady=(5, 0))
+        self.diagnostics_statements_frame = ctk.CTkScrollableFrame(tab, corner_radius=6, height=200)
+        self.diagnostics_statements_frame.pack(fill="both", expand=True, padx=15, pady=(5, 15))
+
+        self.refresh_diagnostics_display()
+
+    def _fill_diagnostics_table(self, frame, rows, name_key):
+        for widget in frame.winfo_children():
+            widget.destroy()
+        if not rows:
+            ctk.CTkLabel(frame, text="Todavía no hay datos registrados.", font=BODY_FONT).grid(row=0, column=0, pady=10, padx=10)
+            return
+
+        headers = ["Nombre", "Llamadas", "Total (ms)", "Media (ms)", "Máx. (ms)", "Filas"]
+        frame.grid_columnconfigure(0, weight=1)
+        for col, header in enumerate(headers):
+            ctk.CTkLabel(frame, text=header, font=BUTTON_FONT).grid(row=0, column=col, padx=6, pady=(0, 4), sticky="w" if col == 0 else "e")
+
+        for row_index, stats in enumerate(rows, start=1):
+            name = stats[name_key]
+            if len(name) > 90:
+                name = name[:87] + "..."
+            values = [name, str(stats['calls']), f"{stats['total_ms']:.1f}", f"{stats['avg_ms']:.2f}",
+                      f"{stats['max_ms']:.1f}", str(stats['rows'])]
+            slow = stats['max_ms'] >= query_monitor.SLOW_QUERY_THRESHOLD_MS
+            for col, value in enumerate(values):
+                ctk.CTkLabel(frame, text=value, font=BODY_FONT, anchor="w" if col == 0 else "e",
+                             text_color=("#C0392B", "#FF6B6B") if slow else None
+                             ).grid(row=row_index, column=col, padx=6, pady=1, sticky="w" if col == 0 else "e")
+
+    def refresh_diagnostics_display(self):
+        if not hasattr(self, 'diagnostics_functions_frame'):
+            return
+        self._fill_diagnostics_table(self.diagnostics_functions_frame, query_monitor.get_function_stats(limit=15), 'function')
+        self._fill_diagnostics_table(self.diagnostics_statements_frame, query_monitor.get_statement_stats(limit=15), 'sql')
+        log_path = query_monitor.get_slow_log_path()
+        self.slow_log_path_label.configure(text=f"Registro de consultas lentas: {log_path}" if log_path else "Registro de consultas lentas: (sin abrir todavía)")
+        cache_parts = []
+        for name, stats in read_cache.get_cache_stats().items():
+            rate = f"{stats['hit_rate']:.0%}" if stats['hit_rate'] is not None else "-"
+            cache_parts.append(f"{name}: {stats['hits']} aciertos / {stats['misses']} fallos ({rate}), "
+                               f"{stats['size']}/{stats['maxsize']} entradas, {stats['evictions']} expulsadas")
+        self.read_cache_label.configure(text="Caché de lecturas (local) — " + " · ".join(cache_parts))
+
+    def apply_slow_threshold_ui(self):
+        try:
+            threshold = float(self.slow_threshold_entry.get().strip())
+            if threshold < 0:
+                raise ValueError
+        except ValueError:
+            messagebox.showerror("Error de Entrada", "El umbral debe ser un número de milisegundos positivo.")
+            return
+        query_monitor.set_slow_query_threshold(threshold)
+        self.refresh_diagnostics_display()
+
+    def toggle_profile_next_action_ui(self):
+        if self.profile_next_action_switch.get():
+            profiler_hook.arm(on_saved=self.on_profile_saved)
+            self.profile_status_label.configure(text="Esperando la próxima actualización, importación o préstamo...")
+        else:
+            profiler_hook.disarm()
+            self.profile_status_label.configure(text="")
+
+    def on_profile_saved(self, action_name, pstats_path, summary_path):
+        self.profile_next_action_switch.deselect()
+        self.profile_status_label.configure(text=f"Perfil de '{action_name}' guardado en: {summary_path}")
+
+    def reset_diagnostics_ui(self):
+        query_monitor.reset_stats()
+        read_cache.reset_stats()
+        self.refresh_diagnostics_display()
+
+    def setup_backups_tab(self):
+        """Admin-only backups of the database: create, verify and restore (see backup_manager)."""
+        tab = self.backups_tab
+
+        controls_frame = ctk.CTkFrame(tab, fg_color="transparent")
+        controls_frame.pack(fill="x", padx=15, pady=(15, 5))
+        self.create_backup_button = ctk.CTkButton(controls_frame, text="Crear Copia Ahora", font=BUTTON_FONT, corner_radius=8,
+                                                  command=self.create_backup_ui)
+        self.create_backup_button.pack(side="left", padx=(0, 10))
+        self.incremental_backup_button = ctk.CTkButton(controls_frame, text="Copia Incremental", font=BUTTON_FONT, corner_radius=8,
+                                                       command=self.create_incremental_backup_ui)
+        self.incremental_backup_button.pack(side="left", padx=(0, 10))
+        self.backup_compress_switch = ctk.CTkSwitch(controls_frame, text="Comprimir (gzip)", font=BODY_FONT)
+        self.backup_compress_switch.select()
+        self.backup_compress_switch.pack(side="left", padx=10)
+        ctk.CTkButton(controls_frame, text="Actualizar", font=BUTTON_FONT, width=110, corner_radius=8,
+                      command=self.refresh_backups_list).pack(side="right", padx=5)
+
+        if self.backup_scheduler:
+            schedule_text = (f"Copias automáticas cada {self.backup_scheduler.interval_seconds / 3600:g} h; "
+                             f"se conservan las {self.backup_scheduler.keep} más recientes.")
+            if self.backup_scheduler.incremental:
+                schedule_text += (f" Incrementales, con una copia completa cada "
+                                  f"{self.backup_scheduler.full_every_seconds / 86400:g} días.")
+        else:
+            schedule_text = "Copias automáticas desactivadas (BIBLIO_BACKUP_HOURS=0)."
+        ctk.CTkLabel(tab, text=schedule_text, font=BODY_FONT, anchor="w").pack(fill="x", padx=15, pady=(0, 2))
+        self.backup_status_label = ctk.CTkLabel(tab, text="", font=BODY_FONT, anchor="w")
+        self.backup_status_label.pack(fill="x", padx=15, pady=(0, 5))
+
+        self.backups_list_frame = ctk.CTkScrollableFrame(tab, label_text="Copias disponibles", label_font=SUBHEADING_FONT, corner_radius=6)
+        self.backups_list_frame.pack(fill="both", expand=True, padx=15, pady=(5, 15))
+        self.refresh_backups_list()
+
+    def _run_backup_task(self, work, on_done, busy_text):
+        # Backups of a large database take seconds: run them off the UI thread and poll for the result.
+        if self.backup_busy:
+            messagebox.showinfo("Copias de Seguridad", "Ya hay una operación de copia en curso.")
+            return
+        self.backup_busy = True
+        self.create_backup_button.configure(state="disabled")
+        self.incremental_backup_button.configure(state="disabled")
+        self.backup_status_label.configure(text=busy_text)
+        result = {}
+        worker = threading.Thread(target=lambda: result.update(value=work()), daemon=True)
+        worker.start()
+
+        def poll():
+            if worker.is_alive():
+                self.after(200, poll)
+                return
+            self.backup_busy = False
+            self.create_backup_button.configure(state="normal")
+            self.incremental_backup_button.configure(state="normal")
+            on_done(result.get('value'))
+        self.after(200, poll)
+
+    def refresh_backups_list(self):
+        for widget in self.backups_list_frame.winfo_children():
+            widget.destroy()
+        backups = backup_manager.list_backups()
+        if not backups:
+            ctk.CTkLabel(self.backups_list_frame, text="Todavía no hay copias de seguridad.", font=BODY_FONT).pack(pady=20)
+            return
+        for backup in backups:
+            row = ctk.CTkFrame(self.backups_list_frame, corner_radius=6, border_width=1, border_color=("gray70", "gray40"))
+            row.pack(fill="x", pady=4, padx=5)
+            details = f"{backup['created']:%d/%m/%Y %H:%M}  ·  {backup['size'] / (1024 * 1024):.1f} MB  ·  {backup['name']}"
+            if backup['increments']:
+                details += f"  ·  +{backup['increments']} incrementales ({backup['increments_size'] / 1024:.0f} KB)"
+            ctk.CTkLabel(row, text=details, font=BODY_FONT, anchor="w").pack(side="left", padx=10, pady=8, fill="x", expand=True)
+            ctk.CTkButton(row, text="Restaurar", font=BUTTON_FONT, width=110, corner_radius=8, fg_color=("#C0392B", "#922B21"),
+                          command=lambda path=backup['path']: self.restore_backup_ui(path)).pack(side="right", padx=(5, 10), pady=8)
+            ctk.CTkButton(row, text="Verificar", font=BUTTON_FONT, width=100, corner_radius=8,
+                          command=lambda path=backup['path']: self.verify_backup_ui(path)).pack(side="right", padx=5, pady=8)
+
+    def create_backup_ui(self):
+        compress = bool(self.backup_compress_switch.get())
+
+        def done(path):
+            if path:
+                self.backup_status_label.configure(text=f"Copia creada: {path}")
+            else:
+                self.backup_status_label.configure(text="")
+                messagebox.showerror("Error", "No se pudo crear la copia de seguridad. Revise la consola para más detalles.")
+            self.refresh_backups_list()
+        self._run_backup_task(lambda: backup_manager.create_backup(compress=compress), done, "Creando copia de seguridad...")
+
+    def create_incremental_backup_ui(self):
+        def done(result):
+            if result is None:
+                self.backup_status_label.configure(text="")
+                messagebox.showerror("Error", "No se pudo crear la copia incremental. Revise la consola para más detalles.")
+            elif result['kind'] == "none":
+                self.backup_status_label.configure(text="No hay cambios desde la última copia.")
+            elif result['kind'] == "full":
+                self.backup_status_label.configure(text=f"No había copia completa de referencia; copia completa creada: {result['path']}")
+            else:
+                self.backup_status_label.configure(
+                    text=f"Copia incremental creada: {result['changes']} cambios, {result['size'] / 1024:.0f} KB.")
+            self.refresh_backups_list()
+        self._run_backup_task(backup_manager.create_incremental_backup, done, "Creando copia incremental...")
+
+    def verify_backup_ui(self, path):
+        def done(outcome):
+            ok, message = outcome
+            self.backup_status_label.configure(text="")
+            if ok:
+                messagebox.showinfo("Copia Verificada", f"La copia '{os.path.basename(path)}' está en buen estado.")
+            else:
+                messagebox.showerror("Copia Dañada", f"La copia '{os.path.basename(path)}' no es válida:\n{message}")
+        self._run_backup_task(lambda: backup_manager.verify_backup(path), done, "Verificando copia...")
+
+    def restore_backup_ui(self, path):
+        if not messagebox.askyesno("Confirmar Restauración",
+                                   f"¿Restaurar la base de datos desde '{os.path.basename(path)}'?\n\n"
+                                   "Se perderán los cambios posteriores a esa copia. Antes de restaurar se "
+                                   "guardará una copia del estado actual."):
+            return
+        with_increments = bool(backup_manager.list_increments(path)) and messagebox.askyesno(
+            "Copias Incrementales", "¿Aplicar también las copias incrementales posteriores a esta copia?")
+
+        def done(restored):
+            self.backup_status_label.configure(text="")
+            self.refresh_backups_list()
+            if not restored:
+                messagebox.showerror("Error", "No se pudo restaurar la copia. La base de datos no se ha modificado.")
+                return
+            self.refresh_changed_views() # the restore moved every data version forward
+            messagebox.showinfo("Restauración Completada", "La base de datos se ha restaurado correctamente.")
+        restore = backup_manager.restore_incremental_backup if with_increments else backup_manager.restore_backup
+        self._run_backup_task(lambda: restore(path), done, "Restaurando copia...")
+
+    def setup_export_tab(self):
+        """Admin-only CSV/XLSX exports (see export_manager), written in a background thread."""
+        tab = self.export_tab
+        form = ctk.CTkFrame(tab, corner_radius=10)
+        form.pack(fill="x", padx=15, pady=15)
+        form.grid_columnconfigure(1, weight=1)
+
+        ctk.CTkLabel(form, text="Datos:", font=BODY_FONT).grid(row=0, column=0, padx=10, pady=8, sticky="w")
+        self.export_kind_menu = ctk.CTkOptionMenu(form, values=list(EXPORT_KINDS), font=BODY_FONT,
+                                                  command=lambda _: self._update_export_period_state())
+        self.export_kind_menu.grid(row=0, column=1, padx=10, pady=8, sticky="w")
+
+        ctk.CTkLabel(form, text="Clase / Ubicación:", font=BODY_FONT).grid(row=1, column=0, padx=10, pady=8, sticky="w")
+        self.export_classroom_menu = ctk.CTkOptionMenu(form, values=["Todas"], font=BODY_FONT)
+        self.export_classroom_menu.grid(row=1, column=1, padx=10, pady=8, sticky="w")
+
+        ctk.CTkLabel(form, text="Periodo (clasificación):", font=BODY_FONT).grid(row=2, column=0, padx=10, pady=8, sticky="w")
+        self.export_period_button = ctk.CTkSegmentedButton(form, values=list(LEADERBOARD_PERIODS), font=BODY_FONT)
+        self.export_period_button.set("Total")
+        self.export_period_button.grid(row=2, column=1, padx=10, pady=8, sticky="w")
+
+        ctk.CTkLabel(form, text="Formato:", font=BODY_FONT).grid(row=3, column=0, padx=10, pady=8, sticky="w")
+        self.export_format_button = ctk.CTkSegmentedButton(form, values=["CSV", "XLSX"], font=BODY_FONT)
+        self.export_format_button.set("CSV")
+        self.export_format_button.grid(row=3, column=1, padx=10, pady=8, sticky="w")
+
+        self.export_button = ctk.CTkButton(tab, text="Exportar...", font=BUTTON_FONT, corner_radius=8, command=self.export_data_ui)
+        self.export_button.pack(padx=15, pady=(0, 5), anchor="w")
+        self.export_status_label = ctk.CTkLabel(tab, text="", font=BODY_FONT, anchor="w")
+        self.export_status_label.pack(fill="x", padx=15, pady=(0, 15))
+        self.refresh_export_classrooms()
+        self._update_export_period_state()
+
+    def refresh_export_classrooms(self):
+        classrooms = sorted(set(backend.get_distinct_classrooms()) | {"Biblioteca"})
+        self.export_classroom_menu.configure(values=["Todas"] + classrooms)
+
+    def _update_export_period_state(self):
+        is_leaderboard = EXPORT_KINDS[self.export_kind_menu.get()] == "leaderboard"
+        self.export_period_button.configure(state="normal" if is_leaderboard else "disabled")
+
+    def export_data_ui(self):
+        kind = EXPORT_KINDS[self.export_kind_menu.get()]
+        classroom = self.export_classroom_menu.get()
+        classroom_filter = None if classroom == "Todas" else classroom
+        period = LEADERBOARD_PERIODS.get(self.export_period_button.get()) if kind == "leaderboard" else None
+        fmt = self.export_format_button.get().lower()
+        path = filedialog.asksaveasfilename(
+            title="Guardar exportación", defaultextension=f".{fmt}",
+            initialfile=export_manager.default_file_name(kind, fmt, period),
+            filetypes=[("CSV", "*.csv")] if fmt == "csv" else [("Excel", "*.xlsx")])
+        if not path:
+            return
+
+        # Large exports take a while: write them off the UI thread and show the row count as it grows.
+        progress = {'rows': 0}
+        result = {}
+        def work():
+            result['rows'] = export_manager.export_db(kind, path, classroom_filter, period,
+                                                      progress=lambda rows: progress.update(rows=rows))
+        worker = threading.Thread(target=work, daemon=True)
+        self.export_button.configure(state="disabled")
+        worker.start()
+
+        def poll():
+            if worker.is_alive():
+                self.export_status_label.configure(text=f"Exportando... {progress['rows']:,} filas".replace(",", "."))
+                self.after(200, poll)
+                return
+            self.export_button.configure(state="normal")
+            if result.get('rows') is None:
+                self.export_status_label.configure(text="")
+                messagebox.showerror("Error", "No se pudo completar la exportación. Revise la consola para más detalles.")
+            else:
+                self.export_status_label.configure(text=f"Exportadas {result['rows']:,} filas a {path}".replace(",", "."))
+        self.after(200, poll)
+
     def setup_leaderboard_tab(self):
        tab = self.leaderboard_tab # Use the instance variable for the tab
        # tab.configure(fg_color=("#FFFFFF", "#2C2C2C")) # Example: Manage Loans / Leaderboard
@@ -2161,6 +2688,18 @@ class App(ctk.CTk):
                                                                )
        self.leaderboard_class_filter_combo.pack(side="left", padx=5, pady=10)
 
+       # Points period: all-time totals, or points earned this term / month / week
+       self.leaderboard_period_combo = ctk.CTkSegmentedButton(controls_frame,
+                                                             values=list(LEADERBOARD_PERIODS),
+                                                             font=BUTTON_FONT,
+                                                             command=lambda _: self.refresh_leaderboard_display(reset_window=True))
+       self.leaderboard_period_combo.pack(side="left", padx=5, pady=10)
+       self.leaderboard_period_combo.set("Total")
+
+       # Logged-in student's own position (filled in by refresh_leaderboard_display)
+       self.leaderboard_my_rank_label = ctk.CTkLabel(controls_frame, text="", font=BODY_FONT)
+       self.leaderboard_my_rank_label.pack(side="left", padx=15, pady=10)
+
        refresh_icon = self.load_icon("refresh")
        self.leaderboard_refresh_button = ctk.CTkButton(controls_frame, text="Refrescar",
                                                       image=refresh_icon, font=BUTTON_FONT, # BUTTON_FONT applied
@@ -2175,7 +2714,7 @@ class App(ctk.CTk):
 
        # Configure commands for filters
        self.leaderboard_filter_type_combo.configure(command=self.on_leaderboard_filter_type_change)
-       self.leaderboard_class_filter_combo.configure(command=self.refresh_leaderboard_display) # Refresh on class change
+       self.leaderboard_class_filter_combo.configure(command=self.on_leaderboard_class_change) # Refresh on class change
        self.leaderboard_refresh_button.configure(command=self.refresh_leaderboard_display)
 
        # Initial population and setup of class filter
@@ -2183,7 +2722,7 @@ class App(ctk.CTk):
 
     def on_leaderboard_filter_type_change(self, selection=None): # selection is passed from segmented button
         if selection == "🏫 Por Clase":
-            classrooms = student_manager.get_distinct_classrooms()
+            classrooms = backend.get_distinct_classrooms()
             if not classrooms: # Handle case with no classrooms
                 classrooms = ["No hay clases"] # Placeholder
                 self.leaderboard_class_filter_combo.configure(state="disabled", values=classrooms)
@@ -2195,98 +2734,173 @@ class App(ctk.CTk):
             self.leaderboard_class_filter_combo.configure(state="disabled", values=[])
             self.leaderboard_class_filter_combo.set("") # Clear selection or set to a placeholder
 
+        self.refresh_leaderboard_display(reset_window=True)
+
+    def _leaderboard_row_style(self, rank):
+        """Returns (background colour, rank font size, name font size increase) for a leaderboard position."""
+        if rank == 1:
+            return ("#FFD700", "#B8860B"), 20, 2 # Gold
+        if rank == 2:
+            return ("#E0E0E0", "#A0A0A0"), 18, 0 # Silver
+        if rank == 3:
+            return ("#CD7F32", "#8C581E"), 18, 0 # Bronze
+        return ("#FFFFFF", "#2B2B2B"), 18, 0
+
+    def _create_leaderboard_item_frame(self, rank, student, show_classroom, entry_icon):
+        item_frame = ctk.CTkFrame(self.leaderboard_scroll_frame, corner_radius=6, border_width=1, border_color=("gray70", "gray40"))
+        item_frame.widgets = {}
+        item_frame.row_state = None # (rank, name, points text) last rendered
+
+        item_frame.widgets['rank_label'] = ctk.CTkLabel(item_frame, text="", font=(APP_FONT_FAMILY, 18, "bold"))
+        item_frame.widgets['rank_label'].pack(side="left", padx=(10,15), pady=10)
+
+        if entry_icon:
+            icon_label = ctk.CTkLabel(item_frame, image=entry_icon, text="", font=BODY_FONT)
+            icon_label.pack(side="left", padx=(0,10), pady=10)
+
+        details_frame = ctk.CTkFrame(item_frame, fg_color="transparent") # Transparent to show item_frame color
+        details_frame.pack(side="left", padx=10, pady=(8,8), expand=True, fill="x")
+
+        item_frame.widgets['name_label'] = ctk.CTkLabel(details_frame, text="", font=(APP_FONT_FAMILY, 16, "bold"), anchor="w")
+        item_frame.widgets['name_label'].pack(fill="x", pady=(0,2))
+
+        item_frame.widgets['points_label'] = ctk.CTkLabel(details_frame, text="", font=BODY_FONT, anchor="w")
+        item_frame.widgets['points_label'].pack(fill="x")
+
+        self._update_leaderboard_item_frame_content(item_frame, rank, student, show_classroom)
+        return item_frame
+
+    def _update_leaderboard_item_frame_content(self, frame, rank, student, show_classroom):
+        """Reconfigures only the parts of the row that changed since it was last rendered."""
+        points_label_text = f"{student.get('points', 0)} Puntos"
+        if show_classroom:
+            points_label_text += f"  |  Clase: {student.get('classroom', 'N/A')}"
+        new_state = (rank, student.get('name', 'N/A'), points_label_text)
+        old_state = frame.row_state
+        if new_state == old_state:
+            return
+
+        old_rank = old_state[0] if old_state else None
+        if rank != old_rank:
+            frame.widgets['rank_label'].configure(text=f"#{rank}")
+            if old_rank is None or self._leaderboard_row_style(old_rank) != self._leaderboard_row_style(rank):
+                item_bg_color, rank_font_size, name_font_size_increase = self._leaderboard_row_style(rank)
+                frame.configure(fg_color=item_bg_color)
+                frame.widgets['rank_label'].configure(font=(APP_FONT_FAMILY, rank_font_size, "bold"))
+                frame.widgets['name_label'].configure(font=(APP_FONT_FAMILY, 16 + name_font_size_increase, "bold"))
+        if old_state is None or old_state[1] != new_state[1]:
+            frame.widgets['name_label'].configure(text=new_state[1])
+        if old_state is None or old_state[2] != new_state[2]:
+            frame.widgets['points_label'].configure(text=points_label_text)
+        frame.row_state = new_state
+
+    def _update_my_leaderboard_rank(self, scope, period=None):
+        """Shows the logged-in student's position and the gap to the student just above them
+        (or, for a month/week leaderboard, the points they earned in that period)."""
+        student_id = backend.get_current_user_id()
+        if not student_id or backend.is_admin():
+            self.leaderboard_my_rank_label.configure(text="")
+            return
+        if period:
+            earned = backend.get_student_points_in_period_db(student_id, *points_manager.period_bounds(period))
+            period_text = {"term": "este trimestre", "month": "este mes", "week": "esta semana"}[period]
+            self.leaderboard_my_rank_label.configure(text=f"Tus puntos {period_text}: {earned}")
+            return
+        entry = backend.get_student_rank_db(student_id, neighbors=1, scope=scope)
+        if not entry:
+            self.leaderboard_my_rank_label.configure(text="")
+            return
+        me = entry['student']
+        rank = me['global_rank'] if scope == "global" else me['class_rank']
+        scope_text = "global" if scope == "global" else f"en {me['classroom']}"
+        text = f"Tu posición {scope_text}: #{rank} ({me['points']} puntos)"
+        above = [n for n in entry['neighbors'] if n['points'] > me['points']]
+        if above:
+            text += f"  |  {above[-1]['points'] - me['points']} puntos para subir"
+        self.leaderboard_my_rank_label.configure(text=text)
+
+    def on_leaderboard_class_change(self, selection=None):
+        self.refresh_leaderboard_display(reset_window=True)
+
+    def load_more_leaderboard_ui(self):
+        self.leaderboard_visible_count += LEADERBOARD_PAGE_SIZE
         self.refresh_leaderboard_display()
 
-    def refresh_leaderboard_display(self):
-        # Clear existing leaderboard entries
-        for widget in self.leaderboard_scroll_frame.winfo_children():
-            widget.destroy()
+    @profiler_hook.profile_next_action
+    def refresh_leaderboard_display(self, reset_window=False):
+        # Rows are kept in self.leaderboard_item_frames (keyed by student id) and only the top
+        # self.leaderboard_visible_count students are shown; "Cargar más" extends the window.
+        if reset_window:
+            self.leaderboard_visible_count = LEADERBOARD_PAGE_SIZE
 
         filter_type = self.leaderboard_filter_type_combo.get()
         classroom_to_filter = None
 
         if filter_type == "🏫 Por Clase":
             classroom_to_filter = self.leaderboard_class_filter_combo.get()
-            # Assuming "Todas las Clases" might be a placeholder if class combo is populated with it.
-            if not classroom_to_filter or classroom_to_filter == "Todas las Clases":
-                # If no specific class or "All Classes" is selected in "Por Clase" mode,
-                # effectively treat as global or show specific message.
-                # For this implementation, if "Todas las Clases" is selected, it means no specific class filter.
-                # However, student_manager.get_students_sorted_by_points expects None for global.
-                # We'll rely on the segmented button's "Global" value to pass None.
-                # If "Por Clase" is selected but the class combo has a "All Classes" type of value,
-                # this might mean we should show all, or prompt user, or disable this state.
-                # For now, if classroom_to_filter is "Todas las Clases", we set it to None
-                # to fetch all students, which might be confusing if "Por Clase" is selected.
-                # This logic might need refinement based on how class_filter_combo is populated.
-                if classroom_to_filter == "Todas las Clases": #This placeholder needs to be consistent if used
-                    classroom_to_filter = None
-                # If classroom_to_filter is empty (e.g. not set), it might also mean fetch all or do nothing.
-                # For now, if it's empty, it will pass None to the backend.
-
-        students_data = student_manager.get_students_sorted_by_points(classroom_filter=classroom_to_filter)
-
-        if not students_data:
-            no_data_label = ctk.CTkLabel(self.leaderboard_scroll_frame, text="No hay datos para mostrar.", font=BODY_FONT)
-            no_data_label.pack(pady=30, padx=10)
-            return
+            # "Todas las Clases" (if ever used as a placeholder) means no specific class filter;
+            # an empty selection also passes None to the backend.
+            if classroom_to_filter == "Todas las Clases":
+                classroom_to_filter = None
+        show_classroom = filter_type == "🏆 Global"
+
+        period = LEADERBOARD_PERIODS.get(self.leaderboard_period_combo.get())
+
+        # One row beyond the window tells us whether there is more to load.
+        if period:
+            # Points earned in the period, summed from the day/week rollups
+            period_start, period_end = points_manager.period_bounds(period)
+            students_data = backend.get_period_leaderboard_db(
+                period_start, period_end, classroom_filter=classroom_to_filter, limit=self.leaderboard_visible_count + 1)
+            rank_key = 'rank'
+        else:
+            students_data = backend.get_leaderboard_db(
+                classroom_filter=classroom_to_filter, limit=self.leaderboard_visible_count + 1)
+            # Tied students share a position (1, 1, 3...): class ranks in the class view, global otherwise.
+            rank_key = 'global_rank' if show_classroom else 'class_rank'
+        has_more = len(students_data) > self.leaderboard_visible_count
+        students_data = students_data[:self.leaderboard_visible_count]
+        self._update_my_leaderboard_rank(scope="global" if show_classroom else "class", period=period)
+
+        if self.no_leaderboard_label is None:
+            self.no_leaderboard_label = ctk.CTkLabel(self.leaderboard_scroll_frame, text="No hay datos para mostrar.", font=BODY_FONT)
+        if self.leaderboard_load_more_button is None:
+            self.leaderboard_load_more_button = ctk.CTkButton(self.leaderboard_scroll_frame, text="Cargar más", font=BUTTON_FONT,
+                                                              command=self.load_more_leaderboard_ui, corner_radius=8)
+
+        new_order = [student['id'] for student in students_data]
+        for student_id in set(self.leaderboard_item_frames) - set(new_order):
+            self.leaderboard_item_frames.pop(student_id).destroy()
 
         entry_icon = self.load_icon("students", size=(24,24))
+        for student in students_data:
+            rank = student[rank_key]
+            frame = self.leaderboard_item_frames.get(student['id'])
+            if frame is None:
+                self.leaderboard_item_frames[student['id']] = self._create_leaderboard_item_frame(rank, student, show_classroom, entry_icon)
+            else:
+                self._update_leaderboard_item_frame_content(frame, rank, student, show_classroom)
+
+        # Re-pack only from the first position whose student changed; the rows above stay put.
+        first_changed = len(new_order)
+        for position, student_id in enumerate(new_order):
+            if position >= len(self.leaderboard_order) or self.leaderboard_order[position] != student_id:
+                first_changed = position
+                break
+        self.leaderboard_load_more_button.pack_forget()
+        for student_id in new_order[first_changed:]:
+            self.leaderboard_item_frames[student_id].pack_forget()
+        for student_id in new_order[first_changed:]:
+            self.leaderboard_item_frames[student_id].pack(fill="x", pady=8, padx=10)
+        self.leaderboard_order = new_order
 
-        gold_color = ("#FFD700", "#B8860B")    # Updated Gold
-        silver_color = ("#E0E0E0", "#A0A0A0")  # Updated Silver
-        bronze_color = ("#CD7F32", "#8C581E")  # Updated Bronze
-        default_item_color = ("#FFFFFF", "#2B2B2B") # Verified: Remains as specified
-
-        for i, student in enumerate(students_data):
-            rank = i + 1
-
-            item_bg_color = default_item_color
-            name_font_size_increase = 0
-            rank_font_size = 18
-
-            if rank == 1:
-                item_bg_color = gold_color
-                name_font_size_increase = 2
-                rank_font_size = 20
-            elif rank == 2:
-                item_bg_color = silver_color
-            elif rank == 3:
-                item_bg_color = bronze_color
-            # else: # For alternating row colors if desired for ranks > 3
-                # if i % 2 == 0:
-                #     item_bg_color = ("#F0F0F0", "#303030")
-                # else:
-                #     item_bg_color = default_item_color # Or another color for odd rows
-
-            item_frame = ctk.CTkFrame(self.leaderboard_scroll_frame, corner_radius=6, border_width=1, border_color=("gray70", "gray40"), fg_color=item_bg_color) # border_color adjusted slightly
-            item_frame.pack(fill="x", pady=8, padx=10)
-
-            rank_label = ctk.CTkLabel(item_frame, text=f"#{rank}", font=(APP_FONT_FAMILY, rank_font_size, "bold"))
-            rank_label.pack(side="left", padx=(10,15), pady=10)
-
-            if entry_icon:
-                icon_label = ctk.CTkLabel(item_frame, image=entry_icon, text="", font=BODY_FONT)
-                icon_label.pack(side="left", padx=(0,10), pady=10)
-
-            details_frame = ctk.CTkFrame(item_frame, fg_color="transparent") # Transparent to show item_frame color
-            details_frame.pack(side="left", padx=10, pady=(8,8), expand=True, fill="x")
-
-            name_text = student.get('name', 'N/A')
-            points_text = student.get('points', 0)
-            classroom_text = student.get('classroom', 'N/A')
-
-            base_name_font_size = 16
-            name_label_font = (APP_FONT_FAMILY, base_name_font_size + name_font_size_increase, "bold")
-            name_label = ctk.CTkLabel(details_frame, text=name_text, font=name_label_font, anchor="w")
-            name_label.pack(fill="x", pady=(0,2))
-
-            points_label_text = f"{points_text} Puntos"
-            if filter_type == "🏆 Global":
-                points_label_text += f"  |  Clase: {classroom_text}"
-
-            points_label = ctk.CTkLabel(details_frame, text=points_label_text, font=BODY_FONT, anchor="w")
-            points_label.pack(fill="x")
+        if not students_data:
+            if not self.no_leaderboard_label.winfo_ismapped():
+                self.no_leaderboard_label.pack(pady=30, padx=10)
+        elif self.no_leaderboard_label.winfo_ismapped():
+            self.no_leaderboard_label.pack_forget()
+        if has_more:
+            self.leaderboard_load_more_button.pack(pady=(5,15))
 
     # def um_toggle_password_visibility(self): # Optional helper
     #     if self.um_show_password_var.get() == "on":
@@ -2297,7 +2911,7 @@ class App(ctk.CTk):
     #         self.um_confirm_password_entry.configure(show="*")
 
     def prompt_lend_book_from_view_tab(self, book_id):
-        book_details = book_manager.get_book_by_id_db(book_id)
+        book_details = backend.get_book_by_id_db(book_id)
         if not book_details:
             messagebox.showerror("Error", f"No se pudo encontrar el libro con ID: {book_id}")
             return
@@ -2321,7 +2935,7 @@ class App(ctk.CTk):
         student_combo = ctk.CTkComboBox(main_frame, font=BODY_FONT, width=400, dropdown_font=BODY_FONT)
         student_combo.pack(fill="x", pady=(0,10))
 
-        students = student_manager.get_students_db()
+        students = backend.get_students_db()
         student_name_to_id_map = {s['name']: s['id'] for s in students}
         student_names = list(student_name_to_id_map.keys())
 
@@ -2337,7 +2951,7 @@ class App(ctk.CTk):
         leader_combo = ctk.CTkComboBox(main_frame, font=BODY_FONT, width=400, dropdown_font=BODY_FONT)
         leader_combo.pack(fill="x", pady=(0,15))
 
-        leaders = student_manager.get_students_db(role_filter='leader')
+        leaders = backend.get_students_db(role_filter='leader')
         leader_name_to_id_map = {f"{l['name']} ({l['classroom']})": l['id'] for l in leaders}
         leader_names = list(leader_name_to_id_map.keys())
 
@@ -2381,6 +2995,7 @@ class App(ctk.CTk):
                  ctk.CTkLabel(main_frame, text="No hay líderes disponibles para autorizar.", text_color="orange", font=BODY_FONT).pack(pady=(5,0))
 
 
+    @profiler_hook.profile_next_action
     def _confirm_lend_action(self, dialog, book_id, student_combo, leader_combo, student_map, leader_map):
         selected_student_name = student_combo.get()
         selected_leader_display_name = leader_combo.get()
@@ -2407,16 +3022,14 @@ class App(ctk.CTk):
         due_date_str = (datetime.now() + timedelta(days=14)).strftime('%Y-%m-%d')
 
         try:
-            success = book_manager.loan_book_db(book_id, student_id, due_date_str, leader_id)
+            success = backend.loan_book_db(book_id, student_id, due_date_str, leader_id)
             if success:
                 messagebox.showinfo("Éxito", "Libro prestado correctamente.", parent=dialog)
-                self.refresh_book_list_ui() # Refresh the main book list
-                if hasattr(self, 'refresh_loan_related_combos_and_lists'):
-                    self.refresh_loan_related_combos_and_lists() # Refresh lists in manage loans tab
+                self.refresh_changed_views()
                 dialog.destroy()
             else:
                 # Check available count again, it might have changed
-                available_count = book_manager.get_available_book_count(book_id)
+                available_count = backend.get_available_book_count(book_id)
                 if available_count == 0:
                     messagebox.showerror("Error", "No se pudo prestar el libro. Ya no hay ejemplares disponibles.", parent=dialog)
                 else:
@@ -2434,3 +3047,9 @@ if __name__ == "__main__":
 
     app = App()
     app.mainloop()
+    if app.backup_scheduler is not None:
+        app.backup_scheduler.stop()
+    if app.versions_reader is not None:
+        app.versions_reader.shutdown(wait=False)
+    if app.ui_monitor is not None:
+        app.ui_monitor.stop() # writes the stall report
@@ -0,0 +1,223 @@
+import sqlite3
+import os
+from datetime import datetime, timedelta
+from utils import get_data_path
+from database.db_setup import CLASSROOM_ID_BY_NAME, is_global_filter
+import query_monitor
+import read_cache
+
+# Every change to a student's points is appended to points_ledger; students.points is
+# only a cached running total of the ledger (kept in step by record_points).
+# record_points also adds each change to the per-day and per-week rollups (points_daily,
+# points_weekly), which the week/month/term leaderboards read instead of the ledger.
+
+DB_PATH_FOR_CODE = os.path.join("database", "library.db")
+
+# Ledger reasons
+REASON_LOAN = "loan"
+REASON_RETURN = "return"
+REASON_WORKSHEET = "worksheet"
+REASON_EARLY_RETURN = "early_return"
+REASON_OPENING_BALANCE = "opening_balance" # totals that existed before the ledger
+REASON_ADJUSTMENT = "adjustment"
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+DATE_FORMAT = '%Y-%m-%d'
+# School terms, as the (month, day) each one starts on: Sept-Dec, Jan-Mar, Apr-Aug.
+TERM_STARTS = ((1, 1), (4, 1), (9, 1))
+
+def _get_resolved_db_path():
+    path = get_data_path(DB_PATH_FOR_CODE)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+def _week_start(day):
+    return day - timedelta(days=day.weekday()) # Monday
+
+def record_points(cursor, student_id, delta, reason, loan_id=None, created_at=None):
+    """Appends a ledger entry and updates the cached total and the day/week rollups, on the
+    caller's cursor. Runs inside the caller's transaction, so they all commit (or roll back) together."""
+    created_at = created_at or datetime.now().strftime(TIMESTAMP_FORMAT)
+    cursor.execute("""
+        INSERT INTO points_ledger (student_id, delta, reason, loan_id, created_at)
+        VALUES (?, ?, ?, ?, ?)
+    """, (student_id, delta, reason, loan_id, created_at))
+    cursor.execute("UPDATE students SET points = points + ? WHERE id = ?", (delta, student_id))
+    query_monitor.on_commit(lambda: read_cache.invalidate_student(student_id))
+    if reason == REASON_OPENING_BALANCE: # not earned in any period
+        return
+    day = datetime.strptime(created_at[:10], DATE_FORMAT).date()
+    cursor.execute("""
+        INSERT INTO points_daily (day, student_id, points) VALUES (?, ?, ?)
+        ON CONFLICT (day, student_id) DO UPDATE SET points = points + excluded.points
+    """, (day.strftime(DATE_FORMAT), student_id, delta))
+    cursor.execute("""
+        INSERT INTO points_weekly (week_start, student_id, points) VALUES (?, ?, ?)
+        ON CONFLICT (week_start, student_id) DO UPDATE SET points = points + excluded.points
+    """, (_week_start(day).strftime(DATE_FORMAT), student_id, delta))
+
+def period_bounds(period, today=None):
+    """Returns (start, end) dates ('YYYY-MM-DD') of the "week" (Monday to Monday), "month" or
+    "term" (see TERM_STARTS) containing today. end is exclusive."""
+    today = today or datetime.now().date()
+    if period == "week":
+        start = _week_start(today)
+        end = start + timedelta(days=7)
+    elif period == "month":
+        start = today.replace(day=1)
+        end = (start + timedelta(days=32)).replace(day=1)
+    elif period == "term":
+        starts = sorted(today.replace(year=year, month=month, day=day)
+                        for year in (today.year - 1, today.year, today.year + 1) for month, day in TERM_STARTS)
+        start = max(s for s in starts if s <= today)
+        end = min(s for s in starts if s > today)
+    else:
+        raise ValueError(f"Unknown period '{period}' (expected 'week', 'month' or 'term').")
+    return start.strftime(DATE_FORMAT), end.strftime(DATE_FORMAT)
+
+def _split_into_buckets(start, end):
+    """Splits [start, end) into whole Monday-to-Monday weeks (read from points_weekly) and
+    the leftover days at either edge (read from points_daily).
+    Returns (weeks, head_days, tail_days), each a (start, end) pair of date strings."""
+    start = datetime.strptime(start[:10], DATE_FORMAT).date()
+    end = datetime.strptime(end[:10], DATE_FORMAT).date()
+    first_monday = start + timedelta(days=(7 - start.weekday()) % 7)
+    last_monday = _week_start(end)
+    if first_monday >= last_monday: # no whole week inside the window
+        first_monday = last_monday = end
+    as_text = lambda day: day.strftime(DATE_FORMAT)
+    return ((as_text(first_monday), as_text(last_monday)),
+            (as_text(start), as_text(first_monday)),
+            (as_text(last_monday), as_text(end)))
+
+@query_monitor.timed
+def add_points_adjustment_db(student_id, delta, loan_id=None):
+    """Manual correction of a student's points (positive or negative). Returns True on success."""
+    def adjust(cursor):
+        cursor.execute("SELECT 1 FROM students WHERE id = ?", (student_id,))
+        if not cursor.fetchone():
+            print(f"Points Error: Student {student_id} does not exist.")
+            return False
+        record_points(cursor, student_id, delta, REASON_ADJUSTMENT, loan_id)
+        return True
+    try:
+        return query_monitor.write_transaction(_get_resolved_db_path(), adjust)
+    except sqlite3.Error as e:
+        print(f"Database error in add_points_adjustment_db: {e}")
+        return False
+
+@query_monitor.timed
+def get_points_history_db(student_id, limit=50):
+    """A student's most recent ledger entries, newest first (uses idx_points_ledger_student)."""
+    conn = None
+    try:
+        conn = query_monitor.connect(_get_resolved_db_path())
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT entry_id, student_id, delta, reason, loan_id, created_at
+            FROM points_ledger
+            WHERE student_id = ?
+            ORDER BY created_at DESC, entry_id DESC
+            LIMIT ?
+        """, (student_id, limit))
+        return [dict(row) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        print(f"Database error in get_points_history_db: {e}")
+        return []
+    finally:
+        if conn:
+            conn.close()
+
+@query_monitor.timed
+def get_student_points_in_period_db(student_id, start, end):
+    """Points a student earned with start <= created_at < end (opening balances excluded)."""
+    conn = None
+    try:
+        conn = query_monitor.connect(_get_resolved_db_path())
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT COALESCE(SUM(delta), 0) FROM points_ledger
+            WHERE student_id = ? AND created_at >= ? AND created_at < ? AND reason != ?
+        """, (student_id, start, end, REASON_OPENING_BALANCE))
+        return cursor.fetchone()[0]
+    except sqlite3.Error as e:
+        print(f"Database error in get_student_points_in_period_db: {e}")
+        return 0
+    finally:
+        if conn:
+            conn.close()
+
+def period_leaderboard_query(start, end, classroom_filter=None):
+    """(query, params) of the period leaderboard of get_period_leaderboard_db, without its
+    ORDER BY / LIMIT, for callers that stream all the rows (export_manager)."""
+    weeks, head_days, tail_days = _split_into_buckets(start, end)
+    query = """
+        SELECT s.id, s.name, c.name AS classroom, period.points,
+               RANK() OVER (ORDER BY period.points DESC) AS rank
+        FROM (
+            SELECT student_id, SUM(points) AS points FROM (
+                SELECT student_id, points FROM points_weekly WHERE week_start >= ? AND week_start < ?
+                UNION ALL
+                SELECT student_id, points FROM points_daily WHERE day >= ? AND day < ?
+                UNION ALL
+                SELECT student_id, points FROM points_daily WHERE day >= ? AND day < ?
+            )
+            GROUP BY student_id
+        ) AS period
+        JOIN students s ON s.id = period.student_id
+        LEFT JOIN classrooms c ON c.id = s.classroom_id
+        WHERE period.points != 0
+    """
+    params = [*weeks, *head_days, *tail_days]
+    if not is_global_filter(classroom_filter):
+        query += f" AND s.classroom_id = {CLASSROOM_ID_BY_NAME}"
+        params.append(classroom_filter)
+    return query, params
+
+@query_monitor.timed
+def get_period_leaderboard_db(start, end, classroom_filter=None, limit=None, offset=0):
+    """Leaderboard of the points earned between the dates start (inclusive) and end (exclusive),
+    e.g. from period_bounds(). Rows have id, name, classroom, points (earned in the period) and
+    rank (tied students share it), ordered like the all-time leaderboard. Students without
+    points in the period are left out.
+    Read from the rollups: whole weeks from points_weekly, edge days from points_daily,
+    each a primary-key range, so the cost depends on the window, not on the ledger size."""
+    conn = None
+    try:
+        conn = query_monitor.connect(_get_resolved_db_path())
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        query, params = period_leaderboard_query(start, end, classroom_filter)
+        query += " ORDER BY period.points DESC, s.name, s.classroom_id, s.id LIMIT ? OFFSET ?"
+        params.extend([-1 if limit is None else limit, offset])
+
+        cursor.execute(query, tuple(params))
+        return [dict(row) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        print(f"Database error in get_period_leaderboard_db: {e}")
+        return []
+    finally:
+        if conn:
+            conn.close()
+
+@query_monitor.timed
+def rebuild_points_cache_db():
+    """Recomputes students.points from the ledger. Returns the number of students whose
+    cached total was wrong and has been corrected, or None on error."""
+    def rebuild(cursor):
+        cursor.execute("""
+            UPDATE students
+            SET points = (SELECT COALESCE(SUM(delta), 0) FROM points_ledger pl WHERE pl.student_id = students.id)
+            WHERE points IS NOT (SELECT COALESCE(SUM(delta), 0) FROM points_ledger pl WHERE pl.student_id = students.id)
+        """)
+        return cursor.rowcount
+    try:
+        corrected = query_monitor.write_transaction(_get_resolved_db_path(), rebuild)
+    except sqlite3.Error as e:
+        print(f"Database error in rebuild_points_cache_db: {e}")
+        return None
+    if corrected:
+        read_cache.clear()
+        print(f"Points cache rebuilt: {corrected} student total(s) corrected from the ledger.")
+    return corrected
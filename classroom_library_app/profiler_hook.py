@@ -0,0 +1,104 @@
+"""
+"Profile next action" support for the admin diagnostics tab.
+
+UI actions decorated with @profile_next_action (tab refreshes, CSV imports, loan operations)
+run normally until an admin arms the profiler. The next decorated action then runs under
+cProfile, and a .pstats file plus a text summary are saved next to the database
+(database/profiles/). Open the .pstats with `python -m pstats <file>` or snakeviz.
+
+Only the action's own call is profiled, but it runs on the UI thread: while it waits in a
+dialog, Tk timers fire too. The periodic change bus poll skips its turn (is_profiling()).
+"""
+import cProfile
+import functools
+import io
+import os
+import pstats
+import re
+from datetime import datetime
+
+from utils import get_data_path
+
+PROFILES_DIR_FOR_CODE = os.path.join("database", "profiles")
+SUMMARY_TOP_N = 30
+
+_armed = False
+_running = False # an action is being profiled (nested decorated calls just run)
+_on_saved = None # callback(action_name, pstats_path, summary_path)
+
+
+def arm(on_saved=None):
+    """Profiles the next decorated action. on_saved is called once the files are written."""
+    global _armed, _on_saved
+    _armed = True
+    _on_saved = on_saved
+
+
+def disarm():
+    global _armed, _on_saved
+    _armed = False
+    _on_saved = None
+
+
+def is_armed():
+    return _armed
+
+
+def is_profiling():
+    """True while a decorated action runs under the profiler. Timers that fire from the event
+    loops of its dialogs (e.g. the change bus poll) check it to stay out of the profile."""
+    return _running
+
+
+def _save_profile(profiler, action_name):
+    profiles_dir = get_data_path(PROFILES_DIR_FOR_CODE)
+    os.makedirs(profiles_dir, exist_ok=True)
+    safe_name = re.sub(r"[^A-Za-z0-9_]+", "_", action_name)
+    base = os.path.join(profiles_dir, f"profile_{datetime.now():%Y%m%d_%H%M%S}_{safe_name}")
+    pstats_path = base + ".pstats"
+    summary_path = base + ".txt"
+    profiler.dump_stats(pstats_path)
+
+    buffer = io.StringIO()
+    stats = pstats.Stats(profiler, stream=buffer).strip_dirs()
+    buffer.write(f"Profile of '{action_name}' taken {datetime.now():%Y-%m-%d %H:%M:%S}\n")
+    buffer.write(f"Full data: {pstats_path}\n\n== Top {SUMMARY_TOP_N} by cumulative time ==\n")
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(SUMMARY_TOP_N)
+    buffer.write(f"\n== Top {SUMMARY_TOP_N} by own time ==\n")
+    stats.sort_stats(pstats.SortKey.TIME).print_stats(SUMMARY_TOP_N)
+    with open(summary_path, "w", encoding="utf-8") as f:
+        f.write(buffer.getvalue())
+    return pstats_path, summary_path
+
+
+def profile_next_action(func):
+    """Decorator for UI actions: runs the action under cProfile if the profiler is armed."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        global _running
+        if not _armed or _running:
+            return func(*args, **kwargs)
+
+        on_saved = _on_saved
+        disarm()
+        _running = True
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e: # another profiler is already active
+            _running = False
+            print(f"Could not start the profiler for '{func.__name__}': {e}")
+            return func(*args, **kwargs)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.disable()
+            _running = False
+            try:
+                pstats_path, summary_path = _save_profile(profiler, func.__name__)
+                print(f"Profile of '{func.__name__}' saved to '{pstats_path}'.")
+                if on_saved:
+                    on_saved(func.__name__, pstats_path, summary_path)
+            except (OSError, TypeError) as e:
+                print(f"Error saving the profile of '{func.__name__}': {e}")
+    return wrapper
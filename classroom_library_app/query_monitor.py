@@ -0,0 +1,528 @@
+"""
+Timing instrumentation for the data layer.
+
+- `@timed` wraps manager functions and records calls, cumulative/max time and rows returned.
+- `connect()` opens an instrumented SQLite connection that does the same for every SQL statement
+  (execute plus the fetches that read its rows).
+- Calls and statements slower than the threshold are written to a rotating slow-query log
+  next to the database (`slow_queries.log`).
+
+- `write_transaction()` runs a write in BEGIN IMMEDIATE and retries it after a jittered backoff
+  when another connection (or process) holds the write lock past the busy timeout. The managers'
+  writes, the CSV imports, the sync server's push and the legacy migration all go through it.
+
+- `enable_pooling()` makes `connect()` hand out connections from a per-database pool; closing
+  one returns it to the pool. The API server uses it so requests don't reopen the file.
+
+Stats are kept in memory for the life of the process; the admin "Diagnóstico" tab shows them.
+The threshold can be set with the BIBLIO_SLOW_QUERY_MS environment variable or
+set_slow_query_threshold(). Set BIBLIO_QUERY_MONITOR=0 to turn instrumentation off.
+"""
+import functools
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sqlite3
+import threading
+import time
+
+SLOW_QUERY_THRESHOLD_MS = float(os.environ.get("BIBLIO_SLOW_QUERY_MS", "100"))
+MONITOR_ENABLED = os.environ.get("BIBLIO_QUERY_MONITOR", "1") != "0"
+SLOW_LOG_NAME = "slow_queries.log"
+SLOW_LOG_MAX_BYTES = 512 * 1024
+SLOW_LOG_BACKUPS = 3
+
+_lock = threading.Lock()
+_function_stats = {}
+_statement_stats = {}
+_local = threading.local() # .function_stack: names of the @timed calls in progress
+_slow_logger = None
+_slow_log_path = None
+_pools = {} # absolute db path -> ConnectionPool, while pooling is enabled
+_pool_size = 0
+POOL_WAIT_SECONDS = 5.0
+BUSY_TIMEOUT_SECONDS = 2.0 # sqlite3 waits this long for a lock before raising "database is locked"
+WRITE_ATTEMPTS = 6
+BACKOFF_BASE_SECONDS = 0.05
+BACKOFF_MAX_SECONDS = 1.0
+_write_stats = {'transactions': 0, 'busy_retries': 0, 'busy_failures': 0}
+
+
+def _new_stats():
+    return {'calls': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'rows': 0}
+
+
+def _record(registry, key, elapsed_ms, rows, new_call=True):
+    with _lock:
+        stats = registry.get(key)
+        if stats is None:
+            stats = registry[key] = _new_stats()
+        if new_call:
+            stats['calls'] += 1
+        stats['total_ms'] += elapsed_ms
+        stats['rows'] += rows
+        return stats
+
+
+def _current_function():
+    stack = getattr(_local, 'function_stack', None)
+    return stack[-1] if stack else None
+
+
+def _row_count(result):
+    """Rows a manager function handed back: list length, 1 for a single record, else 0."""
+    if isinstance(result, list):
+        return len(result)
+    if isinstance(result, tuple) and len(result) == 2 and isinstance(result[0], int): # (count, errors) from the CSV importers
+        return result[0]
+    if isinstance(result, (dict, sqlite3.Row)):
+        return 1
+    return 0
+
+
+def set_slow_query_threshold(ms):
+    global SLOW_QUERY_THRESHOLD_MS
+    SLOW_QUERY_THRESHOLD_MS = float(ms)
+
+
+def configure_slow_log(db_path):
+    """Points the slow-query log at <db directory>/slow_queries.log (done on first connect)."""
+    global _slow_logger, _slow_log_path
+    log_path = os.path.join(os.path.dirname(os.path.abspath(db_path)), SLOW_LOG_NAME)
+    with _lock:
+        if _slow_log_path == log_path:
+            return
+        logger = logging.getLogger("biblio.slow_queries")
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
+        try:
+            handler = logging.handlers.RotatingFileHandler(
+                log_path, maxBytes=SLOW_LOG_MAX_BYTES, backupCount=SLOW_LOG_BACKUPS, encoding="utf-8", delay=True)
+        except OSError as e:
+            print(f"No se pudo abrir el registro de consultas lentas '{log_path}': {e}")
+            return
+        handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        logger.addHandler(handler)
+        _slow_logger = logger
+        _slow_log_path = log_path
+
+
+def get_slow_log_path():
+    return _slow_log_path
+
+
+def _log_slow(kind, name, elapsed_ms, rows):
+    # Only the SQL text (with ? placeholders) is logged, never the parameter values:
+    # they can contain student names and password hashes.
+    if _slow_logger is None or elapsed_ms < SLOW_QUERY_THRESHOLD_MS:
+        return
+    caller = _current_function() if kind == "SQL" else None
+    _slow_logger.info("%s %.1fms rows=%d%s %s", kind, elapsed_ms, rows,
+                      f" in={caller}" if caller else "", name)
+
+
+def timed(func):
+    """Decorator for manager functions: records call count, time and rows returned."""
+    if not MONITOR_ENABLED:
+        return func
+    name = f"{func.__module__}.{func.__name__}"
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        stack = getattr(_local, 'function_stack', None)
+        if stack is None:
+            stack = _local.function_stack = []
+        stack.append(name)
+        start = time.perf_counter()
+        result = None
+        try:
+            result = func(*args, **kwargs)
+            return result
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            stack.pop()
+            rows = _row_count(result)
+            stats = _record(_function_stats, name, elapsed_ms, rows)
+            with _lock:
+                stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+            _log_slow("CALL", name, elapsed_ms, rows)
+    return wrapper
+
+
+def _statement_key(sql):
+    return " ".join(sql.split())
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Times each statement from execute() until its rows have been fetched
+    (or the next statement / close), and counts the rows read or changed."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._active_key = None
+        self._active_ms = 0.0
+        self._active_rows = 0
+
+    def _begin(self, sql, elapsed_ms):
+        self._finish()
+        key = _statement_key(sql)
+        rows = max(self.rowcount, 0) # DML row count; -1 for SELECT
+        _record(_statement_stats, key, elapsed_ms, rows)
+        self._active_key, self._active_ms, self._active_rows = key, elapsed_ms, rows
+
+    def _add_fetch(self, elapsed_ms, rows):
+        if self._active_key is None:
+            return
+        _record(_statement_stats, self._active_key, elapsed_ms, rows, new_call=False)
+        self._active_ms += elapsed_ms
+        self._active_rows += rows
+
+    def _finish(self):
+        if self._active_key is None:
+            return
+        key, elapsed_ms = self._active_key, self._active_ms
+        self._active_key = None
+        with _lock:
+            stats = _statement_stats[key]
+            stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+        _log_slow("SQL", key, elapsed_ms, self._active_rows)
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        super().execute(sql, parameters)
+        self._begin(sql, (time.perf_counter() - start) * 1000)
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        super().executemany(sql, seq_of_parameters)
+        self._begin(sql, (time.perf_counter() - start) * 1000)
+        return self
+
+    def executescript(self, sql_script):
+        start = time.perf_counter()
+        super().executescript(sql_script)
+        self._begin(sql_script, (time.perf_counter() - start) * 1000)
+        return self
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._add_fetch((time.perf_counter() - start) * 1000, 0 if row is None else 1)
+        if row is None:
+            self._finish()
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._add_fetch((time.perf_counter() - start) * 1000, len(rows))
+        if not rows:
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._add_fetch((time.perf_counter() - start) * 1000, len(rows))
+        self._finish()
+        return rows
+
+    def close(self):
+        self._finish()
+        super().close()
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """sqlite3 connection whose cursors (including conn.execute shortcuts) are instrumented."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._open_cursors = []
+
+    def cursor(self, factory=InstrumentedCursor):
+        cursor = super().cursor(factory)
+        if isinstance(cursor, InstrumentedCursor):
+            self._open_cursors.append(cursor)
+        return cursor
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+    def _finish_cursors(self):
+        # Statements whose rows were only partly fetched are finished here.
+        for cursor in self._open_cursors:
+            cursor._finish()
+        self._open_cursors = []
+
+    def close(self):
+        self._finish_cursors()
+        super().close()
+
+
+class _PooledMixin:
+    """close() gives the connection back to its pool instead of closing it."""
+    _pool = None
+    _checked_out = False
+
+    def close(self):
+        if self._pool is None:
+            super().close()
+        elif self._checked_out: # a second close() must not release a connection someone else now holds
+            self._checked_out = False
+            if not self._pool.release(self):
+                super().close()
+
+
+class PooledConnection(_PooledMixin, sqlite3.Connection):
+    pass
+
+
+class PooledInstrumentedConnection(_PooledMixin, InstrumentedConnection):
+    pass
+
+
+class ConnectionPool:
+    """Up to `size` open connections to one database, shared between threads.
+    A caller that finds them all busy waits POOL_WAIT_SECONDS, then gets an extra connection
+    that is really closed afterwards, so a burst slows down instead of failing."""
+
+    def __init__(self, db_path, size):
+        self.db_path = db_path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        self.stats = {'acquired': 0, 'created': 0, 'waited': 0, 'overflow': 0}
+
+    def _open(self, pooled=True):
+        factory = PooledInstrumentedConnection if MONITOR_ENABLED else PooledConnection
+        conn = sqlite3.connect(self.db_path, factory=factory, check_same_thread=False, timeout=BUSY_TIMEOUT_SECONDS)
+        if pooled:
+            conn._pool = self
+        return conn
+
+    def acquire(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = None
+            with self._lock:
+                if self._created < self.size:
+                    self._created += 1
+                    self.stats['created'] += 1
+                    create = True
+                else:
+                    create = False
+            if create:
+                conn = self._open()
+            else:
+                with self._lock:
+                    self.stats['waited'] += 1
+                try:
+                    conn = self._idle.get(timeout=POOL_WAIT_SECONDS)
+                except queue.Empty:
+                    with self._lock:
+                        self.stats['overflow'] += 1
+                    conn = self._open(pooled=False)
+        with self._lock:
+            self.stats['acquired'] += 1
+        conn._checked_out = True
+        return conn
+
+    def release(self, conn):
+        """Puts conn back as a fresh connection would be; returns False if it should be closed instead."""
+        if self._closed:
+            return False
+        try:
+            if isinstance(conn, InstrumentedConnection):
+                conn._finish_cursors()
+            if conn.in_transaction:
+                conn.rollback() # never hand a half-done transaction to the next caller
+            conn.row_factory = None
+            conn.text_factory = str
+            conn.isolation_level = ""
+        except sqlite3.Error:
+            with self._lock:
+                self._created -= 1
+            return False
+        self._idle.put(conn)
+        return True
+
+    def close_all(self):
+        self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn._pool = None
+            conn.close()
+
+
+def enable_pooling(size=8):
+    """From now on connect() reuses up to `size` connections per database."""
+    global _pool_size
+    with _lock:
+        _pool_size = max(1, int(size))
+
+
+def disable_pooling():
+    """Stops pooling and closes the idle pooled connections."""
+    global _pool_size
+    with _lock:
+        _pool_size = 0
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close_all()
+
+
+def get_pool_stats():
+    """{db path: {'size', 'open', 'idle', 'acquired', 'created', 'waited', 'overflow'}} for the active pools."""
+    with _lock:
+        pools = list(_pools.values())
+    return {pool.db_path: dict(pool.stats, size=pool.size, open=pool._created, idle=pool._idle.qsize())
+            for pool in pools}
+
+
+def _get_pool(db_path):
+    key = os.path.abspath(db_path)
+    with _lock:
+        if not _pool_size:
+            return None
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(key, _pool_size)
+        return pool
+
+
+def connect(db_path, **kwargs):
+    """Opens a connection to db_path; instrumented unless monitoring is disabled.
+    With pooling enabled (and no extra sqlite3.connect arguments) it comes from the pool."""
+    if MONITOR_ENABLED and (_slow_logger is None or _slow_log_path is None):
+        configure_slow_log(db_path)
+    pool = None if kwargs else _get_pool(db_path)
+    if pool is not None:
+        return pool.acquire()
+    kwargs.setdefault('timeout', BUSY_TIMEOUT_SECONDS)
+    if not MONITOR_ENABLED:
+        return sqlite3.connect(db_path, **kwargs)
+    kwargs.setdefault('factory', InstrumentedConnection)
+    return sqlite3.connect(db_path, **kwargs)
+
+
+class Rollback(Exception):
+    """Raised by a write_transaction() work function to undo its writes; write_transaction
+    then returns `result` instead of committing."""
+
+    def __init__(self, result=None):
+        super().__init__(result)
+        self.result = result
+
+
+def is_busy_error(error):
+    message = str(error).lower()
+    return isinstance(error, sqlite3.OperationalError) and ("locked" in message or "busy" in message)
+
+
+def write_transaction(db_path, work, attempts=WRITE_ATTEMPTS):
+    """Runs work(cursor) in a BEGIN IMMEDIATE transaction, commits and returns its result.
+
+    IMMEDIATE takes the write lock before work reads anything, so a check such as "is a copy
+    free?" and the write that depends on it can't interleave with another writer. If the lock
+    is still held by someone else after BUSY_TIMEOUT_SECONDS, the transaction is retried after
+    a random pause of up to BACKOFF_BASE_SECONDS * 2**attempt (capped at BACKOFF_MAX_SECONDS),
+    so writers that collided don't all come back at once. work may run more than once and must
+    only change the database through the cursor. Other errors, and the last busy error, are
+    raised for the caller to report.
+    Calls nested in work or made from an on_commit callback keep their own callbacks: the
+    enclosing transaction's list is restored when they finish."""
+    outer_callbacks = getattr(_local, 'after_commit', None)
+    for attempt in range(attempts):
+        conn = connect(db_path)
+        _local.after_commit = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            result = work(conn.cursor())
+            conn.commit()
+            with _lock:
+                _write_stats['transactions'] += 1
+            callbacks, _local.after_commit = _local.after_commit, None
+            for callback in callbacks:
+                callback()
+            return result
+        except Rollback as rollback:
+            conn.rollback()
+            return rollback.result
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                conn.rollback()
+            if not is_busy_error(e) or attempt == attempts - 1:
+                if is_busy_error(e):
+                    with _lock:
+                        _write_stats['busy_failures'] += 1
+                raise
+            with _lock:
+                _write_stats['busy_retries'] += 1
+        finally:
+            _local.after_commit = outer_callbacks
+            conn.close()
+        time.sleep(random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt)))
+
+
+def on_commit(callback):
+    """Runs callback once the write_transaction() running on this thread has committed (not at
+    all if it rolls back). Outside write_transaction() it runs at once."""
+    pending = getattr(_local, 'after_commit', None)
+    if pending is None:
+        callback()
+    else:
+        pending.append(callback)
+
+
+def get_write_stats():
+    """{'transactions', 'busy_retries', 'busy_failures'} of write_transaction() since start/reset."""
+    with _lock:
+        return dict(_write_stats)
+
+
+def _sorted_stats(registry, key_name, sort_by, limit):
+    with _lock:
+        items = [dict(stats, **{key_name: key}) for key, stats in registry.items()]
+    for item in items:
+        item['avg_ms'] = item['total_ms'] / item['calls'] if item['calls'] else 0.0
+    items.sort(key=lambda item: item[sort_by], reverse=True)
+    return items[:limit] if limit else items
+
+
+def get_function_stats(sort_by='total_ms', limit=None):
+    """Manager function stats, slowest (by sort_by) first. Each item is a dict with
+    function, calls, total_ms, max_ms, avg_ms and rows."""
+    return _sorted_stats(_function_stats, 'function', sort_by, limit)
+
+
+def get_statement_stats(sort_by='total_ms', limit=None):
+    """SQL statement stats, slowest (by sort_by) first. Each item is a dict with
+    sql, calls, total_ms, max_ms, avg_ms and rows."""
+    return _sorted_stats(_statement_stats, 'sql', sort_by, limit)
+
+
+def reset_stats():
+    with _lock:
+        _function_stats.clear()
+        _statement_stats.clear()
+        for key in _write_stats:
+            _write_stats[key] = 0
@@ -0,0 +1,147 @@
+"""
+In-process read-through cache for student data that is read far more often than it changes:
+single students (also behind is_student_leader), the leader/admin lists and the classroom list.
+
+- `@cached(cache, db_path_func)` wraps a read function; results are kept per database file and
+  arguments, least recently used entries are evicted past the cache's size.
+- Every entry is stamped with the data_versions counter of its cache (see db_setup.DATA_VERSIONS),
+  read through change_bus.read_data_versions before each lookup. The triggers bump the counter
+  in the writing transaction, so a write from any connection or process makes the older
+  entries unreachable: this process, the API server, sync pushes and pulls, legacy_import,
+  restored backups and the classroom triggers alike. While nothing is written the check is one
+  PRAGMA data_version on a connection kept per thread.
+- The write functions of this process also call `invalidate_student()` /
+  `invalidate_student_lists()` for what they changed, after their transaction has committed
+  (points changes go through query_monitor.on_commit), which frees the old entries right away.
+- Hits are handed out as copies, so a caller changing a dict doesn't change the cached one.
+
+A database without the data_versions table (or that cannot be read) is not cached.
+Set BIBLIO_READ_CACHE=0 to turn caching off.
+"""
+import functools
+import os
+import threading
+from collections import OrderedDict
+from change_bus import read_data_versions
+
+CACHE_ENABLED = os.environ.get("BIBLIO_READ_CACHE", "1") != "0"
+
+
+class LRUCache:
+    def __init__(self, name, maxsize, version_name):
+        self.name = name
+        self.maxsize = maxsize
+        self.version_name = version_name # the data_versions counter its entries depend on
+        self._entries = OrderedDict() # key -> value, least recently used first
+        self._lock = threading.Lock()
+        self._generation = 0 # bumped by every invalidation, see cached()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get(self, key):
+        """(True, value) on a hit, (False, generation) on a miss."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return True, self._entries[key]
+            self.stats['misses'] += 1
+            return False, self._generation
+
+    def put(self, key, value, generation):
+        """Stores value unless an invalidation happened since the miss that read it."""
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def invalidate(self, match=None):
+        """Drops the entries whose key satisfies match(key), or all of them."""
+        with self._lock:
+            self._generation += 1
+            self.stats['invalidations'] += 1
+            if match is None:
+                self._entries.clear()
+                return
+            for key in [key for key in self._entries if match(key)]:
+                del self._entries[key]
+
+    def reset_stats(self):
+        with self._lock:
+            for key in self.stats:
+                self.stats[key] = 0
+
+
+STUDENTS = LRUCache("students", 4096, "students") # get_student_by_id_db, per student
+STUDENT_LISTS = LRUCache("student_lists", 32, "students") # get_students_db filtered by role (rows include points)
+CLASSROOMS = LRUCache("classrooms", 8, "roster") # get_distinct_classrooms
+_caches = (STUDENTS, STUDENT_LISTS, CLASSROOMS)
+
+
+def _copy(value):
+    if isinstance(value, dict):
+        return dict(value)
+    if isinstance(value, list):
+        return [dict(item) if isinstance(item, dict) else item for item in value]
+    return value
+
+
+def cached(cache, db_path_func, when=None):
+    """Caches func's results in cache, keyed by database path, function, arguments and the
+    cache's data version. when(*args, **kwargs) can restrict caching to some calls; empty
+    results (None, []) on a database error are never stored, so the next call retries."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not CACHE_ENABLED or (when is not None and not when(*args, **kwargs)):
+                return func(*args, **kwargs)
+            db_path = db_path_func()
+            versions = read_data_versions(db_path) # read before func, so entries are never older than their stamp
+            if not versions or cache.version_name not in versions:
+                return func(*args, **kwargs)
+            key = (db_path, func.__name__, args, tuple(sorted(kwargs.items())), versions[cache.version_name])
+            hit, value = cache.get(key)
+            if hit:
+                return _copy(value)
+            result = func(*args, **kwargs)
+            if result:
+                cache.put(key, _copy(result), value)
+            return result
+        return wrapper
+    return decorator
+
+
+def invalidate_student(student_id):
+    """A student's row changed (details, password, points): drops it and the lists it may be in."""
+    STUDENTS.invalidate(lambda key: student_id in key[2] or ('student_id', student_id) in key[3])
+    STUDENT_LISTS.invalidate()
+
+
+def invalidate_student_lists():
+    """Students were added or removed, or changed role or classroom."""
+    STUDENT_LISTS.invalidate()
+    CLASSROOMS.invalidate()
+
+
+def clear():
+    for cache in _caches:
+        cache.invalidate()
+
+
+def get_cache_stats():
+    """{cache name: {'size', 'maxsize', 'hits', 'misses', 'evictions', 'invalidations', 'hit_rate'}}."""
+    stats = {}
+    for cache in _caches:
+        with cache._lock:
+            lookups = cache.stats['hits'] + cache.stats['misses']
+            stats[cache.name] = dict(cache.stats, size=len(cache._entries), maxsize=cache.maxsize,
+                                     hit_rate=cache.stats['hits'] / lookups if lookups else None)
+    return stats
+
+
+def reset_stats():
+    for cache in _caches:
+        cache.reset_stats()
@@ -3,6 +3,9 @@ import uuid
 import hashlib
 import os
 from utils import get_data_path
+import query_monitor
+import read_cache
+from database.db_setup import CLASSROOM_ID_BY_NAME, get_classroom_id, is_global_filter, prune_classroom
 
 # DB_PATH = 'database/library.db' # Using the same database file
 
@@ -17,6 +20,11 @@ def _get_resolved_db_path():
     os.makedirs(os.path.dirname(path), exist_ok=True)
     return path
 
+# A student row with its classroom's name (reads join classrooms, see db_setup.get_classroom_id).
+_STUDENT_SELECT = """
+    SELECT s.id, s.name, c.name AS classroom, s.role, s.points, s.hashed_password, s.salt
+    FROM students s LEFT JOIN classrooms c ON c.id = s.classroom_id"""
+
 def generate_student_id():
     """Generates a unique ID for a student."""
     return str(uuid.uuid4())
@@ -61,6 +69,7 @@ def verify_password(stored_hashed_password_hex, salt_hex, provided_password):
     except (ValueError, TypeError): # Handle potential errors from hex conversion (e.g., non-hex string)
         return False
 
+@query_monitor.timed
 def add_student_db(name, classroom, password, role='student'):
     """Adds a new student to the database.
     If password is provided, it's hashed. Otherwise, salt and hash are stored as None.
@@ -72,30 +81,30 @@ def add_student_db(name, classroom, password, role='student'):
     else:
         salt_hex, hashed_password_hex = None, None
 
-    try:
-        conn = sqlite3.connect(_get_resolved_db_path())
-        cursor = conn.cursor()
+    def insert(cursor):
         cursor.execute("""
-            INSERT INTO students (id, name, classroom, role, hashed_password, salt)
+            INSERT INTO students (id, name, classroom_id, role, hashed_password, salt)
             VALUES (?, ?, ?, ?, ?, ?)
-        """, (student_id, name, classroom, role, hashed_password_hex, salt_hex))
-        conn.commit()
+        """, (student_id, name, get_classroom_id(cursor, classroom), role, hashed_password_hex, salt_hex))
         return student_id
+    try:
+        new_id = query_monitor.write_transaction(_get_resolved_db_path(), insert)
     except sqlite3.Error as e:
         print(f"Database error in add_student_db: {e}")
         return None
-    finally:
-        if conn:
-            conn.close()
+    read_cache.invalidate_student_lists()
+    return new_id
 
+@read_cache.cached(read_cache.STUDENTS, lambda: _get_resolved_db_path())
+@query_monitor.timed
 def get_student_by_id_db(student_id):
     """Fetches a single student by their ID.
     Returns a dictionary representing the student, or None if not found."""
     try:
-        conn = sqlite3.connect(_get_resolved_db_path())
+        conn = query_monitor.connect(_get_resolved_db_path())
         conn.row_factory = sqlite3.Row # Access columns by name
         cursor = conn.cursor()
-        cursor.execute("SELECT id, name, classroom, role, points, hashed_password, salt FROM students WHERE id = ?", (student_id,)) # Added 'points'
+        cursor.execute(f"{_STUDENT_SELECT} WHERE s.id = ?", (student_id,))
         student_row = cursor.fetchone()
         return dict(student_row) if student_row else None
     except sqlite3.Error as e:
@@ -105,24 +114,28 @@ def get_student_by_id_db(student_id):
         if conn:
             conn.close()
 
+# Only the small role lists (leaders, admins) are cached, not whole classrooms or the full roster.
+@read_cache.cached(read_cache.STUDENT_LISTS, lambda: _get_resolved_db_path(),
+                   when=lambda classroom_filter=None, role_filter=None: role_filter not in (None, "All") and classroom_filter in (None, "All"))
+@query_monitor.timed
 def get_students_db(classroom_filter=None, role_filter=None):
     """Fetches a list of students, with optional filters for classroom and role.
     Returns a list of dictionaries."""
     try:
-        conn = sqlite3.connect(_get_resolved_db_path())
+        conn = query_monitor.connect(_get_resolved_db_path())
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
 
-        query = "SELECT id, name, classroom, role, points, hashed_password, salt FROM students" # Added 'points'
+        query = _STUDENT_SELECT
         filters = []
         params = []
 
         if classroom_filter and classroom_filter != "All":
-            filters.append("classroom = ?")
+            filters.append(f"s.classroom_id = {CLASSROOM_ID_BY_NAME}")
             params.append(classroom_filter)
 
         if role_filter and role_filter != "All":
-            filters.append("role = ?")
+            filters.append("s.role = ?")
             params.append(role_filter)
 
         if filters:
@@ -138,6 +151,25 @@ def get_students_db(classroom_filter=None, role_filter=None):
         if conn:
             conn.close()
 
+@query_monitor.timed
+def get_students_by_name_db(name):
+    """Fetches all students with exactly this name, in insertion order.
+    Returns a list of dictionaries."""
+    conn = None
+    try:
+        conn = query_monitor.connect(_get_resolved_db_path())
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        cursor.execute(f"{_STUDENT_SELECT} WHERE s.name = ? ORDER BY s.rowid", (name,))
+        return [dict(row) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        print(f"Database error in get_students_by_name_db: {e}")
+        return []
+    finally:
+        if conn:
+            conn.close()
+
+@query_monitor.timed
 def get_students_by_classroom_db(classroom):
     """Fetches students for a specific classroom.
     Returns a list of dictionaries."""
@@ -145,65 +177,77 @@ def get_students_by_classroom_db(classroom):
         return get_students_db() # Or handle as an error/empty list
     return get_students_db(classroom_filter=classroom)
 
+@query_monitor.timed
 def delete_student_db(student_id):
     """Deletes a student from the database by their ID.
     Returns True on successful deletion, False otherwise."""
-    try:
-        conn = sqlite3.connect(_get_resolved_db_path())
-        cursor = conn.cursor()
+    def delete(cursor):
+        cursor.execute("SELECT classroom_id FROM students WHERE id = ?", (student_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return False
         cursor.execute("DELETE FROM students WHERE id = ?", (student_id,))
-        conn.commit()
-        return cursor.rowcount > 0 # Check if any row was affected
+        prune_classroom(cursor, row[0]) # if this was its last student
+        return True
+    try:
+        deleted = query_monitor.write_transaction(_get_resolved_db_path(), delete)
     except sqlite3.Error as e:
         print(f"Database error in delete_student_db: {e}")
         return False
-    finally:
-        if conn:
-            conn.close()
+    read_cache.invalidate_student(student_id)
+    read_cache.invalidate_student_lists()
+    return deleted
 
+@query_monitor.timed
 def update_student_password_db(student_id, new_password):
     """Updates a student's password in the database.
     A new salt is generated for the new password.
     Returns True on successful update, False otherwise."""
     new_salt_hex, new_hashed_password_hex = hash_password(new_password)
-    try:
-        conn = sqlite3.connect(_get_resolved_db_path())
-        cursor = conn.cursor()
+    def update(cursor):
         cursor.execute("""
             UPDATE students
             SET hashed_password = ?, salt = ?
             WHERE id = ?
         """, (new_hashed_password_hex, new_salt_hex, student_id))
-        conn.commit()
         return cursor.rowcount > 0 # Check if any row was affected
+    try:
+        updated = query_monitor.write_transaction(_get_resolved_db_path(), update)
     except sqlite3.Error as e:
         print(f"Database error in update_student_password_db: {e}")
         return False
-    finally:
-        if conn:
-            conn.close()
+    read_cache.invalidate_student(student_id)
+    return updated
 
+@query_monitor.timed
 def update_student_details_db(student_id, name, classroom, role):
     """Updates a student's name, classroom, and role in the database.
     Password and salt are not affected.
     Returns True on successful update, False otherwise."""
-    try:
-        conn = sqlite3.connect(_get_resolved_db_path())
-        cursor = conn.cursor()
+    def update(cursor):
+        cursor.execute("SELECT classroom_id FROM students WHERE id = ?", (student_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return False
+        classroom_id = get_classroom_id(cursor, classroom)
         cursor.execute("""
             UPDATE students
-            SET name = ?, classroom = ?, role = ?
+            SET name = ?, classroom_id = ?, role = ?
             WHERE id = ?
-        """, (name, classroom, role, student_id))
-        conn.commit()
-        return cursor.rowcount > 0 # True if at least one row was updated
+        """, (name, classroom_id, role, student_id))
+        if row[0] != classroom_id:
+            prune_classroom(cursor, row[0]) # if the student was the last one in their old classroom
+        return True
+    try:
+        updated = query_monitor.write_transaction(_get_resolved_db_path(), update)
     except sqlite3.Error as e:
         print(f"Database error in update_student_details_db: {e}")
         return False
-    finally:
-        if conn:
-            conn.close()
+    read_cache.invalidate_student(student_id)
+    read_cache.invalidate_student_lists()
+    return updated
 
+@query_monitor.timed
 def is_student_leader(student_id):
     """Checks if a student is a leader.
     Returns True if the student's role is 'leader', False otherwise.
@@ -215,23 +259,29 @@ def is_student_leader(student_id):
         return True
     return False
 
-def get_students_sorted_by_points(classroom_filter=None):
+@query_monitor.timed
+def get_students_sorted_by_points(classroom_filter=None, limit=None, offset=0):
+    """Students ordered by points (highest first), optionally for one classroom.
+    limit/offset return one window of the ranking; ties are broken by name so windows are stable."""
     conn = None
     students_list = []
     try:
-        conn = sqlite3.connect(_get_resolved_db_path())
+        conn = query_monitor.connect(_get_resolved_db_path())
         conn.row_factory = sqlite3.Row # Use row_factory for dictionary-like row access
         cursor = conn.cursor()
 
-        query = "SELECT id, name, points, classroom FROM students"
+        query = "SELECT s.id, s.name, s.points, c.name AS classroom FROM students s LEFT JOIN classrooms c ON c.id = s.classroom_id"
         params = []
 
-        # Check against display values used in UI for "Global"
-        if classroom_filter and classroom_filter.lower() != "global" and classroom_filter.lower() != "🏆 global":
-            query += " WHERE classroom = ?"
+        if not is_global_filter(classroom_filter):
+            query += f" WHERE s.classroom_id = {CLASSROOM_ID_BY_NAME}"
             params.append(classroom_filter)
 
-        query += " ORDER BY points DESC"
+        # Same column order as idx_students_points / idx_students_classroom_points: no sort needed.
+        query += " ORDER BY s.points DESC, s.name, s.classroom_id, s.id"
+        if limit is not None:
+            query += " LIMIT ? OFFSET ?"
+            params.extend([limit, offset])
 
         cursor.execute(query, tuple(params))
         rows = cursor.fetchall()
@@ -249,14 +299,154 @@ def get_students_sorted_by_points(classroom_filter=None):
         if conn:
             conn.close()
 
+# Global RANK / DENSE_RANK for the distinct points values down to the page's lowest: the
+# students ranked above any of them all have more points, so the GROUP BY walks
+# idx_students_points from the top to the end of the page only, not the whole table.
+_POINTS_RANKS_CTE = """
+    points_ranks AS (
+        SELECT points,
+               1 + COALESCE(SUM(COUNT(*)) OVER (ORDER BY points DESC ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING), 0) AS global_rank,
+               DENSE_RANK() OVER (ORDER BY points DESC) AS global_dense_rank
+        FROM students
+        WHERE points >= (SELECT MIN(points) FROM page)
+        GROUP BY points
+    )"""
+
+@query_monitor.timed
+def get_leaderboard_db(classroom_filter=None, limit=None, offset=0):
+    """Leaderboard rows in the same order as get_students_sorted_by_points, with ranks.
+    Each dict has id, name, classroom, points, global_rank, global_dense_rank, class_rank
+    and class_dense_rank. Tied students share a rank (RANK: 1,1,3 / DENSE_RANK: 1,1,2).
+    classroom_filter limits the rows to one classroom; global ranks stay school-wide."""
+    conn = None
+    try:
+        conn = query_monitor.connect(_get_resolved_db_path())
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        page_limit = -1 if limit is None else limit # LIMIT -1 is "no limit" in SQLite
+
+        if is_global_filter(classroom_filter):
+            # Take the page first (index walk that stops at the LIMIT); per-class ranks
+            # are then counted on idx_students_classroom_points for the page rows only.
+            query = f"""
+                WITH page AS (
+                    SELECT id, name, classroom_id, points FROM students
+                    ORDER BY points DESC, name, classroom_id, id
+                    LIMIT ? OFFSET ?
+                ),
+                {_POINTS_RANKS_CTE}
+                SELECT p.id, p.name, c.name AS classroom, p.points, pr.global_rank, pr.global_dense_rank,
+                       1 + (SELECT COUNT(*) FROM students s2
+                            WHERE s2.classroom_id = p.classroom_id AND s2.points > p.points) AS class_rank,
+                       1 + (SELECT COUNT(DISTINCT s2.points) FROM students s2
+                            WHERE s2.classroom_id = p.classroom_id AND s2.points > p.points) AS class_dense_rank
+                FROM page p JOIN points_ranks pr ON pr.points = p.points
+                LEFT JOIN classrooms c ON c.id = p.classroom_id
+                ORDER BY p.points DESC, p.name, p.classroom_id, p.id
+            """
+            params = (page_limit, offset)
+        else:
+            # The class window runs over the classroom's rows of idx_students_classroom_points
+            # only, before LIMIT/OFFSET, so class ranks are correct on every page.
+            query = f"""
+                WITH page AS (
+                    SELECT id, name, classroom_id, points,
+                           RANK() OVER class_window AS class_rank,
+                           DENSE_RANK() OVER class_window AS class_dense_rank
+                    FROM students
+                    WHERE classroom_id = {CLASSROOM_ID_BY_NAME}
+                    WINDOW class_window AS (ORDER BY points DESC)
+                    ORDER BY points DESC, name, classroom_id, id
+                    LIMIT ? OFFSET ?
+                ),
+                {_POINTS_RANKS_CTE}
+                SELECT p.id, p.name, c.name AS classroom, p.points, pr.global_rank, pr.global_dense_rank,
+                       p.class_rank, p.class_dense_rank
+                FROM page p JOIN points_ranks pr ON pr.points = p.points
+                JOIN classrooms c ON c.id = p.classroom_id
+                ORDER BY p.points DESC, p.name, p.classroom_id, p.id
+            """
+            params = (classroom_filter, page_limit, offset)
+
+        cursor.execute(query, params)
+        return [dict(row) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        print(f"Database error in get_leaderboard_db: {e}")
+        return []
+    finally:
+        if conn:
+            conn.close()
+
+@query_monitor.timed
+def get_student_rank_db(student_id, neighbors=2, scope="global"):
+    """A student's leaderboard entry plus the students right above and below them.
+    scope is "global" (whole school) or "class" (the student's classroom).
+    Returns {'student': row, 'neighbors': [rows in leaderboard order, including the student]}
+    with rows shaped like get_leaderboard_db(), or None if the student does not exist."""
+    conn = None
+    try:
+        conn = query_monitor.connect(_get_resolved_db_path())
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT s.name, s.classroom_id, c.name, s.points
+            FROM students s LEFT JOIN classrooms c ON c.id = s.classroom_id WHERE s.id = ?
+        """, (student_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        name, classroom_id, classroom, points = row
+
+        # Position in the leaderboard = students strictly ahead in (points DESC, name, classroom_id, id).
+        scope_sql = "classroom_id = ? AND " if scope == "class" else ""
+        scope_params = (classroom_id,) if scope == "class" else ()
+        cursor.execute(f"""
+            SELECT (SELECT COUNT(*) FROM students WHERE {scope_sql}points > ?)
+                 + (SELECT COUNT(*) FROM students
+                    WHERE {scope_sql}points = ? AND (name, classroom_id, id) < (?, ?, ?))
+        """, scope_params + (points,) + scope_params + (points, name, classroom_id, student_id))
+        ahead = cursor.fetchone()[0]
+    except sqlite3.Error as e:
+        print(f"Database error in get_student_rank_db: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+    first = max(ahead - neighbors, 0)
+    window = get_leaderboard_db(classroom if scope == "class" else None,
+                                limit=ahead - first + neighbors + 1, offset=first)
+    student = next((entry for entry in window if entry['id'] == student_id), None)
+    if student is None: # deleted or re-scored between the two queries
+        return None
+    return {'student': student, 'neighbors': window}
+
+# One row per classroom, in name order (the name's unique index), each checked for a student
+# on idx_students_classroom_points.
+CLASSROOM_LIST_SQL = """
+    SELECT c.name FROM classrooms c
+    WHERE EXISTS (SELECT 1 FROM students s WHERE s.classroom_id = c.id)
+    ORDER BY c.name
+"""
+
+def classroom_has_students(cursor, classroom):
+    """True if classroom is the name of a classroom with students (two index lookups)."""
+    cursor.execute("""
+        SELECT 1 FROM classrooms c
+        WHERE c.name = ? AND EXISTS (SELECT 1 FROM students s WHERE s.classroom_id = c.id)
+    """, (classroom,))
+    return cursor.fetchone() is not None
+
+@read_cache.cached(read_cache.CLASSROOMS, lambda: _get_resolved_db_path())
+@query_monitor.timed
 def get_distinct_classrooms():
+    """Names of the classrooms that have students, in order."""
     conn = None
     classrooms = []
     try:
-        conn = sqlite3.connect(_get_resolved_db_path())
+        conn = query_monitor.connect(_get_resolved_db_path())
         # conn.row_factory = sqlite3.Row # Not strictly necessary for single column fetch
         cursor = conn.cursor()
-        cursor.execute("SELECT DISTINCT classroom FROM students WHERE classroom IS NOT NULL AND classroom != '' ORDER BY classroom")
+        cursor.execute(CLASSROOM_LIST_SQL)
         rows = cursor.fetchall()
         classrooms = [row[0] for row in rows]
     except sqlite3.Error as e:
@@ -266,16 +456,21 @@ def get_distinct_classrooms():
             conn.close()
     return classrooms
 
+@query_monitor.timed
 def rename_classroom(old_classroom_name, new_classroom_name):
     """
-    Renames a classroom for all students in it.
+    Renames a classroom, for its students and for the books located in it.
+
+    Students and books refer to the classroom by id, so this updates its classrooms row only.
+    If new_classroom_name is already a classroom, the two are merged: the students and books
+    move to it and the old classroom is pruned.
 
     Args:
         old_classroom_name (str): The current name of the classroom.
         new_classroom_name (str): The new name for the classroom.
 
     Returns:
-        bool: True if at least one student's classroom was updated, False otherwise.
+        bool: True if the classroom was renamed, False otherwise.
     """
     if not new_classroom_name or not new_classroom_name.strip():
         print("Error: New classroom name cannot be empty or just whitespace.")
@@ -284,30 +479,39 @@ def rename_classroom(old_classroom_name, new_classroom_name):
         print("Info: Old and new classroom names are the same. No change made.")
         return False # Or True, depending on desired behavior for no-op
 
-    conn = None
-    try:
-        conn = sqlite3.connect(_get_resolved_db_path())
-        cursor = conn.cursor()
-        cursor.execute("UPDATE students SET classroom = ? WHERE classroom = ?",
-                       (new_classroom_name.strip(), old_classroom_name))
-        conn.commit()
-        if cursor.rowcount > 0:
-            print(f"Successfully renamed classroom '{old_classroom_name}' to '{new_classroom_name}' for {cursor.rowcount} students.")
-            return True
-        else:
-            print(f"No students found in classroom '{old_classroom_name}'. No changes made.")
+    new_name = new_classroom_name.strip()
+
+    def rename(cursor):
+        cursor.execute("SELECT id FROM classrooms WHERE name = ?", (old_classroom_name,))
+        row = cursor.fetchone()
+        if row is None:
             return False
+        cursor.execute("SELECT id FROM classrooms WHERE name = ?", (new_name,))
+        target = cursor.fetchone()
+        if target is None:
+            cursor.execute("UPDATE classrooms SET name = ? WHERE id = ?", (new_name, row[0]))
+        else: # merge
+            cursor.execute("UPDATE students SET classroom_id = ? WHERE classroom_id = ?", (target[0], row[0]))
+            cursor.execute("UPDATE books SET location_id = ? WHERE location_id = ?", (target[0], row[0]))
+            prune_classroom(cursor, row[0])
+        return True
+    try:
+        renamed = query_monitor.write_transaction(_get_resolved_db_path(), rename)
     except sqlite3.Error as e:
         print(f"Database error in rename_classroom: {e}")
         return False
-    finally:
-        if conn:
-            conn.close()
+    read_cache.clear() # every cached student of the classroom has the old name
+    if renamed:
+        print(f"Successfully renamed classroom '{old_classroom_name}' to '{new_name}'.")
+        return True
+    print(f"No classroom named '{old_classroom_name}' found. No changes made.")
+    return False
 
 # --- CSV Import Functionality ---
 import csv
 import io # For testing with StringIO
 
+@query_monitor.timed
 def import_students_from_csv(file_path, classroom_name):
     """
     Imports students from a CSV file.
@@ -326,7 +530,6 @@ def import_students_from_csv(file_path, classroom_name):
     success_count = 0
     errors = []
     students_to_insert = []
-    conn = None
 
     if not classroom_name or not classroom_name.strip():
         errors.append("Classroom name cannot be empty.")
@@ -389,19 +592,18 @@ def import_students_from_csv(file_path, classroom_name):
                  errors.append("No se encontraron alumnos válidos para importar en el archivo CSV.")
             return 0, errors
 
-        conn = sqlite3.connect(_get_resolved_db_path())
-        cursor = conn.cursor()
-        conn.execute("BEGIN TRANSACTION;")
-
         try:
-            cursor.executemany("""
-                INSERT INTO students (id, name, classroom, role, hashed_password, salt)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, students_to_insert)
-            conn.commit()
+            def insert_all(cursor):
+                classroom_id = get_classroom_id(cursor, classroom_name.strip())
+                cursor.executemany("""
+                    INSERT INTO students (id, name, classroom_id, role, hashed_password, salt)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, [(student_id, name, classroom_id, role, hashed, salt)
+                      for student_id, name, _, role, hashed, salt in students_to_insert])
+            query_monitor.write_transaction(_get_resolved_db_path(), insert_all)
             success_count = len(students_to_insert)
+            read_cache.invalidate_student_lists()
         except sqlite3.Error as e:
-            conn.rollback()
             errors.append(f"Error de base de datos durante la inserción en lote: {e}. No se importaron alumnos en este lote.")
             return 0, errors # Return 0 successful imports for this batch on DB error
 
@@ -409,11 +611,6 @@ def import_students_from_csv(file_path, classroom_name):
         errors.append(f"Error: No se encontró el archivo '{file_path}'.")
     except Exception as e:
         errors.append(f"Ocurrió un error inesperado durante la importación del CSV: {e}")
-        if conn: # If connection was established before this generic error
-            conn.rollback()
-    finally:
-        if conn:
-            conn.close()
 
     return success_count, errors
 
@@ -0,0 +1,693 @@
+"""
+Offline-first sync between classroom laptops and the central database.
+
+Each laptop keeps working on its own SQLite file (a replica). Loans, returns and extensions made
+there are applied locally at once and also written to sync_outbox, stamped with a hybrid logical
+clock. sync() then:
+
+1. pushes the outbox to the server, which applies the operations in clock order and answers
+   each one with applied / rejected / duplicate;
+2. pulls the rows changed on the server since the laptop's cursor (sync_log, see db_setup),
+   so only the deltas travel.
+
+The server is the authority for the rows; laptops only send operations, never rows. The rules
+are deterministic, so every laptop ends up with the server's state:
+
+- loan: applied if the book still has a free copy on the server. When two laptops lent the last
+  copy offline, the loan that reaches the server first (in clock order within one push) wins.
+  The other is rejected ("no_copy"): the laptop removes it, takes back its borrowing points and
+  records it in sync_conflicts for the leader to sort out.
+- return: closes the loan with the laptop's return date. A loan that is already returned is a
+  duplicate (no points twice).
+- extend: the due date becomes the later of the server's and the requested one, so extensions
+  from two laptops don't undo each other.
+- Operations are recorded by id on the server (sync_applied_ops), so resending one after a lost
+  answer gives the same result instead of applying it twice.
+- An operation the server can't read (missing fields, bad dates...) is rejected ("bad_payload")
+  on its own and logged to the "biblio.sync" logger; the rest of the push is still applied.
+
+While an operation on a loan is still in the outbox, pulled versions of that loan are skipped.
+Applying the operation gives the loan a new sync_log entry on the server, so it arrives on a
+later pull.
+
+Only books, students and loans are replicated. The points ledger and loan history stay on the
+server; a laptop's students.points is the server's total plus what was earned there since the
+last pull.
+
+A laptop starts from create_replica() (a copy of the central database). SyncServer works on the
+central database, SyncClient on a replica. The transports carry their calls: LocalTransport calls a SyncServer in-process (tests, or a laptop acting as the server),
+and HttpTransport goes through api_server.py.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import book_manager
+import data_backend
+import points_manager
+import query_monitor
+import read_cache
+from database.db_setup import SYNC_TABLES
+
+PUSH_BATCH = 200 # operations per push request
+PULL_BATCH = 1000 # changed rows per pull request
+DEFAULT_SYNC_SECONDS = 60
+SERVER_NODE_ID = "server"
+# What a malformed operation (missing keys, values of the wrong type or format) raises while it
+# is applied: the operation is rejected as "bad_payload" and the rest of the push goes on.
+BAD_PAYLOAD_ERRORS = (KeyError, TypeError, ValueError, AttributeError,
+                      sqlite3.IntegrityError, sqlite3.InterfaceError, sqlite3.ProgrammingError)
+
+logger = logging.getLogger("biblio.sync")
+
+
+class HybridLogicalClock:
+    """Stamps like "000001718000000000-00003-node": physical milliseconds, a counter for events
+    in the same millisecond (or while the wall clock is behind a stamp already seen), and the
+    node id. They sort as text in causal order, even across laptops with skewed clocks."""
+
+    def __init__(self, node_id, last=None):
+        self.node_id = node_id
+        self._lock = threading.Lock()
+        self._physical, self._counter = 0, 0
+        if last:
+            self._physical, self._counter, _ = self.parse(last)
+
+    @staticmethod
+    def parse(stamp):
+        physical, counter, node_id = stamp.split("-", 2)
+        return int(physical), int(counter), node_id
+
+    def _format(self):
+        return f"{self._physical:018d}-{self._counter:05d}-{self.node_id}"
+
+    def now(self):
+        """A stamp greater than every stamp this clock has issued or observed."""
+        with self._lock:
+            wall = int(time.time() * 1000)
+            if wall > self._physical:
+                self._physical, self._counter = wall, 0
+            else:
+                self._counter += 1
+            return self._format()
+
+    def observe(self, stamp):
+        """Moves the clock past a stamp received from another node."""
+        physical, counter, _ = self.parse(stamp)
+        with self._lock:
+            if (physical, counter) > (self._physical, self._counter):
+                self._physical, self._counter = physical, counter
+
+    def last(self):
+        with self._lock:
+            return self._format()
+
+
+def _state(cursor, key, default=None):
+    cursor.execute("SELECT value FROM sync_state WHERE key = ?", (key,))
+    row = cursor.fetchone()
+    return row[0] if row else default
+
+
+def _set_state(cursor, key, value):
+    cursor.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)", (key, str(value)))
+
+
+def _loan_state(cursor, loan_id):
+    """'active', 'returned' or None (never seen) for a loan id on this database."""
+    cursor.execute("SELECT 1 FROM loans WHERE loan_id = ?", (loan_id,))
+    if cursor.fetchone():
+        return 'active'
+    cursor.execute("SELECT 1 FROM loan_history WHERE loan_id = ? LIMIT 1", (loan_id,))
+    return 'returned' if cursor.fetchone() else None
+
+
+def _role(cursor, student_id):
+    """The role of student_id on this database, or None if there is no such student."""
+    cursor.execute("SELECT role FROM students WHERE id = ?", (student_id,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def _well_formed(op):
+    """True if op has the fields push() needs to order and record it (the payload is checked
+    when the operation is applied)."""
+    if not isinstance(op.get('op_id'), str) or not isinstance(op.get('payload'), dict):
+        return False
+    try:
+        HybridLogicalClock.parse(op['hlc'])
+    except (KeyError, AttributeError, ValueError):
+        return False
+    return True
+
+
+class SyncServer:
+    """The central side: applies pushed operations and serves the changed rows."""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+    def _clock(self, cursor):
+        return HybridLogicalClock(SERVER_NODE_ID, _state(cursor, 'hlc'))
+
+    def push(self, node_id, ops):
+        """Applies ops ([{'op_id', 'hlc', 'op', 'payload'}]) in clock order, in one transaction.
+        Returns {'results': [{'op_id', 'status', 'reason', 'loan_active'}], 'hlc': server stamp}
+        (results in the order of ops), or None on a database error. A malformed operation is
+        rejected on its own ("bad_payload"); the others are still applied."""
+        def apply_all(cursor):
+            clock = self._clock(cursor)
+            results, valid = {}, []
+            for index, op in enumerate(ops):
+                if _well_formed(op):
+                    valid.append(index)
+                else:
+                    logger.warning("Rejected malformed operation %r from %s", op.get('op_id'), node_id)
+                    results[index] = {'op_id': op.get('op_id'), 'status': 'rejected', 'reason': 'bad_payload',
+                                      'loan_active': False}
+            for index in sorted(valid, key=lambda index: (ops[index]['hlc'], ops[index]['op_id'])):
+                op = ops[index]
+                clock.observe(op['hlc'])
+                cursor.execute("SELECT status, reason FROM sync_applied_ops WHERE op_id = ?", (op['op_id'],))
+                previous = cursor.fetchone()
+                if previous:
+                    status, reason = previous
+                else:
+                    status, reason = self._apply_checked(cursor, node_id, op)
+                    cursor.execute("""
+                        INSERT INTO sync_applied_ops (op_id, node_id, hlc, status, reason, applied_at)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                    """, (op['op_id'], node_id, op['hlc'], status, reason, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+                loan_id = op['payload'].get('loan_id')
+                results[index] = {'op_id': op['op_id'], 'status': status, 'reason': reason,
+                                  'loan_active': isinstance(loan_id, str) and _loan_state(cursor, loan_id) == 'active'}
+            stamp = clock.now()
+            _set_state(cursor, 'hlc', stamp)
+            return {'results': [results[index] for index in range(len(ops))], 'hlc': stamp}
+        try:
+            return query_monitor.write_transaction(self.db_path, apply_all)
+        except sqlite3.Error as e:
+            logger.error("Error applying synced operations from %s: %s", node_id, e)
+            return None
+
+    def _apply_checked(self, cursor, node_id, op):
+        """_apply() in a savepoint: if the payload makes it fail, whatever it wrote is undone
+        and the operation is rejected."""
+        cursor.execute("SAVEPOINT sync_op")
+        try:
+            status, reason = self._apply(cursor, op)
+        except BAD_PAYLOAD_ERRORS as e:
+            cursor.execute("ROLLBACK TO sync_op")
+            logger.warning("Rejected operation %s (%s) from %s: %s: %s",
+                           op['op_id'], op.get('op'), node_id, type(e).__name__, e)
+            status, reason = 'rejected', 'bad_payload'
+        cursor.execute("RELEASE sync_op")
+        return status, reason
+
+    def _apply(self, cursor, op):
+        """Applies one operation; returns (status, reason)."""
+        payload = op['payload']
+        loan_id = payload['loan_id']
+        state = _loan_state(cursor, loan_id)
+        if op['op'] == 'loan':
+            if state is not None:
+                return 'duplicate', None
+            if _role(cursor, payload.get('leader_id')) != 'leader':
+                return 'rejected', 'not_leader'
+            cursor.execute("SELECT 1 FROM students WHERE id = ?", (payload['student_id'],))
+            if not cursor.fetchone():
+                return 'rejected', 'missing_student'
+            cursor.execute("""
+                SELECT b.cantidad_total - (SELECT COUNT(*) FROM loans l WHERE l.book_id = b.id)
+                FROM books b WHERE b.id = ?
+            """, (payload['book_id'],))
+            free = cursor.fetchone()
+            if free is None:
+                return 'rejected', 'missing_book'
+            if free[0] <= 0:
+                return 'rejected', 'no_copy'
+            book_manager.insert_loan(cursor, loan_id, payload['book_id'], payload['student_id'],
+                                     payload['loan_date'], payload['due_date'])
+            return 'applied', None
+        if op['op'] == 'return':
+            if state == 'returned':
+                return 'duplicate', None
+            if _role(cursor, payload.get('leader_id')) != 'leader': # what return_book_db checks
+                return 'rejected', 'not_leader'
+            return_date = datetime.strptime(payload['return_date'], '%Y-%m-%d').date()
+            if book_manager.close_loan(cursor, loan_id, bool(payload.get('worksheet_submitted')), return_date) is None:
+                return 'rejected', 'missing_loan'
+            return 'applied', None
+        if op['op'] == 'extend':
+            if state != 'active':
+                return ('duplicate', None) if state == 'returned' else ('rejected', 'missing_loan')
+            if _role(cursor, payload.get('leader_id')) not in ('leader', 'admin'): # the roles of the extend endpoint
+                return 'rejected', 'not_leader'
+            cursor.execute("UPDATE loans SET due_date = MAX(due_date, ?) WHERE loan_id = ?", (payload['due_date'], loan_id))
+            return 'applied', None
+        return 'rejected', 'unknown_op'
+
+    def pull(self, cursor_seq=0, limit=PULL_BATCH):
+        """Rows changed after cursor_seq: {'changes': [{'table', 'key', 'row' (None if deleted)}],
+        'cursor': seq to ask from next time, 'more': bool}, or None on a database error."""
+        conn = None
+        try:
+            conn = query_monitor.connect(self.db_path)
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            cursor.execute("BEGIN") # one snapshot for the log and the rows
+            cursor.execute("SELECT seq, table_name, row_key FROM sync_log WHERE seq > ? ORDER BY seq LIMIT ?",
+                           (int(cursor_seq), limit))
+            entries = cursor.fetchall()
+            keys_by_table = {}
+            for entry in entries:
+                keys_by_table.setdefault(entry['table_name'], []).append(entry['row_key'])
+            rows = {}
+            for table, keys in keys_by_table.items():
+                key_column = SYNC_TABLES[table]
+                for first in range(0, len(keys), 500):
+                    chunk = keys[first:first + 500]
+                    cursor.execute(f"SELECT * FROM {table} WHERE {key_column} IN ({','.join('?' * len(chunk))})", chunk)
+                    for row in cursor.fetchall():
+                        rows[(table, row[key_column])] = dict(row)
+            changes = [{'table': entry['table_name'], 'key': entry['row_key'],
+                        'row': rows.get((entry['table_name'], entry['row_key']))} for entry in entries]
+            conn.rollback()
+            return {'changes': changes, 'cursor': entries[-1]['seq'] if entries else int(cursor_seq),
+                    'more': len(entries) == limit}
+        except sqlite3.Error as e:
+            print(f"Database error in SyncServer.pull: {e}")
+            return None
+        finally:
+            if conn:
+                conn.close()
+
+
+class LocalTransport:
+    """Calls a SyncServer in the same process. Set online = False to simulate a lost connection."""
+
+    def __init__(self, server):
+        self.server = server
+        self.online = True
+
+    def _check(self):
+        if not self.online:
+            raise ConnectionError("sin conexión con el servidor")
+
+    def push(self, node_id, ops):
+        self._check()
+        return self.server.push(node_id, json.loads(json.dumps(ops))) # same copy semantics as over HTTP
+
+    def pull(self, cursor_seq, limit=PULL_BATCH):
+        self._check()
+        return json.loads(json.dumps(self.server.pull(cursor_seq, limit)))
+
+
+class HttpTransport:
+    """Carries the sync calls over the JSON API, with a logged-in data_backend.HttpBackend."""
+
+    def __init__(self, remote):
+        self.remote = remote
+
+    def _call(self, method, path, body=None):
+        status, payload = self.remote._request(method, path, body, cache=False)
+        if status == 0:
+            raise ConnectionError("sin conexión con el servidor")
+        if status == 401:
+            self.remote.token = None # session expired: OfflineBackend logs in again on the next sync
+        if status != 200:
+            error = payload.get('error') if isinstance(payload, dict) else payload
+            raise ConnectionError(f"el servidor respondió {status}: {error}")
+        return payload
+
+    def push(self, node_id, ops):
+        return self._call("POST", "/api/sync/push", {'node_id': node_id, 'ops': ops})
+
+    def pull(self, cursor_seq, limit=PULL_BATCH):
+        return self._call("GET", f"/api/sync/pull?cursor={int(cursor_seq)}&limit={int(limit)}")
+
+
+def create_replica(central_db_path, replica_db_path):
+    """Sets up a laptop from a copy of the central database (sqlite backup API, so the central
+    one can stay in use). The copy starts pulling after the central log's current end instead of
+    receiving every row again. Returns True on success."""
+    source = target = None
+    try:
+        source = sqlite3.connect(central_db_path)
+        target = sqlite3.connect(replica_db_path)
+        source.backup(target)
+        cursor = target.cursor()
+        cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM sync_log")
+        _set_state(cursor, 'pull_cursor', cursor.fetchone()[0])
+        cursor.execute("DELETE FROM sync_state WHERE key IN ('hlc', 'node_id')")
+        cursor.execute("DELETE FROM sync_applied_ops")
+        target.commit()
+        return True
+    except sqlite3.Error as e:
+        print(f"Error creating replica {replica_db_path}: {e}")
+        return False
+    finally:
+        for conn in (target, source):
+            if conn:
+                conn.close()
+
+
+class SyncClient:
+    """The laptop side: the outbox of a replica database and its sync with the server."""
+
+    def __init__(self, db_path, transport):
+        self.db_path = db_path
+        self.transport = transport
+        self._sync_lock = threading.Lock()
+        conn = sqlite3.connect(db_path)
+        try:
+            cursor = conn.cursor()
+            self.node_id = _state(cursor, 'node_id')
+            if self.node_id is None:
+                self.node_id = uuid.uuid4().hex[:12]
+                _set_state(cursor, 'node_id', self.node_id)
+                conn.commit()
+            self.clock = HybridLogicalClock(self.node_id, _state(cursor, 'hlc'))
+        finally:
+            conn.close()
+
+    def enqueue(self, op, payload):
+        """Adds an operation to the outbox; returns its op_id (or None on a database error)."""
+        op_id = uuid.uuid4().hex
+        conn = None
+        try:
+            conn = query_monitor.connect(self.db_path)
+            stamp = self.clock.now()
+            conn.execute("INSERT INTO sync_outbox (op_id, hlc, op, payload) VALUES (?, ?, ?, ?)",
+                         (op_id, stamp, op, json.dumps(payload)))
+            _set_state(conn.cursor(), 'hlc', stamp)
+            conn.commit()
+            return op_id
+        except sqlite3.Error as e:
+            print(f"Database error in SyncClient.enqueue: {e}")
+            return None
+        finally:
+            if conn:
+                conn.close()
+
+    def discard(self, op_id):
+        """Drops an operation that could not be applied locally after all."""
+        conn = None
+        try:
+            conn = query_monitor.connect(self.db_path)
+            conn.execute("DELETE FROM sync_outbox WHERE op_id = ?", (op_id,))
+            conn.commit()
+        except sqlite3.Error as e:
+            print(f"Database error in SyncClient.discard: {e}")
+        finally:
+            if conn:
+                conn.close()
+
+    def _read(self, query, params=()):
+        conn = query_monitor.connect(self.db_path)
+        try:
+            conn.row_factory = sqlite3.Row
+            return [dict(row) for row in conn.execute(query, params).fetchall()]
+        finally:
+            conn.close()
+
+    def pending_ops(self):
+        return [dict(op, payload=json.loads(op['payload']))
+                for op in self._read("SELECT op_id, hlc, op, payload FROM sync_outbox ORDER BY hlc")]
+
+    def conflicts(self):
+        """Operations the server refused, newest first."""
+        return [dict(c, payload=json.loads(c['payload']))
+                for c in self._read("SELECT * FROM sync_conflicts ORDER BY detected_at DESC, op_id")]
+
+    def _push(self):
+        summary = {'pushed': 0, 'applied': 0, 'rejected': 0, 'duplicate': 0}
+        while True:
+            ops = self.pending_ops()[:PUSH_BATCH]
+            if not ops:
+                return summary
+            response = self.transport.push(self.node_id, ops)
+            if response is None:
+                raise ConnectionError("el servidor no pudo aplicar las operaciones")
+            self.clock.observe(response['hlc'])
+            self._acknowledge(ops, response['results'])
+            summary['pushed'] += len(ops)
+            for result in response['results']:
+                summary[result['status']] += 1
+
+    def _acknowledge(self, ops, results):
+        """Removes the answered operations from the outbox and undoes the refused ones locally."""
+        ops_by_id = {op['op_id']: op for op in ops}
+        conn = query_monitor.connect(self.db_path)
+        try:
+            cursor = conn.cursor()
+            conn.execute("BEGIN IMMEDIATE")
+            now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            for result in results:
+                op = ops_by_id[result['op_id']]
+                loan_id = op['payload']['loan_id']
+                if result['status'] == 'rejected':
+                    cursor.execute("""
+                        INSERT OR REPLACE INTO sync_conflicts (op_id, op, payload, reason, detected_at)
+                        VALUES (?, ?, ?, ?, ?)
+                    """, (op['op_id'], op['op'], json.dumps(op['payload']), result['reason'], now))
+                    if op['op'] == 'loan' and _loan_state(cursor, loan_id) == 'active':
+                        # Take back the borrowing points given when it was lent here.
+                        points_manager.record_points(cursor, op['payload']['student_id'], -book_manager.POINTS_FOR_BORROWING,
+                                                     points_manager.REASON_ADJUSTMENT, loan_id)
+                if not result['loan_active']:
+                    # Not (or no longer) lent on the server: drop it here too, unless later
+                    # operations on it are still waiting in the outbox.
+                    cursor.execute("SELECT 1 FROM sync_outbox WHERE payload LIKE ? AND op_id NOT IN ({})".format(
+                        ",".join("?" * len(ops_by_id))), (f'%"{loan_id}"%', *ops_by_id))
+                    if not cursor.fetchone():
+                        cursor.execute("DELETE FROM loans WHERE loan_id = ?", (loan_id,))
+                cursor.execute("DELETE FROM sync_outbox WHERE op_id = ?", (op['op_id'],))
+            _set_state(cursor, 'hlc', self.clock.last())
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def _pull(self):
+        pulled = 0
+        while True:
+            conn = query_monitor.connect(self.db_path)
+            try:
+                cursor_seq = int(_state(conn.cursor(), 'pull_cursor', 0))
+            finally:
+                conn.close()
+            response = self.transport.pull(cursor_seq)
+            if response is None:
+                raise ConnectionError("el servidor no pudo enviar los cambios")
+            self._apply_changes(response['changes'], response['cursor'])
+            pulled += len(response['changes'])
+            if not response['more']:
+                return pulled
+
+    def _apply_changes(self, changes, new_cursor):
+        """Writes pulled rows into the replica and moves the cursor, in one transaction."""
+        conn = query_monitor.connect(self.db_path)
+        try:
+            cursor = conn.cursor()
+            conn.execute("BEGIN IMMEDIATE")
+            pending_loans = {json.loads(payload)['loan_id'] for (payload,) in
+                             cursor.execute("SELECT payload FROM sync_outbox").fetchall()}
+            columns = {table: [row[1] for row in cursor.execute(f"PRAGMA table_info({table})").fetchall()]
+                       for table in SYNC_TABLES}
+            # Upserts parents first, deletes children first, so loans never point at missing rows.
+            upserts = [c for c in changes if c['row'] is not None]
+            upserts.sort(key=lambda c: list(SYNC_TABLES).index(c['table']))
+            deletes = [c for c in changes if c['row'] is None]
+            deletes.sort(key=lambda c: -list(SYNC_TABLES).index(c['table']))
+            for change in upserts + deletes:
+                table, key_column = change['table'], SYNC_TABLES[change['table']]
+                if table == 'loans' and change['key'] in pending_loans:
+                    continue
+                if change['row'] is None:
+                    cursor.execute(f"DELETE FROM {table} WHERE {key_column} = ?", (change['key'],))
+                    continue
+                if table == 'classrooms':
+                    # A rename may land before the one that freed its name (e.g. two classes
+                    # swapping names); park the local holder under a unique name until then.
+                    cursor.execute("UPDATE classrooms SET name = name || ' (' || id || ')' WHERE name = ? AND id != ?",
+                                   (change['row']['name'], change['key']))
+                names = [name for name in columns[table] if name in change['row']]
+                updates = ", ".join(f"{name} = excluded.{name}" for name in names if name != key_column)
+                cursor.execute(f"""
+                    INSERT INTO {table} ({', '.join(names)}) VALUES ({', '.join('?' * len(names))})
+                    ON CONFLICT({key_column}) DO UPDATE SET {updates}
+                """, [change['row'][name] for name in names])
+            _set_state(cursor, 'pull_cursor', new_cursor)
+            conn.commit()
+            if any(change['table'] in ('students', 'classrooms') for change in changes):
+                read_cache.clear()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def sync(self):
+        """Push, then pull. Returns {'pushed', 'applied', 'rejected', 'duplicate', 'pulled'},
+        or None if the server could not be reached (the outbox is kept for the next try)."""
+        with self._sync_lock:
+            try:
+                summary = self._push()
+                summary['pulled'] = self._pull()
+                return summary
+            except (ConnectionError, OSError) as e:
+                print(f"Sincronización aplazada: {e}")
+                return None
+            except sqlite3.Error as e:
+                print(f"Database error during sync: {e}")
+                return None
+
+
+class OfflineBackend(data_backend.LocalBackend):
+    """LocalBackend on the laptop's replica whose loans, returns and extensions also go to the
+    outbox, synced with the server every interval_seconds in a daemon thread."""
+    is_remote = False
+
+    def __init__(self, server_url, interval_seconds=DEFAULT_SYNC_SECONDS):
+        self.remote = data_backend.HttpBackend(server_url)
+        self.client = SyncClient(book_manager._get_resolved_db_path(), HttpTransport(self.remote))
+        self.interval_seconds = interval_seconds
+        self.last_result = None
+        self._credentials = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def login(self, username, password):
+        if not super().login(username, password):
+            return False
+        self._credentials = (username, password) # kept in memory to log in to the server once it is reachable
+        self.remote.login(username, password)
+        self.start()
+        return True
+
+    def logout(self):
+        super().logout()
+        self.remote.logout()
+        self._credentials = None
+
+    def loan_book_db(self, book_id, student_id, due_date_str, lending_student_leader_id):
+        loan_id = str(uuid.uuid4())
+        # The outbox entry is written first: if the app stops before the local loan, the
+        # server still gets the loan and the next pull brings it back here.
+        op_id = self.client.enqueue('loan', {
+            'loan_id': loan_id, 'book_id': book_id, 'student_id': student_id,
+            'leader_id': lending_student_leader_id, 'loan_date': datetime.now().strftime('%Y-%m-%d'),
+            'due_date': due_date_str})
+        if op_id is None:
+            return False
+        if book_manager.loan_book_db(book_id, student_id, due_date_str, lending_student_leader_id, loan_id=loan_id):
+            return True
+        self.client.discard(op_id)
+        return False
+
+    def return_book_db(self, loan_id, student_leader_id, worksheet_submitted=False):
+        op_id = self.client.enqueue('return', {
+            'loan_id': loan_id, 'leader_id': student_leader_id, 'worksheet_submitted': bool(worksheet_submitted),
+            'return_date': datetime.now().strftime('%Y-%m-%d')})
+        if op_id is None:
+            return False
+        if book_manager.return_book_db(loan_id, student_leader_id, worksheet_submitted):
+            return True
+        self.client.discard(op_id)
+        return False
+
+    def _abandon(self, op_ids):
+        """A bulk operation whose outbox entries could not all be written is not applied at all."""
+        for op_id in op_ids:
+            if op_id:
+                self.client.discard(op_id)
+        return [None] * len(op_ids), ["No se pudo guardar la cola de sincronización."]
+
+    def loan_books_bulk_db(self, loans, lending_student_leader_id):
+        loans = [dict(loan, loan_id=str(uuid.uuid4())) for loan in loans]
+        loan_date = datetime.now().strftime('%Y-%m-%d')
+        op_ids = [self.client.enqueue('loan', {
+            'loan_id': loan['loan_id'], 'book_id': loan['book_id'], 'student_id': loan['student_id'],
+            'leader_id': lending_student_leader_id, 'loan_date': loan_date, 'due_date': loan['due_date']})
+            for loan in loans]
+        if None in op_ids:
+            return self._abandon(op_ids)
+        loan_ids, errors = book_manager.loan_books_bulk_db(loans, lending_student_leader_id)
+        for op_id, loan_id in zip(op_ids, loan_ids):
+            if op_id and not loan_id:
+                self.client.discard(op_id)
+        return loan_ids, errors
+
+    def return_books_bulk_db(self, returns, student_leader_id):
+        return_date = datetime.now().strftime('%Y-%m-%d')
+        op_ids = [self.client.enqueue('return', {
+            'loan_id': item['loan_id'], 'leader_id': student_leader_id,
+            'worksheet_submitted': bool(item.get('worksheet_submitted')), 'return_date': return_date})
+            for item in returns]
+        if None in op_ids:
+            return self._abandon(op_ids)
+        points, errors = book_manager.return_books_bulk_db(returns, student_leader_id)
+        for op_id, awarded in zip(op_ids, points):
+            if op_id and awarded is None:
+                self.client.discard(op_id)
+        return points, errors
+
+    def extend_loan_db(self, loan_id, days_to_extend=14):
+        loans = self.client._read("SELECT due_date FROM loans WHERE loan_id = ?", (loan_id,))
+        if not loans:
+            print(f"Error: Loan ID {loan_id} not found.")
+            return False
+        try:
+            new_due = datetime.strptime(loans[0]['due_date'], '%Y-%m-%d').date() + timedelta(days=days_to_extend)
+        except (TypeError, ValueError) as e:
+            print(f"Date format error for loan ID {loan_id}: {e}")
+            return False
+        op_id = self.client.enqueue('extend', {'loan_id': loan_id, 'leader_id': self.get_current_user_id(),
+                                               'due_date': new_due.strftime('%Y-%m-%d')})
+        if op_id is None:
+            return False
+        if book_manager.extend_loan_db(loan_id, days_to_extend):
+            return True
+        self.client.discard(op_id)
+        return False
+
+    def sync_now(self):
+        if self._credentials and not self.remote.token:
+            self.remote.login(*self._credentials)
+        self.last_result = self.client.sync()
+        return self.last_result
+
+    def _run(self):
+        while True:
+            self.sync_now()
+            if self._stop_event.wait(self.interval_seconds):
+                return
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="sync-scheduler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+
+def create_offline_backend_from_env():
+    """OfflineBackend for BIBLIO_SYNC_URL (sync every BIBLIO_SYNC_SECONDS), or None if it is not set."""
+    url = os.environ.get("BIBLIO_SYNC_URL", "").strip()
+    if not url:
+        return None
+    try:
+        interval = float(os.environ.get("BIBLIO_SYNC_SECONDS", DEFAULT_SYNC_SECONDS))
+    except ValueError:
+        interval = DEFAULT_SYNC_SECONDS
+    print(f"Trabajando sin conexión con sincronización con {url} cada {interval:g} s")
+    return OfflineBackend(url, interval)
@@ -1,14 +1,35 @@
 import unittest
+from unittest import mock
 import os
 import sqlite3
 import uuid # For generating unique names/IDs for testing
+import tempfile
+import json
+import shutil
+import tracemalloc
+import zipfile
+import csv
+import multiprocessing
+import threading
+import urllib.request
+import urllib.error
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 # Modules to be tested
 from . import student_manager
 from . import auth_manager
 from . import book_manager # Added for book tests
+from . import points_manager
+from . import backup_manager
+from . import legacy_import
+from . import export_manager
+from . import api_server
+from . import data_backend
+from . import sync_manager
 from .database import db_setup
+from .test_query_plans import QueryCapture
 from .utils import get_data_path
 
 # --- Test Configuration ---
@@ -34,6 +55,12 @@ def setUpModule():
     # Override DB_PATH in relevant modules BEFORE init_db() is called
     student_manager.DB_PATH = ACTUAL_TEST_DB_PATH
     book_manager.DB_PATH = ACTUAL_TEST_DB_PATH
+    # The managers resolve their database through DB_PATH_FOR_CODE. book_manager and
+    # auth_manager import student_manager by its top-level name, which may be a different
+    # module object than the one imported above, so point that one at the test DB too.
+    for module in (student_manager, book_manager, book_manager.student_manager, auth_manager.student_manager,
+                   points_manager, book_manager.points_manager):
+        module.DB_PATH_FOR_CODE = TEST_DB_PATH_FOR_CODE
     # db_setup needs to know which DB to initialize for the test
     db_setup.DB_PATH_FOR_CODE = TEST_DB_PATH_FOR_CODE # This is what init_db() uses internally with get_data_path
 
@@ -55,6 +82,18 @@ def tearDownModule():
 def _generate_unique_name(base="test"):
     return f"{base}_{uuid.uuid4().hex[:8]}"
 
+def _contention_worker(db_path, book_ids, student_ids, leader_id, rounds):
+    """Runs in a separate process: tries to lend every book `rounds` times; returns the successes."""
+    for module in (book_manager, book_manager.student_manager, book_manager.points_manager):
+        module.DB_PATH_FOR_CODE = db_path
+    book_manager.query_monitor.disable_pooling()
+    lent = 0
+    for round_number in range(rounds):
+        for i, book_id in enumerate(book_ids):
+            lent += bool(book_manager.loan_book_db(book_id, student_ids[(i + round_number) % len(student_ids)],
+                                                   "2030-01-01", leader_id))
+    return lent
+
 # --- Test Classes ---
 class TestStudentManager(unittest.TestCase):
 
@@ -153,6 +192,94 @@ class TestStudentManager(unittest.TestCase):
         self.assertFalse(student_manager.is_student_leader(student_id))
         self.assertFalse(student_manager.is_student_leader("non_existent_id"))
 
+    def test_07_read_cache_invalidation(self):
+        read_cache = student_manager.read_cache
+        read_cache.clear()
+        read_cache.reset_stats()
+        name = _generate_unique_name("cached")
+        user_id = student_manager.add_student_db(name, "Class Cache", "cachepass", "leader")
+        self.assertTrue(student_manager.is_student_leader(user_id))
+        self.assertTrue(student_manager.is_student_leader(user_id))
+        self.assertEqual(read_cache.STUDENTS.stats['hits'], 1)
+
+        # Callers get copies, writes drop the entries they touch.
+        student_manager.get_student_by_id_db(user_id)['role'] = "student"
+        self.assertTrue(student_manager.is_student_leader(user_id))
+        leaders = student_manager.get_students_db(role_filter="leader")
+        self.assertIn(user_id, [s['id'] for s in leaders])
+        self.assertTrue(student_manager.update_student_details_db(user_id, name, "Class Cache", "student"))
+        self.assertFalse(student_manager.is_student_leader(user_id))
+        leaders = student_manager.get_students_db(role_filter="leader")
+        self.assertNotIn(user_id, [s['id'] for s in leaders])
+
+        points_before = student_manager.get_student_by_id_db(user_id)['points']
+        self.assertTrue(book_manager.points_manager.add_points_adjustment_db(user_id, 7))
+        self.assertEqual(student_manager.get_student_by_id_db(user_id)['points'], points_before + 7)
+
+        lru = read_cache.LRUCache("test", 2, "students")
+        for key in ("a", "b"):
+            lru.put(key, key.upper(), 0)
+        lru.get("a")
+        lru.put("c", "C", 0)
+        self.assertEqual(lru.get("b"), (False, 0))
+        self.assertEqual(lru.get("a"), (True, "A"))
+        self.assertEqual(lru.stats['evictions'], 1)
+
+    def test_08_rename_classroom_moves_books_and_merges(self):
+        old_class, new_class, other_class = (_generate_unique_name(c) for c in ("Aula", "AulaNueva", "AulaOtra"))
+        student_id = student_manager.add_student_db(_generate_unique_name("renamed"), old_class, "pass", "student")
+        other_id = student_manager.add_student_db(_generate_unique_name("other"), other_class, "pass", "student")
+        book_id = book_manager.add_book_db("Libro del aula", "Autor", old_class)
+        self.assertIn(old_class, student_manager.get_distinct_classrooms())
+
+        # A rename only updates the classrooms row: students and books refer to it by id.
+        row_versions = """
+            SELECT table_name, seq FROM sync_log
+            WHERE (table_name = 'students' AND row_key = ?) OR (table_name = 'books' AND row_key = ?)
+            ORDER BY table_name
+        """
+        conn = sqlite3.connect(ACTUAL_TEST_DB_PATH)
+        before = conn.execute(row_versions, (student_id, book_id)).fetchall()
+        self.assertTrue(student_manager.rename_classroom(old_class, new_class))
+        self.assertEqual(conn.execute(row_versions, (student_id, book_id)).fetchall(), before)
+        conn.close()
+        self.assertEqual(student_manager.get_student_by_id_db(student_id)['classroom'], new_class)
+        self.assertEqual(book_manager.get_book_by_id_db(book_id)['ubicacion'], new_class)
+        classrooms = student_manager.get_distinct_classrooms()
+        self.assertIn(new_class, classrooms)
+        self.assertNotIn(old_class, classrooms)
+        self.assertFalse(student_manager.rename_classroom(old_class, "Otra"))
+
+        # Renaming onto an existing classroom merges them.
+        self.assertTrue(student_manager.rename_classroom(new_class, other_class))
+        self.assertEqual(student_manager.get_student_by_id_db(student_id)['classroom'], other_class)
+        self.assertEqual(book_manager.get_book_by_id_db(book_id)['ubicacion'], other_class)
+        self.assertNotIn(new_class, student_manager.get_distinct_classrooms())
+        conn = sqlite3.connect(ACTUAL_TEST_DB_PATH)
+        try:
+            ids = conn.execute("SELECT classroom_id FROM students WHERE id IN (?, ?)", (student_id, other_id)).fetchall()
+            location_id = conn.execute("SELECT location_id FROM books WHERE id = ?", (book_id,)).fetchone()
+        finally:
+            conn.close()
+        self.assertEqual(len(set(ids)), 1)
+        self.assertEqual(location_id, ids[0])
+
+    def test_09_read_cache_sees_other_writers(self):
+        name = _generate_unique_name("external")
+        user_id = student_manager.add_student_db(name, "Class External", "pass", "leader")
+        self.assertTrue(student_manager.is_student_leader(user_id))
+        self.assertIn(user_id, [s['id'] for s in student_manager.get_students_db(role_filter="leader")])
+
+        # Another process demotes the leader: nothing in this process invalidates the cache.
+        conn = sqlite3.connect(ACTUAL_TEST_DB_PATH)
+        try:
+            conn.execute("UPDATE students SET role = 'student' WHERE id = ?", (user_id,))
+            conn.commit()
+        finally:
+            conn.close()
+        self.assertFalse(student_manager.is_student_leader(user_id))
+        self.assertNotIn(user_id, [s['id'] for s in student_manager.get_students_db(role_filter="leader")])
+
 
 class TestAuthManager(unittest.TestCase):
 
@@ -230,7 +357,7 @@ class TestDbSetup(unittest.TestCase):
 
         conn = sqlite3.connect(ACTUAL_TEST_DB_PATH)
         cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM students WHERE name = 'admin' AND role = 'admin' AND classroom = 'AdminOffice'")
+        cursor.execute("SELECT COUNT(*) FROM students WHERE name = 'admin' AND role = 'admin' AND classroom_id = (SELECT id FROM classrooms WHERE name = 'AdminOffice')")
         admin_count = cursor.fetchone()[0]
         conn.close()
 
@@ -309,6 +436,1253 @@ class TestBookManager(unittest.TestCase):
     # Skipping CSV import test for now as it involves file I/O and might be flaky in some CI/test environments
     # If it's critical, it can be added with careful path management and cleanup.
 
+class TestPointsLedger(unittest.TestCase):
+    """Points changes are appended to points_ledger and students.points caches their sum."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.classroom = "Class Ledger"
+        cls.leader_id = student_manager.add_student_db(_generate_unique_name("ledger_leader"), cls.classroom, "pw", "leader")
+        cls.student_id = student_manager.add_student_db(_generate_unique_name("ledger_student"), cls.classroom, "pw", "student")
+        cls.book_id = book_manager.add_book_db(_generate_unique_name("Ledger Book"), "Autora", cls.classroom)
+
+    def _cached_points(self, student_id):
+        return student_manager.get_student_by_id_db(student_id)['points']
+
+    def test_01_loan_and_return_are_recorded(self):
+        due_date = (datetime.now().date() + timedelta(days=7)).strftime('%Y-%m-%d')
+        self.assertTrue(book_manager.loan_book_db(self.book_id, self.student_id, due_date, self.leader_id))
+        loan_id = book_manager.get_current_loans_db(student_id_filter=self.student_id)[0]['loan_id']
+        self.assertTrue(book_manager.return_book_db(loan_id, self.leader_id, worksheet_submitted=True))
+
+        history = points_manager.get_points_history_db(self.student_id)
+        self.assertEqual(sorted((e['reason'], e['delta']) for e in history),
+                         [("early_return", 5), ("loan", 10), ("return", 5), ("worksheet", 15)])
+        self.assertTrue(all(e['loan_id'] == loan_id for e in history))
+        self.assertEqual(self._cached_points(self.student_id), sum(e['delta'] for e in history))
+        conn = sqlite3.connect(ACTUAL_TEST_DB_PATH)
+        archived = conn.execute("SELECT book_id, return_date FROM loan_history WHERE loan_id = ?", (loan_id,)).fetchall()
+        conn.close()
+        self.assertEqual(archived, [(self.book_id, datetime.now().strftime('%Y-%m-%d'))])
+
+    def test_02_ledger_is_append_only(self):
+        points_manager.add_points_adjustment_db(self.student_id, 3)
+        conn = sqlite3.connect(ACTUAL_TEST_DB_PATH)
+        try:
+            with self.assertRaises(sqlite3.DatabaseError):
+                conn.execute("UPDATE points_ledger SET delta = 100 WHERE student_id = ?", (self.student_id,))
+            with self.assertRaises(sqlite3.DatabaseError):
+                conn.execute("DELETE FROM points_ledger WHERE student_id = ?", (self.student_id,))
+        finally:
+            conn.close()
+
+    def test_03_period_leaderboard_only_counts_the_period(self):
+        classroom = "Class Ledger Period"
+        ana = student_manager.add_student_db(_generate_unique_name("ana"), classroom, "pw")
+        bea = student_manager.add_student_db(_generate_unique_name("bea"), classroom, "pw")
+        conn = sqlite3.connect(ACTUAL_TEST_DB_PATH)
+        cursor = conn.cursor()
+        for student_id, delta, created_at in [(ana, 50, "2024-02-28 10:00:00"), (ana, 10, "2024-03-01 09:00:00"),
+                                              (bea, 10, "2024-03-15 12:00:00"), (bea, 5, "2024-04-01 00:00:00")]:
+            points_manager.record_points(cursor, student_id, delta, "adjustment", created_at=created_at)
+        conn.commit()
+        conn.close()
+
+        start, end = points_manager.period_bounds("month", today=datetime(2024, 3, 10).date())
+        self.assertEqual((start, end), ("2024-03-01", "2024-04-01"))
+        march = points_manager.get_period_leaderboard_db(start, end, classroom_filter=classroom)
+        self.assertEqual([(r['id'], r['points'], r['rank']) for r in march], [(ana, 10, 1), (bea, 10, 1)]) # tie, then by name
+        self.assertEqual(points_manager.get_student_points_in_period_db(ana, start, end), 10)
+        self.assertEqual(self._cached_points(ana), 60)
+        self.assertEqual(points_manager.period_bounds("week", today=datetime(2024, 3, 10).date()),
+                         ("2024-03-04", "2024-03-11"))
+        self.assertEqual(points_manager.period_bounds("term", today=datetime(2024, 3, 10).date()),
+                         ("2024-01-01", "2024-04-01"))
+        self.assertEqual(points_manager.period_bounds("term", today=datetime(2024, 10, 1).date()),
+                         ("2024-09-01", "2025-01-01"))
+
+    def test_04_cache_rebuild_and_opening_balance(self):
+        legacy_id = student_manager.add_student_db(_generate_unique_name("legacy"), self.classroom, "pw")
+        conn = sqlite3.connect(ACTUAL_TEST_DB_PATH)
+        conn.execute("UPDATE students SET points = 42 WHERE id = ?", (legacy_id,)) # points from before the ledger
+        conn.commit()
+        conn.close()
+        db_setup.init_db()
+        history = points_manager.get_points_history_db(legacy_id)
+        self.assertEqual([(e['reason'], e['delta']) for e in history], [("opening_balance", 42)])
+        db_setup.init_db() # the migration runs once per student
+        self.assertEqual(len(points_manager.get_points_history_db(legacy_id)), 1)
+
+        conn = sqlite3.connect(ACTUAL_TEST_DB_PATH)
+        conn.execute("UPDATE students SET points = 0 WHERE id = ?", (legacy_id,))
+        conn.commit()
+        conn.close()
+        self.assertEqual(points_manager.rebuild_points_cache_db(), 1)
+        self.assertEqual(self._cached_points(legacy_id), 42)
+
+    def test_05_rollups_match_the_ledger_for_any_window(self):
+        classroom = "Class Ledger Rollups"
+        students = [student_manager.add_student_db(_generate_unique_name(f"roll{i}"), classroom, "pw") for i in range(4)]
+        conn = sqlite3.connect(ACTUAL_TEST_DB_PATH)
+        cursor = conn.cursor()
+        first_day = datetime(2023, 1, 25)
+        for n in range(60): # an entry every ~2 days over two months, crossing week and month edges
+            created_at = (first_day + timedelta(days=n * 2, hours=n % 9)).strftime('%Y-%m-%d %H:%M:%S')
+            points_manager.record_points(cursor, students[n % 4], 1 + n % 7, "adjustment", created_at=created_at)
+        points_manager.record_points(cursor, students[0], 500, "opening_balance", created_at="2023-02-10 10:00:00")
+        conn.commit()
+
+        def ledger_totals(start, end):
+            cursor.execute("""
+                SELECT student_id, SUM(delta) FROM points_ledger
+                WHERE created_at >= ? AND created_at < ? AND reason != 'opening_balance' GROUP BY student_id
+            """, (start, end))
+            return {student_id: total for student_id, total in cursor.fetchall() if student_id in students}
+
+        windows = [("2023-02-01", "2023-03-01"), ("2023-02-06", "2023-02-13"), ("2023-02-08", "2023-02-10"),
+                   ("2023-01-28", "2023-03-22"), points_manager.period_bounds("term", today=datetime(2023, 2, 1).date())]
+        for start, end in windows:
+            board = points_manager.get_period_leaderboard_db(start, end, classroom_filter=classroom)
+            self.assertEqual({r['id']: r['points'] for r in board}, ledger_totals(start, end), (start, end))
+            self.assertEqual([r['points'] for r in board], sorted((r['points'] for r in board), reverse=True))
+
+        # A rebuild from the ledger gives the same rollups as the incremental updates.
+        cursor.execute("SELECT * FROM points_daily ORDER BY day, student_id")
+        daily = cursor.fetchall()
+        cursor.execute("SELECT * FROM points_weekly ORDER BY week_start, student_id")
+        weekly = cursor.fetchall()
+        db_setup.rebuild_points_rollups(cursor)
+        conn.commit()
+        cursor.execute("SELECT * FROM points_daily ORDER BY day, student_id")
+        self.assertEqual(cursor.fetchall(), daily)
+        cursor.execute("SELECT * FROM points_weekly ORDER BY week_start, student_id")
+        self.assertEqual(cursor.fetchall(), weekly)
+        conn.close()
+
+    def test_06_return_checks_the_leader_in_its_transaction(self):
+        leader_id = student_manager.add_student_db(_generate_unique_name("ledger_leader"), self.classroom, "pw", "leader")
+        due_date = (datetime.now().date() + timedelta(days=7)).strftime('%Y-%m-%d')
+        self.assertTrue(book_manager.loan_book_db(self.book_id, self.student_id, due_date, leader_id))
+        loan_id = book_manager.get_current_loans_db(student_id_filter=self.student_id)[0]['loan_id']
+        conn = sqlite3.connect(ACTUAL_TEST_DB_PATH)
+        conn.execute("UPDATE students SET role = 'student' WHERE id = ?", (leader_id,))
+        conn.commit()
+        conn.close()
+        points = self._cached_points(self.student_id)
+        # Even with a stale answer from the read cache, the role read under the write lock wins.
+        with mock.patch.object(book_manager.student_manager, "is_student_leader", return_value=True):
+            self.assertFalse(book_manager.return_book_db(loan_id, leader_id))
+        self.assertEqual([l['loan_id'] for l in book_manager.get_current_loans_db(student_id_filter=self.student_id)], [loan_id])
+        self.assertEqual(self._cached_points(self.student_id), points)
+        self.assertTrue(book_manager.return_book_db(loan_id, self.leader_id))
+
+
+class TestLoanReminders(unittest.TestCase):
+    """A classroom's loans: the classroom-scoped loan query and the reminder snapshot, kept
+    current by triggers and rebuilt each day."""
+
+    def setUp(self):
+        self.classroom = _generate_unique_name("Clase Aviso")
+        self.other_classroom = _generate_unique_name("Clase Otra")
+        self.leader_id = student_manager.add_student_db(_generate_unique_name("lider"), self.classroom, "lp", "leader")
+        self.student_ids = [student_manager.add_student_db(_generate_unique_name("alumno"), self.classroom, None, "student")
+                            for _ in range(2)]
+        self.book_id = book_manager.add_book_db("El Principito", "Saint-Exupéry", self.classroom, None, 10)
+
+    def _lend(self, student_id, days_from_today):
+        due_date = (datetime.now().date() + timedelta(days=days_from_today)).strftime('%Y-%m-%d')
+        before = {loan['loan_id'] for loan in book_manager.get_current_loans_db(student_id_filter=student_id)}
+        self.assertTrue(book_manager.loan_book_db(self.book_id, student_id, due_date, self.leader_id))
+        (loan_id,) = {loan['loan_id'] for loan in book_manager.get_current_loans_db(student_id_filter=student_id)} - before
+        return loan_id
+
+    def _reminders(self, classroom=None):
+        return [(r['loan_id'], r['overdue']) for r in book_manager.get_classroom_reminders_db(classroom or self.classroom)]
+
+    def test_01_loans_move_in_and_out_of_the_snapshot(self):
+        overdue = self._lend(self.student_ids[0], -2)
+        due_soon = self._lend(self.student_ids[1], 3)
+        self._lend(self.student_ids[0], 30) # not due soon
+        self.assertEqual(self._reminders(), [(overdue, 1), (due_soon, 0)])
+
+        self.assertTrue(book_manager.extend_loan_db(due_soon, 14))
+        self.assertEqual(self._reminders(), [(overdue, 1)])
+        self.assertTrue(book_manager.return_book_db(overdue, self.leader_id))
+        self.assertEqual(self._reminders(), [])
+
+        due_soon = self._lend(self.student_ids[1], 1)
+        student = student_manager.get_student_by_id_db(self.student_ids[1])
+        self.assertTrue(student_manager.update_student_details_db(student['id'], student['name'], self.other_classroom, "student"))
+        self.assertEqual(self._reminders(), [])
+        self.assertEqual(self._reminders(self.other_classroom), [(due_soon, 0)])
+
+    def test_02_stale_snapshot_is_rebuilt(self):
+        self.assertEqual(self._reminders(), []) # builds today's snapshot
+        conn = sqlite3.connect(ACTUAL_TEST_DB_PATH)
+        conn.execute("UPDATE reminder_state SET value = '2000-01-08' WHERE key = 'due_until'")
+        conn.execute("UPDATE reminder_state SET value = '2000-01-01' WHERE key = 'snapshot_date'")
+        conn.commit()
+        conn.close()
+        loan_id = self._lend(self.student_ids[0], 2) # beyond the stale window: the trigger leaves it out
+        self.assertEqual(self._reminders(), [(loan_id, 0)])
+
+    def test_03_loans_scoped_to_the_borrowers_classroom(self):
+        other_student = student_manager.add_student_db(_generate_unique_name("alumno"), self.other_classroom, None, "student")
+        first = self._lend(self.student_ids[0], 20)
+        second = self._lend(self.student_ids[1], 10)
+        self._lend(other_student, 5) # same book (ubicacion), other class
+        loans = book_manager.get_current_loans_db(classroom_filter=self.classroom)
+        self.assertEqual([loan['loan_id'] for loan in loans], [second, first])
+        self.assertEqual(len(book_manager.get_current_loans_db(ubicacion_filter=self.classroom)), 3)
+
+
+class TestQueryPlanIndexes(unittest.TestCase):
+    """Checks with EXPLAIN QUERY PLAN that the hot queries are served by the composite indexes."""
+
+    SEED_PREFIX = "qp-"
+
+    @classmethod
+    def setUpClass(cls):
+        # Enough rows for the planner statistics to favour the indexes the way a real school DB does.
+        cls.classrooms = [f"QP Clase {i}" for i in range(10)]
+        conn = sqlite3.connect(ACTUAL_TEST_DB_PATH)
+        cursor = conn.cursor()
+        classroom_ids = [db_setup.get_classroom_id(cursor, name) for name in cls.classrooms]
+        books = [(f"{cls.SEED_PREFIX}b{i}", f"Libro {i}", f"Autor {i % 50}", "Cuento", classroom_ids[i % 10], 2)
+                 for i in range(400)]
+        students = [(f"{cls.SEED_PREFIX}s{i}", f"Alumno {i}", classroom_ids[i % 10], "student", i % 37)
+                    for i in range(300)]
+        loans = [(f"{cls.SEED_PREFIX}l{i}", books[(i * 7) % 400][0], students[(i * 11) % 300][0],
+                  "2024-01-01", f"2024-02-{(i % 28) + 1:02d}")
+                 for i in range(500)]
+        cursor.executemany("INSERT INTO books (id, titulo, autor, genero, location_id, cantidad_total) VALUES (?, ?, ?, ?, ?, ?)", books)
+        cursor.executemany("INSERT INTO students (id, name, classroom_id, role, points) VALUES (?, ?, ?, ?, ?)", students)
+        cursor.executemany("INSERT INTO loans (loan_id, book_id, student_id, loan_date, due_date) VALUES (?, ?, ?, ?, ?)", loans)
+        conn.commit()
+        cursor.execute("ANALYZE")
+        conn.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        conn = sqlite3.connect(ACTUAL_TEST_DB_PATH)
+        pattern = f"{cls.SEED_PREFIX}%"
+        conn.execute("DELETE FROM loans WHERE loan_id LIKE ?", (pattern,))
+        conn.execute("DELETE FROM books WHERE id LIKE ?", (pattern,))
+        conn.execute("DELETE FROM students WHERE id LIKE ?", (pattern,))
+        conn.execute("DELETE FROM classrooms WHERE name LIKE 'QP Clase %'")
+        conn.commit()
+        conn.close()
+
+    def _plan(self, call):
+        """EXPLAIN QUERY PLAN of the one SELECT that call() runs, as the manager wrote it."""
+        capture = QueryCapture()
+        # With the read cache on, a repeated read would not reach the database.
+        with capture.active(), mock.patch.object(student_manager.read_cache, "CACHE_ENABLED", False):
+            call()
+        selects = [sql for _, sql in capture.statements if sql.lstrip().upper().startswith(("SELECT", "WITH"))]
+        self.assertEqual(len(selects), 1, selects)
+        conn = sqlite3.connect(ACTUAL_TEST_DB_PATH)
+        try:
+            return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + selects[0])]
+        finally:
+            conn.close()
+
+    def assertNoTempSort(self, plan):
+        self.assertFalse(any("USE TEMP B-TREE" in step for step in plan), f"Unexpected sort in plan: {plan}")
+
+    def test_01_current_loans_read_in_due_date_order_from_index(self):
+        plan = self._plan(book_manager.get_current_loans_db)
+        self.assertIn("SCAN l USING COVERING INDEX idx_loans_due_date_covering", plan)
+        self.assertNoTempSort(plan)
+
+    def test_02_current_loans_by_ubicacion_use_covering_loan_index(self):
+        plan = self._plan(lambda: book_manager.get_current_loans_db(ubicacion_filter=self.classrooms[3]))
+        # The loans side is index-only whichever join order the planner picks.
+        self.assertTrue(any("l USING COVERING INDEX idx_loans_" in step for step in plan), plan)
+        self.assertFalse(any(step.startswith("SCAN b") or step == "SCAN l" for step in plan), plan)
+
+    def test_03_due_soon_without_sort(self):
+        plan = self._plan(book_manager.get_books_due_soon_db)
+        self.assertIn("SEARCH l USING COVERING INDEX idx_loans_due_date_covering (due_date<?)", plan)
+        self.assertNoTempSort(plan)
+
+    def test_04_leaderboard_by_classroom_is_index_only(self):
+        plan = self._plan(lambda: student_manager.get_students_sorted_by_points(classroom_filter=self.classrooms[0]))
+        self.assertIn("SEARCH s USING COVERING INDEX idx_students_classroom_points (classroom_id=?)", plan)
+        self.assertNoTempSort(plan)
+
+    def test_05_global_leaderboard_is_index_only(self):
+        plan = self._plan(student_manager.get_students_sorted_by_points)
+        self.assertIn("SCAN s USING COVERING INDEX idx_students_points", plan)
+        self.assertNoTempSort(plan)
+
+    def test_06_new_releases_walk_date_added_index(self):
+        plan = self._plan(lambda: book_manager.get_new_releases_db(10))
+        self.assertIn("SCAN b USING INDEX idx_books_date_added", plan)
+        self.assertNoTempSort(plan)
+
+    def test_07_functions_still_return_expected_rows(self):
+        classroom = self.classrooms[4]
+        leaderboard = student_manager.get_students_sorted_by_points(classroom_filter=classroom)
+        points = [s['points'] for s in leaderboard]
+        self.assertEqual(points, sorted(points, reverse=True))
+        self.assertTrue(all(s['classroom'] == classroom for s in leaderboard))
+
+        loans = book_manager.get_current_loans_db(ubicacion_filter=classroom)
+        due_dates = [l['due_date'] for l in loans]
+        self.assertEqual(due_dates, sorted(due_dates))
+        self.assertTrue(loans and all(l['ubicacion'] == classroom for l in loans))
+
+    def test_08_leaderboard_windows_are_stable_slices(self):
+        for classroom in (None, self.classrooms[2]):
+            full = student_manager.get_students_sorted_by_points(classroom_filter=classroom)
+            windows = []
+            for offset in range(0, len(full), 7):
+                windows.extend(student_manager.get_students_sorted_by_points(classroom_filter=classroom, limit=7, offset=offset))
+            self.assertEqual([s['id'] for s in windows], [s['id'] for s in full])
+            top = student_manager.get_students_sorted_by_points(classroom_filter=classroom, limit=5)
+            self.assertEqual(top, full[:5])
+        self.assertNoTempSort(self._plan(lambda: student_manager.get_students_sorted_by_points(limit=51)))
+
+    def test_09_leaderboard_ranks_share_ties(self):
+        everyone = student_manager.get_students_sorted_by_points()
+        def expected_ranks(rows):
+            points = [s['points'] for s in rows]
+            distinct = sorted(set(points), reverse=True)
+            return {s['id']: (points.index(s['points']) + 1, distinct.index(s['points']) + 1) for s in rows}
+        global_ranks = expected_ranks(everyone)
+
+        full = student_manager.get_leaderboard_db()
+        self.assertEqual([s['id'] for s in full], [s['id'] for s in everyone])
+        for entry in full:
+            self.assertEqual((entry['global_rank'], entry['global_dense_rank']), global_ranks[entry['id']])
+
+        classroom = self.classrooms[3]
+        class_ranks = expected_ranks(student_manager.get_students_sorted_by_points(classroom_filter=classroom))
+        for entry in student_manager.get_leaderboard_db(classroom):
+            self.assertEqual((entry['class_rank'], entry['class_dense_rank']), class_ranks[entry['id']])
+            self.assertEqual(entry['global_rank'], global_ranks[entry['id']][0])
+        # Global pages carry the same class ranks as the class view, and pages slice the full ranking.
+        page = student_manager.get_leaderboard_db(limit=20, offset=40)
+        self.assertEqual(page, full[40:60])
+        for entry in (e for e in page if e['classroom'] == classroom):
+            self.assertEqual((entry['class_rank'], entry['class_dense_rank']), class_ranks[entry['id']])
+
+    def test_10_student_rank_with_neighbors(self):
+        full = student_manager.get_leaderboard_db()
+        target = full[10]
+        entry = student_manager.get_student_rank_db(target['id'], neighbors=2)
+        self.assertEqual(entry['student'], target)
+        self.assertEqual(entry['neighbors'], full[8:13])
+        top = student_manager.get_student_rank_db(full[0]['id'], neighbors=2)
+        self.assertEqual(top['neighbors'], full[0:3])
+
+        in_class = student_manager.get_leaderboard_db(self.classrooms[5])
+        entry = student_manager.get_student_rank_db(in_class[-1]['id'], neighbors=1, scope="class")
+        self.assertEqual(entry['neighbors'], in_class[-2:])
+        self.assertIsNone(student_manager.get_student_rank_db("qp-no-such-student"))
+
+
+class TestBackupManager(unittest.TestCase):
+    """Online backups, verification, rotation and restore on a throwaway database."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.live_path = os.path.join(self.tmp_dir, "live.db")
+        db_setup.init_db(self.live_path)
+        self._insert_book("Libro Original")
+        self.old_paths = (backup_manager.DB_PATH_FOR_CODE, backup_manager.BACKUP_DIR_FOR_CODE)
+        backup_manager.DB_PATH_FOR_CODE = self.live_path # absolute paths override the app directory
+        backup_manager.BACKUP_DIR_FOR_CODE = os.path.join(self.tmp_dir, "backups")
+
+    def tearDown(self):
+        backup_manager.DB_PATH_FOR_CODE, backup_manager.BACKUP_DIR_FOR_CODE = self.old_paths
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def _insert_book(self, title):
+        conn = sqlite3.connect(self.live_path)
+        conn.execute("INSERT INTO books (id, titulo, autor, location_id) VALUES (?, ?, 'Autora', "
+                     "(SELECT id FROM classrooms WHERE name = 'Biblioteca'))", (uuid.uuid4().hex, title))
+        conn.commit()
+        conn.close()
+
+    def _titles(self):
+        conn = sqlite3.connect(self.live_path)
+        try:
+            return sorted(row[0] for row in conn.execute("SELECT titulo FROM books"))
+        finally:
+            conn.close()
+
+    def test_01_backup_verify_list_and_rotate(self):
+        plain = backup_manager.create_backup(compress=False)
+        packed = backup_manager.create_backup(compress=True)
+        self.assertTrue(plain.endswith(".db") and packed.endswith(".db.gz"))
+        self.assertEqual(backup_manager.verify_backup(plain), (True, "ok"))
+        self.assertEqual(backup_manager.verify_backup(packed), (True, "ok"))
+        self.assertEqual({b['path'] for b in backup_manager.list_backups()}, {plain, packed})
+        self.assertFalse(any(name.endswith(".partial") for name in os.listdir(backup_manager.BACKUP_DIR_FOR_CODE)))
+
+        removed = backup_manager.rotate_backups(keep=1)
+        self.assertEqual(len(removed), 1)
+        self.assertEqual(len(backup_manager.list_backups()), 1)
+
+    def test_02_backup_while_the_app_writes(self):
+        for i in range(300): # enough pages for several backup steps
+            self._insert_book(f"Relleno {i} " + "x" * 500)
+        writes = []
+        def write_during_backup(copied, total):
+            if not writes:
+                self._insert_book("Escrito Durante La Copia")
+                writes.append(copied)
+        backup_manager.PAGES_PER_STEP, old_step = 2, backup_manager.PAGES_PER_STEP
+        try:
+            path = backup_manager.create_backup(compress=False, progress=write_during_backup)
+        finally:
+            backup_manager.PAGES_PER_STEP = old_step
+        self.assertTrue(writes)
+        conn = sqlite3.connect(path)
+        titles = [row[0] for row in conn.execute("SELECT titulo FROM books WHERE titulo NOT LIKE 'Relleno%'")]
+        conn.close()
+        self.assertIn("Escrito Durante La Copia", titles) # the copy restarts and includes the write
+
+    def test_03_restore_replaces_live_database_and_keeps_safety_copy(self):
+        path = backup_manager.create_backup()
+        self._insert_book("Libro Posterior")
+        self.assertTrue(backup_manager.restore_backup(path))
+        self.assertEqual(self._titles(), ["Libro Original"])
+        safety = [b for b in backup_manager.list_backups() if "antes_de_restaurar" in b['name']]
+        self.assertEqual(len(safety), 1)
+        self.assertTrue(backup_manager.restore_backup(safety[0]['path']))
+        self.assertEqual(self._titles(), ["Libro Original", "Libro Posterior"])
+
+    def test_04_damaged_backup_is_rejected(self):
+        path = backup_manager.create_backup(compress=False)
+        with open(path, "r+b") as f:
+            f.seek(0)
+            f.write(b"not a database header")
+        ok, message = backup_manager.verify_backup(path)
+        self.assertFalse(ok)
+        self._insert_book("Libro Nuevo")
+        self.assertFalse(backup_manager.restore_backup(path))
+        self.assertEqual(self._titles(), ["Libro Nuevo", "Libro Original"])
+
+    def test_05_incremental_chain_replays_onto_full_backup(self):
+        first = backup_manager.create_incremental_backup() # no chain yet: starts one
+        self.assertEqual(first['kind'], "full")
+        self.assertEqual(backup_manager.create_incremental_backup()['kind'], "none")
+
+        conn = sqlite3.connect(self.live_path)
+        conn.execute("UPDATE books SET titulo = 'Libro Renombrado' WHERE titulo = 'Libro Original'")
+        conn.commit()
+        conn.close()
+        self._insert_book("Libro Temporal")
+        segment_1 = backup_manager.create_incremental_backup()
+        self.assertEqual((segment_1['kind'], segment_1['changes']), ("incremental", 2))
+
+        conn = sqlite3.connect(self.live_path)
+        conn.execute("DELETE FROM books WHERE titulo = 'Libro Temporal'")
+        conn.commit()
+        conn.close()
+        self._insert_book("Libro Final")
+        backup_manager.create_incremental_backup()
+        self.assertEqual(len(backup_manager.list_increments(first['path'])), 2)
+        self.assertEqual(backup_manager.list_backups()[0]['increments'], 2)
+
+        self._insert_book("Sin Copia")
+        self.assertTrue(backup_manager.restore_incremental_backup(first['path'], upto=1))
+        self.assertEqual(self._titles(), ["Libro Renombrado", "Libro Temporal"])
+        self.assertTrue(backup_manager.restore_incremental_backup(first['path']))
+        self.assertEqual(self._titles(), ["Libro Final", "Libro Renombrado"])
+        self.assertEqual(backup_manager.restore_backup(first['path']), True) # the base itself is untouched
+        self.assertEqual(self._titles(), ["Libro Original"])
+
+    def test_06_restore_resets_chain_and_rotation_drops_increments(self):
+        full = backup_manager.create_backup()
+        self._insert_book("Libro Dos")
+        backup_manager.create_incremental_backup()
+        self.assertTrue(backup_manager.restore_backup(full))
+        conn = sqlite3.connect(self.live_path)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM change_log").fetchone()[0], 0)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM backup_state").fetchone()[0], 0)
+        conn.close()
+        # The safety copy taken by the restore is the newest full backup; drop everything older.
+        backup_manager.rotate_backups(keep=1)
+        self.assertFalse(os.path.exists(backup_manager._increments_dir(full)))
+
+
+class TestLegacyImport(unittest.TestCase):
+    """Migration of Bibliov0.4.html exports into a throwaway database."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, "migrated.db")
+        db_setup.init_db(self.db_path)
+        self.old_path = legacy_import.DB_PATH_FOR_CODE
+        legacy_import.DB_PATH_FOR_CODE = self.db_path
+
+    def tearDown(self):
+        legacy_import.DB_PATH_FOR_CODE = self.old_path
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def _write(self, name, text):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("\ufeff" + text) # the legacy downloads start with a BOM
+        return path
+
+    def _query(self, sql):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return conn.execute(sql).fetchall()
+        finally:
+            conn.close()
+
+    def test_01_local_storage_dump_with_csv_history(self):
+        day = 24 * 3600 * 1000
+        lent = datetime(2024, 3, 4, 10, 0).timestamp() * 1000
+        dump = {
+            "books": json.dumps([
+                {"id": 1700000000001, "titulo": "Manolito Gafotas", "autor": "Elvira Lindo", "genero": "Humor", "ubicacion": "Biblioteca", "cantidad": 1},
+                {"id": 1700000000002, "titulo": "Platero y yo", "autor": "Juan Ramón Jiménez", "genero": "undefined", "ubicacion": "3ºA", "cantidad": 2},
+                {"id": 1700000000003, "titulo": "manolito  gafotas", "autor": "Elvira Lindo", "genero": "Humor", "ubicacion": "Biblioteca", "cantidad": 1},
+            ]),
+            "users": json.dumps([{"username": "admin", "password": "admin", "role": "admin"},
+                                 {"username": "Maestra Ana", "password": "clave", "role": "usuario"}]),
+            "loans": json.dumps([
+                {"bookIndex": 1700000000001, "usuario": "Lucía", "fechaPrestamo": "4/3/2024", "fechaPrestamoTS": lent,
+                 "fechaVencimiento": "18/3/2024", "fechaVencimientoTS": lent + 14 * day, "devuelto": False},
+                {"bookIndex": 1700000000099, "usuario": "Lucía", "fechaPrestamo": "4/3/2024", "devuelto": False},
+            ]),
+        }
+        dump_path = self._write("localStorage.json", json.dumps(dump))
+        history_path = self._write("backup_history_loans.csv",
+                                   "LibroID,Usuario,Fecha de Préstamo,Fecha de Vencimiento,Fecha de Devolución\n"
+                                   '"1700000000002","Pedro, el de 3ºA","2/10/2023","16/10/2023","13/10/2023"\n'
+                                   '"1700000000003","Lucía","9/1/2024","23/1/2024","undefined"\n')
+
+        summary, errors = legacy_import.import_legacy_data([history_path, dump_path], classroom="Antigua")
+        self.assertEqual(summary['books'], {'created': 2, 'duplicates': 1, 'skipped': 0})
+        self.assertEqual(summary['users']['created'], 1) # 'admin' already exists
+        self.assertEqual(summary['active_loans'], {'created': 1, 'duplicates': 0, 'skipped': 1})
+        self.assertEqual(summary['history_loans']['created'], 2)
+        self.assertEqual(summary['borrowers_created'], 2)
+        self.assertEqual(len(errors), 1)
+
+        books = dict(self._query("SELECT titulo, cantidad_total FROM books"))
+        self.assertEqual(books, {"Manolito Gafotas": 3, "Platero y yo": 2}) # 1 + 1 on the shelf, 1 lent
+        self.assertEqual(self._query("SELECT loan_date, due_date FROM loans"), [("2024-03-04", "2024-03-18")])
+        history = sorted(self._query("SELECT s.name, h.loan_date, h.return_date FROM loan_history h JOIN students s ON s.id = h.student_id"))
+        self.assertEqual(history, [("Lucía", "2024-01-09", None), ("Pedro, el de 3ºA", "2023-10-02", "2023-10-13")])
+        role, = self._query("SELECT role FROM students WHERE name = 'Maestra Ana'")[0]
+        self.assertEqual(role, "leader")
+
+        again, _ = legacy_import.import_legacy_data([dump_path, history_path], classroom="Antigua")
+        self.assertEqual(sum(counts['created'] for section, counts in again.items() if section != 'borrowers_created'), 0)
+        self.assertEqual(again['borrowers_created'], 0)
+        self.assertEqual(again['history_loans']['duplicates'], 2) # skipped by idx_loan_history_legacy
+
+    def test_02_csv_books_quotes_and_unknown_files(self):
+        books_path = self._write("backup_books.csv",
+                                 "Título,Autor,Género,Ubicación,Cantidad\n"
+                                 '"El "Lazarillo", edición escolar","Anónimo","Clásico","Biblioteca","2"\n'
+                                 '"Solo título"\n')
+        summary, errors = legacy_import.import_legacy_data([books_path])
+        self.assertEqual(summary['books'], {'created': 1, 'duplicates': 0, 'skipped': 1})
+        self.assertEqual(self._query("SELECT titulo, autor FROM books"), [('El "Lazarillo", edición escolar', "Anónimo")])
+
+        unknown = self._write("notas.csv", "a,b\n1,2\n")
+        summary, errors = legacy_import.import_legacy_data([books_path, unknown])
+        self.assertIsNone(summary)
+        self.assertEqual(len(self._query("SELECT id FROM books")), 1) # nothing imported
+
+    def test_03_waits_for_another_writer(self):
+        books_path = self._write("backup_books.csv", "Título,Autor,Género,Ubicación,Cantidad\n"
+                                                     '"Momo","Michael Ende","Fantasía","Biblioteca","1"\n')
+        monitor = legacy_import.query_monitor
+        blocker = sqlite3.connect(self.db_path, check_same_thread=False)
+        blocker.execute("BEGIN IMMEDIATE")
+        monitor.reset_stats()
+        release = threading.Timer(0.3, blocker.rollback)
+        release.start()
+        try:
+            with mock.patch.object(monitor, "BUSY_TIMEOUT_SECONDS", 0.05):
+                summary, errors = legacy_import.import_legacy_data([books_path])
+        finally:
+            release.join()
+            blocker.close()
+        self.assertEqual(summary['books']['created'], 1)
+        self.assertGreaterEqual(monitor.get_write_stats()['busy_retries'], 1)
+
+
+class TestExportManager(unittest.TestCase):
+    """CSV/XLSX exports streamed from a throwaway database."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, "export.db")
+        db_setup.init_db(self.db_path)
+        conn = sqlite3.connect(self.db_path)
+        classroom_id = {name: db_setup.get_classroom_id(conn.cursor(), name) for name in ("Biblioteca", "3ºA", "4ºB")}
+        conn.executemany("INSERT INTO books (id, titulo, autor, genero, location_id, cantidad_total) VALUES (?, ?, ?, ?, ?, ?)",
+                         [("b1", "Platero y yo", "Juan Ramón Jiménez", "Poesía", classroom_id["Biblioteca"], 3),
+                          ("b2", "Manolito <Gafotas> & cía", "Elvira Lindo", None, classroom_id["3ºA"], 1)])
+        conn.executemany("INSERT INTO students (id, name, classroom_id, role, points) VALUES (?, ?, ?, 'student', ?)",
+                         [("s1", "Lucía", classroom_id["3ºA"], 30), ("s2", "Pedro", classroom_id["3ºA"], 10),
+                          ("s3", "Ana", classroom_id["4ºB"], 30)])
+        conn.execute("INSERT INTO loans (loan_id, book_id, student_id, loan_date, due_date) VALUES ('l1', 'b1', 's1', '2024-01-01', '2024-01-15')")
+        conn.commit()
+        conn.close()
+        self.old_values = (export_manager.DB_PATH_FOR_CODE, export_manager.FETCH_SIZE, export_manager.XLSX_MAX_ROWS)
+        export_manager.DB_PATH_FOR_CODE = self.db_path
+
+    def tearDown(self):
+        export_manager.DB_PATH_FOR_CODE, export_manager.FETCH_SIZE, export_manager.XLSX_MAX_ROWS = self.old_values
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def _read_csv(self, path):
+        with open(path, newline="", encoding="utf-8-sig") as f:
+            return list(csv.reader(f))
+
+    def _xlsx_sheets(self, path):
+        ns = {"m": "http://schemas.openxmlformats.org/spreadsheetml/2006/main"}
+        with zipfile.ZipFile(path) as workbook:
+            names = [sheet.get("name") for sheet in ET.fromstring(workbook.read("xl/workbook.xml")).iter(f"{{{ns['m']}}}sheet")]
+            sheets = []
+            for n in range(1, len(names) + 1):
+                root = ET.fromstring(workbook.read(f"xl/worksheets/sheet{n}.xml"))
+                sheets.append([[cell.findtext("m:v", namespaces=ns) or cell.findtext("m:is/m:t", namespaces=ns)
+                                for cell in row.findall("m:c", ns)] for row in root.iter(f"{{{ns['m']}}}row")])
+        return names, sheets
+
+    def test_01_csv_books_with_availability_and_leaderboard(self):
+        path = os.path.join(self.tmp_dir, "books.csv")
+        progress = []
+        self.assertEqual(export_manager.export_db("books", path, progress=progress.append), 2)
+        rows = self._read_csv(path)
+        self.assertEqual(rows[0], export_manager.EXPORTS["books"][1])
+        self.assertEqual(rows[1][1:], ["Manolito <Gafotas> & cía", "Elvira Lindo", "", "3ºA", "1", "0", "1"])
+        self.assertEqual(rows[2][1:], ["Platero y yo", "Juan Ramón Jiménez", "Poesía", "Biblioteca", "3", "1", "2"])
+        self.assertEqual(progress, [2])
+
+        path = os.path.join(self.tmp_dir, "leaderboard.csv")
+        self.assertEqual(export_manager.export_db("leaderboard", path, classroom_filter="3ºA"), 2)
+        self.assertEqual(self._read_csv(path)[1:], [["1", "1", "Lucía", "3ºA", "30"], ["3", "2", "Pedro", "3ºA", "10"]])
+        self.assertIsNone(export_manager.export_db("books", os.path.join(self.tmp_dir, "books.pdf")))
+        self.assertFalse(any(name.endswith(".partial") for name in os.listdir(self.tmp_dir)))
+
+    def test_02_xlsx_escapes_text_and_starts_new_sheets(self):
+        path = os.path.join(self.tmp_dir, "books.xlsx")
+        self.assertEqual(export_manager.export_db("books", path), 2)
+        names, sheets = self._xlsx_sheets(path)
+        self.assertEqual(names, ["Libros"])
+        self.assertEqual(sheets[0][1][1], "Manolito <Gafotas> & cía")
+        self.assertEqual(sheets[0][2][5:], ["3", "1", "2"])
+
+        export_manager.XLSX_MAX_ROWS = 2 # header + 1 row per sheet
+        path = os.path.join(self.tmp_dir, "students.xlsx")
+        self.assertEqual(export_manager.export_db("students", path, classroom_filter="3ºA"), 2)
+        names, sheets = self._xlsx_sheets(path)
+        self.assertEqual(names, ["Alumnos", "Alumnos (2)"])
+        self.assertEqual([sheet[0][0] for sheet in sheets], ["ID"] * 2)
+        self.assertEqual([sheet[1][1] for sheet in sheets], ["Lucía", "Pedro"])
+
+    def test_03_memory_does_not_grow_with_rows(self):
+        export_manager.FETCH_SIZE = 500
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("""
+            WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 40000)
+            INSERT INTO loan_history (loan_id, book_id, student_id, loan_date, due_date, return_date)
+            SELECT 'h' || i, 'b1', 's1', '2023-01-01', '2023-01-15', '2023-01-10' FROM n
+        """)
+        conn.commit()
+        conn.close()
+        peaks = {}
+        for limit in (4000, 40000):
+            conn = sqlite3.connect(self.db_path)
+            conn.execute("DELETE FROM loan_history WHERE history_id > ?", (limit,))
+            conn.commit()
+            conn.close()
+            for fmt in ("csv", "xlsx"):
+                tracemalloc.start()
+                export_manager.export_db("loan_history", os.path.join(self.tmp_dir, f"history.{fmt}"))
+                peaks[limit, fmt] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+        for fmt in ("csv", "xlsx"):
+            self.assertLess(peaks[40000, fmt], peaks[4000, fmt] * 1.5, peaks) # 10x the rows, about the same memory
+
+
+class TestApiServer(unittest.TestCase):
+    """The JSON API served from a throwaway database on a free port."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        managers = (api_server.student_manager, api_server.book_manager, api_server.points_manager, api_server.change_bus)
+        self.old_paths = [(module, module.DB_PATH_FOR_CODE) for module in managers]
+        self.server = api_server.create_server(os.path.join(self.tmp_dir, "api.db"), port=0, pool_size=4)
+        self.thread = api_server.start_in_thread(self.server)
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.leader_id = api_server.student_manager.add_student_db("Líder API", "3ºA", "lider123", "leader")
+        self.student_id = api_server.student_manager.add_student_db("Lucía API", "3ºA", None, "student")
+        self.book_id = api_server.book_manager.add_book_db("Platero y yo", "Juan Ramón Jiménez", "3ºA", "Poesía", 1)
+
+    def tearDown(self):
+        api_server.stop_server(self.server)
+        self.thread.join(5)
+        for module, path in self.old_paths:
+            module.DB_PATH_FOR_CODE = path
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def _call(self, method, path, body=None, token=None):
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        request = urllib.request.Request(self.base_url + path, data=data, method=method)
+        request.add_header("Content-Type", "application/json")
+        if token:
+            request.add_header("Authorization", f"Bearer {token}")
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            return e.code, json.loads(e.read())
+
+    def _login(self, username, password):
+        status, payload = self._call("POST", "/api/login", {"username": username, "password": password})
+        self.assertEqual(status, 200, payload)
+        return payload['token']
+
+    def test_01_tokens_and_roles(self):
+        self.assertEqual(self._call("GET", "/api/books")[0], 401)
+        self.assertEqual(self._call("POST", "/api/login", {"username": "Líder API", "password": "mal"})[0], 401)
+
+        student_token = self._login("Lucía API", "")
+        status, books = self._call("GET", "/api/books?ubicacion=3%C2%BAA", token=student_token)
+        self.assertEqual((status, [b['id'] for b in books]), (200, [self.book_id]))
+        status, payload = self._call("POST", "/api/loans", {"book_id": self.book_id, "student_id": self.student_id},
+                                     token=student_token)
+        self.assertEqual(status, 403)
+        self.assertIn("error", payload)
+        self.assertEqual(self._call("GET", f"/api/students/{self.leader_id}", token=student_token)[0], 403)
+
+        leader_token = self._login("Líder API", "lider123")
+        status, students = self._call("GET", "/api/students?classroom=3%C2%BAA", token=leader_token)
+        self.assertEqual(status, 200)
+        self.assertEqual({s['id'] for s in students}, {self.leader_id, self.student_id})
+        self.assertNotIn("hashed_password", students[0])
+
+        self.assertEqual(self._call("POST", "/api/logout", token=leader_token)[0], 200)
+        self.assertEqual(self._call("GET", "/api/books", token=leader_token)[0], 401)
+
+    def test_02_lend_and_return(self):
+        leader_token = self._login("Líder API", "lider123")
+        status, payload = self._call("POST", "/api/loans", {"book_id": self.book_id, "student_id": self.student_id},
+                                     token=leader_token)
+        self.assertEqual(status, 201, payload)
+        # The only copy is out now.
+        status, _ = self._call("POST", "/api/loans", {"book_id": self.book_id, "student_id": self.leader_id},
+                               token=leader_token)
+        self.assertEqual(status, 409)
+        status, book = self._call("GET", f"/api/books/{self.book_id}", token=leader_token)
+        self.assertEqual(book['disponibles'], 0)
+
+        student_token = self._login("Lucía API", None)
+        status, loans = self._call("GET", f"/api/loans?student_id={self.leader_id}", token=student_token)
+        self.assertEqual([loan['student_id'] for loan in loans], [self.student_id]) # students only see their own
+
+        status, payload = self._call("POST", f"/api/loans/{loans[0]['loan_id']}/return", {"worksheet_submitted": True},
+                                     token=leader_token)
+        self.assertEqual(status, 200, payload)
+        self.assertEqual(self._call("GET", "/api/loans", token=leader_token)[1], [])
+        status, board = self._call("GET", "/api/leaderboard?classroom=3%C2%BAA&limit=1", token=student_token)
+        self.assertEqual((board[0]['id'], board[0]['points']), (self.student_id, 10 + 5 + 20))
+
+        # Every request above went through the pool instead of opening its own connection.
+        stats = api_server.query_monitor.get_pool_stats()
+        pool = stats[os.path.abspath(os.path.join(self.tmp_dir, "api.db"))]
+        self.assertLessEqual(pool['open'], 4)
+        self.assertGreater(pool['acquired'], pool['open'])
+
+    def test_03_http_backend_matches_local(self):
+        remote, local = data_backend.HttpBackend(self.base_url), data_backend.LocalBackend()
+        self.addCleanup(remote.close)
+        self.assertTrue(remote.login("admin", "adminpass"))
+        self.assertTrue(remote.is_admin())
+        by_id = lambda rows: sorted(rows, key=lambda row: row['id'])
+        self.assertEqual(by_id(remote.get_all_books_db()), by_id(local.get_all_books_db()))
+        self.assertEqual(remote.get_distinct_classrooms(), local.get_distinct_classrooms())
+
+        # Unchanged catalogue: revalidated with its ETag, answered 304, same rows from the cache.
+        books = remote.get_all_books_db()
+        self.assertEqual(remote.stats['not_modified'], 1)
+        self.assertEqual(by_id(books), by_id(local.get_all_books_db()))
+        new_id = remote.add_book_db("Manolito Gafotas", "Elvira Lindo", "3ºA")
+        self.assertIn(new_id, {book['id'] for book in remote.get_all_books_db()})
+        self.assertEqual(remote.stats['not_modified'], 1)
+
+        student = remote.get_student_by_id_db(self.leader_id)
+        self.assertNotIn("hashed_password", student)
+        self.assertTrue(data_backend.student_has_password(student))
+        self.assertFalse(data_backend.student_has_password(local.get_student_by_id_db(self.student_id)))
+
+    def test_04_http_backend_batch_and_fetch_all(self):
+        remote = data_backend.HttpBackend(self.base_url)
+        self.addCleanup(remote.close)
+        self.assertTrue(remote.login("admin", "adminpass"))
+        # The desktop app lends as the leader picked in the loans tab, also when an admin is logged in.
+        self.assertTrue(remote.loan_book_db(self.book_id, self.student_id, "2030-01-01", self.leader_id))
+        other_id = remote.add_book_db("Matilda", "Roald Dahl", "3ºA", None, 2)
+
+        requests_before = remote.stats['requests']
+        counts = remote.batch([("get_available_book_count", (book_id,), {}) for book_id in (self.book_id, other_id, "nope")])
+        self.assertEqual(counts, [0, 2, 0])
+        self.assertEqual(remote.stats['requests'], requests_before + 1)
+
+        data = remote.fetch_all({'students': ("get_students_by_classroom_db", ("3ºA",), {}),
+                                 'loans': ("get_current_loans_db", (), {'ubicacion_filter': "3ºA"})})
+        self.assertEqual({s['id'] for s in data['students']}, {self.leader_id, self.student_id})
+        self.assertEqual([loan['book_id'] for loan in data['loans']], [self.book_id])
+        self.assertTrue(remote.return_book_db(data['loans'][0]['loan_id'], self.leader_id))
+        self.assertFalse(remote.return_book_db(data['loans'][0]['loan_id'], self.leader_id))
+
+    def test_05_bulk_lend_and_return_in_one_request(self):
+        remote = data_backend.HttpBackend(self.base_url)
+        self.addCleanup(remote.close)
+        self.assertTrue(remote.login("Líder API", "lider123"))
+        other_id = api_server.book_manager.add_book_db("Matilda", "Roald Dahl", "3ºA", None, 2)
+        requests_before = remote.stats['requests']
+        loan_ids, errors = remote.loan_books_bulk_db([
+            {'book_id': self.book_id, 'student_id': self.student_id, 'due_date': "2030-01-01"},
+            {'book_id': self.book_id, 'student_id': self.leader_id, 'due_date': "2030-01-01"}, # its only copy is taken above
+            {'book_id': other_id, 'student_id': "nadie", 'due_date': "2030-01-01"},
+            {'book_id': other_id, 'student_id': self.leader_id, 'due_date': "2030-01-01"},
+        ], self.leader_id)
+        self.assertEqual(remote.stats['requests'], requests_before + 1)
+        self.assertEqual([loan_id is not None for loan_id in loan_ids], [True, False, False, True])
+        self.assertEqual(len(errors), 2)
+        self.assertEqual(len(remote.get_current_loans_db()), 2)
+
+        points, errors = remote.return_books_bulk_db(
+            [{'loan_id': loan_ids[0], 'worksheet_submitted': True}, {'loan_id': loan_ids[0]}, {'loan_id': loan_ids[3]}],
+            self.leader_id)
+        self.assertEqual(points, [5 + 15 + 5, None, 5 + 5])
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(remote.get_current_loans_db(), [])
+
+    def test_06_data_versions_drive_remote_refreshes(self):
+        remote = data_backend.HttpBackend(self.base_url)
+        self.addCleanup(remote.close)
+        self.assertTrue(remote.login("Líder API", "lider123"))
+        refreshed = []
+        bus = data_backend.change_bus.ChangeBus(remote.get_data_versions_db)
+        bus.subscribe(("loans",), lambda: refreshed.append("loans"))
+        bus.subscribe(("roster",), lambda: refreshed.append("roster"))
+        bus.poll()
+        self.assertEqual(bus.poll(), set())
+        self.assertEqual(remote.stats['not_modified'], 1) # an idle poll is a 304
+
+        self.assertTrue(remote.loan_book_db(self.book_id, self.student_id, "2030-01-01", self.leader_id))
+        self.assertEqual(bus.poll(), {"loans", "students"}) # the loan's points moved "students", not "roster"
+        self.assertEqual(refreshed, ["loans"])
+
+    def test_07_sessions_follow_the_current_student_row(self):
+        admin_id = api_server.student_manager.add_student_db("Admin API", "AdminOffice", "clave", "admin")
+        token = self._login("Admin API", "clave")
+        rename = {"old_name": "3ºA", "new_name": "3ºA bis"}
+        api_server.student_manager.update_student_details_db(admin_id, "Admin API", "AdminOffice", "leader")
+        self.assertEqual(self._call("POST", "/api/classrooms/rename", rename, token=token)[0], 403)
+        self.assertEqual(self._call("GET", "/api/books", token=token)[0], 200) # still a leader
+        api_server.student_manager.delete_student_db(admin_id)
+        self.assertEqual(self._call("GET", "/api/books", token=token)[0], 401)
+
+    def test_08_ranking_pages_are_capped(self):
+        token = self._login("Lucía API", "")
+        with mock.patch.object(api_server, "MAX_LEADERBOARD_ROWS", 1), mock.patch.object(api_server, "MAX_RANK_NEIGHBORS", 0):
+            self.assertEqual(len(self._call("GET", "/api/leaderboard?limit=-1", token=token)[1]), 1)
+            self.assertEqual(len(self._call("GET", "/api/leaderboard?limit=1000000", token=token)[1]), 1)
+            status, rank = self._call("GET", f"/api/students/{self.student_id}/rank?neighbors=1000000000", token=token)
+        self.assertEqual(status, 200)
+        self.assertEqual([entry['id'] for entry in rank['neighbors']], [self.student_id])
+
+    def test_09_items_of_a_failed_bulk_call_stay_queued(self):
+        remote = data_backend.HttpBackend(self.base_url)
+        self.addCleanup(remote.close)
+        self.assertTrue(remote.login("Líder API", "lider123"))
+        loans = [{'book_id': self.book_id, 'student_id': self.student_id, 'due_date': "2030-01-01"},
+                 {'book_id': "nope", 'student_id': self.student_id, 'due_date': "2030-01-01"}]
+        loan_ids, errors = api_server.book_manager.loan_books_bulk_db(loans, self.student_id) # not a leader: nothing is tried
+        self.assertEqual(data_backend.bulk_items_not_attempted(loans, loan_ids, errors), loans)
+        loan_ids, errors = remote.loan_books_bulk_db(loans, self.leader_id)
+        self.assertEqual(data_backend.bulk_items_not_attempted(loans, loan_ids, errors), []) # the second is refused, not retried
+        unreachable = data_backend.HttpBackend("http://127.0.0.1:9")
+        self.addCleanup(unreachable.close)
+        returns = [{'loan_id': loan_ids[0]}]
+        points, errors = unreachable.return_books_bulk_db(returns, self.leader_id)
+        self.assertEqual(data_backend.bulk_items_not_attempted(returns, points, errors), returns)
+
+
+class TestChangeBus(unittest.TestCase):
+    """Data version counters, written by another connection as another process would."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, "versions.db")
+        db_setup.init_db(self.db_path)
+        self.change_bus = data_backend.change_bus
+        self.old_path = self.change_bus.DB_PATH_FOR_CODE
+        self.change_bus.DB_PATH_FOR_CODE = self.db_path
+        self.conn = sqlite3.connect(self.db_path)
+
+    def tearDown(self):
+        self.conn.close()
+        self.change_bus.DB_PATH_FOR_CODE = self.old_path
+        self.change_bus.close_watchers() # drops this thread's connections to the temp file
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def test_01_subscribers_run_only_for_their_tables(self):
+        calls = []
+        bus = self.change_bus.ChangeBus(self.change_bus.get_data_versions_db)
+        bus.subscribe(("books", "loans"), lambda: calls.append("books"))
+        bus.subscribe(("roster",), lambda: calls.append("roster"))
+        bus.subscribe(("students",), lambda: calls.append("students"))
+        self.assertEqual(bus.poll(), set())
+        self.assertEqual(bus.poll(), set())
+
+        student_id = str(uuid.uuid4())
+        classroom_id = db_setup.get_classroom_id(self.conn.cursor(), "5ºA")
+        self.conn.execute("INSERT INTO students (id, name, classroom_id, role) VALUES (?, 'Irene', ?, 'student')",
+                          (student_id, classroom_id))
+        self.conn.execute("INSERT INTO books (id, titulo, autor, location_id) VALUES ('b1', 'Momo', 'Michael Ende', ?)", (classroom_id,))
+        self.conn.commit()
+        self.assertEqual(bus.poll(), {"books", "students", "roster"})
+        self.assertEqual(calls, ["books", "roster", "students"])
+
+        calls.clear()
+        points_manager.record_points(self.conn.cursor(), student_id, 10, points_manager.REASON_ADJUSTMENT)
+        self.conn.commit()
+        self.assertEqual(bus.poll(), {"students"})
+        self.assertEqual(calls, ["students"])
+
+    def test_02_restored_versions_move_forward(self):
+        versions = self.change_bus.get_data_versions_db()
+        self.conn.execute("UPDATE data_versions SET version = 0") # what an older copy of the file would hold
+        db_setup.bump_data_versions(self.conn.cursor(), versions)
+        self.conn.commit()
+        moved = self.change_bus.get_data_versions_db()
+        self.assertTrue(all(moved[name] == versions[name] + 1 for name in db_setup.DATA_VERSIONS))
+
+    def test_03_subscribers_read_other_writers_data(self):
+        # The views re-read through read_cache: its entries must not outlive the versions the bus saw.
+        classroom = _generate_unique_name("Aula")
+        leader_id = student_manager.add_student_db(_generate_unique_name("Lider"), classroom, "pass", "leader")
+        seen = {}
+        bus = self.change_bus.ChangeBus(lambda: self.change_bus.read_data_versions(ACTUAL_TEST_DB_PATH))
+        bus.subscribe(("roster",), lambda: seen.update(classrooms=student_manager.get_distinct_classrooms()))
+        bus.subscribe(("students",), lambda: seen.update(
+            leaders=[s['id'] for s in student_manager.get_students_db(role_filter="leader")]))
+        bus.poll()
+        self.assertIn(classroom, student_manager.get_distinct_classrooms()) # now cached
+        self.assertIn(leader_id, [s['id'] for s in student_manager.get_students_db(role_filter="leader")])
+
+        conn = sqlite3.connect(ACTUAL_TEST_DB_PATH)
+        try:
+            conn.execute("UPDATE classrooms SET name = ? WHERE name = ?", (classroom + " Renombrada", classroom))
+            conn.execute("UPDATE students SET role = 'student' WHERE id = ?", (leader_id,))
+            conn.commit()
+        finally:
+            conn.close()
+        self.assertEqual(bus.poll(), {"books", "roster", "students"}) # books show their location's name
+        self.assertIn(classroom + " Renombrada", seen['classrooms'])
+        self.assertNotIn(classroom, seen['classrooms'])
+        self.assertNotIn(leader_id, seen['leaders'])
+
+    def test_04_versions_read_on_another_thread(self):
+        # The desktop app reads a server's counters on a worker and applies them on the Tk thread.
+        threads = []
+        bus = self.change_bus.ChangeBus(None)
+        bus.subscribe(("books",), lambda: threads.append(threading.current_thread()))
+        with ThreadPoolExecutor(max_workers=1) as reader:
+            self.assertEqual(bus.apply_versions(reader.submit(self.change_bus.get_data_versions_db).result()), set())
+            self.conn.execute("INSERT INTO books (id, titulo, autor) VALUES ('b1', 'Momo', 'Michael Ende')")
+            self.conn.commit()
+            self.assertEqual(bus.apply_versions(None), set()) # the read failed: nothing moves
+            self.assertEqual(bus.apply_versions(reader.submit(self.change_bus.get_data_versions_db).result()), {"books"})
+        self.assertEqual(threads, [threading.current_thread()])
+
+
+class TestSync(unittest.TestCase):
+    """Two laptops working offline on copies of a central database, synced in-process."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.central = os.path.join(self.tmp_dir, "central.db")
+        db_setup.init_db(self.central)
+        self.leader_id, self.student_id, self.book_id = uuid.uuid4().hex, uuid.uuid4().hex, uuid.uuid4().hex
+        conn = sqlite3.connect(self.central)
+        classroom_id = db_setup.get_classroom_id(conn.cursor(), "4ºB")
+        conn.execute("INSERT INTO students (id, name, classroom_id, role) VALUES (?, 'Líder Sync', ?, 'leader')",
+                     (self.leader_id, classroom_id))
+        conn.execute("INSERT INTO students (id, name, classroom_id, role) VALUES (?, 'Pablo Sync', ?, 'student')",
+                     (self.student_id, classroom_id))
+        conn.execute("INSERT INTO books (id, titulo, autor, location_id, cantidad_total) VALUES (?, 'Momo', 'Michael Ende', ?, 1)",
+                     (self.book_id, classroom_id))
+        conn.commit()
+        conn.close()
+        self.server = sync_manager.SyncServer(self.central)
+        self.laptops = []
+        for name in ("a.db", "b.db"):
+            path = os.path.join(self.tmp_dir, name)
+            self.assertTrue(sync_manager.create_replica(self.central, path))
+            self.laptops.append((path, sync_manager.SyncClient(path, sync_manager.LocalTransport(self.server))))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def _query(self, db_path, query, params=()):
+        conn = sqlite3.connect(db_path)
+        try:
+            return conn.execute(query, params).fetchall()
+        finally:
+            conn.close()
+
+    def _lend(self, laptop):
+        """What OfflineBackend.loan_book_db does: outbox entry, then the local loan."""
+        path, client = laptop
+        loan_id = str(uuid.uuid4())
+        client.enqueue('loan', {'loan_id': loan_id, 'book_id': self.book_id, 'student_id': self.student_id,
+                                'leader_id': self.leader_id, 'loan_date': "2024-05-06", 'due_date': "2024-05-20"})
+        conn = sqlite3.connect(path)
+        book_manager.insert_loan(conn.cursor(), loan_id, self.book_id, self.student_id, "2024-05-06", "2024-05-20")
+        conn.commit()
+        conn.close()
+        return loan_id
+
+    def _points(self, db_path):
+        return self._query(db_path, "SELECT points FROM students WHERE id = ?", (self.student_id,))[0][0]
+
+    def test_01_last_copy_lent_on_two_laptops(self):
+        (path_a, client_a), (path_b, client_b) = self.laptops
+        loan_a, loan_b = self._lend(self.laptops[0]), self._lend(self.laptops[1])
+
+        client_a.transport.online = False
+        self.assertIsNone(client_a.sync())
+        self.assertEqual(len(client_a.pending_ops()), 1) # kept for the next try
+        client_a.transport.online = True
+
+        self.assertEqual(client_a.sync(), {'pushed': 1, 'applied': 1, 'rejected': 0, 'duplicate': 0, 'pulled': 2})
+        summary = client_b.sync()
+        self.assertEqual((summary['applied'], summary['rejected']), (0, 1))
+
+        # B dropped its loan, took back the borrowing points and now has A's loan from the server.
+        self.assertEqual(self._query(path_b, "SELECT loan_id FROM loans"), [(loan_a,)])
+        self.assertEqual([(c['payload']['loan_id'], c['reason']) for c in client_b.conflicts()], [(loan_b, "no_copy")])
+        self.assertEqual(self._query(self.central, "SELECT loan_id FROM loans"), [(loan_a,)])
+        self.assertEqual(self._points(path_b), self._points(self.central))
+        self.assertEqual(client_a.pending_ops() + client_b.pending_ops(), [])
+
+        # An answer lost on the way: sending the same operation again doesn't lend twice.
+        op = {'op_id': "reenviada", 'hlc': client_a.clock.now(), 'op': 'loan',
+              'payload': {'loan_id': str(uuid.uuid4()), 'book_id': self.book_id, 'student_id': self.student_id,
+                          'leader_id': self.leader_id, 'loan_date': "2024-05-07", 'due_date': "2024-05-21"}}
+        first = self.server.push(client_a.node_id, [op])['results'][0]
+        self.assertEqual(first['status'], 'rejected')
+        self.assertEqual(self.server.push(client_a.node_id, [op])['results'][0], first)
+
+    def test_02_extend_and_return_from_both_laptops(self):
+        (path_a, client_a), (path_b, client_b) = self.laptops
+        loan_id = self._lend(self.laptops[0])
+        client_a.sync()
+        client_b.sync()
+        client_a.enqueue('extend', {'loan_id': loan_id, 'leader_id': self.leader_id, 'due_date': "2024-06-10"})
+        client_b.enqueue('extend', {'loan_id': loan_id, 'leader_id': self.leader_id, 'due_date': "2024-06-03"})
+        client_a.sync()
+        client_b.sync() # the later date wins whatever the order
+        self.assertEqual(self._query(self.central, "SELECT due_date FROM loans"), [("2024-06-10",)])
+
+        for client in (client_a, client_b):
+            client.enqueue('return', {'loan_id': loan_id, 'leader_id': self.leader_id,
+                                      'worksheet_submitted': True, 'return_date': "2024-06-01"})
+        self.assertEqual(client_b.sync()['applied'], 1)
+        self.assertEqual(client_a.sync()['duplicate'], 1)
+        self.assertEqual(self._query(self.central, "SELECT COUNT(*) FROM loan_history"), [(1,)])
+        self.assertEqual(self._points(self.central), book_manager.POINTS_FOR_BORROWING + book_manager.POINTS_FOR_RETURNING
+                         + book_manager.POINTS_FOR_WORKSHEET + book_manager.POINTS_FOR_EARLY_RETURN)
+        for path in (path_a, path_b, self.central):
+            self.assertEqual(self._query(path, "SELECT COUNT(*) FROM loans"), [(0,)])
+
+    def test_03_pull_sends_only_changed_rows(self):
+        path_a, client_a = self.laptops[0]
+        client_a.sync()
+        cursor = self._query(path_a, "SELECT value FROM sync_state WHERE key = 'pull_cursor'")[0][0]
+        self.assertEqual(self.server.pull(cursor)['changes'], [])
+
+        conn = sqlite3.connect(self.central)
+        conn.execute("UPDATE books SET titulo = 'Momo (edición ilustrada)' WHERE id = ?", (self.book_id,))
+        conn.commit()
+        conn.close()
+        changes = self.server.pull(cursor)['changes']
+        self.assertEqual([(c['table'], c['key'], c['row']['titulo']) for c in changes],
+                         [("books", self.book_id, "Momo (edición ilustrada)")])
+        self.assertEqual(client_a.sync()['pulled'], 1)
+        self.assertEqual(self._query(path_a, "SELECT titulo FROM books WHERE id = ?", (self.book_id,)),
+                         [("Momo (edición ilustrada)",)])
+
+    def test_04_malformed_operation_is_rejected_alone(self):
+        clock = sync_manager.HybridLogicalClock("portatil-roto")
+        loan_id = str(uuid.uuid4())
+        loan = {'loan_id': loan_id, 'book_id': self.book_id, 'student_id': self.student_id,
+                'leader_id': self.leader_id, 'loan_date': "2024-05-06", 'due_date': "2024-05-20"}
+        ops = [{'op_id': "mala-fecha", 'hlc': clock.now(), 'op': 'return',
+                'payload': {'loan_id': loan_id, 'leader_id': self.leader_id, 'return_date': "mañana"}},
+               {'op_id': "sin-fecha", 'hlc': clock.now(), 'op': 'loan',
+                'payload': {k: v for k, v in loan.items() if k != 'due_date'} | {'loan_id': str(uuid.uuid4())}},
+               {'op_id': "buena", 'hlc': clock.now(), 'op': 'loan', 'payload': loan},
+               {'op_id': "sin-reloj", 'op': 'extend', 'payload': {'loan_id': loan_id, 'due_date': "2024-06-01"}}]
+        with self.assertLogs("biblio.sync", "WARNING") as logs:
+            response = self.server.push("portatil-roto", ops)
+        self.assertEqual([(r['op_id'], r['status'], r['reason']) for r in response['results']],
+                         [("mala-fecha", "rejected", "bad_payload"), ("sin-fecha", "rejected", "bad_payload"),
+                          ("buena", "applied", None), ("sin-reloj", "rejected", "bad_payload")])
+        self.assertEqual(len(logs.records), 3)
+        self.assertEqual(self._query(self.central, "SELECT loan_id FROM loans"), [(loan_id,)])
+        # The rejection is recorded like any other answer, so a resend gets the same one.
+        resent = self.server.push("portatil-roto", ops[:1])['results'][0]
+        self.assertEqual((resent['status'], resent['reason']), ("rejected", "bad_payload"))
+
+    def test_05_returns_and_extensions_need_a_leader(self):
+        clock = sync_manager.HybridLogicalClock("portatil-alumno")
+        loan_id = self._lend(self.laptops[0])
+        self.laptops[0][1].sync()
+        ops = [{'op_id': "prorroga-alumno", 'hlc': clock.now(), 'op': 'extend',
+                'payload': {'loan_id': loan_id, 'leader_id': self.student_id, 'due_date': "2024-09-01"}},
+               {'op_id': "prorroga-anonima", 'hlc': clock.now(), 'op': 'extend',
+                'payload': {'loan_id': loan_id, 'due_date': "2024-09-01"}},
+               {'op_id': "devolucion-alumno", 'hlc': clock.now(), 'op': 'return',
+                'payload': {'loan_id': loan_id, 'leader_id': self.student_id, 'return_date': "2024-05-10"}}]
+        response = self.server.push("portatil-alumno", ops)
+        self.assertEqual([(r['status'], r['reason']) for r in response['results']], [("rejected", "not_leader")] * 3)
+        self.assertEqual(self._query(self.central, "SELECT loan_id, due_date FROM loans"), [(loan_id, "2024-05-20")])
+
+class TestConcurrentLoans(unittest.TestCase):
+    """Loans from several processes on one database file, and the busy retry of write_transaction."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, "contention.db")
+        db_setup.init_db(self.db_path)
+        self.monitor = book_manager.query_monitor
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def test_01_no_overselling_across_processes(self):
+        conn = sqlite3.connect(self.db_path)
+        leader_id = uuid.uuid4().hex
+        classroom_id = db_setup.get_classroom_id(conn.cursor(), "5ºA")
+        conn.execute("INSERT INTO students (id, name, classroom_id, role) VALUES (?, 'Líder Carrera', ?, 'leader')",
+                     (leader_id, classroom_id))
+        student_ids = [uuid.uuid4().hex for _ in range(4)]
+        conn.executemany("INSERT INTO students (id, name, classroom_id) VALUES (?, ?, ?)",
+                         [(sid, f"Alumno {i}", classroom_id) for i, sid in enumerate(student_ids)])
+        copies = {uuid.uuid4().hex: n for n in (1, 1, 2, 3)}
+        conn.executemany("INSERT INTO books (id, titulo, autor, location_id, cantidad_total) VALUES (?, 'Escaso', 'Autora', ?, ?)",
+                         [(book_id, classroom_id, n) for book_id, n in copies.items()])
+        conn.commit()
+        conn.close()
+
+        with multiprocessing.get_context("fork").Pool(6) as pool:
+            lent = pool.starmap(_contention_worker, [(self.db_path, list(copies), student_ids, leader_id, 5)] * 6)
+
+        conn = sqlite3.connect(self.db_path)
+        per_book = dict(conn.execute("SELECT book_id, COUNT(*) FROM loans GROUP BY book_id").fetchall())
+        total_points = conn.execute("SELECT SUM(points) FROM students").fetchone()[0]
+        conn.close()
+        self.assertEqual(per_book, copies) # every copy lent exactly once, none twice
+        self.assertEqual(sum(lent), sum(copies.values()))
+        self.assertEqual(total_points, book_manager.POINTS_FOR_BORROWING * sum(copies.values()))
+
+    def test_02_busy_writer_is_retried(self):
+        blocker = sqlite3.connect(self.db_path, check_same_thread=False)
+        blocker.execute("BEGIN IMMEDIATE")
+        old_timeout = self.monitor.BUSY_TIMEOUT_SECONDS
+        self.monitor.BUSY_TIMEOUT_SECONDS = 0.05
+        self.monitor.reset_stats()
+        release = threading.Timer(0.3, blocker.rollback)
+        release.start()
+        try:
+            result = self.monitor.write_transaction(
+                self.db_path, lambda cursor: cursor.execute("UPDATE students SET points = points").rowcount)
+        finally:
+            release.join()
+            blocker.close()
+            self.monitor.BUSY_TIMEOUT_SECONDS = old_timeout
+        self.assertEqual(result, 1) # the default admin
+        stats = self.monitor.get_write_stats()
+        self.assertGreaterEqual(stats['busy_retries'], 1)
+        self.assertEqual((stats['transactions'], stats['busy_failures']), (1, 0))
+
+
+class TestQueryMonitor(unittest.TestCase):
+    """Stats and slow-query log recorded by query_monitor for manager calls, and its on_commit callbacks."""
+
+    def setUp(self):
+        # The managers import query_monitor by top-level name, so use their instance.
+        self.monitor = book_manager.query_monitor
+        self.monitor.reset_stats()
+
+    def tearDown(self):
+        self.monitor.set_slow_query_threshold(100)
+        log_path = self.monitor.get_slow_log_path()
+        if log_path and os.path.exists(log_path):
+            for handler in self.monitor._slow_logger.handlers:
+                handler.close()
+            os.remove(log_path)
+
+    def test_01_function_and_statement_stats(self):
+        book_manager.add_book_db(_generate_unique_name("Monitored Book"), "Autor", "Biblioteca")
+        books = book_manager.get_all_books_db(ubicacion_filter="Biblioteca")
+        book_manager.get_all_books_db(ubicacion_filter="Biblioteca")
+
+        functions = {f['function']: f for f in self.monitor.get_function_stats()}
+        listed = functions[f"{book_manager.__name__}.get_all_books_db"]
+        self.assertEqual(listed['calls'], 2)
+        self.assertEqual(listed['rows'], 2 * len(books))
+        self.assertGreaterEqual(listed['total_ms'], listed['max_ms'])
+
+        select = [s for s in self.monitor.get_statement_stats() if "WHERE b.location_id = (SELECT id FROM classrooms WHERE name = ?)" in s['sql']]
+        self.assertEqual(len(select), 1)
+        self.assertEqual(select[0]['calls'], 2)
+        self.assertEqual(select[0]['rows'], 2 * len(books))
+        insert = [s for s in self.monitor.get_statement_stats() if s['sql'].startswith("INSERT INTO books")]
+        self.assertEqual(insert[0]['rows'], 1)
+
+    def test_02_slow_calls_are_logged(self):
+        self.monitor.set_slow_query_threshold(0)
+        student_manager.get_distinct_classrooms()
+        log_path = self.monitor.get_slow_log_path()
+        self.assertIsNotNone(log_path)
+        for handler in self.monitor._slow_logger.handlers:
+            handler.flush()
+        with open(log_path, encoding="utf-8") as f:
+            log_text = f.read()
+        self.assertIn("CALL", log_text)
+        self.assertIn("SELECT c.name FROM classrooms c", log_text)
+        self.assertIn(f"in={student_manager.__name__}.get_distinct_classrooms", log_text)
+
+    def test_03_nested_transactions_keep_the_outer_callbacks(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir, ignore_errors=True)
+        db_path, other_path = os.path.join(tmp_dir, "outer.db"), os.path.join(tmp_dir, "other.db")
+        calls = []
+        def inner(cursor):
+            self.monitor.on_commit(lambda: calls.append("inner"))
+        def from_callback(cursor):
+            self.monitor.on_commit(lambda: calls.append("from callback"))
+        def outer(cursor):
+            self.monitor.on_commit(lambda: calls.append("outer 1"))
+            self.monitor.write_transaction(other_path, inner)
+            self.monitor.on_commit(lambda: self.monitor.write_transaction(other_path, from_callback))
+            self.monitor.on_commit(lambda: calls.append("outer 2"))
+        self.monitor.write_transaction(db_path, outer)
+        self.assertEqual(calls, ["inner", "outer 1", "from callback", "outer 2"])
+
 if __name__ == '__main__':
     # This allows running the tests directly from this file.
     # However, it's often better to use the unittest discovery mechanism:
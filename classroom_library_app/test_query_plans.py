@@ -0,0 +1,362 @@
+import unittest
+import os
+import re
+import csv
+import json
+import sqlite3
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from unittest import mock
+
+# Modules whose SQL is checked
+from . import student_manager
+from . import auth_manager
+from . import book_manager
+from . import points_manager
+from . import legacy_import
+from . import generate_test_db
+from .utils import get_data_path
+
+# --- Test Configuration ---
+TEST_DB_PATH_FOR_CODE = os.path.join("database", "test_query_plans.db")
+ACTUAL_TEST_DB_PATH = ""
+GENERATED_CLASSROOMS = []
+
+# Tables that are allowed to be scanned because they stay tiny in every school.
+SMALL_TABLES = set()
+
+# Plan steps that are expected for a given call, keyed by the call label used in HOT_CALLS.
+# Anything not listed here makes the test fail when it shows up as a SCAN of a large table
+# or as a USE TEMP B-TREE step.
+ALLOWED_PLAN_STEPS = {
+    # These return the whole table by design.
+    "book_manager.get_all_books_db(all)": ["SCAN b"],
+    "student_manager.get_students_db(all)": ["SCAN s"],
+    "student_manager.get_students_sorted_by_points(global)": ["SCAN s USING COVERING INDEX idx_students_points"],
+    "book_manager.get_current_loans_db(all)": ["SCAN l USING COVERING INDEX idx_loans_due_date_covering"],
+    # Substring search (LIKE '%...%') cannot use a b-tree index.
+    "book_manager.search_books_db(titulo)": ["SCAN b"],
+    "book_manager.search_books_db(autor)": ["SCAN b"],
+    # Aggregates over every loan / random order over every book.
+    "book_manager.get_most_read_books_db": ["SCAN l USING COVERING INDEX idx_loans_book_due_covering", "USE TEMP B-TREE FOR ORDER BY"],
+    "book_manager.get_recommendations_db": ["SCAN b", "USE TEMP B-TREE FOR ORDER BY"],
+    # Either the location's books drive the plan and its loans are sorted (small set), or, when
+    # a location holds a large share of the books, the (active) loans are walked in due date order.
+    "book_manager.get_current_loans_db(ubicacion)": ["USE TEMP B-TREE FOR ORDER BY",
+                                                     "SCAN l USING COVERING INDEX idx_loans_due_date_covering"],
+    # Likewise from the students of the classroom (idx_students_classroom_points) to their loans.
+    "book_manager.get_current_loans_db(classroom)": ["USE TEMP B-TREE FOR ORDER BY"],
+    # Ordered walk of idx_books_date_added, stopped by the LIMIT.
+    "book_manager.get_new_releases_db": ["SCAN b USING INDEX idx_books_date_added"],
+    # The global page is an idx_students_points walk stopped by the LIMIT; points_ranks then only
+    # range-scans that index down to the page. The temp b-trees sort one page (global) or one
+    # classroom for the class window (class).
+    **{label: ["SCAN students USING COVERING INDEX idx_students_points", "USE TEMP B-TREE FOR ORDER BY"]
+       for label in ("student_manager.get_leaderboard_db(global)", "student_manager.get_student_rank_db(global)")},
+    **{label: ["USE TEMP B-TREE FOR ORDER BY"]
+       for label in ("student_manager.get_leaderboard_db(classroom)", "student_manager.get_student_rank_db(class)")},
+    # The window's rollup rows are primary-key ranges of points_weekly/points_daily; they are
+    # then summed per student (GROUP BY) and the sums ranked/sorted, all in temp b-trees.
+    **{label: ["USE TEMP B-TREE FOR GROUP BY", "USE TEMP B-TREE FOR ORDER BY"]
+       for label in ("points_manager.get_period_leaderboard_db(month)", "points_manager.get_period_leaderboard_db(classroom)")},
+    # Walk of the classrooms table's name index (one row per classroom, already in order).
+    "student_manager.get_distinct_classrooms": ["SCAN c USING COVERING INDEX sqlite_autoindex_classrooms_1"],
+}
+
+_SCAN_RE = re.compile(r"^SCAN (\S+)")
+_TABLE_REF_RE = re.compile(r"\b(?:FROM|JOIN|UPDATE|INTO)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?", re.IGNORECASE)
+_EXPLAINABLE_RE = re.compile(r"^\s*(SELECT|WITH|UPDATE|DELETE)\b", re.IGNORECASE)
+_CTE_RE = re.compile(r"(?:\bWITH|,)\s*(\w+)\s+AS\s*\(", re.IGNORECASE)
+_SUBQUERY_ALIAS_RE = re.compile(r"\)\s+AS\s+(\w+)", re.IGNORECASE)
+_SQL_KEYWORDS = {"WHERE", "JOIN", "LEFT", "INNER", "ON", "SET", "GROUP", "ORDER", "LIMIT", "VALUES"}
+
+
+def _table_aliases(sql):
+    """Maps every alias (and table name) used in the statement to its table name."""
+    aliases = {}
+    for table, alias in _TABLE_REF_RE.findall(sql):
+        aliases[table] = table
+        if alias and alias.upper() not in _SQL_KEYWORDS:
+            aliases[alias] = table
+    return aliases
+
+
+def find_plan_violations(sql, plan_steps, allowed_steps=()):
+    """Returns the plan steps that scan a large table or build a temp b-tree
+    and are not covered by one of allowed_steps (substring match)."""
+    aliases = _table_aliases(sql)
+    # Scanning a CTE or a FROM (...) AS alias subquery reads its (already computed) result.
+    cte_names = set(_CTE_RE.findall(sql)) | set(_SUBQUERY_ALIAS_RE.findall(sql))
+    violations = []
+    for step in plan_steps:
+        if any(allowed in step for allowed in allowed_steps):
+            continue
+        scan = _SCAN_RE.match(step)
+        if scan:
+            name = scan.group(1)
+            if name.startswith("(") or name == "CONSTANT":
+                continue # subquery / constant row, not a table
+            if aliases.get(name, name) in SMALL_TABLES or aliases.get(name, name) in cte_names:
+                continue
+            violations.append(step)
+        elif "USE TEMP B-TREE" in step:
+            violations.append(step)
+    return violations
+
+
+class QueryCapture:
+    """Records every SQL statement executed through sqlite3.connect while active,
+    tagged with the label of the call that issued it."""
+
+    def __init__(self):
+        self.statements = [] # (label, sql)
+        self.current_label = None
+        self._real_connect = sqlite3.connect
+
+    def _connect(self, *args, **kwargs):
+        conn = self._real_connect(*args, **kwargs)
+        label = self.current_label
+        conn.set_trace_callback(lambda sql: self.statements.append((label, sql)))
+        return conn
+
+    @contextmanager
+    def active(self):
+        with mock.patch.object(sqlite3, "connect", self._connect):
+            yield self
+
+    @contextmanager
+    def label(self, name):
+        self.current_label = name
+        try:
+            yield
+        finally:
+            self.current_label = None
+
+
+def setUpModule():
+    global ACTUAL_TEST_DB_PATH
+    ACTUAL_TEST_DB_PATH = get_data_path(TEST_DB_PATH_FOR_CODE)
+    os.makedirs(os.path.dirname(ACTUAL_TEST_DB_PATH), exist_ok=True)
+    if os.path.exists(ACTUAL_TEST_DB_PATH):
+        os.remove(ACTUAL_TEST_DB_PATH)
+    for module in (student_manager, book_manager, book_manager.student_manager, auth_manager.student_manager,
+                   points_manager, book_manager.points_manager, legacy_import):
+        module.DB_PATH_FOR_CODE = TEST_DB_PATH_FOR_CODE
+    # Enough rows that the planner behaves as on a real school database.
+    summary = generate_test_db.generate_database(ACTUAL_TEST_DB_PATH, classrooms=12, students=600, books=2000, loans=1500)
+    GENERATED_CLASSROOMS.extend(summary['classrooms'])
+
+
+def tearDownModule():
+    if os.path.exists(ACTUAL_TEST_DB_PATH):
+        os.remove(ACTUAL_TEST_DB_PATH)
+
+
+class TestPlanViolationDetection(unittest.TestCase):
+
+    def test_01_flags_full_scan_of_large_table(self):
+        sql = "SELECT * FROM loans l WHERE l.loan_date = '2024-01-01'"
+        self.assertEqual(find_plan_violations(sql, ["SCAN l"]), ["SCAN l"])
+
+    def test_02_flags_temp_btree_unless_allowed(self):
+        steps = ["SEARCH s USING INDEX idx_students_role (role=?)", "USE TEMP B-TREE FOR ORDER BY"]
+        self.assertEqual(find_plan_violations("SELECT * FROM students s", steps), ["USE TEMP B-TREE FOR ORDER BY"])
+        self.assertEqual(find_plan_violations("SELECT * FROM students s", steps, ["USE TEMP B-TREE FOR ORDER BY"]), [])
+
+    def test_03_ignores_index_searches(self):
+        steps = ["SEARCH books USING INDEX sqlite_autoindex_books_1 (id=?)"]
+        self.assertEqual(find_plan_violations("SELECT * FROM books WHERE id = 'x'", steps), [])
+
+    def test_04_ignores_scans_of_cte_and_subquery_results(self):
+        sql = "WITH page AS (SELECT id FROM students LIMIT 5) SELECT * FROM page p JOIN loans l ON l.student_id = p.id"
+        self.assertEqual(find_plan_violations(sql, ["SCAN p", "SCAN l"]), ["SCAN l"])
+        sql = "SELECT * FROM (SELECT student_id FROM loans GROUP BY student_id) AS t JOIN students s ON s.id = t.student_id"
+        self.assertEqual(find_plan_violations(sql, ["SCAN t", "SCAN loans"]), ["SCAN loans"])
+
+
+class TestSyntheticDataGenerator(unittest.TestCase):
+
+    def test_01_same_seed_same_data_and_consistent_loans(self):
+        tmp_dir = tempfile.mkdtemp()
+        paths = [os.path.join(tmp_dir, f"gen{i}.db") for i in range(2)]
+        try:
+            for path in paths:
+                summary = generate_test_db.generate_database(path, classrooms=5, students=100, books=150, loans=200, seed=7)
+                self.assertEqual(summary['students'], 101) # + default admin
+                self.assertEqual(summary['books'], 150)
+            dumps = []
+            for path in paths:
+                conn = sqlite3.connect(path)
+                dumps.append([conn.execute(f"SELECT * FROM {table} ORDER BY 1").fetchall()
+                              for table in ("books", "loans", "loan_history", "points_ledger")])
+                over_lent = conn.execute("""
+                    SELECT COUNT(*) FROM books b
+                    WHERE b.cantidad_total < (SELECT COUNT(*) FROM loans l WHERE l.book_id = b.id)
+                """).fetchone()[0]
+                leaders = conn.execute("SELECT COUNT(*) FROM students WHERE role = 'leader'").fetchone()[0]
+                # The ledger is the loans': borrowing points on each loan date, return points on each return date.
+                unmatched_entries = conn.execute("""
+                    SELECT COUNT(*) FROM points_ledger p
+                    WHERE NOT EXISTS (SELECT 1 FROM loan_history h WHERE h.loan_id = p.loan_id AND h.student_id = p.student_id
+                                      AND substr(p.created_at, 1, 10) = CASE p.reason WHEN 'loan' THEN h.loan_date ELSE h.return_date END)
+                      AND NOT EXISTS (SELECT 1 FROM loans l WHERE l.loan_id = p.loan_id AND l.student_id = p.student_id
+                                      AND p.reason = 'loan' AND substr(p.created_at, 1, 10) = l.loan_date)
+                """).fetchone()[0]
+                returns = conn.execute("SELECT COUNT(*) FROM points_ledger WHERE reason = 'return'").fetchone()[0]
+                wrong_totals = conn.execute("""
+                    SELECT COUNT(*) FROM students s
+                    WHERE s.points != (SELECT COALESCE(SUM(delta), 0) FROM points_ledger p WHERE p.student_id = s.id)
+                """).fetchone()[0]
+                conn.close()
+                self.assertEqual(over_lent, 0)
+                self.assertEqual(leaders, 10)
+                self.assertEqual(summary['loan_history'], 300) # three returned loans per student
+                self.assertEqual((unmatched_entries, returns, wrong_totals), (0, 300, 0))
+            self.assertEqual(dumps[0], dumps[1])
+        finally:
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+            os.rmdir(tmp_dir)
+
+
+class TestManagerQueryPlans(unittest.TestCase):
+    """Runs every manager function against a seeded database and checks the plan of each statement."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.classrooms = GENERATED_CLASSROOMS
+        conn = sqlite3.connect(ACTUAL_TEST_DB_PATH)
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM students WHERE role = 'leader' AND classroom_id = (SELECT id FROM classrooms WHERE name = ?) LIMIT 1", (cls.classrooms[0],))
+        cls.leader_id = cursor.fetchone()[0]
+        cursor.execute("SELECT id, name FROM students WHERE role = 'student' AND classroom_id = (SELECT id FROM classrooms WHERE name = ?) LIMIT 1", (cls.classrooms[0],))
+        cls.borrower_id, cls.borrower_name = cursor.fetchone()
+        cursor.execute("""
+            SELECT b.id FROM books b
+            WHERE b.cantidad_total > (SELECT COUNT(*) FROM loans l WHERE l.book_id = b.id) LIMIT 1
+        """)
+        cls.book_id = cursor.fetchone()[0]
+        conn.close()
+        cls.capture = QueryCapture()
+        cls.csv_dir = tempfile.mkdtemp()
+        # With the read cache on, repeated reads (is_student_leader) would not reach the database.
+        with cls.capture.active(), mock.patch.object(student_manager.read_cache, "CACHE_ENABLED", False):
+            for label, call in cls._hot_calls():
+                with cls.capture.label(label):
+                    call()
+
+    @classmethod
+    def tearDownClass(cls):
+        for name in os.listdir(cls.csv_dir):
+            os.remove(os.path.join(cls.csv_dir, name))
+        os.rmdir(cls.csv_dir)
+
+    @classmethod
+    def _write_csv(cls, name, rows):
+        path = os.path.join(cls.csv_dir, name)
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            csv.writer(f).writerows(rows)
+        return path
+
+    @classmethod
+    def _hot_calls(cls):
+        classroom = cls.classrooms[0]
+        leader_id, borrower_id, book_id = cls.leader_id, cls.borrower_id, cls.book_id
+        due_date = (datetime.now().date() + timedelta(days=14)).strftime('%Y-%m-%d')
+        month = points_manager.period_bounds("month")
+        books_csv = cls._write_csv("books.csv", [["Título", "Autor", "Género", "Ubicación", "Cantidad_Total"],
+                                                 ["Libro CSV", "Autor CSV", "Poesía", classroom, "2"]])
+        students_csv = cls._write_csv("students.csv", [["Apellido", "Nombre"], ["Pérez", "Ana"]])
+        legacy_dump = os.path.join(cls.csv_dir, "localStorage.json")
+        with open(legacy_dump, "w", encoding="utf-8") as f:
+            json.dump({"books": [{"id": 1, "titulo": "Libro legado", "autor": "Autor", "ubicacion": classroom, "cantidad": 1}],
+                       "users": [{"username": cls.borrower_name, "password": "", "role": "usuario"}],
+                       "loans": [{"bookIndex": 1, "usuario": cls.borrower_name, "fechaPrestamo": "4/3/2024", "devuelto": False},
+                                 {"bookIndex": 1, "usuario": "Lectora Legada", "fechaPrestamo": "2/10/2023",
+                                  "fechaDevolucion": "13/10/2023", "devuelto": True}]}, f)
+
+        def loan_then_return():
+            loans_before = {l['loan_id'] for l in book_manager.get_current_loans_db(student_id_filter=borrower_id)}
+            book_manager.loan_book_db(book_id, borrower_id, due_date, leader_id)
+            loans = book_manager.get_current_loans_db(student_id_filter=borrower_id)
+            new_loan_id = next(l['loan_id'] for l in loans if l['loan_id'] not in loans_before)
+            book_manager.extend_loan_db(new_loan_id)
+            book_manager.return_book_db(new_loan_id, leader_id, worksheet_submitted=True)
+
+        def student_lifecycle():
+            student_id = student_manager.add_student_db("Plan Tester", classroom, "pw", "student")
+            student_manager.update_student_details_db(student_id, "Plan Tester 2", classroom, "student")
+            student_manager.update_student_password_db(student_id, "pw2")
+            student_manager.delete_student_db(student_id)
+
+        return [
+            ("auth_manager.login", lambda: auth_manager.login(cls.borrower_name, "nope")),
+            ("book_manager.add_book_db", lambda: book_manager.add_book_db("Nuevo", "Autora", classroom, "Cuento", 1)),
+            ("book_manager.get_all_books_db(all)", lambda: book_manager.get_all_books_db()),
+            ("book_manager.get_all_books_db(ubicacion)", lambda: book_manager.get_all_books_db(ubicacion_filter=classroom)),
+            ("book_manager.get_book_by_id_db", lambda: book_manager.get_book_by_id_db(book_id)),
+            ("book_manager.import_books_from_csv_db", lambda: book_manager.import_books_from_csv_db(books_csv)),
+            ("book_manager.search_books_db(titulo)", lambda: book_manager.search_books_db("dragón", "titulo")),
+            ("book_manager.search_books_db(autor)", lambda: book_manager.search_books_db("García", "autor")),
+            ("book_manager.get_available_book_count", lambda: book_manager.get_available_book_count(book_id)),
+            ("book_manager.loan_extend_return", loan_then_return),
+            ("book_manager.get_current_loans_db(all)", lambda: book_manager.get_current_loans_db()),
+            ("book_manager.get_current_loans_db(ubicacion)", lambda: book_manager.get_current_loans_db(ubicacion_filter=classroom)),
+            ("book_manager.get_current_loans_db(student)", lambda: book_manager.get_current_loans_db(student_id_filter=borrower_id)),
+            ("book_manager.get_current_loans_db(classroom)", lambda: book_manager.get_current_loans_db(classroom_filter=classroom)),
+            ("book_manager.get_books_due_soon_db(all)", lambda: book_manager.get_books_due_soon_db(7)),
+            ("book_manager.get_books_due_soon_db(ubicacion)", lambda: book_manager.get_books_due_soon_db(7, ubicacion_filter=classroom)),
+            ("book_manager.get_books_due_soon_db(classroom)", lambda: book_manager.get_books_due_soon_db(7, classroom_filter=classroom)),
+            ("book_manager.get_classroom_reminders_db", lambda: book_manager.get_classroom_reminders_db(classroom)),
+            ("book_manager.get_most_read_books_db", lambda: book_manager.get_most_read_books_db(10)),
+            ("book_manager.get_new_releases_db", lambda: book_manager.get_new_releases_db(10)),
+            ("book_manager.get_recommendations_db", lambda: book_manager.get_recommendations_db(10)),
+            ("student_manager.student_lifecycle", student_lifecycle),
+            ("student_manager.get_student_by_id_db", lambda: student_manager.get_student_by_id_db(borrower_id)),
+            ("student_manager.get_students_db(all)", lambda: student_manager.get_students_db()),
+            ("student_manager.get_students_db(classroom)", lambda: student_manager.get_students_db(classroom_filter=classroom)),
+            ("student_manager.get_students_db(leader)", lambda: student_manager.get_students_db(role_filter="leader")),
+            ("student_manager.is_student_leader", lambda: student_manager.is_student_leader(leader_id)),
+            ("student_manager.get_students_sorted_by_points(global)", lambda: student_manager.get_students_sorted_by_points()),
+            ("student_manager.get_students_sorted_by_points(classroom)", lambda: student_manager.get_students_sorted_by_points(classroom)),
+            ("student_manager.get_leaderboard_db(global)", lambda: student_manager.get_leaderboard_db(limit=51)),
+            ("student_manager.get_leaderboard_db(classroom)", lambda: student_manager.get_leaderboard_db(classroom, limit=51)),
+            ("student_manager.get_student_rank_db(global)", lambda: student_manager.get_student_rank_db(borrower_id)),
+            ("student_manager.get_student_rank_db(class)", lambda: student_manager.get_student_rank_db(borrower_id, scope="class")),
+            ("points_manager.get_period_leaderboard_db(month)", lambda: points_manager.get_period_leaderboard_db(*month, limit=51)),
+            ("points_manager.get_period_leaderboard_db(classroom)", lambda: points_manager.get_period_leaderboard_db(*month, classroom, limit=51)),
+            ("points_manager.get_points_history_db", lambda: points_manager.get_points_history_db(borrower_id)),
+            ("points_manager.get_student_points_in_period_db", lambda: points_manager.get_student_points_in_period_db(borrower_id, *month)),
+            ("points_manager.add_points_adjustment_db", lambda: points_manager.add_points_adjustment_db(borrower_id, 1)),
+            ("student_manager.get_distinct_classrooms", lambda: student_manager.get_distinct_classrooms()),
+            ("student_manager.rename_classroom", lambda: student_manager.rename_classroom(cls.classrooms[-1], "Aula Renombrada")),
+            ("student_manager.import_students_from_csv", lambda: student_manager.import_students_from_csv(students_csv, classroom)),
+            # Run twice: the second run finds everything through the indexes.
+            ("legacy_import.import_legacy_data", lambda: [legacy_import.import_legacy_data([legacy_dump]) for _ in range(2)]),
+        ]
+
+    def test_01_every_call_issued_sql(self):
+        labels_with_sql = {label for label, _ in self.capture.statements}
+        missing = [label for label, _ in self._hot_calls() if label not in labels_with_sql]
+        self.assertEqual(missing, [], "Some calls did not reach the database")
+
+    def test_02_no_unexpected_scans_or_temp_sorts(self):
+        conn = sqlite3.connect(ACTUAL_TEST_DB_PATH)
+        failures = []
+        try:
+            for label, sql in self.capture.statements:
+                if not _EXPLAINABLE_RE.match(sql):
+                    continue
+                plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql)]
+                violations = find_plan_violations(sql, plan, ALLOWED_PLAN_STEPS.get(label, ()))
+                if violations:
+                    failures.append(f"{label}: {violations}\n    {' '.join(sql.split())}")
+        finally:
+            conn.close()
+        self.assertEqual(failures, [], "Queries with unexpected full scans or temp b-tree sorts:\n" + "\n".join(failures))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,130 @@
+import unittest
+import os
+import time
+import tempfile
+
+from .ui_monitor import UILatencyMonitor
+from . import profiler_hook
+
+
+class FakeRoot:
+    """Stands in for the Tk root: after() only remembers the callback, the test fires it."""
+
+    def __init__(self):
+        self.pending = None
+
+    def after(self, ms, callback):
+        self.pending = callback
+        return "after#1"
+
+    def after_cancel(self, after_id):
+        self.pending = None
+
+    def fire(self):
+        callback, self.pending = self.pending, None
+        callback()
+
+
+class FakeApp:
+    def refresh_book_list_ui(self):
+        time.sleep(0.15)
+        return "done"
+
+    def lend_book_ui(self):
+        self.refresh_book_list_ui()
+
+    def load_icon(self, name):
+        return None
+
+
+class TestUILatencyMonitor(unittest.TestCase):
+
+    def setUp(self):
+        self.report_dir = tempfile.mkdtemp()
+        self.report_path = os.path.join(self.report_dir, "ui_stall_report.txt")
+        self.root = FakeRoot()
+        self.app = FakeApp()
+        self.monitor = UILatencyMonitor(self.root, stall_threshold_ms=100, heartbeat_ms=10, report_path=self.report_path)
+        self.monitor.instrument_handlers(self.app)
+        self.monitor._started_at = time.perf_counter()
+        self.monitor._schedule()
+
+    def tearDown(self):
+        if os.path.exists(self.report_path):
+            os.remove(self.report_path)
+        os.rmdir(self.report_dir)
+
+    def test_01_stall_is_attributed_to_the_handler_that_blocked(self):
+        self.assertEqual(self.app.lend_book_ui(), None)
+        self.root.fire() # heartbeat runs late, after the handler
+        self.assertEqual(len(self.monitor.stalls), 1)
+        culprit_path, culprit_ms = self.monitor.stalls[0]['culprits'][0]
+        self.assertEqual(culprit_path, "lend_book_ui")
+        self.assertGreaterEqual(culprit_ms, 150)
+        self.assertEqual([path for path, _ in self.monitor.stalls[0]['culprits']],
+                         ["lend_book_ui", "lend_book_ui > refresh_book_list_ui"])
+        self.assertEqual(self.monitor.handler_stats["lend_book_ui"]['stalls'], 1)
+        self.assertNotIn("load_icon", self.monitor.handler_stats)
+
+    def test_02_on_time_heartbeat_is_not_a_stall(self):
+        self.root.fire()
+        self.assertEqual(self.monitor.stalls, [])
+        self.assertIsNotNone(self.root.pending) # rescheduled
+
+    def test_03_report_written_on_stop(self):
+        self.app.refresh_book_list_ui()
+        self.root.fire()
+        self.monitor.stop()
+        with open(self.report_path, encoding="utf-8") as f:
+            report = f.read()
+        self.assertIn("Stalls: 1", report)
+        self.assertIn("refresh_book_list_ui", report)
+        self.assertIsNone(self.root.pending)
+
+
+@profiler_hook.profile_next_action
+def _profiled_refresh(n):
+    return sum(_profiled_helper(i) for i in range(n))
+
+
+@profiler_hook.profile_next_action
+def _profiled_helper(i):
+    return i * i
+
+
+class TestProfilerHook(unittest.TestCase):
+
+    def setUp(self):
+        self.profiles_dir = tempfile.mkdtemp()
+        self.original_dir = profiler_hook.PROFILES_DIR_FOR_CODE
+        profiler_hook.PROFILES_DIR_FOR_CODE = self.profiles_dir # absolute path wins in get_data_path
+
+    def tearDown(self):
+        profiler_hook.disarm()
+        profiler_hook.PROFILES_DIR_FOR_CODE = self.original_dir
+        for name in os.listdir(self.profiles_dir):
+            os.remove(os.path.join(self.profiles_dir, name))
+        os.rmdir(self.profiles_dir)
+
+    def test_01_not_armed_runs_without_profiling(self):
+        self.assertEqual(_profiled_refresh(10), 285)
+        self.assertEqual(os.listdir(self.profiles_dir), [])
+
+    def test_02_armed_profiles_only_the_next_outer_action(self):
+        saved = []
+        profiler_hook.arm(on_saved=lambda *args: saved.append(args))
+        self.assertEqual(_profiled_refresh(10), 285) # nested decorated calls are not profiled separately
+        self.assertFalse(profiler_hook.is_armed())
+        self.assertEqual(len(saved), 1)
+        action_name, pstats_path, summary_path = saved[0]
+        self.assertEqual(action_name, "_profiled_refresh")
+        self.assertTrue(pstats_path.endswith(".pstats") and os.path.exists(pstats_path))
+        with open(summary_path, encoding="utf-8") as f:
+            summary = f.read()
+        self.assertIn("_profiled_helper", summary)
+        _profiled_refresh(10)
+        self.assertEqual(len(os.listdir(self.profiles_dir)), 2) # one .pstats + one .txt
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,164 @@
+"""
+Opt-in event-loop latency monitor for the Tk/CustomTkinter UI.
+
+A heartbeat is scheduled with after() every HEARTBEAT_MS. If the heartbeat runs late by more
+than the stall threshold, the event loop was blocked; the stall is attributed to the wrapped
+UI handlers (refresh_book_list_ui, refresh_leaderboard_display, ...) that ran since the
+previous heartbeat, or to the handler still running if the loop was re-entered via update().
+
+Enable it with BIBLIO_UI_MONITOR=1 (or BIBLIO_UI_MONITOR=<threshold ms>). On exit a stall
+report is written next to the database (ui_stall_report.txt) and summarized on stdout.
+"""
+import atexit
+import functools
+import os
+import time
+from datetime import datetime
+
+from utils import get_data_path
+
+HEARTBEAT_MS = 50
+DEFAULT_STALL_THRESHOLD_MS = 100
+REPORT_PATH_FOR_CODE = os.path.join("database", "ui_stall_report.txt")
+# App methods not worth wrapping: called many times per refresh and never slow on their own.
+EXCLUDED_HANDLERS = {"load_icon", "quit_application"}
+
+
+class UILatencyMonitor:
+    """Measures heartbeat drift on a Tk root and attributes stalls to UI handlers."""
+
+    def __init__(self, root, stall_threshold_ms=DEFAULT_STALL_THRESHOLD_MS, heartbeat_ms=HEARTBEAT_MS, report_path=None):
+        self.root = root
+        self.stall_threshold_ms = stall_threshold_ms
+        self.heartbeat_ms = heartbeat_ms
+        self.report_path = report_path or get_data_path(REPORT_PATH_FOR_CODE)
+        self.handler_stats = {} # name -> {'calls', 'total_ms', 'max_ms', 'stalls'}
+        self.stalls = [] # {'at', 'drift_ms', 'culprits': [(path, ms)]}
+        self.beats = 0
+        self._stack = [] # handlers currently running (nested calls)
+        self._since_last_beat = [] # (path, elapsed_ms) of handlers that finished since the last beat
+        self._expected_at = None
+        self._after_id = None
+        self._started_at = None
+        self._report_written = False
+
+    def start(self):
+        self._started_at = time.perf_counter()
+        self._schedule()
+        atexit.register(self.stop)
+
+    def _schedule(self):
+        self._expected_at = time.perf_counter() + self.heartbeat_ms / 1000
+        try:
+            self._after_id = self.root.after(self.heartbeat_ms, self._beat)
+        except Exception: # root already destroyed
+            self._after_id = None
+
+    def _beat(self):
+        drift_ms = (time.perf_counter() - self._expected_at) * 1000
+        self.beats += 1
+        if drift_ms >= self.stall_threshold_ms:
+            self._record_stall(drift_ms)
+        self._since_last_beat = []
+        self._schedule()
+
+    def _record_stall(self, drift_ms):
+        if self._stack:
+            # The loop was re-entered (update()) while a handler was still running.
+            culprits = [(" > ".join(self._stack) + " (running)", drift_ms)]
+        else:
+            culprits = sorted(self._since_last_beat, key=lambda c: c[1], reverse=True)[:3]
+        if not culprits:
+            culprits = [("(no instrumented handler)", drift_ms)]
+        self.stalls.append({'at': datetime.now(), 'drift_ms': drift_ms, 'culprits': culprits})
+        blamed = culprits[0][0].split(" > ")[0].replace(" (running)", "")
+        if blamed in self.handler_stats:
+            self.handler_stats[blamed]['stalls'] += 1
+
+    def wrap(self, name, method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            self._stack.append(name)
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed_ms = (time.perf_counter() - start) * 1000
+                path = " > ".join(self._stack)
+                self._stack.pop()
+                stats = self.handler_stats.setdefault(name, {'calls': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'stalls': 0})
+                stats['calls'] += 1
+                stats['total_ms'] += elapsed_ms
+                stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+                self._since_last_beat.append((path, elapsed_ms))
+        return wrapper
+
+    def instrument_handlers(self, app):
+        """Replaces the public methods defined on the app's class with timed wrappers on the instance.
+        Must run before widgets are created so that command=self.handler picks up the wrapper."""
+        for name, attr in vars(type(app)).items():
+            if name.startswith("_") or name in EXCLUDED_HANDLERS or not callable(attr):
+                continue
+            setattr(app, name, self.wrap(name, getattr(app, name)))
+
+    def stop(self):
+        if self._after_id is not None:
+            try:
+                self.root.after_cancel(self._after_id)
+            except Exception:
+                pass
+            self._after_id = None
+        if not self._report_written:
+            self._report_written = True
+            self.write_report()
+
+    def build_report(self):
+        session_s = time.perf_counter() - self._started_at if self._started_at else 0.0
+        worst = max((s['drift_ms'] for s in self.stalls), default=0.0)
+        lines = [
+            f"UI stall report - {datetime.now():%Y-%m-%d %H:%M:%S}",
+            f"Heartbeat every {self.heartbeat_ms} ms, stall threshold {self.stall_threshold_ms} ms, "
+            f"session {session_s:.1f} s, {self.beats} heartbeats",
+            f"Stalls: {len(self.stalls)} (worst {worst:.0f} ms)",
+            "",
+            "Handlers by max time:",
+        ]
+        by_max = sorted(self.handler_stats.items(), key=lambda item: item[1]['max_ms'], reverse=True)
+        for name, stats in by_max:
+            lines.append(f"  {name:45s} calls {stats['calls']:5d}  total {stats['total_ms']:10.1f} ms  "
+                         f"max {stats['max_ms']:8.1f} ms  stalls {stats['stalls']:3d}")
+        lines += ["", "Stalls (chronological):"]
+        for stall in self.stalls:
+            culprits = "; ".join(f"{path} ({ms:.0f} ms)" for path, ms in stall['culprits'])
+            at_text = stall['at'].strftime('%H:%M:%S.%f')[:-3]
+            lines.append(f"  {at_text}  +{stall['drift_ms']:.0f} ms  {culprits}")
+        return "\n".join(lines) + "\n"
+
+    def write_report(self):
+        report = self.build_report()
+        try:
+            os.makedirs(os.path.dirname(self.report_path), exist_ok=True)
+            with open(self.report_path, "w", encoding="utf-8") as f:
+                f.write(report)
+            print(f"UI monitor: {len(self.stalls)} stall(s), report written to '{self.report_path}'.")
+        except OSError as e:
+            print(f"UI monitor: could not write stall report '{self.report_path}': {e}")
+            print(report)
+
+
+def create_from_env(app):
+    """Starts a monitor for the app if BIBLIO_UI_MONITOR is set; returns it, or None when disabled."""
+    setting = os.environ.get("BIBLIO_UI_MONITOR", "").strip()
+    if not setting or setting == "0":
+        return None
+    threshold = DEFAULT_STALL_THRESHOLD_MS
+    if setting != "1":
+        try:
+            threshold = float(setting)
+        except ValueError:
+            print(f"UI monitor: ignoring invalid BIBLIO_UI_MONITOR value '{setting}', using {threshold} ms.")
+    monitor = UILatencyMonitor(app, stall_threshold_ms=threshold)
+    monitor.instrument_handlers(app)
+    monitor.start()
+    print(f"UI monitor enabled (stall threshold {threshold:g} ms).")
+    return monitor